@@ -72,6 +72,7 @@ clean:
 	-$(RM) -r seq vec openmp openmp4 cuda openacc
 	-$(RM) *_op.cpp
 	-$(RM) .generated .generated
+	-$(RM) .op2_cache
 	-$(RM) *.d
 	-$(RM) *.o
 	-$(RM) out_grid.*
@@ -83,6 +83,13 @@ extern int OP_hybrid_gpu;
 extern int OP_maps_base_index;
 extern int OP_mpi_test_frequency;
 extern int OP_partial_exchange;
+extern char *OP_plan_dir; /* directory execution plans are saved to */
+extern int OP_plan_memory_mb; /* limit on plan memory in MB, 0 for none */
+extern int OP_color_balance;  /* even out the colour sizes of plans */
+extern int OP_auto_part_size; /* choose part sizes from the cache size */
+extern int OP_cache_size;     /* bytes of cache per core, 0 if unknown */
+extern int OP_autotune;       /* tune the part size of each loop online */
+extern char *OP_tune_file;    /* file tuned part sizes are kept in */
 
 /*
  * enum list for op_par_loop
@@ -273,6 +280,8 @@ void op_timing_realloc(int);
 
 void op_timing_realloc_manytime(int kernel, int num_timers);
 
+int op_tune_part_size(int nk, char const *name, int part_size);
+
 void op_timers_core(double *cpu, double *et);
 
 void op_dump_dat(op_dat data);
@@ -85,9 +85,65 @@ typedef struct {
   float transfer;    /* bytes of data transfer per kernel call */
   float transfer2;   /* bytes of cache line per kernel call */
   int count;         /* number of times called */
+  int staging;       /* staging the plan was built for */
+  int evicted;       /* plan arrays freed to save memory, rebuilt on next use */
+  size_t bytes;      /* host memory held by the plan */
+  unsigned long long last_used; /* op_plan_core call that last returned it */
+  char const **aliases; /* names of the other kernels sharing the plan */
+  int naliases;         /* number of aliases */
+  int exec_length;      /* number of elements, including executed halo */
+  int *ncolelem;        /* number of elements of each color */
+  double time;          /* wall time spent building or reading the plan */
+  int **inv_offs; /* offsets into inv_pos for each element of each staged
+                     dataset, see op_plan_inverse */
+  int **inv_pos;  /* positions in ind_maps that refer to each element */
+  int *inv_size;  /* number of elements of each staged dataset */
+  int *inds;      /* indirect dataset of each argument, -1 if direct */
 } op_plan;
 
+/* plan statistics, filled in by op_plan_get_info */
+typedef struct {
+  char const *name;     /* kernel the plan was built for */
+  int naliases;         /* number of other kernels sharing the plan */
+  int staging;          /* staging the plan was built for */
+  int count;            /* number of times used */
+  int exec_length;      /* number of elements, including executed halo */
+  int nblocks;          /* number of blocks */
+  int ncolors;          /* number of block colors (thread colors with
+                           OP_COLOR2) */
+  int ncolors_core;     /* number of core colors in MPI */
+  int ncolors_owned;    /* number of colors for blocks with owned elements */
+  int const *ncolblk;   /* number of blocks of each color, NULL with
+                           OP_COLOR2 */
+  int const *ncolelem;  /* number of elements of each color */
+  double reuse;         /* references to staged indirect data per element
+                           staged, 0 if nothing is staged */
+  double time;          /* wall time spent building or reading the plan */
+  size_t bytes;         /* host memory held by the plan */
+  int evicted;          /* plan arrays freed, ncolblk, ncolelem and reuse
+                           are not available */
+} op_plan_info;
+
+/* inverse of a map, from each element of the to set to the map entries that
+   refer to it, see op_get_map_inverse */
+typedef struct {
+  op_map map;    /* map inverted */
+  int *map_data; /* map->map when the inverse was built */
+  int from_size; /* elements of the from set covered, including executed
+                    halo */
+  int size;      /* elements of the to set, including halos */
+  int *offs;     /* entries for element e are pos[offs[e]] to
+                    pos[offs[e+1]-1] */
+  int *pos;      /* from set element * map->dim + map index of each entry */
+  size_t bytes;  /* host memory held by the inverse */
+} op_map_inverse;
+
 extern op_plan *OP_plans;
+extern int OP_plan_index;
+extern size_t OP_plan_bytes; /* host memory held by all plans */
+extern op_map_inverse **OP_map_inverses; /* by map index, NULL if not built */
+extern int OP_map_inverse_max;
+extern size_t OP_map_inverse_bytes; /* host memory held by all map inverses */
 
 #ifdef __cplusplus
 extern "C" {
@@ -113,6 +169,18 @@ op_plan *op_plan_get(char const *name, op_set set, int part_size, int nargs,
 
 void op_plan_check(op_plan OP_plan, int ninds, int *inds);
 
+void op_plan_inverse(op_plan *plan);
+
+char *op_plan_inc_buffer(size_t bytes);
+
+op_map_inverse *op_get_map_inverse(op_map map);
+
+int op_plan_get_info(int ip, op_plan_info *info);
+
+void op_plan_info_to_csv(const char *);
+
+void op_plan_info_to_json(const char *);
+
 void op_rt_exit(void);
 
 bool op_type_equivalence(const char *a, const char *b);
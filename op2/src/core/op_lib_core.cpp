@@ -36,6 +36,7 @@
  */
 
 #include "op_lib_core.h"
+#include "op_rt_support.h"
 #include <malloc.h>
 #include <string.h>
 #include <sys/time.h>
@@ -58,6 +59,13 @@ int OP_set_index = 0, OP_set_max = 0, OP_map_index = 0, OP_map_max = 0,
 
 int OP_mpi_test_frequency = 1<<30;
 int OP_partial_exchange = 0;
+char *OP_plan_dir = NULL;
+int OP_plan_memory_mb = 0;
+int OP_color_balance = 0;
+int OP_auto_part_size = 0;
+int OP_cache_size = 0;
+int OP_autotune = 0;
+char *OP_tune_file = NULL;
 /*
  * Lists of sets, maps and dats declared in OP2 programs
  */
@@ -181,6 +189,21 @@ void op_set_args(int argc, char *argv) {
     OP_auto_soa = 1;
     op_printf("\n Enabling Automatic AoS->SoA Conversion\n");
   }
+  pch = strstr(argv, "OP_COLOR_BALANCE");
+  if (pch != NULL) {
+    OP_color_balance = 1;
+    op_printf("\n Enabling balanced colouring of execution plans\n");
+  }
+  pch = strstr(argv, "OP_AUTO_PART_SIZE");
+  if (pch != NULL) {
+    OP_auto_part_size = 1;
+    op_printf("\n Enabling cache based part sizes\n");
+  }
+  pch = strstr(argv, "OP_AUTOTUNE");
+  if (pch != NULL) {
+    OP_autotune = 1;
+    op_printf("\n Enabling online tuning of part sizes\n");
+  }
   pch = strstr(argv, "OP_PARTIAL_EXCHANGE");
   if (pch != NULL) {
     OP_partial_exchange = 1;
@@ -193,6 +216,25 @@ void op_set_args(int argc, char *argv) {
     op_printf("\n OP_hybrid_balance  = %g \n", OP_hybrid_balance);
   }
 
+  pch = strstr(argv, "OP_PLAN_DIR=");
+  if (pch != NULL) {
+    op_free(OP_plan_dir);
+    OP_plan_dir = copy_str(pch + 12);
+    op_printf("\n OP_plan_dir  = %s \n", OP_plan_dir);
+  }
+  pch = strstr(argv, "OP_PLAN_MEMORY_MB=");
+  if (pch != NULL) {
+    strncpy(temp, pch, 30);
+    OP_plan_memory_mb = atoi(temp + 18);
+    op_printf("\n OP_plan_memory_mb  = %d \n", OP_plan_memory_mb);
+  }
+  pch = strstr(argv, "OP_TUNE_FILE=");
+  if (pch != NULL) {
+    op_free(OP_tune_file);
+    OP_tune_file = copy_str(pch + 13);
+    op_printf("\n OP_tune_file  = %s \n", OP_tune_file);
+  }
+
   pch = strstr(argv, "OP_MAPS_BASE_INDEX=");
   if (pch != NULL) {
     strncpy(temp, pch, 25);
@@ -210,6 +252,176 @@ void op_set_args(int argc, char *argv) {
   }
 }
 
+/*
+ * size in bytes of the cache of one core, from the Linux sysfs entries of
+ * CPU 0: its L2 cache (divided between the CPUs sharing it, usually hardware
+ * threads), or its share of the L3 cache if there is no L2. Returns 0 if
+ * there is no such information.
+ */
+
+static int op_read_cache_entry(int index, char const *entry, char *buf,
+                               int n) {
+  char path[128];
+  snprintf(path, sizeof(path), "/sys/devices/system/cpu/cpu0/cache/index%d/%s",
+           index, entry);
+  FILE *fp = fopen(path, "r");
+  if (fp == NULL)
+    return 0;
+  int ok = fgets(buf, n, fp) != NULL;
+  fclose(fp);
+  return ok;
+}
+
+static int op_detect_cache_size() {
+  int sizes[4] = {0, 0, 0, 0}; /* per CPU, by level */
+  char buf[256];
+
+  for (int index = 0; index < 16; index++) {
+    if (!op_read_cache_entry(index, "level", buf, sizeof(buf)))
+      break;
+    int level = atoi(buf);
+    if (level < 2 || level > 3 ||
+        !op_read_cache_entry(index, "type", buf, sizeof(buf)) ||
+        strncmp(buf, "Instruction", 11) == 0 ||
+        !op_read_cache_entry(index, "size", buf, sizeof(buf)))
+      continue;
+
+    char *unit;
+    long size = strtol(buf, &unit, 10);
+    if (*unit == 'K')
+      size *= 1024;
+    else if (*unit == 'M')
+      size *= 1024 * 1024;
+
+    /* count the CPUs in a list such as "0-3,8-11" */
+    int ncpus = 0;
+    if (op_read_cache_entry(index, "shared_cpu_list", buf, sizeof(buf))) {
+      char *p = buf;
+      while (*p >= '0' && *p <= '9') {
+        long first = strtol(p, &p, 10), last = first;
+        if (*p == '-')
+          last = strtol(p + 1, &p, 10);
+        ncpus += last - first + 1;
+        if (*p == ',')
+          p++;
+      }
+    }
+    sizes[level] = (int)(size / MAX(ncpus, 1));
+  }
+
+  return sizes[2] > 0 ? sizes[2] : sizes[3];
+}
+
+/*
+ * online part size tuning: the first OP_TUNE_NCAND * OP_TUNE_REPS calls of
+ * each indirect loop try the candidate part sizes in turn, the first call with
+ * each candidate (which builds its plan) is not timed, then the fastest one
+ * is used from there on. The choices are kept in a tuning file, a C header of
+ * OP_PART_SIZE_<nk> defines, which later runs read at op_init.
+ */
+
+#define OP_TUNE_NCAND 6
+#define OP_TUNE_REPS 3
+
+static int const OP_tune_cand[OP_TUNE_NCAND] = {64, 128, 256, 512, 1024, 2048};
+
+typedef struct {
+  char *name;      /* kernel name, NULL if unused */
+  int part_size;   /* chosen part size, 0 if not chosen yet */
+  int calls;       /* calls made while tuning */
+  double last;     /* kernel time at the previous call */
+  double times[OP_TUNE_NCAND];
+} op_tune_entry;
+
+static op_tune_entry *OP_tune = NULL;
+static int OP_tune_max = 0;
+
+static op_tune_entry *op_tune_entry_get(int nk) {
+  if (nk >= OP_tune_max) {
+    int max = nk + 10;
+    OP_tune = (op_tune_entry *)op_realloc(OP_tune, max * sizeof(op_tune_entry));
+    memset(OP_tune + OP_tune_max, 0,
+           (max - OP_tune_max) * sizeof(op_tune_entry));
+    OP_tune_max = max;
+  }
+  return &OP_tune[nk];
+}
+
+static void op_tune_load(char const *file) {
+  FILE *fp = fopen(file, "r");
+  if (fp == NULL)
+    return;
+
+  char line[256], name[128];
+  int nk, size, n = 0;
+  while (fgets(line, sizeof(line), fp) != NULL) {
+    if (sscanf(line, "#define OP_PART_SIZE_%d %d /* %127s", &nk, &size,
+               name) != 3 ||
+        nk < 0 || size <= 0)
+      continue;
+    op_tune_entry *e = op_tune_entry_get(nk);
+    op_free(e->name);
+    e->name = copy_str(name);
+    e->part_size = size;
+    n++;
+  }
+  fclose(fp);
+  op_printf("\n Read %d tuned part sizes from %s\n", n, file);
+}
+
+static void op_tune_save(char const *file) {
+  if (!op_is_root())
+    return;
+
+  FILE *fp = fopen(file, "w");
+  if (fp == NULL) {
+    printf(" op_tune_save error -- cannot write %s\n", file);
+    return;
+  }
+  fprintf(fp, "/* part sizes chosen by OP_AUTOTUNE */\n");
+  for (int nk = 0; nk < OP_tune_max; nk++)
+    if (OP_tune[nk].part_size > 0)
+      fprintf(fp, "#define OP_PART_SIZE_%d %d /* %s */\n", nk,
+              OP_tune[nk].part_size, OP_tune[nk].name);
+  fclose(fp);
+}
+
+int op_tune_part_size(int nk, char const *name, int part_size) {
+  if (nk < OP_tune_max && OP_tune[nk].part_size > 0 &&
+      strcmp(OP_tune[nk].name, name) == 0)
+    return OP_tune[nk].part_size;
+  if (!OP_autotune)
+    return part_size;
+
+  op_tune_entry *e = op_tune_entry_get(nk);
+  if (e->name == NULL || strcmp(e->name, name) != 0) {
+    op_free(e->name);
+    memset(e, 0, sizeof(op_tune_entry));
+    e->name = copy_str(name);
+  }
+
+  /* time of the previous call, kept in times[0] if there are thread timers */
+  double now = 0.0;
+  if (nk < OP_kern_max)
+    now = OP_kernels[nk].time + OP_kernels[nk].times[0];
+  if (e->calls > 0 && e->calls % OP_TUNE_REPS != 1)
+    e->times[(e->calls - 1) / OP_TUNE_REPS] += now - e->last;
+  e->last = now;
+
+  if (e->calls < OP_TUNE_NCAND * OP_TUNE_REPS)
+    return OP_tune_cand[e->calls++ / OP_TUNE_REPS];
+
+  int best = 0;
+  for (int c = 1; c < OP_TUNE_NCAND; c++)
+    if (e->times[c] < e->times[best])
+      best = c;
+  e->part_size = OP_tune_cand[best];
+  if (OP_diags > 1)
+    op_printf(" kernel %d (%s): tuned part size %d\n", nk, name,
+              e->part_size);
+  return e->part_size;
+}
+
 /*
  * OP core functions: these must be called by back-end specific functions
  */
@@ -224,6 +436,38 @@ void op_init_core(int argc, char **argv, int diags) {
     op_printf("\n OP_hybrid_balance  = %g \n", OP_hybrid_balance);
   }
 
+  if (getenv("OP_PLAN_DIR")) {
+    op_free(OP_plan_dir);
+    OP_plan_dir = copy_str(getenv("OP_PLAN_DIR"));
+    op_printf("\n OP_plan_dir  = %s \n", OP_plan_dir);
+  }
+
+  if (getenv("OP_PLAN_MEMORY_MB")) {
+    OP_plan_memory_mb = atoi(getenv("OP_PLAN_MEMORY_MB"));
+    op_printf("\n OP_plan_memory_mb  = %d \n", OP_plan_memory_mb);
+  }
+
+  if (getenv("OP_TUNE_FILE")) {
+    op_free(OP_tune_file);
+    OP_tune_file = copy_str(getenv("OP_TUNE_FILE"));
+    op_printf("\n OP_tune_file  = %s \n", OP_tune_file);
+  }
+
+  if (getenv("OP_AUTOTUNE")) {
+    OP_autotune = 1;
+    op_printf("\n Enabling online tuning of part sizes\n");
+  }
+
+  if (getenv("OP_COLOR_BALANCE")) {
+    OP_color_balance = 1;
+    op_printf("\n Enabling balanced colouring of execution plans\n");
+  }
+
+  if (getenv("OP_AUTO_PART_SIZE")) {
+    OP_auto_part_size = 1;
+    op_printf("\n Enabling cache based part sizes\n");
+  }
+
   if (getenv("OP_AUTO_SOA") || OP_auto_soa == 1) {
     OP_auto_soa = 1;
     op_printf("\n Enabling Automatic AoS->SoA Conversion\n");
@@ -275,6 +519,12 @@ void op_init_core(int argc, char **argv, int diags) {
     }*/
   }
 
+  OP_cache_size = op_detect_cache_size();
+  if (OP_auto_part_size)
+    op_printf("\n OP_cache_size  = %d kB \n", OP_cache_size / 1024);
+  if (OP_tune_file != NULL)
+    op_tune_load(OP_tune_file);
+
   /*Initialize the double linked list to hold op_dats*/
   TAILQ_INIT(&OP_dat_list);
 }
@@ -552,6 +802,21 @@ void op_exit_core() {
   free(OP_kernels);
   OP_kernels = NULL;
 
+  op_free(OP_plan_dir);
+  OP_plan_dir = NULL;
+
+  // save and free the tuned part sizes
+
+  if (OP_autotune && OP_tune_file != NULL)
+    op_tune_save(OP_tune_file);
+  for (int nk = 0; nk < OP_tune_max; nk++)
+    op_free(OP_tune[nk].name);
+  op_free(OP_tune);
+  OP_tune = NULL;
+  OP_tune_max = 0;
+  op_free(OP_tune_file);
+  OP_tune_file = NULL;
+
   // reset initial values
 
   OP_set_index = 0;
@@ -817,6 +1082,47 @@ void op_diagnostic_output() {
       printf("%10s %10d %10s\n", (item->dat)->name, (item->dat)->dim,
              (item->dat)->set->name);
     }
+
+    printf("\n      plan     kernel      calls      bytes\n");
+    printf("  -----------------------------------------\n");
+    for (int n = 0; n < OP_plan_index; n++) {
+      if (OP_plans[n].evicted)
+        printf("%10d %10s %10d    evicted\n", n, OP_plans[n].name,
+               OP_plans[n].count);
+      else
+        printf("%10d %10s %10d %10zu\n", n, OP_plans[n].name,
+               OP_plans[n].count, OP_plans[n].bytes);
+      for (int a = 0; a < OP_plans[n].naliases; a++)
+        printf("%10s %10s\n", "", OP_plans[n].aliases[a]);
+    }
+    printf("%10s %10s %10s %10zu\n", "total", "", "", OP_plan_bytes);
+
+    printf("\n       map    inverse      bytes\n");
+    printf("  ------------------------------\n");
+    for (int n = 0; n < OP_map_inverse_max; n++) {
+      op_map_inverse *inv = OP_map_inverses[n];
+      if (inv != NULL)
+        printf("%10s %10d %10zu\n", inv->map->name, inv->size, inv->bytes);
+    }
+    printf("%10s %10s %10zu\n", "total", "", OP_map_inverse_bytes);
+
+    /* blocks of each block colour, or elements of each colour with a
+       single block */
+    printf("\n      plan     colour sizes\n");
+    printf("  -----------------------------------------\n");
+    for (int n = 0; n < OP_plan_index; n++) {
+      op_plan *plan = &OP_plans[n];
+      if (plan->evicted || plan->ncolblk == NULL)
+        continue;
+      printf("%10d %10s", n, plan->staging == OP_COLOR2 ? "elements" : "blocks");
+      for (int c = 0; c < plan->ncolors; c++) {
+        if (plan->staging != OP_COLOR2)
+          printf(" %d", plan->ncolblk[c]);
+        else if (plan->col_offsets != NULL)
+          printf(" %d", plan->col_offsets[0][c + 1] - plan->col_offsets[0][c]);
+      }
+      printf("\n");
+    }
     printf("\n");
   }
 }
@@ -890,6 +1196,8 @@ void op_timing_output_core() {
       }
     }
   }
+  if (OP_map_inverse_bytes > 0 && op_is_root())
+    printf("\n  map inverses: %zu bytes\n", OP_map_inverse_bytes);
 }
 
 void op_timing_output_2_file(const char *outputFileName) {
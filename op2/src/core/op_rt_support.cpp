@@ -38,6 +38,18 @@
  */
 
 #include "op_rt_support.h"
+#include <unistd.h>
+#include <uthash.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+/* OpenMP directive that is left out of libraries built without OpenMP */
+#ifdef _OPENMP
+#define OP_PRAGMA_OMP(...) _Pragma(#__VA_ARGS__)
+#else
+#define OP_PRAGMA_OMP(...)
+#endif
 
 /*
  * Global variables
@@ -46,45 +58,165 @@
 int OP_plan_index = 0, OP_plan_max = 0;
 op_plan *OP_plans;
 double OP_plan_time = 0;
+size_t OP_plan_bytes = 0;
+static unsigned long long OP_plan_clock = 0; /* number of plan lookups */
+static char *OP_inc_buf = NULL;     /* see op_plan_inc_buffer */
+static size_t OP_inc_buf_bytes = 0;
+op_map_inverse **OP_map_inverses = NULL;
+int OP_map_inverse_max = 0;
+size_t OP_map_inverse_bytes = 0;
+
+/*
+ * hash index over OP_plans, keyed on everything a plan is matched on, so an
+ * existing plan is found without comparing against every plan built so far.
+ * Entries hold plan indices rather than pointers because OP_plans is
+ * reallocated as it grows; plans whose keys hash to the same value are
+ * chained through next.
+ */
+
+typedef struct op_plan_entry {
+  UT_hash_handle hh;          /* makes this structure hashable */
+  unsigned int hash;          /* hash of the plan key */
+  int ip;                     /* index of the plan in OP_plans */
+  struct op_plan_entry *next; /* next plan with the same hash */
+} op_plan_entry;
+
+/*
+ * last plan returned to each call site, keyed on the address of the kernel
+ * name passed in by the host stub, so a loop called repeatedly with the
+ * same arguments only checks that one plan
+ */
+
+typedef struct {
+  UT_hash_handle hh; /* makes this structure hashable */
+  char const *name;  /* kernel name as passed by the call site */
+  int ip;            /* index of the plan last returned to it */
+} op_plan_site;
+
+static op_plan_entry *OP_plan_tab = NULL;
+static op_plan_site *OP_plan_sites = NULL;
 
 extern op_kernel *OP_kernels;
 extern int OP_kern_max;
 
+/*
+ * free the execution plan arrays of a plan, keeping the input arguments it
+ * was built for
+ */
+
+static void op_plan_free_arrays(op_plan *plan) {
+  free(plan->inds_staged);
+  free(plan->nthrcol);
+  free(plan->thrcol);
+  free(plan->offset);
+  free(plan->ind_offs);
+  free(plan->ind_sizes);
+  free(plan->nelems);
+  free(plan->blkmap);
+  free(plan->ind_map);
+  free(plan->ind_maps);
+  free(plan->nindirect);
+  free(plan->loc_map);
+  free(plan->loc_maps);
+  free(plan->ncolblk);
+  free(plan->nsharedCol);
+  free(plan->ncolelem);
+  op_free(plan->col_reord);
+  if (plan->col_offsets != NULL) {
+    op_free(plan->col_offsets[0]);
+    op_free(plan->col_offsets);
+  }
+  if (plan->inv_offs != NULL) {
+    for (int m = 0; m < plan->ninds_staged; m++) {
+      free(plan->inv_offs[m]);
+      free(plan->inv_pos[m]);
+    }
+    free(plan->inv_offs);
+    free(plan->inv_pos);
+    free(plan->inv_size);
+  }
+  plan->inds_staged = NULL;
+  plan->nthrcol = NULL;
+  plan->thrcol = NULL;
+  plan->offset = NULL;
+  plan->ind_offs = NULL;
+  plan->ind_sizes = NULL;
+  plan->nelems = NULL;
+  plan->blkmap = NULL;
+  plan->ind_map = NULL;
+  plan->ind_maps = NULL;
+  plan->nindirect = NULL;
+  plan->loc_map = NULL;
+  plan->loc_maps = NULL;
+  plan->ncolblk = NULL;
+  plan->nsharedCol = NULL;
+  plan->ncolelem = NULL;
+  plan->col_reord = NULL;
+  plan->col_offsets = NULL;
+  plan->inv_offs = NULL;
+  plan->inv_pos = NULL;
+  plan->inv_size = NULL;
+}
+
+static void op_plan_free(op_plan *plan) {
+  free(plan->dats);
+  free(plan->idxs);
+  free(plan->inds);
+  free(plan->maps);
+  free(plan->accs);
+  free(plan->optflags);
+  op_plan_free_arrays(plan);
+}
+
+static void op_map_inverse_free(op_map_inverse *inv) {
+  if (inv == NULL)
+    return;
+  free(inv->offs);
+  free(inv->pos);
+  free(inv);
+}
+
 void op_rt_exit() {
   /* free storage for plans */
   for (int ip = 0; ip < OP_plan_index; ip++) {
-    free(OP_plans[ip].dats);
-    free(OP_plans[ip].idxs);
-    free(OP_plans[ip].maps);
-    free(OP_plans[ip].accs);
-    free(OP_plans[ip].optflags);
-    free(OP_plans[ip].inds_staged);
-    free(OP_plans[ip].nthrcol);
-    free(OP_plans[ip].thrcol);
-    free(OP_plans[ip].offset);
-    free(OP_plans[ip].ind_offs);
-    free(OP_plans[ip].ind_sizes);
-    free(OP_plans[ip].nelems);
-    free(OP_plans[ip].blkmap);
-    free(OP_plans[ip].ind_map);
-    free(OP_plans[ip].ind_maps);
-    free(OP_plans[ip].nindirect);
-    free(OP_plans[ip].loc_map);
-    free(OP_plans[ip].loc_maps);
-    free(OP_plans[ip].ncolblk);
-    free(OP_plans[ip].nsharedCol);
-    op_free(OP_plans[ip].col_reord);
-    if (OP_plans[ip].col_offsets != NULL) {
-      op_free(OP_plans[ip].col_offsets[0]);
-      op_free(OP_plans[ip].col_offsets);
-    }
+    op_plan_free(&OP_plans[ip]);
+    free(OP_plans[ip].aliases);
   }
 
   OP_plan_index = 0;
   OP_plan_max = 0;
+  OP_plan_bytes = 0;
 
   free(OP_plans);
   OP_plans = NULL;
+
+  free(OP_inc_buf);
+  OP_inc_buf = NULL;
+  OP_inc_buf_bytes = 0;
+
+  /* free the map inverses */
+  for (int i = 0; i < OP_map_inverse_max; i++)
+    op_map_inverse_free(OP_map_inverses[i]);
+  free(OP_map_inverses);
+  OP_map_inverses = NULL;
+  OP_map_inverse_max = 0;
+  OP_map_inverse_bytes = 0;
+
+  /* free the plan index */
+  op_plan_entry *entry, *tmp_entry;
+  HASH_ITER(hh, OP_plan_tab, entry, tmp_entry) {
+    HASH_DEL(OP_plan_tab, entry);
+    while (entry != NULL) {
+      op_plan_entry *next = entry->next;
+      free(entry);
+      entry = next;
+    }
+  }
+  op_plan_site *site, *tmp_site;
+  HASH_ITER(hh, OP_plan_sites, site, tmp_site) {
+    HASH_DEL(OP_plan_sites, site);
+    free(site);
+  }
 }
 
 /*
@@ -122,6 +254,87 @@ int comp2(const void *a, const void *b) {
   return 0;
 }
 
+/*
+ * hash of the key an execution plan is matched on: the set, partition size,
+ * staging and the size, dim, map, index, access and indirect dataset of every
+ * argument
+ * (FNV-1a). The kernel name is not part of it, so kernels with the same
+ * access pattern share a plan.
+ */
+
+static unsigned int op_plan_hash_bytes(unsigned int hash, const void *bytes,
+                                       size_t n) {
+  const unsigned char *c = (const unsigned char *)bytes;
+  for (size_t i = 0; i < n; i++)
+    hash = (hash ^ c[i]) * 16777619u;
+  return hash;
+}
+
+static unsigned int op_plan_hash(op_set set, int part_size, int nargs,
+                                 op_arg *args, int ninds, int *inds,
+                                 int staging) {
+  unsigned int hash = 2166136261u;
+  hash = op_plan_hash_bytes(hash, &set, sizeof(op_set));
+  hash = op_plan_hash_bytes(hash, &part_size, sizeof(int));
+  hash = op_plan_hash_bytes(hash, &staging, sizeof(int));
+  hash = op_plan_hash_bytes(hash, &nargs, sizeof(int));
+  hash = op_plan_hash_bytes(hash, &ninds, sizeof(int));
+  for (int m = 0; m < nargs; m++) {
+    int key[5] = {-1, -1, args[m].idx, args[m].acc, inds[m]};
+    if (args[m].dat != NULL) {
+      key[0] = args[m].dat->size;
+      key[1] = args[m].dat->dim;
+    }
+    hash = op_plan_hash_bytes(hash, key, sizeof(key));
+    hash = op_plan_hash_bytes(hash, &args[m].map, sizeof(op_map));
+  }
+  return hash;
+}
+
+/*
+ * check whether an existing execution plan matches the arguments
+ */
+
+static int op_plan_match(op_plan *plan, op_set set, int part_size, int nargs,
+                         op_arg *args, int ninds, int *inds, int staging) {
+  if (set != plan->set || nargs != plan->nargs || ninds != plan->ninds ||
+      part_size != plan->part_size || staging != plan->staging)
+    return 0;
+
+  for (int m = 0; m < nargs; m++) {
+    if (args[m].map != plan->maps[m] || args[m].idx != plan->idxs[m] ||
+        args[m].acc != plan->accs[m] || inds[m] != plan->inds[m])
+      return 0;
+    if (args[m].dat != NULL && plan->dats[m] != NULL) {
+      if (args[m].dat->size != plan->dats[m]->size ||
+          args[m].dat->dim != plan->dats[m]->dim)
+        return 0;
+    } else if (args[m].dat != plan->dats[m]) {
+      return 0;
+    }
+  }
+  return 1;
+}
+
+/*
+ * record that kernel name uses a plan, unless it is already known to
+ */
+
+static void op_plan_add_alias(op_plan *plan, char const *name) {
+  if (name == plan->name || strcmp(name, plan->name) == 0)
+    return;
+  for (int n = 0; n < plan->naliases; n++) {
+    if (name == plan->aliases[n] || strcmp(name, plan->aliases[n]) == 0)
+      return;
+  }
+  if (OP_diags > 1)
+    printf(" kernel %s shares the execution plan of kernel %s\n", name,
+           plan->name);
+  plan->aliases = (char const **)op_realloc(
+      plan->aliases, (plan->naliases + 1) * sizeof(char const *));
+  plan->aliases[plan->naliases++] = name;
+}
+
 /*
  * plan check routine
  */
@@ -187,111 +400,1372 @@ void op_plan_check(op_plan OP_plan, int ninds, int *inds) {
     blkmap[n] = OP_plan.blkmap[n];
   qsort(blkmap, nblock, sizeof(int), comp);
 
-  err = 0;
-  for (int n = 0; n < nblock; n++)
-    err += (blkmap[n] != n);
+  err = 0;
+  for (int n = 0; n < nblock; n++)
+    err += (blkmap[n] != n);
+
+  free(blkmap);
+
+  if (err != 0) {
+    printf(" *** OP_plan_check: blkmap error \n");
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: blkmap   OK \n");
+  }
+
+  /*
+   * check ind_offs and ind_sizes are consistent
+   */
+
+  err = 0;
+
+  for (int i = 0; i < ninds; i++) {
+    ntot = 0;
+
+    for (int n = 0; n < nblock; n++) {
+      err += (OP_plan.ind_offs[i + n * ninds] != ntot);
+      ntot += OP_plan.ind_sizes[i + n * ninds];
+    }
+  }
+
+  if (err != 0) {
+    printf(" *** OP_plan_check: ind_offs error \n");
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: ind_offs OK \n");
+  }
+
+  /*
+   * check ind_maps correctly ordered within each block
+   * and indices within range
+   */
+
+  err = 0;
+
+  for (int m = 0; m < ninds; m++) {
+    int m2 = 0;
+    while (inds[m2] != m)
+      m2++;
+    if (OP_plan.maps[m2] == NULL)
+      continue; // it is a deactivated optional argument
+    int halo_size = (OP_plan.maps[m2]->to)->exec_size +
+                    (OP_plan.maps[m2]->to)->nonexec_size;
+    int set_size = OP_plan.maps[m2]->to->size + halo_size;
+
+    ntot = 0;
+
+    for (int n = 0; n < nblock; n++) {
+      int last = -1;
+      for (int e = ntot; e < ntot + OP_plan.ind_sizes[m + n * ninds]; e++) {
+        err += (OP_plan.ind_maps[m][e] <= last);
+        last = OP_plan.ind_maps[m][e];
+      }
+      err += (last >= set_size);
+      ntot += OP_plan.ind_sizes[m + n * ninds];
+    }
+  }
+
+  if (err != 0) {
+    printf(" *** OP_plan_check: ind_maps error \n");
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: ind_maps OK \n");
+  }
+
+  /*
+   *check maps (most likely source of errors)
+   */
+
+  err = 0;
+
+  for (int m = 0; m < OP_plan.nargs; m++) {
+    if (OP_plan.maps[m] != NULL && OP_plan.optflags[m] &&
+        OP_plan.loc_maps[m] != NULL) {
+      op_map map = OP_plan.maps[m];
+      int m2 = inds[m];
+
+      ntot = 0;
+      for (int n = 0; n < nblock; n++) {
+        for (int e = ntot; e < ntot + OP_plan.nelems[n]; e++) {
+          int p_local = OP_plan.loc_maps[m][e];
+          int p_global =
+              OP_plan.ind_maps[m2][p_local + OP_plan.ind_offs[m2 + n * ninds]];
+          err += (p_global != map->map[OP_plan.idxs[m] + e * map->dim]);
+        }
+        ntot += OP_plan.nelems[n];
+      }
+    }
+  }
+
+  if (err != 0) {
+    printf(" *** OP_plan_check: %d maps error(s) \n", err);
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: maps     OK \n");
+  }
+
+  /*
+   * check thread and block coloring: elements of the same color within a
+   * block, and blocks of the same color, must not increment or read-write
+   * the same indirect data element
+   */
+
+  /* thread color of each element, undoing any permutation by color */
+  int ngroups = 0;
+  int *color = (int *)op_malloc(exec_length * sizeof(int));
+  err = 0;
+
+  for (int n = 0; n < nblock; n++) {
+    for (int e = OP_plan.offset[n]; e < OP_plan.offset[n] + OP_plan.nelems[n];
+         e++) {
+      int e2 = e;
+      if (OP_plan.col_offsets != NULL)
+        e2 = OP_plan.offset[n] + OP_plan.col_reord[e];
+      color[e2] = OP_plan.thrcol[e];
+      if (color[e2] < 0 || color[e2] >= OP_plan.nthrcol[n]) {
+        err++;
+        color[e2] = 0;
+      }
+    }
+    ngroups += OP_plan.nthrcol[n] + 1;
+  }
+
+  /* order the elements by block and thread color */
+  int *group_end = (int *)op_calloc(ngroups + 1, sizeof(int));
+  int *order = (int *)op_malloc(exec_length * sizeof(int));
+  int g0 = 0;
+  for (int n = 0; n < nblock; n++) {
+    for (int e = OP_plan.offset[n]; e < OP_plan.offset[n] + OP_plan.nelems[n];
+         e++)
+      group_end[g0 + color[e] + 1]++;
+    g0 += OP_plan.nthrcol[n] + 1;
+  }
+  for (int g = 0; g < ngroups; g++)
+    group_end[g + 1] += group_end[g];
+  g0 = 0;
+  for (int n = 0; n < nblock; n++) {
+    for (int e = OP_plan.offset[n]; e < OP_plan.offset[n] + OP_plan.nelems[n];
+         e++)
+      order[group_end[g0 + color[e]]++] = e;
+    g0 += OP_plan.nthrcol[n] + 1;
+  }
+
+  int blkerr = 0;
+  for (int m = 0; m < OP_plan.nargs; m++) {
+    if (OP_plan.maps[m] == NULL || !OP_plan.optflags[m] ||
+        OP_plan.idxs[m] < 0 ||
+        (OP_plan.accs[m] != OP_INC && OP_plan.accs[m] != OP_RW))
+      continue;
+
+    /* check each indirect dataset once, together with all its arguments */
+    int m2 = 0;
+    while (m2 < m && !(OP_plan.dats[m2] == OP_plan.dats[m] &&
+                       OP_plan.maps[m2] == OP_plan.maps[m] &&
+                       OP_plan.accs[m2] == OP_plan.accs[m] &&
+                       OP_plan.optflags[m2] && OP_plan.idxs[m2] >= 0))
+      m2++;
+    if (m2 < m)
+      continue;
+
+    op_set to = OP_plan.maps[m]->to;
+    int to_size = to->size + to->exec_size + to->nonexec_size;
+    int *stamp = (int *)op_malloc(to_size * sizeof(int));
+    int *owner = (int *)op_malloc(to_size * sizeof(int));
+
+    for (int i = 0; i < to_size; i++)
+      stamp[i] = -1;
+    int g = 0;
+    for (int k = 0; k < exec_length; k++) {
+      while (k >= group_end[g])
+        g++;
+      int e = order[k];
+      for (m2 = m; m2 < OP_plan.nargs; m2++) {
+        if (OP_plan.dats[m2] != OP_plan.dats[m] ||
+            OP_plan.maps[m2] != OP_plan.maps[m] ||
+            OP_plan.accs[m2] != OP_plan.accs[m] || !OP_plan.optflags[m2] ||
+            OP_plan.idxs[m2] < 0)
+          continue;
+        op_map map = OP_plan.maps[m2];
+        int p = map->map[OP_plan.idxs[m2] + e * map->dim];
+        err += (stamp[p] == g && owner[p] != e);
+        stamp[p] = g;
+        owner[p] = e;
+      }
+    }
+
+    for (int i = 0; i < to_size; i++)
+      stamp[i] = -1;
+    int b2 = 0;
+    for (int col = 0; col < OP_plan.ncolors; col++) {
+      for (int k = 0; k < OP_plan.ncolblk[col]; k++, b2++) {
+        int n = OP_plan.blkmap[b2];
+        for (int e = OP_plan.offset[n];
+             e < OP_plan.offset[n] + OP_plan.nelems[n]; e++) {
+          for (m2 = m; m2 < OP_plan.nargs; m2++) {
+            if (OP_plan.dats[m2] != OP_plan.dats[m] ||
+                OP_plan.maps[m2] != OP_plan.maps[m] ||
+                OP_plan.accs[m2] != OP_plan.accs[m] || !OP_plan.optflags[m2] ||
+                OP_plan.idxs[m2] < 0)
+              continue;
+            op_map map = OP_plan.maps[m2];
+            int p = map->map[OP_plan.idxs[m2] + e * map->dim];
+            blkerr += (stamp[p] == col && owner[p] != n);
+            stamp[p] = col;
+            owner[p] = n;
+          }
+        }
+      }
+    }
+
+    free(stamp);
+    free(owner);
+  }
+
+  free(color);
+  free(group_end);
+  free(order);
+
+  if (err != 0) {
+    printf(" *** OP_plan_check: %d thread color error(s) \n", err);
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: thrcol   OK \n");
+  }
+
+  if (blkerr != 0) {
+    printf(" *** OP_plan_check: %d block color error(s) \n", blkerr);
+  } else if (OP_diags > 6) {
+    printf(" *** OP_plan_check: blkcol   OK \n");
+  }
+}
+
+/*
+ * execution plans saved to OP_plan_dir, so that repeat runs on the same mesh
+ * skip plan construction. A plan file is named after a checksum of
+ * everything the plan is built from: the set sizes (and so the partition),
+ * the block size, the arguments and the contents of their maps. The checksum is
+ * stored in the file as well, and checked again when the plan is read back.
+ */
+
+#define OP_PLAN_FILE_VERSION 2
+
+typedef struct {
+  char magic[8];                /* "OP2PLAN" */
+  int version;                  /* OP_PLAN_FILE_VERSION */
+  unsigned long long checksum;  /* checksum of the plan inputs */
+  int exec_length, nblocks, ninds_staged;
+  int ncolors, ncolors_core, ncolors_owned, nshared;
+  int nblock_colors;            /* size of ncolblk and nsharedCol */
+  int ncol_offsets;             /* size of col_offsets, 0 if there are none */
+  float transfer, transfer2;
+} op_plan_file_header;
+
+static unsigned long long op_plan_checksum_bytes(unsigned long long sum,
+                                                 const void *bytes, size_t n) {
+  const unsigned char *c = (const unsigned char *)bytes;
+  for (size_t i = 0; i < n; i++)
+    sum = (sum ^ c[i]) * 1099511628211ull;
+  return sum;
+}
+
+static unsigned long long op_plan_checksum(op_set set, int bsize, int nargs,
+                                           op_arg *args, int ninds, int *inds,
+                                           int staging, int exec_length) {
+  int key[] = {OP_PLAN_FILE_VERSION, set->size,   set->core_size,
+               set->exec_size,       set->nonexec_size, exec_length,
+               bsize,                staging,     OP_cache_line_size,
+               nargs,                ninds,       OP_color_balance};
+  unsigned long long sum = 14695981039346656037ull;
+  sum = op_plan_checksum_bytes(sum, key, sizeof(key));
+
+  for (int m = 0; m < nargs; m++) {
+    int arg_key[] = {args[m].opt, args[m].idx, args[m].acc, inds[m], -1, -1};
+    if (args[m].dat != NULL) {
+      arg_key[4] = args[m].dat->size;
+      arg_key[5] = args[m].dat->dim;
+    }
+    sum = op_plan_checksum_bytes(sum, arg_key, sizeof(arg_key));
+    if (args[m].map == NULL || !args[m].opt)
+      continue;
+
+    op_map map = args[m].map;
+    int map_key[] = {map->dim, map->to->size, map->to->exec_size,
+                     map->to->nonexec_size};
+    sum = op_plan_checksum_bytes(sum, map_key, sizeof(map_key));
+
+    /* the map contents only need adding once per map */
+    int m2 = 0;
+    while (m2 < m && !(args[m2].map == map && args[m2].opt))
+      m2++;
+    if (m2 == m)
+      sum = op_plan_checksum_bytes(sum, map->map,
+                                   (size_t)exec_length * map->dim * sizeof(int));
+  }
+  return sum;
+}
+
+static void op_plan_file_name(char *fname, size_t n,
+                              unsigned long long checksum) {
+  snprintf(fname, n, "%s/plan_%016llx.op2plan", OP_plan_dir, checksum);
+}
+
+/*
+ * number of entries of ind_maps[m] used by the plan
+ */
+
+static int op_plan_ind_map_size(op_plan *plan, int m) {
+  if (plan->nblocks == 0)
+    return 0;
+  int b = plan->nblocks - 1;
+  return plan->ind_offs[m + b * plan->ninds_staged] +
+         plan->ind_sizes[m + b * plan->ninds_staged];
+}
+
+/*
+ * number of block colours; with OP_COLOR2 there is a single block and
+ * ncolors holds the number of thread colours instead
+ */
+
+static int op_plan_block_colors(op_plan *plan) {
+  return plan->staging == OP_COLOR2 ? 1 : plan->ncolors;
+}
+
+static int op_plan_col_offsets_size(op_plan *plan) {
+  if (plan->col_offsets == NULL)
+    return 0;
+  int size = 0;
+  for (int b = 0; b < plan->nblocks; b++)
+    size += plan->nthrcol[b] + 1;
+  return size;
+}
+
+static void op_plan_write(op_plan *plan, unsigned long long checksum,
+                          int exec_length) {
+  char fname[1024], tmpname[1100];
+  op_plan_file_name(fname, sizeof(fname), checksum);
+  snprintf(tmpname, sizeof(tmpname), "%s.%d", fname, (int)getpid());
+
+  FILE *fp = fopen(tmpname, "wb");
+  if (fp == NULL) {
+    printf(" op_plan warning -- cannot write execution plan to %s\n", fname);
+    return;
+  }
+
+  int nblocks = plan->nblocks;
+  int ns = plan->ninds_staged;
+
+  op_plan_file_header header;
+  memset(&header, 0, sizeof(header));
+  strcpy(header.magic, "OP2PLAN");
+  header.version = OP_PLAN_FILE_VERSION;
+  header.checksum = checksum;
+  header.exec_length = exec_length;
+  header.nblocks = nblocks;
+  header.ninds_staged = ns;
+  header.ncolors = plan->ncolors;
+  header.ncolors_core = plan->ncolors_core;
+  header.ncolors_owned = plan->ncolors_owned;
+  header.nshared = plan->nshared;
+  header.nblock_colors = op_plan_block_colors(plan);
+  header.ncol_offsets = op_plan_col_offsets_size(plan);
+  header.transfer = plan->transfer;
+  header.transfer2 = plan->transfer2;
+
+  /* fwrite returns 0 for 0 items, so empty arrays do not count as errors */
+  size_t ok = fwrite(&header, sizeof(header), 1, fp) == 1;
+  ok = ok && fwrite(plan->offset, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fwrite(plan->nelems, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fwrite(plan->nthrcol, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fwrite(plan->blkmap, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fwrite(plan->thrcol, sizeof(int), exec_length, fp) ==
+                 (size_t)exec_length;
+  ok = ok && fwrite(plan->ind_offs, sizeof(int), nblocks * ns, fp) ==
+                 (size_t)(nblocks * ns);
+  ok = ok && fwrite(plan->ind_sizes, sizeof(int), nblocks * ns, fp) ==
+                 (size_t)(nblocks * ns);
+  ok = ok && fwrite(plan->nindirect, sizeof(int), plan->ninds, fp) ==
+                 (size_t)plan->ninds;
+  for (int m = 0; m < ns; m++) {
+    size_t size = op_plan_ind_map_size(plan, m);
+    ok = ok && fwrite(plan->ind_maps[m], sizeof(int), size, fp) == size;
+  }
+  for (int m = 0; m < plan->nargs; m++) {
+    if (plan->inds_staged[m] >= 0)
+      ok = ok && fwrite(plan->loc_maps[m], sizeof(short), exec_length, fp) ==
+                     (size_t)exec_length;
+  }
+  ok = ok && fwrite(plan->ncolblk, sizeof(int), header.nblock_colors, fp) ==
+                 (size_t)header.nblock_colors;
+  ok = ok && fwrite(plan->nsharedCol, sizeof(int), header.nblock_colors,
+                    fp) == (size_t)header.nblock_colors;
+  if (header.ncol_offsets > 0) {
+    ok = ok && fwrite(plan->col_reord, sizeof(int), exec_length, fp) ==
+                   (size_t)exec_length;
+    ok = ok && fwrite(plan->col_offsets[0], sizeof(int), header.ncol_offsets,
+                      fp) == (size_t)header.ncol_offsets;
+  }
+
+  if (fclose(fp) != 0)
+    ok = 0;
+
+  /* write to a temporary file first, so that a plan file is never seen half
+     written by another process */
+  if (!ok || rename(tmpname, fname) != 0) {
+    printf(" op_plan warning -- cannot write execution plan to %s\n", fname);
+    remove(tmpname);
+  } else if (OP_diags > 1) {
+    printf(" execution plan saved to %s\n", fname);
+  }
+}
+
+/*
+ * read a saved plan into a newly allocated one; returns 1 on success. On
+ * failure the plan arrays are left to be filled in by op_plan_core.
+ */
+
+static int op_plan_read(op_plan *plan, unsigned long long checksum,
+                        int exec_length) {
+  char fname[1024];
+  op_plan_file_name(fname, sizeof(fname), checksum);
+
+  FILE *fp = fopen(fname, "rb");
+  if (fp == NULL)
+    return 0;
+
+  int nblocks = plan->nblocks;
+  int ns = plan->ninds_staged;
+  plan->nsharedCol = NULL;
+
+  op_plan_file_header header;
+  size_t ok = fread(&header, sizeof(header), 1, fp) == 1;
+  ok = ok && memcmp(header.magic, "OP2PLAN", 8) == 0 &&
+       header.version == OP_PLAN_FILE_VERSION &&
+       header.checksum == checksum && header.exec_length == exec_length &&
+       header.nblocks == nblocks && header.ninds_staged == ns &&
+       header.nblock_colors >= 0 && header.nblock_colors <= exec_length &&
+       (header.ncol_offsets > 0) == (plan->staging == OP_STAGE_PERMUTE ||
+                                     plan->staging == OP_COLOR2);
+
+  ok = ok && fread(plan->offset, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fread(plan->nelems, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fread(plan->nthrcol, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fread(plan->blkmap, sizeof(int), nblocks, fp) == (size_t)nblocks;
+  ok = ok && fread(plan->thrcol, sizeof(int), exec_length, fp) ==
+                 (size_t)exec_length;
+  ok = ok && fread(plan->ind_offs, sizeof(int), nblocks * ns, fp) ==
+                 (size_t)(nblocks * ns);
+  ok = ok && fread(plan->ind_sizes, sizeof(int), nblocks * ns, fp) ==
+                 (size_t)(nblocks * ns);
+  ok = ok && fread(plan->nindirect, sizeof(int), plan->ninds, fp) ==
+                 (size_t)plan->ninds;
+  for (int m = 0; ok && m < ns; m++) {
+    int count = 0; /* ind_maps[m] has room for exec_length per argument */
+    for (int m2 = 0; m2 < plan->nargs; m2++)
+      count += (plan->inds_staged[m2] == m);
+    size_t size = op_plan_ind_map_size(plan, m);
+    ok = size <= (size_t)count * exec_length &&
+         fread(plan->ind_maps[m], sizeof(int), size, fp) == size;
+  }
+  for (int m = 0; m < plan->nargs; m++) {
+    if (plan->inds_staged[m] >= 0)
+      ok = ok && fread(plan->loc_maps[m], sizeof(short), exec_length, fp) ==
+                     (size_t)exec_length;
+  }
+  ok = ok && fread(plan->ncolblk, sizeof(int), header.nblock_colors, fp) ==
+                 (size_t)header.nblock_colors;
+
+  if (ok) {
+    plan->nsharedCol = (int *)op_malloc(header.nblock_colors * sizeof(int));
+    ok = fread(plan->nsharedCol, sizeof(int), header.nblock_colors, fp) ==
+         (size_t)header.nblock_colors;
+  }
+  if (ok && header.ncol_offsets > 0) {
+    ok = fread(plan->col_reord, sizeof(int), exec_length, fp) ==
+         (size_t)exec_length;
+    int *col_offsets = (int *)op_malloc(header.ncol_offsets * sizeof(int));
+    ok = ok && fread(col_offsets, sizeof(int), header.ncol_offsets, fp) ==
+                   (size_t)header.ncol_offsets;
+    plan->col_offsets = (int **)op_malloc(nblocks * sizeof(int *));
+    int size = 0;
+    for (int b = 0; b < nblocks; b++) {
+      plan->col_offsets[b] = col_offsets + size;
+      size += plan->nthrcol[b] + 1;
+    }
+    ok = ok && size == header.ncol_offsets;
+    for (int i = exec_length; i < exec_length + 16; i++)
+      plan->col_reord[i] = 0;
+    if (plan->staging == OP_COLOR2)
+      plan->color2_offsets = plan->col_offsets[0];
+  }
+  fclose(fp);
+
+  if (!ok) {
+    printf(" op_plan warning -- ignoring unreadable execution plan %s\n",
+           fname);
+    free(plan->nsharedCol);
+    plan->nsharedCol = NULL;
+    if (plan->col_offsets != NULL) {
+      op_free(plan->col_offsets[0]);
+      op_free(plan->col_offsets);
+      plan->col_offsets = NULL;
+    }
+    for (int col = 0; col < exec_length; col++)
+      plan->ncolblk[col] = 0;
+    for (int m = 0; m < plan->ninds; m++)
+      plan->nindirect[m] = 0;
+    return 0;
+  }
+
+  plan->ncolors = header.ncolors;
+  plan->ncolors_core = header.ncolors_core;
+  plan->ncolors_owned = header.ncolors_owned;
+  plan->nshared = header.nshared;
+  plan->transfer = header.transfer;
+  plan->transfer2 = header.transfer2;
+
+  if (OP_diags > 1)
+    printf(" execution plan read from %s\n", fname);
+  return 1;
+}
+
+/*
+ * add the time spent on a plan since wall_t1 to its kernel's plan time
+ */
+
+static void op_plan_add_time(op_plan *plan, char const *name,
+                             double wall_t1) {
+  double cpu_t2, wall_t2;
+  op_timers_core(&cpu_t2, &wall_t2);
+  plan->time += wall_t2 - wall_t1;
+  for (int i = 0; i < OP_kern_max; i++) {
+    if (strcmp(name, OP_kernels[i].name) == 0) {
+      OP_kernels[i].plan_time += wall_t2 - wall_t1;
+      break;
+    }
+  }
+  OP_plan_time += wall_t2 - wall_t1;
+}
+
+/*
+ * plan memory. The plans not used for longest are evicted (their arrays
+ * freed) when the plans take more than OP_plan_memory_mb, and rebuilt when
+ * they are next used. Plans whose arrays have been moved to the GPU hold no
+ * host memory and are never evicted.
+ */
+
+static size_t op_plan_memory(op_plan *plan, int exec_length) {
+  int nargs = plan->nargs;
+  int nblocks = plan->nblocks;
+  int ns = plan->ninds_staged;
+  int nstaged = 0; /* arguments with a loc_map */
+  for (int m = 0; m < nargs; m++)
+    nstaged += plan->inds_staged[m] >= 0;
+
+  size_t bytes = nargs * (sizeof(op_dat) + sizeof(op_map) + sizeof(op_access) +
+                          3 * sizeof(int) + sizeof(short *)) +
+                 ns * sizeof(int *) + plan->ninds * sizeof(int) +
+                 plan->naliases * sizeof(char const *);
+  bytes += (size_t)nblocks * (4 + 2 * ns) * sizeof(int); /* per block */
+  bytes += (size_t)(2 * exec_length + 16) * sizeof(int); /* thrcol, col_reord */
+  bytes += (size_t)nstaged * exec_length * (sizeof(int) + sizeof(short));
+  bytes += 2 * op_plan_block_colors(plan) * sizeof(int);
+  bytes += plan->ncolors * sizeof(int); /* ncolelem */
+  if (plan->col_offsets != NULL)
+    bytes += nblocks * sizeof(int *) + op_plan_col_offsets_size(plan) * sizeof(int);
+  return bytes;
+}
+
+static void op_plan_evict(int keep) {
+  size_t limit = (size_t)OP_plan_memory_mb * 1024 * 1024;
+  while (OP_plan_memory_mb > 0 && OP_plan_bytes > limit) {
+    int lru = -1;
+    for (int ip = 0; ip < OP_plan_index; ip++) {
+      if (ip != keep && !OP_plans[ip].evicted && OP_plans[ip].bytes > 0 &&
+          (lru == -1 || OP_plans[ip].last_used < OP_plans[lru].last_used))
+        lru = ip;
+    }
+    if (lru == -1)
+      return;
+
+    if (OP_diags > 1)
+      printf(" evicting execution plan #%d for kernel %s (%zu bytes)\n", lru,
+             OP_plans[lru].name, OP_plans[lru].bytes);
+    op_plan_free_arrays(&OP_plans[lru]);
+    OP_plan_bytes -= OP_plans[lru].bytes;
+    OP_plans[lru].bytes = 0;
+    OP_plans[lru].evicted = 1;
+  }
+}
+
+/*
+ * account for a plan that has just been built or read, evicting others if
+ * needed
+ */
+
+static void op_plan_store(int ip, int exec_length) {
+  op_plan *plan = &OP_plans[ip];
+
+  /* ncolblk was allocated for the worst case of one block per colour */
+  plan->ncolblk = (int *)op_realloc(
+      plan->ncolblk, MAX(op_plan_block_colors(plan), 1) * sizeof(int));
+
+  /* elements of each colour, kept for op_plan_get_info as nelems and blkmap
+     may be moved to the GPU */
+  plan->exec_length = exec_length;
+  plan->ncolelem = (int *)op_calloc(MAX(plan->ncolors, 1), sizeof(int));
+  if (plan->staging == OP_COLOR2) {
+    if (plan->col_offsets != NULL)
+      for (int col = 0; col < plan->ncolors; col++)
+        plan->ncolelem[col] =
+            plan->col_offsets[0][col + 1] - plan->col_offsets[0][col];
+  } else {
+    for (int col = 0, b = 0; col < plan->ncolors; col++)
+      for (int k = 0; k < plan->ncolblk[col]; k++, b++)
+        plan->ncolelem[col] += plan->nelems[plan->blkmap[b]];
+  }
+
+  plan->bytes = op_plan_memory(plan, exec_length);
+  OP_plan_bytes += plan->bytes;
+  op_plan_evict(ip);
+}
+
+/*
+ * replicate and reduce execution of plans built with OP_STAGE_INC: instead of
+ * colouring, each block adds its increments to its own entries of a buffer,
+ * ind_sizes of them for each staged dataset starting at ind_offs, and the
+ * entries for each element of the dataset are summed afterwards. The
+ * inverse of ind_maps gives these entries.
+ */
+
+void op_plan_inverse(op_plan *plan) {
+  if (plan->inv_offs != NULL)
+    return;
+
+  int ns = plan->ninds_staged;
+  plan->inv_offs = (int **)op_malloc(ns * sizeof(int *));
+  plan->inv_pos = (int **)op_malloc(ns * sizeof(int *));
+  plan->inv_size = (int *)op_malloc(ns * sizeof(int));
+  size_t bytes = ns * (2 * sizeof(int *) + sizeof(int));
+
+  for (int m = 0; m < ns; m++) {
+    int m2 = 0;
+    while (plan->inds_staged[m2] != m)
+      m2++;
+    int size = 0;
+    if (plan->maps[m2] != NULL) { // else a deactivated optional argument
+      op_set to = plan->maps[m2]->to;
+      size = to->size + to->exec_size + to->nonexec_size;
+    }
+    int npos = op_plan_ind_map_size(plan, m);
+    int *ind_map = plan->ind_maps[m];
+
+    /* counting sort of the positions by element */
+    int *offs = (int *)op_calloc(size + 1, sizeof(int));
+    int *pos = (int *)op_malloc(MAX(npos, 1) * sizeof(int));
+    for (int p = 0; p < npos; p++)
+      offs[ind_map[p] + 1]++;
+    for (int e = 0; e < size; e++)
+      offs[e + 1] += offs[e];
+    for (int p = 0; p < npos; p++)
+      pos[offs[ind_map[p]]++] = p;
+    for (int e = size; e > 0; e--) // undo the increments of the last loop
+      offs[e] = offs[e - 1];
+    offs[0] = 0;
+
+    plan->inv_offs[m] = offs;
+    plan->inv_pos[m] = pos;
+    plan->inv_size[m] = size;
+    bytes += (size_t)(size + 1 + npos) * sizeof(int);
+  }
+
+  plan->bytes += bytes;
+  OP_plan_bytes += bytes;
+  op_plan_evict(plan - OP_plans);
+}
+
+/*
+ * buffer for the increments of loops run without colouring, either the block
+ * increments of replicate and reduce execution or the per element increments
+ * gathered with op_get_map_inverse, shared by all loops
+ */
+
+char *op_plan_inc_buffer(size_t bytes) {
+  if (bytes > OP_inc_buf_bytes) {
+    free(OP_inc_buf);
+    OP_inc_buf = (char *)op_malloc(bytes);
+    OP_inc_buf_bytes = bytes;
+  }
+  return OP_inc_buf;
+}
+
+/*
+ * inverse of a map, from each element of the to set to the entries of the map
+ * that refer to it, built on first use and kept until op_rt_exit. It is
+ * rebuilt if the map has been renumbered or partitioned since.
+ */
+
+op_map_inverse *op_get_map_inverse(op_map map) {
+  if (map->index >= OP_map_inverse_max) {
+    int max = MAX(map->index + 1, 2 * OP_map_inverse_max);
+    OP_map_inverses = (op_map_inverse **)op_realloc(
+        OP_map_inverses, max * sizeof(op_map_inverse *));
+    for (int i = OP_map_inverse_max; i < max; i++)
+      OP_map_inverses[i] = NULL;
+    OP_map_inverse_max = max;
+  }
+
+  op_set from = map->from, to = map->to;
+  int from_size = from->size + from->exec_size;
+  int size = to->size + to->exec_size + to->nonexec_size;
+
+  op_map_inverse *inv = OP_map_inverses[map->index];
+  if (inv != NULL) {
+    if (inv->map_data == map->map && inv->from_size == from_size &&
+        inv->size == size)
+      return inv;
+    OP_map_inverse_bytes -= inv->bytes;
+    op_map_inverse_free(inv);
+  }
+
+  int npos = from_size * map->dim;
+  inv = (op_map_inverse *)op_malloc(sizeof(op_map_inverse));
+  inv->map = map;
+  inv->map_data = map->map;
+  inv->from_size = from_size;
+  inv->size = size;
+  inv->offs = (int *)op_calloc(size + 1, sizeof(int));
+  inv->pos = (int *)op_malloc(MAX(npos, 1) * sizeof(int));
+  inv->bytes = sizeof(op_map_inverse) + (size_t)(size + 1 + npos) * sizeof(int);
+
+  /* counting sort of the map entries by element, as in op_plan_inverse */
+  int *offs = inv->offs;
+  for (int p = 0; p < npos; p++)
+    offs[map->map[p] + 1]++;
+  for (int e = 0; e < size; e++)
+    offs[e + 1] += offs[e];
+  for (int p = 0; p < npos; p++)
+    inv->pos[offs[map->map[p]]++] = p;
+  for (int e = size; e > 0; e--)
+    offs[e] = offs[e - 1];
+  offs[0] = 0;
+
+  OP_map_inverses[map->index] = inv;
+  OP_map_inverse_bytes += inv->bytes;
+  return inv;
+}
+
+/*
+ * plan statistics
+ */
+
+int op_plan_get_info(int ip, op_plan_info *info) {
+  if (ip < 0 || ip >= OP_plan_index)
+    return 0;
+  op_plan *plan = &OP_plans[ip];
+
+  info->name = plan->name;
+  info->naliases = plan->naliases;
+  info->staging = plan->staging;
+  info->count = plan->count;
+  info->exec_length = plan->exec_length;
+  info->nblocks = plan->nblocks;
+  info->ncolors = plan->ncolors;
+  info->ncolors_core = plan->ncolors_core;
+  info->ncolors_owned = plan->ncolors_owned;
+  info->ncolblk = NULL;
+  info->ncolelem = NULL;
+  info->reuse = 0.0;
+  info->time = plan->time;
+  info->bytes = plan->bytes;
+  info->evicted = plan->evicted;
+  if (plan->evicted)
+    return 1;
+
+  if (plan->staging != OP_COLOR2)
+    info->ncolblk = plan->ncolblk;
+  info->ncolelem = plan->ncolelem;
+
+  /* every element references one staged element per staged argument */
+  long refs = 0, staged = 0;
+  for (int m = 0; m < plan->nargs; m++)
+    if (plan->inds_staged[m] >= 0)
+      refs += plan->exec_length;
+  for (int m = 0; m < plan->ninds; m++)
+    staged += plan->nindirect[m];
+  if (staged > 0)
+    info->reuse = (double)refs / staged;
+  return 1;
+}
+
+static void op_plan_fprint_list(FILE *fp, int const *list, int n,
+                                char const *sep) {
+  for (int i = 0; list != NULL && i < n; i++)
+    fprintf(fp, "%s%d", i > 0 ? sep : "", list[i]);
+}
+
+void op_plan_info_to_csv(const char *outputFileName) {
+  FILE *fp = fopen(outputFileName, "w");
+  if (fp == NULL) {
+    printf("ERROR: Failed to open file for writing: '%s'\n", outputFileName);
+    return;
+  }
+  fprintf(fp, "plan,kernel,aliases,staging,count,elements,blocks,colors,"
+              "core colors,owned colors,reuse,build time,bytes,evicted,"
+              "blocks per color,elements per color\n");
+  op_plan_info info;
+  for (int ip = 0; op_plan_get_info(ip, &info); ip++) {
+    fprintf(fp, "%d,%s,%d,%d,%d,%d,%d,%d,%d,%d,%f,%f,%zu,%d,", ip, info.name,
+            info.naliases, info.staging, info.count, info.exec_length,
+            info.nblocks, info.ncolors, info.ncolors_core, info.ncolors_owned,
+            info.reuse, info.time, info.bytes, info.evicted);
+    op_plan_fprint_list(fp, info.ncolblk, info.ncolors, " ");
+    fprintf(fp, ",");
+    op_plan_fprint_list(fp, info.ncolelem, info.ncolors, " ");
+    fprintf(fp, "\n");
+  }
+  fclose(fp);
+}
+
+void op_plan_info_to_json(const char *outputFileName) {
+  FILE *fp = fopen(outputFileName, "w");
+  if (fp == NULL) {
+    printf("ERROR: Failed to open file for writing: '%s'\n", outputFileName);
+    return;
+  }
+  fprintf(fp, "[");
+  op_plan_info info;
+  for (int ip = 0; op_plan_get_info(ip, &info); ip++) {
+    fprintf(fp, "%s\n  {\"plan\": %d, \"kernel\": \"%s\", \"aliases\": [",
+            ip > 0 ? "," : "", ip, info.name);
+    for (int a = 0; a < info.naliases; a++)
+      fprintf(fp, "%s\"%s\"", a > 0 ? ", " : "", OP_plans[ip].aliases[a]);
+    fprintf(fp,
+            "], \"staging\": %d, \"count\": %d, \"elements\": %d, "
+            "\"blocks\": %d, \"colors\": %d, \"core_colors\": %d, "
+            "\"owned_colors\": %d, \"reuse\": %f, \"build_time\": %f, "
+            "\"bytes\": %zu, \"evicted\": %d, \"blocks_per_color\": ",
+            info.staging, info.count, info.exec_length, info.nblocks,
+            info.ncolors, info.ncolors_core, info.ncolors_owned, info.reuse,
+            info.time, info.bytes, info.evicted);
+    if (info.ncolblk != NULL) {
+      fprintf(fp, "[");
+      op_plan_fprint_list(fp, info.ncolblk, info.ncolors, ", ");
+      fprintf(fp, "]");
+    } else {
+      fprintf(fp, "null");
+    }
+    fprintf(fp, ", \"elements_per_color\": ");
+    if (info.ncolelem != NULL) {
+      fprintf(fp, "[");
+      op_plan_fprint_list(fp, info.ncolelem, info.ncolors, ", ");
+      fprintf(fp, "]");
+    } else {
+      fprintf(fp, "null");
+    }
+    fprintf(fp, "}");
+  }
+  fprintf(fp, "\n]\n");
+  fclose(fp);
+}
+
+/*
+ * parallel plan construction. The loops below are OpenMP parallel when the
+ * library is built with OpenMP (the openmp library is) and run serially
+ * otherwise.
+ */
+
+/*
+ * the chunks that op_plan_colour splits items into. This is fixed, rather
+ * than the number of threads, so that plans do not depend on the number of
+ * threads.
+ */
+
+#define OP_PLAN_CHUNKS 64
+#define OP_PLAN_SHARED 0xffffffffu
+
+/*
+ * mark indirect data element *p as used by chunk (from 1), or as shared if
+ * it is used by more than one chunk
+ */
+
+static inline void op_plan_claim(uint *p, uint chunk) {
+#ifdef _OPENMP
+  uint old = __atomic_load_n(p, __ATOMIC_RELAXED);
+  while (old != chunk && old != OP_PLAN_SHARED &&
+         !__atomic_compare_exchange_n(p, &old, old == 0 ? chunk : OP_PLAN_SHARED,
+                                      false, __ATOMIC_RELAXED,
+                                      __ATOMIC_RELAXED))
+    ;
+#else
+  if (*p == 0)
+    *p = chunk;
+  else if (*p != chunk)
+    *p = OP_PLAN_SHARED;
+#endif
+}
+
+#define OP_PLAN_BOUNDARY 1 // shares indirect data with another chunk
+
+/*
+ * greedily colour item i with the first colour, from base, that is not used
+ * at any of the indirect data elements it increments or read-writes. An item
+ * is element i if offset is NULL, and block i otherwise. Returns the colour,
+ * or -1 if all 32 colours from base are used.
+ */
+
+static inline int op_plan_colour_item(int i, int *offset, int *nelems,
+                                      uint mask, int nargs, op_arg *args,
+                                      int *inds, uint **work) {
+  int e0 = offset == NULL ? i : offset[i];
+  int e1 = offset == NULL ? i + 1 : e0 + nelems[i];
+
+  for (int m = 0; m < nargs; m++) {
+    if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+        args[m].opt)
+      for (int e = e0; e < e1; e++)
+        mask |= work[inds[m]][args[m].map->map[args[m].idx +
+                                               e * args[m].map->dim]];
+  }
+
+  int color = ffs(~mask) - 1; // find first bit not set
+  if (color == -1)            // run out of colors on this pass
+    return -1;
+
+  mask = 1 << color;
+  for (int m = 0; m < nargs; m++) {
+    if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+        args[m].opt)
+      for (int e = e0; e < e1; e++)
+        work[inds[m]][args[m].map->map[args[m].idx + e * args[m].map->dim]] |=
+            mask;
+  }
+  return color;
+}
+
+/*
+ * even out the sizes of the colours mincol to ncolors-1 of items i0 to i1-1
+ * (see op_plan_colour), when there are at most 32 of them. Items of colours
+ * larger than the average move, in order, to the smallest colour none of
+ * their neighbours has. work is rebuilt with the colours at each indirect
+ * data element; bits of the colours items move away from are left set, which
+ * only limits later moves.
+ */
+
+static void op_plan_balance(int i0, int i1, int *offset, int *nelems,
+                            int mincol, int ncolors, int halo_from, int nargs,
+                            op_arg *args, int *inds, int ninds, uint **work,
+                            int *to_sizes, int *col) {
+  int ncol = ncolors - mincol;
+  int size[32] = {0};
+  int target = (i1 - i0 + ncol - 1) / ncol;
+
+  for (int m = 0; m < ninds; m++) {
+    if (work[m] == NULL)
+      continue;
+    for (int t = 0; t < to_sizes[m]; t++)
+      work[m][t] = 0;
+  }
+  for (int i = i0; i < i1; i++) {
+    size[col[i] - mincol]++;
+    int e0 = offset == NULL ? i : offset[i];
+    int e1 = offset == NULL ? i + 1 : e0 + nelems[i];
+    for (int m = 0; m < nargs; m++) {
+      if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+          args[m].opt)
+        for (int e = e0; e < e1; e++)
+          work[inds[m]][args[m].map->map[args[m].idx + e * args[m].map->dim]] |=
+              1u << (col[i] - mincol);
+    }
+  }
+
+  for (int i = i0; i < i1; i++) {
+    int c = col[i] - mincol;
+    if (size[c] <= target)
+      continue;
+    int e0 = offset == NULL ? i : offset[i];
+    int e1 = offset == NULL ? i + 1 : e0 + nelems[i];
+    uint mask = i >= halo_from ? 1 : 0;
+    for (int m = 0; m < nargs; m++) {
+      if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+          args[m].opt)
+        for (int e = e0; e < e1; e++)
+          mask |= work[inds[m]][args[m].map->map[args[m].idx +
+                                                 e * args[m].map->dim]];
+    }
+
+    int best = -1;
+    for (int k = 0; k < ncol; k++) {
+      if (!(mask & (1u << k)) && size[k] < target &&
+          (best == -1 || size[k] < size[best]))
+        best = k;
+    }
+    if (best == -1)
+      continue;
+
+    size[c]--;
+    size[best]++;
+    col[i] = mincol + best;
+    for (int m = 0; m < nargs; m++) {
+      if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+          args[m].opt)
+        for (int e = e0; e < e1; e++)
+          work[inds[m]][args[m].map->map[args[m].idx + e * args[m].map->dim]] |=
+              1u << best;
+    }
+  }
+}
+
+/*
+ * colour items i0 to i1-1 so that no two items that increment or read-write
+ * the same indirect data element share a colour. Colours start at mincol,
+ * and items from halo_from on cannot take colour mincol. Returns the number
+ * of colours (at least mincol).
+ *
+ * The items are split into contiguous chunks. Items that share indirect data
+ * with another chunk (boundary items) are coloured first, serially; the
+ * remaining items of different chunks have no indirect data in common, so
+ * the chunks are then coloured in parallel. Both steps are greedy in item
+ * order, so the colouring is close to that of a serial greedy colouring.
+ * work holds bit masks of the colours used at each indirect data element, 32
+ * colours at a time, and owner the chunk using it. With OP_COLOR_BALANCE the
+ * colour sizes are evened out afterwards.
+ */
+
+static int op_plan_colour(int i0, int i1, int *offset, int *nelems, int mincol,
+                          int halo_from, int nargs, op_arg *args, int *inds,
+                          int ninds, uint **work, uint **owner, int *to_sizes,
+                          int *col, char *flags) {
+  int n = i1 - i0;
+  int nchunks = MIN(OP_PLAN_CHUNKS, n);
+  int ncolors = mincol;
+  int remaining = n;
+
+  /* find the boundary items */
+  for (int m = 0; m < ninds; m++) {
+    if (owner[m] == NULL)
+      continue;
+OP_PRAGMA_OMP(omp parallel for)
+    for (int t = 0; t < to_sizes[m]; t++)
+      owner[m][t] = 0;
+  }
+
+OP_PRAGMA_OMP(omp parallel for schedule(static))
+  for (int c = 0; c < nchunks; c++) {
+    for (int i = i0 + (long)n * c / nchunks;
+         i < i0 + (long)n * (c + 1) / nchunks; i++) {
+      int e0 = offset == NULL ? i : offset[i];
+      int e1 = offset == NULL ? i + 1 : e0 + nelems[i];
+      col[i] = -1;
+      flags[i] = 0;
+      for (int m = 0; m < nargs; m++) {
+        if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+            args[m].opt)
+          for (int e = e0; e < e1; e++)
+            op_plan_claim(&owner[inds[m]][args[m].map->map[args[m].idx +
+                                                           e * args[m].map->dim]],
+                          c + 1);
+      }
+    }
+  }
+
+OP_PRAGMA_OMP(omp parallel for schedule(static))
+  for (int i = i0; i < i1; i++) {
+    int e0 = offset == NULL ? i : offset[i];
+    int e1 = offset == NULL ? i + 1 : e0 + nelems[i];
+    for (int m = 0; m < nargs && flags[i] == 0; m++) {
+      if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+          args[m].opt)
+        for (int e = e0; e < e1; e++)
+          if (owner[inds[m]][args[m].map->map[args[m].idx +
+                                              e * args[m].map->dim]] ==
+              OP_PLAN_SHARED) {
+            flags[i] = OP_PLAN_BOUNDARY;
+            break;
+          }
+    }
+  }
+
+  for (int base = mincol; remaining > 0; base += 32) {
+    for (int m = 0; m < ninds; m++) {
+      if (work[m] == NULL)
+        continue;
+OP_PRAGMA_OMP(omp parallel for)
+      for (int t = 0; t < to_sizes[m]; t++)
+        work[m][t] = 0; // zero out color arrays
+    }
+
+    for (int i = i0; i < i1; i++) {
+      if (col[i] != -1 || !(flags[i] & OP_PLAN_BOUNDARY))
+        continue;
+      uint mask = (i >= halo_from && base == mincol) ? 1 : 0;
+      int color =
+          op_plan_colour_item(i, offset, nelems, mask, nargs, args, inds, work);
+      if (color != -1) {
+        col[i] = base + color;
+        ncolors = MAX(ncolors, base + color + 1);
+      }
+    }
+
+OP_PRAGMA_OMP(omp parallel for schedule(dynamic, 1) reduction(max : ncolors))
+    for (int c = 0; c < nchunks; c++) {
+      for (int i = i0 + (long)n * c / nchunks;
+           i < i0 + (long)n * (c + 1) / nchunks; i++) {
+        if (col[i] != -1 || (flags[i] & OP_PLAN_BOUNDARY))
+          continue;
+        uint mask = (i >= halo_from && base == mincol) ? 1 : 0;
+        int color = op_plan_colour_item(i, offset, nelems, mask, nargs, args,
+                                        inds, work);
+        if (color != -1) {
+          col[i] = base + color;
+          ncolors = MAX(ncolors, base + color + 1);
+        }
+      }
+    }
+
+    remaining = 0;
+    for (int i = i0; i < i1; i++)
+      remaining += col[i] == -1;
+  }
+
+  if (OP_color_balance && ncolors - mincol > 1 && ncolors - mincol <= 32)
+    op_plan_balance(i0, i1, offset, nelems, mincol, ncolors, halo_from, nargs,
+                    args, inds, ninds, work, to_sizes, col);
+  return ncolors;
+}
+
+/*
+ * sort a list of n non-negative integers by least significant digit radix
+ * sort, one byte at a time, using tmp (n ints); only as many bytes as the
+ * range of the values needs are sorted
+ */
 
-  free(blkmap);
+static void op_plan_radix_sort(int *list, int *tmp, int n) {
+  if (n < 2)
+    return;
+  int min = list[0], max = list[0];
+  for (int i = 1; i < n; i++) {
+    min = MIN(min, list[i]);
+    max = MAX(max, list[i]);
+  }
 
-  if (err != 0) {
-    printf(" *** OP_plan_check: blkmap error \n");
-  } else if (OP_diags > 6) {
-    printf(" *** OP_plan_check: blkmap   OK \n");
+  int npasses = 0;
+  while (npasses < 4 && ((uint)(max - min) >> (8 * npasses)) != 0)
+    npasses++;
+
+  int *src = list, *dst = tmp;
+  for (int pass = 0; pass < npasses; pass++) {
+    int shift = 8 * pass;
+    int count[257] = {0};
+    for (int i = 0; i < n; i++)
+      count[(((uint)(src[i] - min) >> shift) & 255) + 1]++;
+    for (int d = 0; d < 256; d++)
+      count[d + 1] += count[d];
+    for (int i = 0; i < n; i++)
+      dst[count[((uint)(src[i] - min) >> shift) & 255]++] = src[i];
+    int *swap = src;
+    src = dst;
+    dst = swap;
   }
+  if (src != list)
+    memcpy(list, src, n * sizeof(int));
+}
 
-  /*
-   * check ind_offs and ind_sizes are consistent
-   */
+/*
+ * private work space of a thread building blocks with op_plan_block. Lists
+ * have room for the indirect references of one block (nargs*bsize). The
+ * distinct elements of a block are found with an open addressing hash table
+ * of size 1 << hbits, whose slots are in use when their stamp is the current
+ * generation, so that it never needs clearing.
+ */
 
-  err = 0;
+typedef struct {
+  int *work2;  /* indirect elements */
+  int *lidx;   /* their local indices (first hash table slots) */
+  int *list;   /* staged indirection lists */
+  int *tmp;    /* radix sort buffer */
+  uint *mask;  /* color masks */
+  int *keys;   /* hash table elements */
+  int *vals;   /* and their local indices */
+  uint *stamp; /* and generations */
+  uint gen;
+  int hbits;
+} op_plan_scratch;
+
+static void op_plan_scratch_init(op_plan_scratch *s, int nargs, int bsize) {
+  int n = nargs * bsize + 1;
+  s->hbits = 1;
+  while ((1 << s->hbits) < 2 * n)
+    s->hbits++;
+  int h = 1 << s->hbits;
+  s->work2 = (int *)op_malloc((5 * n + 2 * h) * sizeof(int));
+  s->lidx = s->work2 + n;
+  s->list = s->work2 + 2 * n;
+  s->tmp = s->work2 + 3 * n;
+  s->mask = (uint *)(s->work2 + 4 * n);
+  s->keys = s->work2 + 5 * n;
+  s->vals = s->work2 + 5 * n + h;
+  s->stamp = (uint *)op_calloc(h, sizeof(uint));
+  s->gen = 0;
+}
 
-  for (int i = 0; i < ninds; i++) {
-    ntot = 0;
+static void op_plan_scratch_free(op_plan_scratch *s) {
+  free(s->work2);
+  free(s->stamp);
+}
 
-    for (int n = 0; n < nblock; n++) {
-      err += (OP_plan.ind_offs[i + n * ninds] != ntot);
-      ntot += OP_plan.ind_sizes[i + n * ninds];
-    }
-  }
+/*
+ * hash table slot of element t, adding it if it is not in the table yet
+ */
 
-  if (err != 0) {
-    printf(" *** OP_plan_check: ind_offs error \n");
-  } else if (OP_diags > 6) {
-    printf(" *** OP_plan_check: ind_offs OK \n");
+static inline int op_plan_slot(op_plan_scratch *s, int t, int *added) {
+  int hmask = (1 << s->hbits) - 1;
+  int h = ((uint)t * 0x9e3779b1u) >> (32 - s->hbits);
+  while (s->stamp[h] == s->gen && s->keys[h] != t)
+    h = (h + 1) & hmask;
+  *added = s->stamp[h] != s->gen;
+  if (*added) {
+    s->stamp[h] = s->gen;
+    s->keys[h] = t;
   }
+  return h;
+}
 
-  /*
-   * check ind_maps correctly ordered within each block
-   * and indices within range
-   */
-
-  err = 0;
+/*
+ * build the indirection lists (ind_sizes and loc_maps) and the thread colours
+ * of block b. Blocks only write to their own part of the plan, so they are
+ * built in parallel: scratch and maskoff (ninds ints) are private to the
+ * calling thread. The block's entries of ind_maps are returned in a new list,
+ * to be copied into place once the offsets of all blocks are known.
+ */
 
+static int *op_plan_block(op_plan *plan, int b, op_arg *args, int *inds,
+                          int ninds, int bsize, op_plan_scratch *scratch,
+                          int *maskoff) {
+  int nargs = plan->nargs;
+  int ninds_staged = plan->ninds_staged;
+  int *inds_staged = plan->inds_staged;
+  int prev_offset = plan->offset[b];
+  int bs = plan->nelems[b];
+
+  int *work2 = scratch->work2;
+  int *lidx = scratch->lidx;
+  int *list = scratch->list;
+  uint *mask = scratch->mask;
+  int nlist = 0, nmask = 0;
+
+  /* loop over indirection sets */
   for (int m = 0; m < ninds; m++) {
     int m2 = 0;
     while (inds[m2] != m)
       m2++;
-    if (OP_plan.maps[m2] == NULL)
-      continue; // it is a deactivated optional argument
-    int halo_size = (OP_plan.maps[m2]->to)->exec_size +
-                    (OP_plan.maps[m2]->to)->nonexec_size;
-    int set_size = OP_plan.maps[m2]->to->size + halo_size;
+    int m3 = inds_staged[m2];
+    maskoff[m] = nmask;
+    if (args[m2].opt == 0) {
+      if (m3 >= 0)
+        plan->ind_sizes[m3 + b * ninds_staged] = 0;
+      continue;
+    }
+    int colored = 0;
+    for (int m2 = 0; m2 < nargs; m2++)
+      colored |= inds[m2] == m && (args[m2].acc == OP_INC || args[m2].acc == OP_RW);
+    if (m3 < 0 && !colored)
+      continue;
 
-    ntot = 0;
+    /* build the list of distinct elements indirectly referenced in this
+       block, and sort it */
 
-    for (int n = 0; n < nblock; n++) {
-      int last = -1;
-      for (int e = ntot; e < ntot + OP_plan.ind_sizes[m + n * ninds]; e++) {
-        err += (OP_plan.ind_maps[m][e] <= last);
-        last = OP_plan.ind_maps[m][e];
+    if (++scratch->gen == 0) { // generations wrapped around
+      memset(scratch->stamp, 0, sizeof(uint) << scratch->hbits);
+      scratch->gen = 1;
+    }
+    int ne = 0; /* number of distinct elements */
+    for (int m2 = 0; m2 < nargs; m2++) {
+      if (inds[m2] == m) {
+        for (int e = 0; e < bs; e++) {
+          int t = args[m2].map->map[args[m2].idx +
+                                    (prev_offset + e) * args[m2].map->dim];
+          int added;
+          lidx[m2 * bsize + e] = op_plan_slot(scratch, t, &added);
+          if (added)
+            work2[ne++] = t;
+        }
       }
-      err += (last >= set_size);
-      ntot += OP_plan.ind_sizes[m + n * ninds];
     }
-  }
 
-  if (err != 0) {
-    printf(" *** OP_plan_check: ind_maps error \n");
-  } else if (OP_diags > 6) {
-    printf(" *** OP_plan_check: ind_maps OK \n");
+    op_plan_radix_sort(work2, scratch->tmp, ne);
+
+    /* renumber the mappings within the block */
+
+    int added;
+    for (int e = 0; e < ne; e++)
+      scratch->vals[op_plan_slot(scratch, work2[e], &added)] = e;
+
+    for (int m2 = 0; m2 < nargs; m2++) {
+      if (inds[m2] == m) {
+        for (int e = 0; e < bs; e++)
+          lidx[m2 * bsize + e] = scratch->vals[lidx[m2 * bsize + e]];
+        if (plan->loc_maps[m2] != NULL)
+          for (int e = 0; e < bs; e++)
+            plan->loc_maps[m2][prev_offset + e] = (short)lidx[m2 * bsize + e];
+      }
+    }
+
+    if (m3 >= 0) {
+      for (int e = 0; e < ne; e++)
+        list[nlist + e] = work2[e];
+      nlist += ne;
+      plan->ind_sizes[m3 + b * ninds_staged] = ne;
+    }
+    nmask += ne;
   }
 
-  /*
-   *check maps (most likely source of errors)
-   */
+  /* now colour main set elements */
 
-  err = 0;
+  int *thrcol = &plan->thrcol[prev_offset];
+  for (int e = 0; e < bs; e++)
+    thrcol[e] = -1;
 
-  for (int m = 0; m < OP_plan.nargs; m++) {
-    if (OP_plan.maps[m] != NULL && OP_plan.optflags[m] &&
-        OP_plan.loc_maps[m] != NULL) {
-      op_map map = OP_plan.maps[m];
-      int m2 = inds[m];
+  int repeat = 1;
+  int ncolor = 0;
+  int ncolors = 0;
 
-      ntot = 0;
-      for (int n = 0; n < nblock; n++) {
-        for (int e = ntot; e < ntot + OP_plan.nelems[n]; e++) {
-          int p_local = OP_plan.loc_maps[m][e];
-          int p_global =
-              OP_plan.ind_maps[m2][p_local + OP_plan.ind_offs[m2 + n * ninds]];
-          err += (p_global != map->map[OP_plan.idxs[m] + e * map->dim]);
+  while (repeat) {
+    repeat = 0;
+
+    for (int i = 0; i < nmask; i++)
+      mask[i] = 0; /* zero out color array */
+
+    for (int e = 0; e < bs; e++) {
+      if (thrcol[e] == -1) {
+        uint bits = 0;
+        for (int m = 0; m < nargs; m++)
+          if (inds[m] >= 0 && (args[m].acc == OP_INC || args[m].acc == OP_RW) &&
+              args[m].opt)
+            bits |= mask[maskoff[inds[m]] +
+                         lidx[m * bsize + e]]; /* set bits of mask */
+
+        int color = ffs(~bits) - 1; /* find first bit not set */
+        if (color == -1) {          /* run out of colors on this pass */
+          repeat = 1;
+        } else {
+          thrcol[e] = ncolor + color;
+          bits = 1 << color;
+          ncolors = MAX(ncolors, ncolor + color + 1);
+
+          for (int m = 0; m < nargs; m++)
+            if (inds[m] >= 0 &&
+                (args[m].acc == OP_INC || args[m].acc == OP_RW) && args[m].opt)
+              mask[maskoff[inds[m]] + lidx[m * bsize + e]] |=
+                  bits; /* set color bit */
         }
-        ntot += OP_plan.nelems[n];
       }
     }
-  }
 
-  if (err != 0) {
-    printf(" *** OP_plan_check: %d maps error(s) \n", err);
-  } else if (OP_diags > 6) {
-    printf(" *** OP_plan_check: maps     OK \n");
+    ncolor += 32; /* increment base level */
   }
 
-  /*
-   * check thread and block coloring
-   */
+  plan->nthrcol[b] = ncolors; /* number of thread colors in this block */
 
-  return;
+  if (nlist == 0)
+    return NULL;
+  int *block_list = (int *)op_malloc(nlist * sizeof(int));
+  memcpy(block_list, list, nlist * sizeof(int));
+  return block_list;
 }
 
 /*
@@ -309,43 +1783,79 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
     }
   }
 
-  /* first look for an existing execution plan */
-
-  int ip = 0, match = 0;
-
-  while (match == 0 && ip < OP_plan_index) {
-    if ((strcmp(name, OP_plans[ip].name) == 0) && (set == OP_plans[ip].set) &&
-        (nargs == OP_plans[ip].nargs) && (ninds == OP_plans[ip].ninds) &&
-        (part_size == OP_plans[ip].part_size)) {
-      match = 1;
-      for (int m = 0; m < nargs; m++) {
-        if (args[m].dat != NULL && OP_plans[ip].dats[m] != NULL)
-          match = match && (args[m].dat->size == OP_plans[ip].dats[m]->size) &&
-                  (args[m].dat->dim == OP_plans[ip].dats[m]->dim) &&
-                  (args[m].map == OP_plans[ip].maps[m]) &&
-                  (args[m].idx == OP_plans[ip].idxs[m]) &&
-                  (args[m].acc == OP_plans[ip].accs[m]);
-        else
-          match = match && (args[m].dat == OP_plans[ip].dats[m]) &&
-                  (args[m].map == OP_plans[ip].maps[m]) &&
-                  (args[m].idx == OP_plans[ip].idxs[m]) &&
-                  (args[m].acc == OP_plans[ip].accs[m]);
+  /* first look for an existing execution plan, starting with the one last
+     returned to this call site */
+
+  int ip = -1;
+
+  op_plan_site *site;
+  HASH_FIND_PTR(OP_plan_sites, &name, site);
+  if (site != NULL && op_plan_match(&OP_plans[site->ip], set, part_size, nargs,
+                                    args, ninds, inds, staging))
+    ip = site->ip;
+
+  unsigned int hash = 0;
+  op_plan_entry *head = NULL;
+  if (ip == -1) {
+    hash = op_plan_hash(set, part_size, nargs, args, ninds, inds, staging);
+    HASH_FIND_INT(OP_plan_tab, &hash, head);
+    for (op_plan_entry *entry = head; entry != NULL; entry = entry->next) {
+      if (op_plan_match(&OP_plans[entry->ip], set, part_size, nargs, args,
+                        ninds, inds, staging)) {
+        ip = entry->ip;
+        break;
       }
     }
-    ip++;
   }
 
-  if (match) {
-    ip--;
+  OP_plan_clock++;
+  if (ip != -1 && (site == NULL || site->ip != ip))
+    op_plan_add_alias(&OP_plans[ip], name);
+
+  if (ip != -1 && !OP_plans[ip].evicted) {
+    if (site == NULL) {
+      site = (op_plan_site *)op_malloc(sizeof(op_plan_site));
+      site->name = name;
+      HASH_ADD_PTR(OP_plan_sites, name, site);
+    }
+    site->ip = ip;
     if (OP_diags > 3)
       printf(" old execution plan #%d\n", ip);
     OP_plans[ip].count++;
+    OP_plans[ip].last_used = OP_plan_clock;
     return &(OP_plans[ip]);
+  }
+
+  int count = 0; /* calls of the plan before it was evicted */
+  if (ip != -1) {
+    if (OP_diags > 1)
+      printf(" rebuilding execution plan #%d for kernel %s\n", ip, name);
+    count = OP_plans[ip].count;
+    op_plan_free(&OP_plans[ip]);
   } else {
+    ip = OP_plan_index;
     if (OP_diags > 1)
       printf(" new execution plan #%d for kernel %s\n", ip, name);
+
+    op_plan_entry *entry = (op_plan_entry *)op_malloc(sizeof(op_plan_entry));
+    entry->hash = hash;
+    entry->ip = ip;
+    if (head == NULL) {
+      entry->next = NULL;
+      HASH_ADD_INT(OP_plan_tab, hash, entry);
+    } else {
+      entry->next = head->next;
+      head->next = entry;
+    }
+  }
+  if (site == NULL) {
+    site = (op_plan_site *)op_malloc(sizeof(op_plan_site));
+    site->name = name;
+    HASH_ADD_PTR(OP_plan_sites, name, site);
   }
-  double wall_t1, wall_t2, cpu_t1, cpu_t2;
+  site->ip = ip;
+
+  double wall_t1, cpu_t1;
   op_timers_core(&cpu_t1, &wall_t1);
   /* work out worst case shared memory requirement per element */
 
@@ -359,19 +1869,36 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
   }
 
   int maxbytes = 0;
+  int indbytes = 0; // indirect data referenced per element, staged or not
   for (int m = 0; m < nargs; m++) {
     if (args[m].opt && inds[m] >= 0) {
       if ((staging == OP_STAGE_INC && args[m].acc == OP_INC) ||
           (staging == OP_STAGE_ALL || staging == OP_STAGE_PERMUTE))
         maxbytes += args[m].dat->size;
+      indbytes += args[m].dat->size;
     }
   }
 
   /* set blocksize and number of blocks; adaptive size based on 48kB of shared
-   * memory */
+   * memory, or on the cache of a CPU core with OP_AUTO_PART_SIZE */
 
   int bsize = part_size; // blocksize
-  if (bsize == 0 && maxbytes > 0)
+  if (bsize == 0 && OP_auto_part_size && OP_cache_size > 0 && indbytes > 0 &&
+      staging != OP_COLOR2) {
+    // the indirect data of a block should fill about half of the cache
+    bsize = MIN(OP_cache_size / (2 * indbytes), 4096); // short loc_maps
+#ifdef _OPENMP
+    int nthreads = omp_get_max_threads();
+#else
+    int nthreads = 1;
+#endif
+    // but leave each thread a few blocks of every colour
+    bsize = MIN(bsize, exec_length / (16 * nthreads));
+    bsize = MAX(bsize / 64 * 64, 64);
+    if (OP_diags > 1)
+      printf(" part size %d for kernel %s (%d bytes per element, %d kB cache)\n",
+             bsize, name, indbytes, OP_cache_size / 1024);
+  } else if (bsize == 0 && maxbytes > 0)
     bsize = MAX((24 * 1024 / (64 * maxbytes)) * 64,
                 256); // 48kB exactly is too much, make it 24
   else if (bsize == 0 && maxbytes == 0)
@@ -465,6 +1992,7 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
 
   OP_plans[ip].dats = (op_dat *)op_malloc(nargs * sizeof(op_dat));
   OP_plans[ip].idxs = (int *)op_malloc(nargs * sizeof(int));
+  OP_plans[ip].inds = (int *)op_malloc(nargs * sizeof(int));
   OP_plans[ip].optflags = (int *)op_malloc(nargs * sizeof(int));
   OP_plans[ip].maps = (op_map *)op_malloc(nargs * sizeof(op_map));
   OP_plans[ip].accs = (op_access *)op_malloc(nargs * sizeof(op_access));
@@ -486,6 +2014,10 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
   OP_plans[ip].ncolblk =
       (int *)op_calloc(exec_length, sizeof(int)); /* max possibly needed */
   OP_plans[ip].blkmap = (int *)op_calloc(nblocks, sizeof(int));
+  OP_plans[ip].ncolelem = NULL;
+  OP_plans[ip].inv_offs = NULL;
+  OP_plans[ip].inv_pos = NULL;
+  OP_plans[ip].inv_size = NULL;
 
   int *offsets = (int *)op_malloc((ninds_staged + 1) * sizeof(int));
   offsets[0] = 0;
@@ -512,6 +2044,7 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
 
     OP_plans[ip].dats[m] = args[m].dat;
     OP_plans[ip].idxs[m] = args[m].idx;
+    OP_plans[ip].inds[m] = inds[m];
     OP_plans[ip].optflags[m] = args[m].opt;
     OP_plans[ip].maps[m] = args[m].map;
     OP_plans[ip].accs[m] = args[m].acc;
@@ -527,24 +2060,32 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
     }
   }
 
-  OP_plans[ip].name = name;
+  if (count == 0) { /* a rebuilt plan keeps its name and aliases */
+    OP_plans[ip].name = name;
+    OP_plans[ip].aliases = NULL;
+    OP_plans[ip].naliases = 0;
+    OP_plans[ip].time = 0.0;
+  }
   OP_plans[ip].set = set;
   OP_plans[ip].nargs = nargs;
   OP_plans[ip].ninds = ninds;
   OP_plans[ip].ninds_staged = ninds_staged;
   OP_plans[ip].part_size = part_size;
+  OP_plans[ip].staging = staging;
   OP_plans[ip].nblocks = nblocks;
   OP_plans[ip].ncolors_core = 0;
   OP_plans[ip].ncolors_owned = 0;
-  OP_plans[ip].count = 1;
+  OP_plans[ip].count = count + 1;
   OP_plans[ip].inds_staged = inds_staged;
+  OP_plans[ip].evicted = 0;
+  OP_plans[ip].last_used = OP_plan_clock;
 
-  OP_plan_index++;
+  if (ip == OP_plan_index)
+    OP_plan_index++;
 
   /* define aliases */
 
   op_dat *dats = OP_plans[ip].dats;
-  int *idxs = OP_plans[ip].idxs;
   op_map *maps = OP_plans[ip].maps;
   op_access *accs = OP_plans[ip].accs;
 
@@ -555,9 +2096,28 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
   int *ind_sizes = OP_plans[ip].ind_sizes;
   int *nindirect = OP_plans[ip].nindirect;
 
-  /* allocate working arrays */
-  uint **work;
-  work = (uint **)op_malloc(ninds * sizeof(uint *));
+  /* reuse the plan saved by an earlier run on the same mesh, if any */
+
+  unsigned long long checksum = 0;
+  if (OP_plan_dir != NULL) {
+    checksum = op_plan_checksum(set, bsize, nargs, args, ninds, inds, staging,
+                                exec_length);
+    if (op_plan_read(&OP_plans[ip], checksum, exec_length)) {
+      op_plan_check(OP_plans[ip], ninds_staged, inds_staged);
+      free(inds_to_inds_staged);
+      free(invinds_staged);
+      op_plan_store(ip, exec_length);
+      op_plan_add_time(&OP_plans[ip], name, wall_t1);
+      return &(OP_plans[ip]);
+    }
+  }
+
+  /* allocate working arrays: colour masks and owning chunks for each
+     indirect dataset */
+
+  uint **work = (uint **)op_malloc(ninds * sizeof(uint *));
+  uint **owner = (uint **)op_malloc(ninds * sizeof(uint *));
+  int *to_sizes = (int *)op_malloc(ninds * sizeof(int));
 
   for (int m = 0; m < ninds; m++) {
     int m2 = 0;
@@ -565,21 +2125,18 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
       m2++;
     if (args[m2].opt == 0) {
       work[m] = NULL;
+      owner[m] = NULL;
+      to_sizes[m] = 0;
       continue;
     }
 
-    int to_size = (maps[m2]->to)->exec_size + (maps[m2]->to)->nonexec_size +
+    to_sizes[m] = (maps[m2]->to)->exec_size + (maps[m2]->to)->nonexec_size +
                   (maps[m2]->to)->size;
-    work[m] = (uint *)op_malloc(to_size * sizeof(uint));
+    work[m] = (uint *)op_malloc(to_sizes[m] * sizeof(uint));
+    owner[m] = (uint *)op_malloc(to_sizes[m] * sizeof(uint));
   }
 
-  int *work2;
-  work2 =
-      (int *)op_malloc(nargs * bsize * sizeof(int)); /* max possibly needed */
-
-  /* process set one block at a time */
-
-  float total_colors = 0;
+  /* set up the blocks */
 
   prev_offset = 0;
   next_offset = 0;
@@ -601,276 +2158,172 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
       prev_offset = 0;
       next_offset = exec_length;
     };
-    int bs = next_offset - prev_offset;
-
-    offset[b] = prev_offset; /* offset for block */
-    nelems[b] = bs;          /* size of block */
-
-    /* loop over indirection sets */
-    for (int m = 0; m < ninds; m++) {
-      int m2 = 0;
-      while (inds[m2] != m)
-        m2++;
-      int m3 = inds_staged[m2];
-      if (m3 < 0)
-        continue;
-      if (args[m2].opt == 0) {
-        if (b == 0) {
-          ind_offs[m3 + b * ninds_staged] = 0;
-          ind_sizes[m3 + b * ninds_staged] = 0;
-        } else {
-          ind_offs[m3 + b * ninds_staged] =
-              ind_offs[m3 + (b - 1) * ninds_staged];
-          ind_sizes[m3 + b * ninds_staged] = 0;
-        }
-        continue;
-      }
-      /* build the list of elements indirectly referenced in this block */
-
-      int ne = 0; /* number of elements */
-      for (int m2 = 0; m2 < nargs; m2++) {
-        if (inds[m2] == m) {
-          for (int e = prev_offset; e < next_offset; e++)
-            work2[ne++] = maps[m2]->map[idxs[m2] + e * maps[m2]->dim];
-        }
-      }
 
-      /* sort them, then eliminate duplicates */
-
-      qsort(work2, ne, sizeof(int), comp);
-
-      int nde = 0;
-      int p = 0;
-      while (p < ne) {
-        work2[nde] = work2[p];
-        while (p < ne && work2[p] == work2[nde])
-          p++;
-        nde++;
-      }
-      ne = nde; /* number of distinct elements */
-
-      /*
-         if (OP_diags > 5) { printf(" indirection set %d: ",m); for (int e=0;
-         e<ne; e++) printf("
-         %d",work2[e]); printf(" \n"); } */
-
-      /* store mapping and renumbered mappings in execution plan */
+    offset[b] = prev_offset;               /* offset for block */
+    nelems[b] = next_offset - prev_offset; /* size of block */
+  }
 
-      for (int e = 0; e < ne; e++) {
-        ind_maps[m3][nindirect[m]++] = work2[e];
-        work[m][work2[e]] = e; // inverse mapping
-      }
+  /* build the indirection lists and colour the elements of each block; with
+     a single block, colour its elements in parallel instead */
 
-      for (int m2 = 0; m2 < nargs; m2++) {
-        if (inds[m2] == m) {
-          for (int e = prev_offset; e < next_offset; e++)
-            OP_plans[ip].loc_maps[m2][e] =
-                (short)(work[m][maps[m2]->map[idxs[m2] + e * maps[m2]->dim]]);
-        }
-      }
+  float total_colors = 0;
+  int **blk_lists = (int **)op_calloc(nblocks, sizeof(int *));
 
-      if (b == 0) {
-        ind_offs[m3 + b * ninds_staged] = 0;
-        ind_sizes[m3 + b * ninds_staged] = nindirect[m];
-      } else {
-        ind_offs[m3 + b * ninds_staged] =
-            ind_offs[m3 + (b - 1) * ninds_staged] +
-            ind_sizes[m3 + (b - 1) * ninds_staged];
-        ind_sizes[m3 + b * ninds_staged] =
-            nindirect[m] - ind_offs[m3 + b * ninds_staged];
+  if (staging == OP_COLOR2) {
+    char *flags = (char *)op_malloc(exec_length * sizeof(char));
+    int halo_from = exec_length;
+    if (halo_exchange && set->core_size > 0)
+      halo_from = set->core_size; // elements that need the halo exchange
+    OP_plans[ip].nthrcol[0] =
+        op_plan_colour(0, exec_length, NULL, NULL, 0, halo_from, nargs, args,
+                       inds, ninds, work, owner, to_sizes, OP_plans[ip].thrcol,
+                       flags);
+    total_colors = OP_plans[ip].nthrcol[0];
+    free(flags);
+  } else {
+OP_PRAGMA_OMP(omp parallel)
+    {
+      op_plan_scratch scratch;
+      op_plan_scratch_init(&scratch, nargs, bsize);
+      int *maskoff = (int *)op_malloc((ninds + 1) * sizeof(int));
+OP_PRAGMA_OMP(omp for schedule(dynamic) reduction(+ : total_colors))
+      for (int b = 0; b < nblocks; b++) {
+        blk_lists[b] = op_plan_block(&OP_plans[ip], b, args, inds, ninds, bsize,
+                                     &scratch, maskoff);
+        total_colors += OP_plans[ip].nthrcol[b];
       }
+      op_plan_scratch_free(&scratch);
+      free(maskoff);
     }
+  }
 
-    /* now colour main set elements */
-
-    for (int e = prev_offset; e < next_offset; e++)
-      OP_plans[ip].thrcol[e] = -1;
-
-    int repeat = 1;
-    int ncolor = 0;
-    int ncolors = 0;
-
-    while (repeat) {
-      repeat = 0;
-
-      for (int m = 0; m < nargs; m++) {
-        if (inds[m] >= 0 && args[m].opt)
-          for (int e = prev_offset; e < next_offset; e++)
-            work[inds[m]][maps[m]->map[idxs[m] + e * maps[m]->dim]] =
-                0; /* zero out color array */
-      }
-
-      for (int e = prev_offset; e < next_offset; e++) {
-        if (OP_plans[ip].thrcol[e] == -1) {
-          int mask = 0;
-          if (staging == OP_COLOR2 && halo_exchange && 
-              e >= set->core_size && set->core_size>0 && //if element needs halo axchange to finish
-              ncolor == 0)
-            mask = 1;
-          for (int m = 0; m < nargs; m++)
-            if (inds[m] >= 0 && (accs[m] == OP_INC || accs[m] == OP_RW) &&
-                args[m].opt)
-              mask |=
-                  work[inds[m]]
-                      [maps[m]->map[idxs[m] +
-                                    e * maps[m]->dim]]; /* set bits of mask */
-
-          int color = ffs(~mask) - 1; /* find first bit not set */
-          if (color == -1) {          /* run out of colors on this pass */
-            repeat = 1;
-          } else {
-            OP_plans[ip].thrcol[e] = ncolor + color;
-            mask = 1 << color;
-            ncolors = MAX(ncolors, ncolor + color + 1);
-
-            for (int m = 0; m < nargs; m++)
-              if (inds[m] >= 0 && (accs[m] == OP_INC || accs[m] == OP_RW) &&
-                  args[m].opt)
-                work[inds[m]][maps[m]->map[idxs[m] + e * maps[m]->dim]] |=
-                    mask; /* set color bit */
-          }
-        }
-      }
+  /* put the blocks' indirection lists in place */
 
-      ncolor += 32; /* increment base level */
+  for (int m = 0; m < ninds; m++) {
+    int m2 = 0;
+    while (inds[m2] != m)
+      m2++;
+    int m3 = inds_staged[m2];
+    if (m3 < 0)
+      continue;
+    int ntot = 0;
+    for (int b = 0; b < nblocks; b++) {
+      ind_offs[m3 + b * ninds_staged] = ntot;
+      ntot += ind_sizes[m3 + b * ninds_staged];
     }
+    nindirect[m] = ntot;
+  }
 
-    OP_plans[ip].nthrcol[b] =
-        ncolors; /* number of thread colors in this block */
-    total_colors += ncolors;
-
-    // if(ncolors>1) printf(" number of colors in this block = %d \n",ncolors);
+OP_PRAGMA_OMP(omp parallel for)
+  for (int b = 0; b < nblocks; b++) {
+    int pos = 0;
+    for (int m = 0; m < ninds; m++) {
+      int m2 = 0;
+      while (inds[m2] != m)
+        m2++;
+      int m3 = inds_staged[m2];
+      if (m3 < 0)
+        continue;
+      int size = ind_sizes[m3 + b * ninds_staged];
+      memcpy(&ind_maps[m3][ind_offs[m3 + b * ninds_staged]], &blk_lists[b][pos],
+             size * sizeof(int));
+      pos += size;
+    }
+    free(blk_lists[b]);
   }
+  free(blk_lists);
 
   /* create element permutation by color */
   if (staging == OP_STAGE_PERMUTE || staging == OP_COLOR2) {
     int size_of_col_offsets = 0;
+    int max_ncolor = 0;
     for (int b = 0; b < nblocks; b++) {
       size_of_col_offsets += OP_plans[ip].nthrcol[b] + 1;
+      max_ncolor = MAX(max_ncolor, OP_plans[ip].nthrcol[b]);
     }
     // allocate
     OP_plans[ip].col_offsets = (int **)op_malloc(nblocks * sizeof(int *));
     int *col_offsets = (int *)op_malloc(size_of_col_offsets * sizeof(int *));
 
     size_of_col_offsets = 0;
-    op_keyvalue *kv = (op_keyvalue *)op_malloc(bsize * sizeof(op_keyvalue));
     for (int b = 0; b < nblocks; b++) {
-      int ncolor = OP_plans[ip].nthrcol[b];
-      for (int e = 0; e < nelems[b]; e++) {
-        kv[e].key = OP_plans[ip].thrcol[offset[b] + e];
-        kv[e].value = e;
-      }
-      qsort(kv, nelems[b], sizeof(op_keyvalue), comp2);
       OP_plans[ip].col_offsets[b] = col_offsets + size_of_col_offsets;
-      OP_plans[ip].col_offsets[b][0] = 0;
-      size_of_col_offsets += (ncolor + 1);
-
-      // Set up permutation and pointers to beginning of each color
-      ncolor = 0;
-      for (int e = 0; e < nelems[b]; e++) {
-        OP_plans[ip].thrcol[offset[b] + e] = kv[e].key;
-        OP_plans[ip].col_reord[offset[b] + e] = kv[e].value;
-        if (e > 0)
-          if (kv[e].key > kv[e - 1].key) {
-            ncolor++;
-            OP_plans[ip].col_offsets[b][ncolor] = e;
-          }
+      size_of_col_offsets += OP_plans[ip].nthrcol[b] + 1;
+    }
+
+    // counting sort of each block's elements by color
+OP_PRAGMA_OMP(omp parallel)
+    {
+      int *start = (int *)op_malloc((max_ncolor + 1) * sizeof(int));
+OP_PRAGMA_OMP(omp for schedule(dynamic))
+      for (int b = 0; b < nblocks; b++) {
+        int ncolor = OP_plans[ip].nthrcol[b];
+        int *thrcol = &OP_plans[ip].thrcol[offset[b]];
+        for (int c = 0; c <= ncolor; c++)
+          start[c] = 0;
+        for (int e = 0; e < nelems[b]; e++)
+          start[thrcol[e] + 1]++;
+        for (int c = 0; c < ncolor; c++)
+          start[c + 1] += start[c];
+
+        // pointers to the beginning of each color present in the block
+        int ncol = 0;
+        OP_plans[ip].col_offsets[b][0] = 0;
+        for (int c = 0; c < ncolor; c++)
+          if (start[c + 1] > start[c])
+            OP_plans[ip].col_offsets[b][ncol++] = start[c];
+        OP_plans[ip].col_offsets[b][ncol] = nelems[b];
+
+        // set up permutation, and sort the colors to match
+        for (int e = 0; e < nelems[b]; e++)
+          OP_plans[ip].col_reord[offset[b] + start[thrcol[e]]++] = e;
+        int e = 0;
+        for (int c = 0; c < ncolor; c++)
+          while (e < start[c])
+            thrcol[e++] = c;
       }
-      OP_plans[ip].col_offsets[b][ncolor + 1] = nelems[b];
+      free(start);
     }
     for (int i = exec_length; i < exec_length + 16; i++)
       OP_plans[ip].col_reord[i] = 0;
-		if (staging == OP_COLOR2)
+    if (staging == OP_COLOR2)
       OP_plans[ip].color2_offsets = OP_plans[ip].col_offsets[0];
   }
 
-  /* color the blocks, after initialising colors to 0 */
-
-  int *blk_col;
-
-  blk_col = (int *)op_malloc(nblocks * sizeof(int));
-  for (int b = 0; b < nblocks; b++)
-    blk_col[b] = -1;
-
-  int repeat = 1;
-  int ncolor = 0;
-  int ncolors = 0;
-
-  while (repeat) {
-    repeat = 0;
-
-    for (int m = 0; m < nargs; m++) {
-      if (inds[m] >= 0 && args[m].opt) {
-        int to_size = (maps[m]->to)->exec_size + (maps[m]->to)->nonexec_size +
-                      (maps[m]->to)->size;
-        for (int e = 0; e < to_size; e++)
-          work[inds[m]][e] = 0; // zero out color arrays
-      }
-    }
-    prev_offset = 0;
-    next_offset = 0;
-    for (int b = 0; b < nblocks; b++) {
-      prev_offset = next_offset;
-
-      if (prev_offset + bsize >= set->core_size &&
-          prev_offset < set->core_size) {
-        next_offset = set->core_size;
-      } else if (prev_offset + bsize >= set->size && prev_offset < set->size &&
-                 indirect_reduce) {
-        next_offset = set->size;
-      } else if (prev_offset + bsize >= exec_length &&
-                 prev_offset < exec_length) {
-        next_offset = exec_length;
-      } else {
-        next_offset = prev_offset + bsize;
-      }
-      if (blk_col[b] == -1) { // color not yet assigned to block
-        uint mask = 0;
-        if (next_offset > set->core_size) { // should not use block colors from
-                                            // the core set when doing the
-                                            // non_core ones
-          if (prev_offset <= set->core_size)
-            OP_plans[ip].ncolors_core = ncolors;
-          for (int shifter = 0; shifter < OP_plans[ip].ncolors_core-ncolor; shifter++)
-            mask |= 1 << shifter;
-          if (prev_offset == set->size && indirect_reduce)
-            OP_plans[ip].ncolors_owned = ncolors;
-          for (int shifter = OP_plans[ip].ncolors_core;
-               indirect_reduce && shifter < OP_plans[ip].ncolors_owned-ncolor;
-               shifter++)
-            mask |= 1 << shifter;
-        }
-
-        for (int m = 0; m < nargs; m++) {
-          if (inds[m] >= 0 && (accs[m] == OP_INC || accs[m] == OP_RW) &&
-              args[m].opt)
-            for (int e = prev_offset; e < next_offset; e++)
-              mask |= work[inds[m]]
-                          [maps[m]->map[idxs[m] + e * maps[m]->dim]]; // set
-                                                                      // bits of
-                                                                      // mask
-        }
-
-        int color = ffs(~mask) - 1; // find first bit not set
-        if (color == -1) {          // run out of colors on this pass
-          repeat = 1;
-        } else {
-          blk_col[b] = ncolor + color;
-          mask = 1 << color;
-          ncolors = MAX(ncolors, ncolor + color + 1);
-
-          for (int m = 0; m < nargs; m++) {
-            if (inds[m] >= 0 && (accs[m] == OP_INC || accs[m] == OP_RW) &&
-                args[m].opt)
-              for (int e = prev_offset; e < next_offset; e++)
-                work[inds[m]][maps[m]->map[idxs[m] + e * maps[m]->dim]] |= mask;
-          }
-        }
-      }
+  /* color the blocks. Blocks with core elements are colored first, then
+     owned and then halo blocks, each starting at a new color so that the
+     earlier colors can run during the MPI halo exchange */
+
+  int *blk_col = (int *)op_malloc(nblocks * sizeof(int));
+  char *flags = (char *)op_malloc(nblocks * sizeof(char));
+
+  int nb_core = 0;
+  while (nb_core < nblocks && offset[nb_core] + nelems[nb_core] <= set->core_size)
+    nb_core++;
+  int nb_owned = nb_core;
+  while (nb_owned < nblocks && offset[nb_owned] < set->size)
+    nb_owned++;
+
+  int ncolors = op_plan_colour(0, nb_core, offset, nelems, 0, nb_core, nargs,
+                               args, inds, ninds, work, owner, to_sizes, blk_col,
+                               flags);
+  if (nb_core < nblocks) {
+    OP_plans[ip].ncolors_core = ncolors;
+    if (indirect_reduce && nb_owned < nblocks) {
+      ncolors = op_plan_colour(nb_core, nb_owned, offset, nelems, ncolors,
+                               nb_owned, nargs, args, inds, ninds, work, owner,
+                               to_sizes, blk_col, flags);
+      OP_plans[ip].ncolors_owned = ncolors;
+      ncolors = op_plan_colour(nb_owned, nblocks, offset, nelems, ncolors,
+                               nblocks, nargs, args, inds, ninds, work, owner,
+                               to_sizes, blk_col, flags);
+    } else {
+      ncolors = op_plan_colour(nb_core, nblocks, offset, nelems, ncolors,
+                               nblocks, nargs, args, inds, ninds, work, owner,
+                               to_sizes, blk_col, flags);
     }
-
-    ncolor += 32; // increment base level
   }
+  free(flags);
 
   /* store block mapping and number of blocks per color */
 
@@ -881,31 +2334,25 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
   if (staging == OP_COLOR2)
     OP_plans[ip].ncolors = OP_plans[ip].nthrcol[0];
 
-  /*for(int col = 0; col = OP_plans[ip].ncolors;col++) //should initialize to
-    zero because op_calloc returns garbage!!
-    {
-    OP_plans[ip].ncolblk[col] = 0;
-    }*/
-
   for (int b = 0; b < nblocks; b++)
     OP_plans[ip].ncolblk[blk_col[b]]++; // number of blocks of each color
 
   for (int c = 1; c < ncolors; c++)
     OP_plans[ip].ncolblk[c] += OP_plans[ip].ncolblk[c - 1]; // cumsum
 
-  for (int c = 0; c < ncolors; c++)
-    work2[c] = 0;
+  int *col_count = (int *)op_calloc(ncolors, sizeof(int));
 
   for (int b = 0; b < nblocks; b++) {
     int c = blk_col[b];
-    int b2 = work2[c]; // number of preceding blocks of this color
+    int b2 = col_count[c]; // number of preceding blocks of this color
     if (c > 0)
       b2 += OP_plans[ip].ncolblk[c - 1]; // plus previous colors
 
     OP_plans[ip].blkmap[b2] = b;
 
-    work2[c]++; // increment counter
+    col_count[c]++; // increment counter
   }
+  free(col_count);
 
   for (int c = ncolors - 1; c > 0; c--)
     OP_plans[ip].ncolblk[c] -= OP_plans[ip].ncolblk[c - 1]; // undo cumsum
@@ -913,32 +2360,9 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
   /* reorder blocks by color? */
 
   /* work out shared memory requirements */
-  OP_plans[ip].nsharedCol = (int *)op_malloc(ncolors * sizeof(int));
-  float total_shared = 0;
-  for (int col = 0; col < ncolors; col++) {
-    OP_plans[ip].nsharedCol[col] = 0;
-    for (int b = 0; b < nblocks; b++) {
-      if (blk_col[b] == col) {
-        int nbytes = 0;
-        for (int m = 0; m < ninds_staged; m++) {
-          int m2 = 0;
-          while (inds_staged[m2] != m)
-            m2++;
-          if (args[m2].opt == 0)
-            continue;
-
-          nbytes +=
-              ROUND_UP_64(ind_sizes[m + b * ninds_staged] * dats[m2]->size);
-        }
-        OP_plans[ip].nsharedCol[col] =
-            MAX(OP_plans[ip].nsharedCol[col], nbytes);
-        total_shared += nbytes;
-      }
-    }
-  }
-
+  OP_plans[ip].nsharedCol = (int *)op_calloc(ncolors, sizeof(int));
   OP_plans[ip].nshared = 0;
-  total_shared = 0;
+  float total_shared = 0;
 
   for (int b = 0; b < nblocks; b++) {
     int nbytes = 0;
@@ -951,17 +2375,20 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
 
       nbytes += ROUND_UP_64(ind_sizes[m + b * ninds_staged] * dats[m2]->size);
     }
+    OP_plans[ip].nsharedCol[blk_col[b]] =
+        MAX(OP_plans[ip].nsharedCol[blk_col[b]], nbytes);
     OP_plans[ip].nshared = MAX(OP_plans[ip].nshared, nbytes);
     total_shared += nbytes;
   }
 
   /* work out total bandwidth requirements */
 
-  OP_plans[ip].transfer = 0;
-  OP_plans[ip].transfer2 = 0;
+  float transfer = 0;
+  float transfer2 = 0;
   float transfer3 = 0;
 
   if (staging != OP_COLOR2 && staging != OP_STAGE_INC) {
+OP_PRAGMA_OMP(omp parallel for reduction(+ : transfer, transfer2, transfer3))
     for (int b = 0; b < nblocks; b++) {
       for (int m = 0; m < nargs; m++) // for each argument
       {
@@ -973,16 +2400,16 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
                 accs[m] == OP_WRITE) // if you only read or write it
               fac = 1.0f;
             if (dats[m] != NULL) {
-              OP_plans[ip].transfer +=
+              transfer +=
                   fac * nelems[b] * dats[m]->size; // cost of reading it all
-              OP_plans[ip].transfer2 += fac * nelems[b] * dats[m]->size;
+              transfer2 += fac * nelems[b] * dats[m]->size;
               transfer3 += fac * nelems[b] * dats[m]->size;
             }
           } else // if it is indirectly addressed: cost of reading the pointer
                  // to it
           {
-            OP_plans[ip].transfer += nelems[b] * sizeof(short);
-            OP_plans[ip].transfer2 += nelems[b] * sizeof(short);
+            transfer += nelems[b] * sizeof(short);
+            transfer2 += nelems[b] * sizeof(short);
             transfer3 += nelems[b] * sizeof(short);
           }
         }
@@ -998,11 +2425,11 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
         if (accs[m2] == OP_READ || accs[m2] == OP_WRITE) // only read it
           fac = 1.0f;
         if (staging == OP_STAGE_INC && accs[m2] != OP_INC) {
-          OP_plans[ip].transfer += 1;
-          OP_plans[ip].transfer2 += 1;
+          transfer += 1;
+          transfer2 += 1;
           continue;
         }
-        OP_plans[ip].transfer +=
+        transfer +=
             fac * ind_sizes[m + b * ninds] *
             dats[m2]->size; // simply read all data one by one
 
@@ -1023,12 +2450,12 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
                                       // dim*sizeof(type))
           if (l_new > l_old) // if it is on a further cache line (that is not
                              // yet loaded, - i_map is ordered)
-            OP_plans[ip].transfer2 +=
+            transfer2 +=
                 fac * OP_cache_line_size; // load the cache line
           l_old = l_new;
           l_new = ((i_map + 1) * dats[m2]->size - 1) /
                   OP_cache_line_size; // the last byte of the data
-          OP_plans[ip].transfer2 += fac * (l_new - l_old) *
+          transfer2 += fac * (l_new - l_old) *
                                     OP_cache_line_size; // again, if not loaded,
                                                         // load it (can be
                                                         // multiple cache lines)
@@ -1061,13 +2488,16 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
         fac = 1.0f;
         if (accs[m2] == OP_RW)
           fac = 2.0f;
-        OP_plans[ip].transfer += fac * ind_sizes[m + b * ninds] * sizeof(int);
-        OP_plans[ip].transfer2 += fac * ind_sizes[m + b * ninds] * sizeof(int);
+        transfer += fac * ind_sizes[m + b * ninds] * sizeof(int);
+        transfer2 += fac * ind_sizes[m + b * ninds] * sizeof(int);
         transfer3 += fac * ind_sizes[m + b * ninds] * sizeof(int);
       }
     }
   }
 
+  OP_plans[ip].transfer = transfer;
+  OP_plans[ip].transfer2 = transfer2;
+
   /* print out useful information */
 
   if (OP_diags > 1) {
@@ -1086,30 +2516,31 @@ op_plan *op_plan_core(char const *name, op_set set, int part_size, int nargs,
     printf(" data transfer (total)  = %.2f MB \n",
            OP_plans[ip].transfer2 / (1024.0f * 1024.0f));
     printf(" SoA/AoS transfer ratio = %.2f \n\n",
-           transfer3 / OP_plans[ip].transfer2);
+           transfer3 / transfer2);
   }
 
   /* validate plan info */
 
   op_plan_check(OP_plans[ip], ninds_staged, inds_staged);
 
+  if (OP_plan_dir != NULL)
+    op_plan_write(&OP_plans[ip], checksum, exec_length);
+
   /* free work arrays */
 
-  for (int m = 0; m < ninds; m++)
+  for (int m = 0; m < ninds; m++) {
     free(work[m]);
+    free(owner[m]);
+  }
   free(work);
-  free(work2);
+  free(owner);
+  free(to_sizes);
   free(blk_col);
   free(inds_to_inds_staged);
   free(invinds_staged);
-  op_timers_core(&cpu_t2, &wall_t2);
-  for (int i = 0; i < OP_kern_max; i++) {
-    if (strcmp(name, OP_kernels[i].name) == 0) {
-      OP_kernels[i].plan_time += wall_t2 - wall_t1;
-      break;
-    }
-  }
+  op_plan_store(ip, exec_length);
+  op_plan_add_time(&OP_plans[ip], name, wall_t1);
+
   /* return pointer to plan */
-  OP_plan_time += wall_t2 - wall_t1;
   return &(OP_plans[ip]);
 }
@@ -92,6 +92,7 @@ op_plan * checkExistingPlan (char name[], op_set set,
   {
     if ( //( strcmp ( name, OP_plans[ip].name ) == 0 )
         ( set == OP_plans[ip].set )
+        && ( !OP_plans[ip].evicted )
         && ( argsNumber == OP_plans[ip].nargs )
         && ( indsNumber == OP_plans[ip].ninds )
         && ( partitionSize == OP_plans[ip].part_size ) )
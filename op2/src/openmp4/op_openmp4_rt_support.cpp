@@ -111,6 +111,10 @@ op_plan *op_plan_get_stage_upload(char const *name, op_set set, int part_size,
     plan->nelems_d = plan->nelems;
     op_mvHostToDevice((void **)&(plan->blkmap), sizeof(int) * plan->nblocks);
     plan->blkmap_d = plan->blkmap;
+
+    /* the plan is on the device now, and is never evicted */
+    OP_plan_bytes -= plan->bytes;
+    plan->bytes = 0;
   }
 
   return plan;
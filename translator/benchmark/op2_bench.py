@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+"""
+OP2 translator benchmark
+
+Generates synthetic OP2 applications of a given size, translates them
+with the C (op2.py) and Fortran (op2_fortran.py) translators and reports
+how long the translation took, end-to-end and per phase, as JSON.
+
+usage: ./op2_bench.py [options]
+
+  --kernels=N       number of op_par_loops / user kernels (default 20)
+  --args=N          arguments per op_par_loop (default 8)
+  --maps=N          number of distinct maps (default 4)
+  --map-dim=N       dimension of each map (default 2)
+  --vec=N           vector (negative index) map arguments per loop (default 1)
+  --macros=N        number of chained C macros used for dimensions (default 50)
+  --translators=L   comma separated list of 'c' and 'fortran' (default both)
+  --targets=L       code generation targets passed to the translators
+  -j N              number of code generator processes for op2.py
+  --repeat=N        number of timed repetitions (default 3)
+  --output=FILE     write the JSON report to FILE instead of stdout
+  --compare=FILE    compare with a previous report, and exit with status 2
+                    if any timing regressed by more than the tolerance
+  --tolerance=F     allowed relative slowdown for --compare (default 0.25)
+  --keep=DIR        generate the applications in DIR and keep them
+  -h, --help        print this message
+
+Each repetition translates a freshly generated copy of the application
+with the translation cache disabled. 'end_to_end' is the wall clock time
+of the translator run as a separate process. The per-phase timings come
+from a second, instrumented run with the code generators run one after
+another:
+
+  parse          scanning the sources for OP2 API calls
+  macros         parsing and evaluating C macro definitions (C only)
+  kernel_lookup  locating the user kernel declarations (C only)
+  generate.X     importing and running code generator X
+  other          everything else (writing *_op files, ...)
+
+For the Fortran translator 'parse' includes everything that is not code
+generation. Vector arguments are only generated for the C application;
+note that the C 'vec' generator skips any application with vector
+arguments, so use --vec=0 to time it.
+"""
+
+import sys
+import os
+import json
+import time
+import getopt
+import shutil
+import platform
+import datetime
+import tempfile
+import subprocess
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+translator_dirs = {
+  'c':       os.path.join(bench_dir, '..', 'c'),
+  'fortran': os.path.join(bench_dir, '..', 'fortran')}
+translator_scripts = {
+  'c':       os.path.join(translator_dirs['c'], 'op2.py'),
+  'fortran': os.path.join(translator_dirs['fortran'], 'op2_fortran.py')}
+
+default_params = {
+  'kernels': 20,
+  'args': 8,
+  'maps': 4,
+  'map-dim': 2,
+  'vec': 1,
+  'macros': 50}
+
+##########################################################################
+# synthetic applications
+##########################################################################
+
+def arg_kind(p, a):
+  """Kind of argument 'a' of every loop: vector, indirect or direct, and
+  whether it is read or written"""
+
+  if a < p['vec']:
+    return ('vec', 'read')
+  kinds = [('ind', 'read'), ('ind', 'inc'), ('dir', 'read'), ('dir', 'write')]
+  return kinds[(a - p['vec']) % len(kinds)]
+
+def arg_dim(p, k, a):
+  """Index of the macro giving the dimension of argument 'a' of loop 'k';
+  macro i evaluates to i%4+1"""
+
+  return (k*p['args'] + a) % p['macros']
+
+def write_c_app(path, p):
+  """Write bench.cpp and one header per kernel into 'path'"""
+
+  lines = ['#include "op_seq.h"', '']
+  lines += ['#define OP2_BENCH_DIM_0 1']
+  for i in range(1, p['macros']):
+    lines += ['#define OP2_BENCH_DIM_%d (OP2_BENCH_DIM_%d - OP2_BENCH_DIM_%d + %d)'
+              % (i, i-1, i-1, i%4+1)]
+  lines += ['']
+  for k in range(0, p['kernels']):
+    lines += ['#include "bench_kernel_%d.h"' % k]
+  lines += ['',
+            'int main(int argc, char **argv) {',
+            '  op_init(argc, argv, 2);',
+            '',
+            '  int nnode = 0, nedge = 0;',
+            '  int *map_data = NULL;',
+            '  double *dat_data = NULL;',
+            '  double bench_const = 1.0;',
+            '',
+            '  op_set nodes = op_decl_set(nnode, "nodes");',
+            '  op_set edges = op_decl_set(nedge, "edges");']
+  for m in range(0, p['maps']):
+    lines += ['  op_map map%d = op_decl_map(edges, nodes, %d, map_data, "map%d");'
+              % (m, p['map-dim'], m)]
+  for i in range(0, p['macros']):
+    lines += ['  op_dat node%d = op_decl_dat(nodes, OP2_BENCH_DIM_%d, "double", dat_data, "node%d");'
+              % (i, i, i)]
+    lines += ['  op_dat edge%d = op_decl_dat(edges, OP2_BENCH_DIM_%d, "double", dat_data, "edge%d");'
+              % (i, i, i)]
+  lines += ['  op_decl_const(1, "double", &bench_const);', '']
+
+  for k in range(0, p['kernels']):
+    args = []
+    params = []
+    body = []
+    for a in range(0, p['args']):
+      kind, acc = arg_kind(p, a)
+      d = arg_dim(p, k, a)
+      m = (k + a) % p['maps']
+      if kind == 'vec':
+        args += ['op_arg_dat(node%d, -%d, map%d, OP2_BENCH_DIM_%d, "double", OP_READ)'
+                 % (d, p['map-dim'], m, d)]
+        params += ['const double **arg%d' % a]
+        body += ['  for (int i = 0; i < %d; i++)' % p['map-dim'],
+                 '    sum += arg%d[i][0];' % a]
+      elif kind == 'ind':
+        args += ['op_arg_dat(node%d, %d, map%d, OP2_BENCH_DIM_%d, "double", %s)'
+                 % (d, a % p['map-dim'], m, d, 'OP_READ' if acc == 'read' else 'OP_INC')]
+      else:
+        args += ['op_arg_dat(edge%d, -1, OP_ID, OP2_BENCH_DIM_%d, "double", %s)'
+                 % (d, d, 'OP_READ' if acc == 'read' else 'OP_WRITE')]
+      if kind != 'vec':
+        params += [('const double *arg%d' if acc == 'read' else 'double *arg%d') % a]
+        if acc == 'read':
+          body += ['  sum += arg%d[0];' % a]
+    for a in range(0, p['args']):
+      kind, acc = arg_kind(p, a)
+      if acc == 'inc':
+        body += ['  arg%d[0] += sum;' % a]
+      elif acc == 'write':
+        body += ['  arg%d[0] = sum;' % a]
+
+    lines += ['  op_par_loop(bench_kernel_%d, "bench_kernel_%d", edges,' % (k, k)]
+    lines += ['              ' + arg + (',' if a < len(args)-1 else ');')
+              for a, arg in enumerate(args)]
+    with open(os.path.join(path, 'bench_kernel_%d.h' % k), 'w') as f:
+      f.write('inline void bench_kernel_%d(%s) {\n' % (k, ', '.join(params)) +
+              '  double sum = 0.0;\n' + '\n'.join(body) + '\n}\n')
+
+  lines += ['', '  op_exit();', '}', '']
+  with open(os.path.join(path, 'bench.cpp'), 'w') as f:
+    f.write('\n'.join(lines))
+  return ['bench.cpp']
+
+def write_fortran_app(path, p):
+  """Write bench.F90 and the .inc/.inc2 kernel files into 'path'"""
+
+  dims = [i%4+1 for i in range(0, p['macros'])]
+  lines = ['program BENCH',
+           '  use OP2_FORTRAN_DECLARATIONS',
+           '  use OP2_Fortran_Reference',
+           '  use, intrinsic :: ISO_C_BINDING',
+           '',
+           '  implicit none',
+           '',
+           '  integer(4) :: nnode, nedge',
+           '  integer(4), dimension(:), allocatable, target :: map_data',
+           '  real(8), dimension(:), allocatable, target :: dat_data',
+           '  type(op_set) :: nodes, edges',
+           '  type(op_map) :: ' + ', '.join('map%d' % m for m in range(0, p['maps'])),
+           '  type(op_dat) :: ' + ', '.join('node%d, edge%d' % (i, i) for i in range(0, p['macros'])),
+           '',
+           '  call op_init_base (0, 0)',
+           '  call op_decl_set ( nnode, nodes, \'nodes\' )',
+           '  call op_decl_set ( nedge, edges, \'edges\' )']
+  for m in range(0, p['maps']):
+    lines += ['  call op_decl_map ( edges, nodes, %d, map_data, map%d, \'map%d\' )'
+              % (p['map-dim'], m, m)]
+  for i in range(0, p['macros']):
+    lines += ['  call op_decl_dat ( nodes, %d, \'real(8)\', dat_data, node%d, \'node%d\' )' % (dims[i], i, i)]
+    lines += ['  call op_decl_dat ( edges, %d, \'real(8)\', dat_data, edge%d, \'edge%d\' )' % (dims[i], i, i)]
+  lines += ['']
+
+  for k in range(0, p['kernels']):
+    args = []
+    decls = []
+    body = []
+    for a in range(0, p['args']):
+      kind, acc = arg_kind(p, a)
+      d = arg_dim(p, k, a)
+      m = (k + a) % p['maps']
+      if kind == 'dir':
+        args += ['op_arg_dat (edge%d, -1, OP_ID, %d, "real(8)", %s)'
+                 % (d, dims[d], 'OP_READ' if acc == 'read' else 'OP_WRITE')]
+      else:
+        # vector arguments become one indirect argument per map index
+        args += ['op_arg_dat (node%d, %d, map%d, %d, "real(8)", %s)'
+                 % (d, a % p['map-dim'] + 1, m, dims[d], 'OP_READ' if acc == 'read' else 'OP_INC')]
+      decls += [(d, acc)]
+      if acc == 'read':
+        body += ['  sum = sum + arg%d(1)' % a]
+    for a in range(0, p['args']):
+      if decls[a][1] == 'inc':
+        body += ['  arg%d(1) = arg%d(1) + sum' % (a, a)]
+      elif decls[a][1] == 'write':
+        body += ['  arg%d(1) = sum' % a]
+
+    lines += ['  call op_par_loop_%d ( bench_kernel_%d, edges, &' % (p['args'], k)]
+    lines += ['                   & ' + arg + (', &' if a < len(args)-1 else ')')
+              for a, arg in enumerate(args)]
+
+    argnames = ', '.join('arg%d' % a for a in range(0, p['args']))
+    for suffix, fname in [('', '.inc'), ('_gpu', '.inc2')]:
+      kernel = ['SUBROUTINE bench_kernel_%d%s(%s)' % (k, suffix, argnames),
+                '  IMPLICIT NONE']
+      for a, (d, acc) in enumerate(decls):
+        kernel += ['  REAL(kind=8)%s :: arg%d(%d)' % (', INTENT(IN)' if acc == 'read' else '', a, dims[d])]
+      kernel += ['  REAL(kind=8) :: sum', '', '  sum = 0.0'] + body + ['END SUBROUTINE', '']
+      with open(os.path.join(path, 'bench_kernel_%d%s' % (k, fname)), 'w') as f:
+        f.write('\n'.join(kernel))
+
+  lines += ['', '  call op_exit ( )', 'end program BENCH', '']
+  with open(os.path.join(path, 'bench.F90'), 'w') as f:
+    f.write('\n'.join(lines))
+  return ['bench.F90']
+
+app_writers = {'c': write_c_app, 'fortran': write_fortran_app}
+
+##########################################################################
+# instrumented translator runs, executed in a child process
+##########################################################################
+
+def timed(timings, key, fn, active):
+  """Wrap 'fn' so that its run time is added to timings[key]. Calls made
+  while another wrapped function is running are not counted twice."""
+
+  def wrapper(*args, **kwargs):
+    if active:
+      return fn(*args, **kwargs)
+    active.append(key)
+    start = time.perf_counter()
+    try:
+      return fn(*args, **kwargs)
+    finally:
+      timings[key] = timings.get(key, 0.0) + time.perf_counter() - start
+      active.pop()
+  return wrapper
+
+def c_phases(files, targets):
+  sys.path.insert(0, translator_dirs['c'])
+  import op2
+
+  timings = {}
+  active = []
+  phases = {
+    'parse':         ['op_lex', 'op_parse_calls', 'op_decl_set_parse',
+                      'op_decl_const_parse', 'op_par_loop_parse'],
+    'macros':        ['op_parse_macro_defs', 'self_evaluate_macro_defs',
+                      'evaluate_macro_defs_in_string'],
+    'kernel_lookup': ['op_index_kernel_decls']}
+  for phase in phases:
+    for name in phases[phase]:
+      setattr(op2, name, timed(timings, phase, getattr(op2, name), active))
+
+  load_code_generator = op2.load_code_generator
+  def load_timed_code_generator(target):
+    start = time.perf_counter()
+    generator = load_code_generator(target)
+    timings['generate.'+target] = time.perf_counter() - start
+    return timed(timings, 'generate.'+target, generator, active)
+  op2.load_code_generator = load_timed_code_generator
+
+  start = time.perf_counter()
+  op2.main(srcFilesAndDirs=files, jobs=1, targets=targets)
+  total = time.perf_counter() - start
+  timings['other'] = total - sum(timings.values())
+  timings['total'] = total
+  return timings
+
+def fortran_phases(files, targets):
+  import runpy
+  import importlib
+  sys.path.insert(0, translator_dirs['fortran'])
+
+  timings = {}
+  active = []
+  import_module = importlib.import_module
+  def import_timed_module(name, package=None):
+    start = time.perf_counter()
+    module = import_module(name, package)
+    if name.startswith('op2_gen_') and not 'generate.'+name in timings:
+      timings['generate.'+name] = time.perf_counter() - start
+      setattr(module, name, timed(timings, 'generate.'+name, getattr(module, name), active))
+    return module
+  importlib.import_module = import_timed_module
+
+  sys.argv = [translator_scripts['fortran']] + files
+  if targets is not None:
+    sys.argv += ['--targets='+targets]
+  start = time.perf_counter()
+  runpy.run_path(translator_scripts['fortran'], run_name='__main__')
+  total = time.perf_counter() - start
+  timings['parse'] = total - sum(timings.values())
+  timings['total'] = total
+  return timings
+
+phase_runners = {'c': c_phases, 'fortran': fortran_phases}
+
+##########################################################################
+# driver
+##########################################################################
+
+def run_translator(translator, path, files, targets, jobs):
+  """Time one run of 'translator' on the application in 'path' as a
+  separate process"""
+
+  cmd = [sys.executable, translator_scripts[translator]]
+  if jobs is not None and translator == 'c':
+    cmd += ['-j', str(jobs)]
+  if targets is not None:
+    cmd += ['--targets='+targets]
+  env = dict(os.environ, OP2_TRANSLATOR_CACHE='0')
+  start = time.perf_counter()
+  proc = subprocess.run(cmd + files, cwd=path, env=env,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  elapsed = time.perf_counter() - start
+  if proc.returncode != 0:
+    print(proc.stderr.decode(), file=sys.stderr)
+    print('ERROR: ' + translator + ' translator failed in ' + path, file=sys.stderr)
+    sys.exit(1)
+  return elapsed
+
+def run_phases(translator, path, files, targets):
+  """Run the instrumented translator in a child process and return its
+  per-phase timings"""
+
+  result = os.path.join(path, 'phases.json')
+  cmd = [sys.executable, os.path.abspath(__file__), '--phases='+translator,
+         '--phase-output='+result]
+  if targets is not None:
+    cmd += ['--targets='+targets]
+  env = dict(os.environ, OP2_TRANSLATOR_CACHE='0')
+  proc = subprocess.run(cmd + files, cwd=path, env=env,
+                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+  if proc.returncode != 0 or not os.path.isfile(result):
+    print(proc.stderr.decode(), file=sys.stderr)
+    print('ERROR: instrumented ' + translator + ' translator failed in ' + path, file=sys.stderr)
+    sys.exit(1)
+  with open(result, 'r') as f:
+    return json.load(f)
+
+def summary(runs):
+  runs = sorted(runs)
+  return {'min': runs[0],
+          'median': runs[len(runs)//2],
+          'max': runs[-1],
+          'runs': runs}
+
+def benchmark(translator, params, work_dir, repeat, targets, jobs):
+  end_to_end = []
+  phases = {}
+  for r in range(0, repeat):
+    for mode in ['end_to_end', 'phases']:
+      path = os.path.join(work_dir, '%s_%s_%d' % (translator, mode, r))
+      if os.path.isdir(path):
+        shutil.rmtree(path)
+      os.makedirs(path)
+      files = app_writers[translator](path, params)
+      if mode == 'end_to_end':
+        end_to_end.append(run_translator(translator, path, files, targets, jobs))
+      else:
+        for phase, seconds in run_phases(translator, path, files, targets).items():
+          phases.setdefault(phase, []).append(seconds)
+  return {'end_to_end': summary(end_to_end),
+          'phases': dict((phase, summary(phases[phase])) for phase in sorted(phases))}
+
+def compare(report, baseline, tolerance):
+  """Return a description of every timing in 'report' that is slower than
+  the same timing in 'baseline' by more than 'tolerance' (a fraction);
+  differences of less than 10ms are ignored as noise"""
+
+  regressions = []
+  ignore = ['repeat']
+  if dict((k, v) for k, v in report['parameters'].items() if not k in ignore) != \
+     dict((k, v) for k, v in baseline.get('parameters', {}).items() if not k in ignore):
+    print('WARNING: the baseline was measured with different parameters: ' +
+          str(baseline.get('parameters')), file=sys.stderr)
+  for translator in report['results']:
+    old = baseline.get('results', {}).get(translator)
+    if old is None:
+      continue
+    new = report['results'][translator]
+    pairs = [('end_to_end', new['end_to_end'], old['end_to_end'])]
+    pairs += [(phase, new['phases'][phase], old['phases'][phase])
+              for phase in new['phases'] if phase in old['phases']]
+    for name, n, o in pairs:
+      if n['min'] > o['min']*(1.0 + tolerance) and n['min'] - o['min'] > 0.01:
+        regressions.append('%s %s: %.3fs -> %.3fs' % (translator, name, o['min'], n['min']))
+  return regressions
+
+def main(argv):
+  optlist, args = getopt.getopt(argv, 'hj:',
+                                [k+'=' for k in default_params] +
+                                ['help', 'translators=', 'targets=', 'repeat=', 'output=',
+                                 'compare=', 'tolerance=', 'keep=',
+                                 'phases=', 'phase-output='])
+  params = dict(default_params)
+  translators = ['c', 'fortran']
+  targets = None
+  jobs = None
+  repeat = 3
+  output = None
+  baseline = None
+  tolerance = 0.25
+  keep = None
+  phases = None
+  phase_output = None
+  for opt, val in optlist:
+    opt = opt.lstrip('-')
+    if opt in ('h', 'help'):
+      print(__doc__)
+      return 0
+    elif opt in params:
+      params[opt] = int(val)
+    elif opt == 'j':
+      jobs = int(val)
+    elif opt == 'translators':
+      translators = [t.strip() for t in val.split(',') if t.strip() != '']
+    elif opt == 'targets':
+      targets = val
+    elif opt == 'repeat':
+      repeat = int(val)
+    elif opt == 'output':
+      output = val
+    elif opt == 'compare':
+      baseline = val
+    elif opt == 'tolerance':
+      tolerance = float(val)
+    elif opt == 'keep':
+      keep = val
+    elif opt == 'phases':
+      phases = val
+    elif opt == 'phase-output':
+      phase_output = val
+
+  # internal: instrumented run in a child process
+  if phases is not None:
+    timings = phase_runners[phases](args, targets)
+    with open(phase_output, 'w') as f:
+      json.dump(timings, f)
+    return 0
+
+  for t in translators:
+    if not t in app_writers:
+      print('Unknown translator \''+t+'\', valid translators are: c, fortran')
+      return 1
+  if params['args'] < 2 or params['vec'] >= params['args'] or \
+     min(params['kernels'], params['maps'], params['map-dim'], params['macros']) < 1:
+    print('Invalid application size: ' + str(params))
+    return 1
+
+  work_dir = keep if keep is not None else tempfile.mkdtemp(prefix='op2_bench_')
+  try:
+    results = {}
+    for t in translators:
+      results[t] = benchmark(t, params, work_dir, repeat, targets, jobs)
+  finally:
+    if keep is None:
+      shutil.rmtree(work_dir)
+
+  report = {'date': datetime.datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'parameters': dict(params, targets=targets or 'all', jobs=jobs, repeat=repeat),
+            'results': results}
+  text = json.dumps(report, indent=2, sort_keys=True)
+  if output is None:
+    print(text)
+  else:
+    with open(output, 'w') as f:
+      f.write(text + '\n')
+
+  if baseline is not None:
+    with open(baseline, 'r') as f:
+      regressions = compare(report, json.load(f), tolerance)
+    for r in regressions:
+      print('REGRESSION: ' + r, file=sys.stderr)
+    if regressions:
+      return 2
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -9,7 +9,7 @@ target-specific code to execute the user's kernel functions.
 This prototype is written in Python and is directly based on the
 parsing and code generation of the matlab source code transformation code
 
-usage: ./op2.py 'file1','file2', ..., [kernel_dir]
+usage: ./op2.py [-j jobs] [--targets=target1,target2,...] 'file1','file2', ..., [kernel_dir]
 
 This takes as input
 
@@ -32,96 +32,172 @@ file1_kernels.cu   -- for CUDA execution
 
 If user kernel files are located in a sub-directory (e.g. 'kernel_dir'), then
 this directory can be provided as argument as well.
+
+The target-specific code generators run concurrently in up to 'jobs'
+worker processes (default: the value of OP2_TRANSLATOR_JOBS, or else
+the number of CPUs).
+
+Only the code generators for the selected targets are run: 'seq', 'vec',
+'openmp', 'openacc', 'cuda', 'cuda_hyb' and 'openmp4', or 'all' (the
+default). Targets are given with --targets or the OP2_TARGETS
+environment variable; 'cuda_hyb' implies 'cuda' and 'openmp'.
 """
 
 import sys
 import re
 import datetime
 import os
-
-# Import MPI+SEQ and MPI+autovectorised SEQ
-from op2_gen_seq import op2_gen_seq
-from op2_gen_mpi_vec import op2_gen_mpi_vec
-
-# import OpenMP and CUDA code generation functions
-from op2_gen_openmp_simple import op2_gen_openmp_simple
-from op2_gen_openmp import op2_gen_openmp
-
-from op2_gen_openacc import op2_gen_openacc
-
-from op2_gen_cuda import op2_gen_cuda
-from op2_gen_cuda_simple import op2_gen_cuda_simple
-from op2_gen_cuda_simple_hyb import op2_gen_cuda_simple_hyb
-from op2_gen_openmp4 import op2_gen_openmp4
+import copy
+import concurrent.futures
+
+import importlib
+
+# Target-specific code generators, by target name. Each module provides
+# a generator function of the same name, and is only imported if its
+# target is selected.
+code_generators = {
+  'seq':      'op2_gen_seq',             # MPI+GENSEQ version - initial version, no vectorisation
+  'vec':      'op2_gen_mpi_vec',         # MPI+GENSEQ with code that gets auto vectorised with intel compiler (version 15.0 and above)
+  'openmp':   'op2_gen_openmp_simple',   # Simplified and Optimized OpenMP code generator
+  'openacc':  'op2_gen_openacc',
+  'cuda':     'op2_gen_cuda_simple',     # Optimized for Kepler GPUs
+  'cuda_hyb': 'op2_gen_cuda_simple_hyb', # CPU and GPU will then do comutations as a hybrid application
+  'openmp4':  'op2_gen_openmp4'}         # GPUs with OpenMP4.5
+default_targets = ['seq', 'vec', 'openmp', 'openacc', 'cuda', 'cuda_hyb', 'openmp4']
+
+# the hybrid kernels include the CUDA and OpenMP master kernel files
+target_dependencies = {'cuda_hyb': ['cuda', 'openmp']}
 
 from op2_gen_common import *
+import op2_gen_common
+import op2_cache
+
+# Single pass lexer for the OP2 C/C++ API: comments, string and character
+# literals, identifiers and the punctuation that delimits calls
+op_lex_pattern = re.compile(r'''
+    (?P<comment>//[^\n]*|/\*.*?\*/)
+  | (?P<string>"(?:\\.|[^\\"])*"|'(?:\\.|[^\\'])*')
+  | (?P<number>\.?[0-9][\w.]*)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<punct>[(),;])
+''', re.DOTALL | re.VERBOSE)
+
+def op_lex(text):
+  """Scan 'text' once, returning a copy of it with comments blanked out
+  (so that offsets into it are offsets into 'text') and the list of calls
+  to op_* functions that it makes, in source order.
+
+  Each call is a dict holding the function 'name', the offset 'loc' of the
+  name, the comment-free text of each top-level argument in 'args', the
+  op_* calls nested in its arguments in 'calls', and the offset 'end' of
+  the terminating ';' (or of the closing parenthesis if there is none)."""
+
+  clean = []
+  clean_from = 0
+  calls = []
+  frames = []      # for each open parenthesis, the call it opens (or None)
+  pending = None   # op_* name waiting for its opening parenthesis
+  finished = None  # top-level call waiting for its terminating ';'
+
+  for m in op_lex_pattern.finditer(text):
+    kind = m.lastgroup
+    if kind == 'comment':
+      clean.append(text[clean_from:m.start()])
+      clean.append(re.sub(r'[^\n]', ' ', m.group()))
+      clean_from = m.end()
+      continue
+
+    if finished is not None:
+      if m.group() == ';':
+        finished['end'] = m.start()
+      finished = None
+
+    if kind == 'name':
+      if m.group().startswith('op_'):
+        pending = {'name': m.group(), 'loc': m.start(), 'args': [],
+                   'calls': [], 'end': -1}
+        continue
+    elif m.group() == '(':
+      if pending is not None:
+        pending['arg_start'] = m.end()
+      frames.append(pending)
+    elif frames and m.group() in (',', ')'):
+      call = frames[-1]
+      if call is not None:
+        call['args'].append((call['arg_start'], m.start()))
+        call['arg_start'] = m.end()
+      if m.group() == ')':
+        frames.pop()
+        if call is not None:
+          call['end'] = m.start()
+          del call['arg_start']
+          parents = [f for f in frames if f is not None]
+          if parents:
+            parents[-1]['calls'].append(call)
+          else:
+            calls.append(call)
+            finished = call
+    pending = None
 
-# from http://stackoverflow.com/a/241506/396967
-def comment_remover(text):
-  """Remove comments from text"""
+  clean.append(text[clean_from:])
+  clean = ''.join(clean)
 
-  def replacer(match):
-    s = match.group(0)
-    if s.startswith('/'):
-      return ""
-    else:
-      return s
-  pattern = re.compile(
-    r'//.*?$|/\*.*?\*/|\'(?:\\.|[^\\\'])*\'|"(?:\\.|[^\\"])*"',
-    re.DOTALL | re.MULTILINE
-  )
-  return re.sub(pattern, replacer, text)
+  def resolve_args(call):
+    call['args'] = [clean[start:end] for (start, end) in call['args']]
+    if call['args'] == ['']:
+      call['args'] = []
+    for c in call['calls']:
+      resolve_args(c)
+  for call in calls:
+    resolve_args(call)
 
+  return clean, calls
 
-def op_parse_calls(text):
-  """Parsing for op_init/op_exit/op_partition/op_hdf5 calls"""
 
-  # remove comments just for this call
-  text = comment_remover(text)
+def op_parse_calls(calls):
+  """Parsing for op_init/op_exit/op_partition/op_hdf5 calls"""
 
-  inits = len(re.findall('op_init', text))
-  exits = len(re.findall('op_exit', text))
-  parts = len(re.findall('op_partition', text))
-  hdf5s = len(re.findall('hdf5', text))
+  inits = len([c for c in calls if 'op_init' in c['name']])
+  exits = len([c for c in calls if 'op_exit' in c['name']])
+  parts = len([c for c in calls if 'op_partition' in c['name']])
+  hdf5s = len([c for c in calls if 'hdf5' in c['name']])
 
   return (inits, exits, parts, hdf5s)
 
-def op_decl_set_parse(text):
+def op_decl_set_parse(calls):
   """Parsing for op_decl_set calls"""
 
   sets = []
-  for m in re.finditer('op_decl_set\((.*)\)', text):
-    args = m.group(1).split(',')
-
-    # check for syntax errors
-    if len(args) != 2:
-      print('Error in op_decl_set : must have three arguments')
-      return
-
-    sets.append({
-      'name': args[1].strip()
-      })
-  for m in re.finditer('op_decl_set_hdf5\((.*)\)', text):
-    args = m.group(1).split(',')
+  for c in calls:
+    if c['name'] != 'op_decl_set' and c['name'] != 'op_decl_set_hdf5':
+      continue
+    args = c['args']
 
     # check for syntax errors
     if len(args) != 2:
-      print('Error in op_decl_set : must have three arguments')
+      print('Error in ' + c['name'] + ' : must have two arguments')
       return
 
-    sets.append({
-      'name': args[1].strip()[1:-1]
-      })
+    if c['name'] == 'op_decl_set':
+      sets.append({
+        'name': args[1].strip()
+        })
+    else:
+      sets.append({
+        'name': args[1].strip()[1:-1]
+        })
 
   return sets
 
 
-def op_decl_const_parse(text):
+def op_decl_const_parse(calls):
   """Parsing for op_decl_const calls"""
 
   consts = []
-  for m in re.finditer('op_decl_const\((.*)\)', text):
-    args = m.group(1).split(',')
+  for c in calls:
+    if c['name'] != 'op_decl_const':
+      continue
+    args = c['args']
 
     # check for syntax errors
     if len(args) != 3:
@@ -129,7 +205,8 @@ def op_decl_const_parse(text):
       return
 
     consts.append({
-      'loc': m.start(),
+      'loc': c['loc'],
+      'end': c['end'],
       'dim': args[0].strip(),
       'type': args[1].strip(),
       'name': args[2].strip(),
@@ -149,94 +226,67 @@ def extract_declared_globals(text):
   return globals_found
 
 
-def arg_parse(text, j):
-  """Parsing arguments in op_par_loop to find the correct closing brace"""
-
-  depth = 0
-  loc2 = j
-  while 1:
-    if text[loc2] == '(':
-      depth = depth + 1
-
-    elif text[loc2] == ')':
-      depth = depth - 1
-      if depth == 0:
-        return loc2
-    loc2 = loc2 + 1
-
-
-def get_arg_dat(arg_string, j):
-  loc = arg_parse(arg_string, j + 1)
-  dat_args_string = arg_string[arg_string.find('(', j) + 1:loc]
-
-  # remove comments
-  dat_args_string = comment_remover(dat_args_string)
+def get_arg_dat(call):
+  dat_args = call['args']
 
   # check for syntax errors
-  if len(dat_args_string.split(',')) != 6:
+  if len(dat_args) != 6:
     print('Error parsing op_arg_dat(%s): must have six arguments' \
-        % dat_args_string)
+        % ','.join(dat_args))
     return
 
-  # split the dat_args_string into  6 and create a struct with the elements
+  # split the dat_args into  6 and create a struct with the elements
   # and type as op_arg_dat
   temp_dat = {'type': 'op_arg_dat',
-        'dat': dat_args_string.split(',')[0].strip(),
-        'idx': dat_args_string.split(',')[1].strip(),
-        'map': dat_args_string.split(',')[2].strip(),
-        'dim': dat_args_string.split(',')[3].strip(),
-        'typ': dat_args_string.split(',')[4].strip(),
-        'acc': dat_args_string.split(',')[5].strip(),
+        'dat': dat_args[0].strip(),
+        'idx': dat_args[1].strip(),
+        'map': dat_args[2].strip(),
+        'dim': dat_args[3].strip(),
+        'typ': dat_args[4].strip(),
+        'acc': dat_args[5].strip(),
         'opt':''}
 
   return temp_dat
 
-def get_opt_arg_dat(arg_string, j):
-  loc = arg_parse(arg_string, j + 1)
-  dat_args_string = arg_string[arg_string.find('(', j) + 1:loc]
+def get_opt_arg_dat(call):
+  dat_args = call['args']
 
-  # remove comments
-  dat_args_string = comment_remover(dat_args_string)
   # check for syntax errors
-  if len(dat_args_string.split(',')) != 7:
+  if len(dat_args) != 7:
     print('Error parsing op_opt_arg_dat(%s): must have 7 arguments' \
-        % dat_args_string)
+        % ','.join(dat_args))
     return
 
-  # split the dat_args_string into  6 and create a struct with the elements
-  # and type as op_arg_dat
+  # split the dat_args into  7 and create a struct with the elements
+  # and type as op_opt_arg_dat
   temp_dat = {'type': 'op_opt_arg_dat',
-        'opt': dat_args_string.split(',')[0].strip(),
-        'dat': dat_args_string.split(',')[1].strip(),
-        'idx': dat_args_string.split(',')[2].strip(),
-        'map': dat_args_string.split(',')[3].strip(),
-        'dim': dat_args_string.split(',')[4].strip(),
-        'typ': dat_args_string.split(',')[5].strip(),
-        'acc': dat_args_string.split(',')[6].strip()}
+        'opt': dat_args[0].strip(),
+        'dat': dat_args[1].strip(),
+        'idx': dat_args[2].strip(),
+        'map': dat_args[3].strip(),
+        'dim': dat_args[4].strip(),
+        'typ': dat_args[5].strip(),
+        'acc': dat_args[6].strip()}
 
   return temp_dat
 
 
-def get_arg_gbl(arg_string, k):
-  loc = arg_parse(arg_string, k + 1)
-  gbl_args_string = arg_string[arg_string.find('(', k) + 1:loc]
-
-  # remove comments
-  gbl_args_string = comment_remover(gbl_args_string)
+def get_arg_gbl(call):
+  gbl_args = call['args']
 
   # check for syntax errors
-  if len(gbl_args_string.split(',')) != 4:
+  if len(gbl_args) != 4:
     print('Error parsing op_arg_gbl(%s): must have four arguments' \
-        % gbl_args_string)
+        % ','.join(gbl_args))
     return
 
-  # split the gbl_args_string into  4 and create a struct with the elements
+  # split the gbl_args into  4 and create a struct with the elements
   # and type as op_arg_gbl
   temp_gbl = {'type': 'op_arg_gbl',
-        'data': gbl_args_string.split(',')[0].strip(),
-        'dim': gbl_args_string.split(',')[1].strip(),
-        'typ': gbl_args_string.split(',')[2].strip(),
-        'acc': gbl_args_string.split(',')[3].strip(),
+        'data': gbl_args[0].strip(),
+        'dim': gbl_args[1].strip(),
+        'typ': gbl_args[2].strip(),
+        'acc': gbl_args[3].strip(),
         'opt':''}
 
   return temp_gbl
@@ -246,75 +296,239 @@ def append_init_soa(text):
   text = re.sub('\\bop_mpi_init\\b\\s*\((.*)\)','op_mpi_init_soa(\\1,1)', text)
   return text
 
-def op_par_loop_parse(text):
+def op_par_loop_parse(calls):
   """Parsing for op_par_loop calls"""
 
   loop_args = []
 
-  search = "op_par_loop"
-  i = text.find(search)
-  while i > -1:
-    arg_string = text[text.find('(', i) + 1:text.find(';', i + 11)]
+  for c in calls:
+    if c['name'] != 'op_par_loop':
+      continue
 
     # parse arguments in par loop
     temp_args = []
     num_args = 0
 
-    # parse each op_arg_dat
-    search2 = "op_arg_dat"
-    search3 = "op_arg_gbl"
-    search4 = "op_opt_arg_dat"
-    j = arg_string.find(search2)
-    k = arg_string.find(search3)
-    l = arg_string.find(search4)
-
-    while j > -1 or k > -1 or l > -1:
-      index = min(j if (j > -1) else sys.maxsize,k if (k > -1) else sys.maxsize,l if (l > -1) else sys.maxsize )
-      if index == j:
-        temp_dat = get_arg_dat(arg_string, j)
-        # append this struct to a temporary list/array
-        temp_args.append(temp_dat)
+    # parse each op_arg_dat, op_opt_arg_dat and op_arg_gbl
+    for arg_call in c['calls']:
+      if arg_call['name'] == 'op_arg_dat':
+        temp_args.append(get_arg_dat(arg_call))
         num_args = num_args + 1
-        j = arg_string.find(search2, j + 11)
-
-      elif index == k:
-        temp_gbl = get_arg_gbl(arg_string, k)
-        # append this struct to a temporary list/array
-        temp_args.append(temp_gbl)
+      elif arg_call['name'] == 'op_arg_gbl':
+        temp_args.append(get_arg_gbl(arg_call))
         num_args = num_args + 1
-        k = arg_string.find(search3, k + 11)
-
-      elif index == l:
-        temp_dat = get_opt_arg_dat(arg_string, l)
-        # append this struct to a temporary list/array
-        temp_args.append(temp_dat)
+      elif arg_call['name'] == 'op_opt_arg_dat':
+        temp_args.append(get_opt_arg_dat(arg_call))
         num_args = num_args + 1
-        l = arg_string.find(search4, l + 15)
 
-    temp = {'loc': i,
-        'name1': arg_string.split(',')[0].strip(),
-        'name2': arg_string.split(',')[1].strip(),
-        'set': arg_string.split(',')[2].strip(),
+    temp = {'loc': c['loc'],
+        'end': c['end'],
+        'name1': c['args'][0].strip(),
+        'name2': c['args'][1].strip(),
+        'set': c['args'][2].strip(),
         'args': temp_args,
         'nargs': num_args}
 
     loop_args.append(temp)
-    i = text.find(search, i + 10)
   print('\n\n')
   return (loop_args)
 
-def op_check_kernel_in_text(text, name):
-  match = False
-  inline_impl_pattern = r'inline[ \n]+void[ \n]+'+name+'\s*\('
-  matches = re.findall(inline_impl_pattern, text)
-  decl_pattern = r'([$\n]+)(void[ \n]+'+name+'\([ \n]*'+'[ \nA-Za-z0-9\*\_\.,#]+\);)'
-  if len(re.findall(inline_impl_pattern, text)) == 1:
-    match = True
-  elif len(re.findall(decl_pattern, text)) == 1:
-    match = True
-  return match
-
-def main(srcFilesAndDirs=sys.argv[1:]):
+# targets whose code generators can generate fused loops
+fusion_targets = ['seq', 'openmp']
+
+def op_fuse_check(loops, loop, macro_defs):
+  """Return the reason the op_par_loop 'loop' cannot be fused with the
+  adjacent 'loops' before it, or None if it can"""
+
+  if loop['set'] != loops[0]['set']:
+    return 'different sets'
+
+  def indirect(arg):
+    return arg['type'] != 'op_arg_gbl' and arg['map'] != 'OP_ID'
+  def writes_indirect(l):
+    return any(indirect(a) and a['acc'] != 'OP_READ' for a in l['args'])
+  def reduces(l):
+    return any(a['type'] == 'op_arg_gbl' and a['acc'] != 'OP_READ' for a in l['args'])
+  def has_gbl(l):
+    return any(a['type'] == 'op_arg_gbl' for a in l['args'])
+
+  for l in loops + [loop]:
+    for arg in l['args']:
+      if arg['type'] == 'op_opt_arg_dat':
+        return 'optional argument in ' + l['name1']
+      if indirect(arg):
+        idx = evaluate_macro_defs_in_string(macro_defs, arg['idx'])
+        if not idx.isdigit():
+          return 'vector argument in ' + l['name1']
+
+  # a reduction is only complete at the end of its loop
+  if (any(reduces(l) for l in loops) and has_gbl(loop)) or \
+     (reduces(loop) and any(has_gbl(l) for l in loops)):
+    return 'global reduction'
+
+  # element n of 'loop' may read or write data that another element of
+  # 'loops' writes or reads through a map, unless both only increment it
+  for l in loops:
+    for a in l['args']:
+      for b in loop['args']:
+        if a['type'] == 'op_arg_gbl' or b['type'] == 'op_arg_gbl' or \
+           a['dat'] != b['dat'] or not (indirect(a) or indirect(b)):
+          continue
+        if a['acc'] == 'OP_READ' and b['acc'] == 'OP_READ':
+          continue
+        if a['acc'] == 'OP_INC' and b['acc'] == 'OP_INC' and indirect(a) and indirect(b):
+          continue
+        return 'dependency through ' + a['dat']
+
+  # the loops must execute the same elements, including executed halo
+  if any(writes_indirect(l) for l in loops) != writes_indirect(loop):
+    return 'different halo requirements'
+  return None
+
+def op_fuse(loops):
+  """Fuse 'loops' into a single op_par_loop over the union of their
+  arguments, each argument passed once, calling their kernels in turn"""
+
+  def key(arg):
+    if arg['type'] == 'op_arg_gbl':
+      return (arg['data'], arg['dim'], arg['typ'])
+    return (arg['dat'], arg['idx'], arg['map'], arg['dim'], arg['typ'])
+
+  name = '_'.join([l['name1'] for l in loops])
+  args = []
+  fused = []
+  for l in loops:
+    fused_args = []
+    for arg in l['args']:
+      keys = [key(a) for a in args]
+      if key(arg) in keys:
+        m = keys.index(key(arg))
+        if args[m]['acc'] != arg['acc']:
+          args[m]['acc'] = 'OP_RW'  # the same element, read and written
+      else:
+        m = len(args)
+        args.append(dict(arg))
+      fused_args.append(m)
+    fused.append({'name': l['name1'], 'args': fused_args})
+
+  return {'loc': loops[0]['loc'],
+      'end': loops[-1]['end'],
+      'name1': name,
+      'name2': '"' + name + '"',
+      'set': loops[0]['set'],
+      'args': args,
+      'nargs': len(args),
+      'fused': fused}
+
+def op_fuse_loops(text, loop_args, macro_defs):
+  """Fuse each run of op_par_loops in 'text' that follow each other with
+  nothing but white space and comments between them, and that can be
+  fused (see op_fuse_check)"""
+
+  runs = []
+  for loop in loop_args:
+    if runs:
+      between = text[runs[-1][-1]['end']+1:loop['loc']]
+      if comment_remover(between).strip() == '':
+        reason = op_fuse_check(runs[-1], loop, macro_defs)
+        if reason is None:
+          runs[-1].append(loop)
+          continue
+        print('not fusing ' + loop['name1'] + ' with ' + runs[-1][-1]['name1'] + ': ' + reason)
+    runs.append([loop])
+
+  fused_loops = []
+  for run in runs:
+    if len(run) > 1:
+      print('fusing loops ' + ', '.join([l['name1'] for l in run]))
+      fused_loops.append(op_fuse(run))
+    else:
+      fused_loops.append(run[0])
+  return fused_loops
+
+# an inline implementation or a declaration of a kernel
+inline_impl_pattern = re.compile(r'inline[ \n]+void[ \n]+(\w+)\s*\(')
+decl_pattern = re.compile(r'[$\n]+void[ \n]+(\w+)\([ \n]*[ \nA-Za-z0-9\*\_\.,#]+\);')
+
+def op_find_kernels_in_text(text):
+  """Return the names of the kernels that 'text' implements inline, or
+  declares, exactly once"""
+
+  inline_impls = {}
+  for name in inline_impl_pattern.findall(text):
+    inline_impls[name] = inline_impls.get(name, 0) + 1
+  decls = {}
+  for name in decl_pattern.findall(text):
+    decls[name] = decls.get(name, 0) + 1
+
+  return set([name for name in inline_impls if inline_impls[name] == 1] +
+             [name for name in decls if decls[name] == 1])
+
+def op_index_kernel_decls(filepaths, decl_index):
+  """Add each of 'filepaths' not yet in 'decl_index' to it, mapped to the
+  kernels found in it, so that every candidate file is scanned once"""
+
+  for filepath in filepaths:
+    if not filepath in decl_index:
+      decl_index[filepath] = op_find_kernels_in_text(read_text_file(filepath))
+
+def parse_targets(targets):
+  """Parse a comma separated list of code generation targets, adding
+  any targets that the selected ones depend on"""
+
+  selected = []
+  for target in targets.split(','):
+    target = target.strip()
+    if target == '':
+      continue
+    if target == 'all':
+      selected += default_targets
+    elif target in code_generators:
+      selected += [target] + target_dependencies.get(target, [])
+    else:
+      print('Unknown code generation target \'' + target + '\', valid targets are: ' + \
+            ', '.join(default_targets))
+      sys.exit(1)
+  return [t for t in default_targets if t in selected]
+
+def load_code_generator(target):
+  module = importlib.import_module(code_generators[target])
+  return getattr(module, code_generators[target])
+
+def run_code_generator(generator, args):
+  """Run one backend code generator, returning the files it wrote"""
+
+  del op2_gen_common.generated_files[:]
+  generator(*args)
+  return list(op2_gen_common.generated_files)
+
+def run_code_generators(generators, jobs):
+  """Run the (generator, args) pairs in 'generators' using up to 'jobs'
+  worker processes, returning the files they wrote.
+
+  Generators build their output in local CodeEmitter buffers and so are
+  re-entrant; separate processes are still used because generation is
+  CPU bound. Each process gets its own copy of the descriptors, which
+  generators may modify."""
+
+  if jobs is None:
+    jobs = int(os.getenv('OP2_TRANSLATOR_JOBS', os.cpu_count() or 1))
+  jobs = max(1, min(jobs, len(generators)))
+
+  generated_files = []
+  if jobs == 1:
+    for generator, args in generators:
+      generated_files += run_code_generator(generator, copy.deepcopy(args))
+    return generated_files
+
+  with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+    futures = [pool.submit(run_code_generator, generator, args)
+               for generator, args in generators]
+    for future in futures:
+      generated_files += future.result()
+  return generated_files
+
+def main(srcFilesAndDirs=sys.argv[1:], jobs=None, targets=None):
 
   # declare constants
 
@@ -343,17 +557,32 @@ def main(srcFilesAndDirs=sys.argv[1:]):
 
   auto_soa=os.getenv('OP_AUTO_SOA','0')
 
+  if targets is None:
+    targets = os.getenv('OP2_TARGETS', 'all')
+  targets = parse_targets(targets)
+
+  fuse_loops = os.getenv('OP_FUSE_LOOPS', '0') != '0'
+  unfusable = [t for t in targets if not t in fusion_targets]
+  if fuse_loops and unfusable:
+    print('Loop fusion (OP_FUSE_LOOPS) is only supported by the ' + \
+          ' and '.join(fusion_targets) + ' targets, not by: ' + ', '.join(unfusable) + \
+          '. Select targets with --targets or OP2_TARGETS.')
+    sys.exit(1)
+
   OP_accs_labels = ['OP_READ', 'OP_WRITE', 'OP_RW', 'OP_INC',
             'OP_MAX', 'OP_MIN']
 
   src_files = [s for s in srcFilesAndDirs if os.path.isfile(s)]
   src_dirs  = [d for d in srcFilesAndDirs if os.path.isdir(d)]
+  missing = [s for s in srcFilesAndDirs if not s in src_files + src_dirs]
+  if missing:
+    print('No such file or directory: ' + ', '.join(missing))
+    sys.exit(1)
 
   ## Extract macro definitions:
   for src_file in src_files:
     print(("Parsing file '" + src_file + "' for macro definitions."))
-    with open(src_file, 'r') as f:
-      text = f.read()
+    text = read_text_file(src_file)
 
     local_defs = op_parse_macro_defs(text)
     for k in list(local_defs.keys()):
@@ -365,11 +594,16 @@ def main(srcFilesAndDirs=sys.argv[1:]):
         macro_defs[k] = local_defs[k]
   self_evaluate_macro_defs(macro_defs)
 
+  ## Load results of the previous translation, if any:
+  cache_file = op2_cache.cache_path()
+  translator_version = op2_cache.translator_version()
+  cache = op2_cache.load_cache(cache_file, translator_version, srcFilesAndDirs)
+  new_cache = op2_cache.empty_cache()
+
   ## Identify global variables already declared as 'extern':
   declared_globals = []
   for src_file in src_files:
-    with open(src_file, 'r') as f:
-      text = f.read()
+    text = read_text_file(src_file)
     declared_globals += extract_declared_globals(text)
 
   ## Loop over all input source files to search for op_par_loop calls
@@ -379,20 +613,45 @@ def main(srcFilesAndDirs=sys.argv[1:]):
     src_file_num = src_file_num + 1
     print(("Processing file " + str(src_file_num+1) + " of " + str(len(src_files)) + \
           ": " + src_file))
-    with open(src_file, 'r') as f:
-      text = f.read()
+    text = read_text_file(src_file)
 
     any_soa = 0
 
+    # reuse the parse results of an unchanged file from the cache
+    file_key = op2_cache.digest(text, macro_defs, auto_soa)
+    cached = op2_cache.cached_file_entry(cache, src_file, file_key)
+
     # check for op_init/op_exit/op_partition/op_hdf5 calls
-    inits, exits, parts, hdf5s = op_parse_calls(text)
+    if cached:
+      print('using cached parse of ' + src_file)
+      inits, exits, parts, hdf5s = cached['calls']
+    else:
+      clean_text, calls = op_lex(text)
+      inits, exits, parts, hdf5s = op_parse_calls(calls)
+
+    if inits > 0 and auto_soa!='0':
+      text = append_init_soa(text)
+      if not cached:
+        clean_text, calls = op_lex(text)
+
+    if cached:
+      const_args = cached['consts']
+      set_list = cached['sets']
+      loop_args = cached['loops']
+    else:
+      const_args = op_decl_const_parse(calls)
+      set_list = op_decl_set_parse(calls)
+      loop_args = op_par_loop_parse(calls)
+    op2_cache.store_file_entry(new_cache, src_file, file_key,
+                               [inits, exits, parts, hdf5s],
+                               const_args, set_list, loop_args)
+    if fuse_loops:
+      loop_args = op_fuse_loops(text, loop_args, macro_defs)
 
     if inits + exits + parts + hdf5s > 0:
       print(' ')
     if inits > 0:
       print('contains op_init call')
-      if auto_soa!='0':
-        text = append_init_soa(text)
     if exits > 0:
       print('contains op_exit call')
     if parts > 0:
@@ -405,10 +664,8 @@ def main(srcFilesAndDirs=sys.argv[1:]):
     npart = npart + parts
     nhdf5 = nhdf5 + hdf5s
 
-    # parse and process constants
+    # process constants
 
-    const_args = op_decl_const_parse(text)
-    set_list = op_decl_set_parse(text)
     for i in range(0, len(set_list)):
       sets.append(set_list[i])
 
@@ -448,12 +705,12 @@ def main(srcFilesAndDirs=sys.argv[1:]):
         temp["user_declared"] = temp["name"] in declared_globals
         consts.append(temp)
 
-    # parse and process op_par_loop calls
+    # process op_par_loop calls
 
-    loop_args = op_par_loop_parse(text)
     for i in range(0, len(loop_args)):
       name = loop_args[i]['name1']
       nargs = loop_args[i]['nargs']
+      fused = loop_args[i].get('fused')
       print('\nprocessing kernel ' + name + ' with ' + str(nargs) + ' arguments', end=' ')
 
       # process arguments
@@ -663,26 +920,28 @@ def main(srcFilesAndDirs=sys.argv[1:]):
 
       if not repeat:
         nkernels = nkernels + 1
-        temp = {'name': name,
-            'nargs': nargs,
-            'dims': dims,
-            'maps': maps,
-            'var': var,
-            'typs': typs,
-            'accs': accs,
-            'idxs': idxs,
-            'inds': inds,
-            'soaflags': soaflags,
-            'optflags': optflags,
-
-            'ninds': ninds,
-            'inddims': inddims,
-            'indaccs': indaccs,
-            'indtyps': indtyps,
-            'invinds': invinds,
-            'mapnames' : mapnames,
-            'mapinds': mapinds,
-            'invmapinds' : invmapinds}
+        temp = Kernel(name=name,
+            nargs=nargs,
+            dims=dims,
+            maps=maps,
+            var=var,
+            typs=typs,
+            accs=accs,
+            idxs=idxs,
+            inds=inds,
+            soaflags=soaflags,
+            optflags=optflags,
+
+            ninds=ninds,
+            inddims=inddims,
+            indaccs=indaccs,
+            indtyps=indtyps,
+            invinds=invinds,
+            mapnames=mapnames,
+            mapinds=mapinds,
+            invmapinds=invmapinds)
+        if fused is not None:
+          temp['fused'] = fused
         kernels.append(temp)
         (kernels_in_files[src_file_num]).append(nkernels - 1)
       else:
@@ -721,11 +980,11 @@ def main(srcFilesAndDirs=sys.argv[1:]):
 
     if op_src_dirpath != "" and not os.path.exists(op_src_dirpath):
       os.makedirs(op_src_dirpath)
-    fid = open(op_src_filepath, 'w')
+    op_text = []
     date = datetime.datetime.now()
     #fid.write('//\n// auto-generated by op2.py on ' +
     #          date.strftime("%Y-%m-%d %H:%M") + '\n//\n\n')
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
+    op_text.append('//\n// auto-generated by op2.py\n//\n\n')
 
     loc_old = 0
 
@@ -753,7 +1012,7 @@ def main(srcFilesAndDirs=sys.argv[1:]):
     # process header, loops and constants
     for loc in range(0, len(locs)):
       if locs[loc] != -1:
-        fid.write(text[loc_old:locs[loc] - 1])
+        op_text.append(text[loc_old:locs[loc] - 1])
         loc_old = locs[loc] - 1
 
       indent = ''
@@ -765,9 +1024,9 @@ def main(srcFilesAndDirs=sys.argv[1:]):
         ind = ind + 1
 
       if (locs[loc] in loc_header) and (locs[loc] != -1):
-        fid.write(' "op_lib_cpp.h"\n\n')
-        fid.write('//\n// op_par_loop declarations\n//\n')
-        fid.write('#ifdef OPENACC\n#ifdef __cplusplus\nextern "C" {\n#endif\n#endif\n')
+        op_text.append(' "op_lib_cpp.h"\n\n')
+        op_text.append('//\n// op_par_loop declarations\n//\n')
+        op_text.append('#ifdef OPENACC\n#ifdef __cplusplus\nextern "C" {\n#endif\n#endif\n')
         for k_iter in range(0, len(kernels_in_files[src_file_num])):
           k = kernels_in_files[src_file_num][k_iter]
           line = '\nvoid op_par_loop_' + \
@@ -775,17 +1034,17 @@ def main(srcFilesAndDirs=sys.argv[1:]):
           for n in range(1, kernels[k]['nargs']):
             line = line + '  op_arg,\n'
           line = line + '  op_arg );\n'
-          fid.write(line)
+          op_text.append(line)
 
-        fid.write('#ifdef OPENACC\n#ifdef __cplusplus\n}\n#endif\n#endif\n')
-        fid.write('\n')
+        op_text.append('#ifdef OPENACC\n#ifdef __cplusplus\n}\n#endif\n#endif\n')
+        op_text.append('\n')
         loc_old = locs[loc] + header_len-1
         continue
 
       if locs[loc] in loc_loops:
         indent = indent + ' ' * len('op_par_loop')
-        endofcall = text.find(';', locs[loc])
         curr_loop = loc_loops.index(locs[loc])
+        endofcall = loop_args[curr_loop]['end']
         name = loop_args[curr_loop]['name1']
         line = str(' op_par_loop_' + name + '(' +
                loop_args[curr_loop]['name2'] + ',' +
@@ -810,85 +1069,72 @@ def main(srcFilesAndDirs=sys.argv[1:]):
               ',' + elem['dim'] + ',' + elem['typ'] + \
               ',' + elem['acc'] + '),\n' + indent
 
-        fid.write(line[0:-len(indent) - 2] + ');')
+        op_text.append(line[0:-len(indent) - 2] + ');')
 
         loc_old = endofcall + 1
         continue
 
       if locs[loc] in loc_consts:
         curr_const = loc_consts.index(locs[loc])
-        endofcall = text.find(';', locs[loc])
+        endofcall = const_args[curr_const]['end']
         name = const_args[curr_const]['name']
-        fid.write(indent[0:-2] + 'op_decl_const2("' + name.strip() +
+        op_text.append(indent[0:-2] + 'op_decl_const2("' + name.strip() +
               '",' + str(const_args[curr_const]['dim']) + ',' +
               const_args[curr_const]['type'] + ',' +
               const_args[curr_const]['name2'].strip() + ');')
         loc_old = endofcall + 1
         continue
 
-    fid.write(text[loc_old:])
-    fid.close()
+    op_text.append(text[loc_old:])
+    op2_gen_common.write_text_file(op_src_filepath, ''.join(op_text))
   # end of loop over input source files
 
-  ## Loop over kernels, looking for a header file named after each
+  ## Look for each kernel's declaration in a header file named after the
   ## kernel in either working directory or one of the input-supplied
   ## directories:
-  for nk in range(0, len(kernels)):
-    k_data = kernels[nk]
+  decl_index = {}
+  named_files = {}
+  # for fused loops, the declarations of the kernels they call
+  decl_kernels = [k for k in kernels if not 'fused' in k] + \
+                 [f for k in kernels if 'fused' in k for f in k['fused']]
+  for k_data in decl_kernels:
     k_name = k_data["name"]
-    if not "decl_filepath" in list(k_data.keys()):
-      src_file = k_name + ".h"
-      if os.path.isfile(src_file):
-        with open(src_file, 'r') as f:
-          text = f.read()
-        if op_check_kernel_in_text(text, k_name):
-          k_data["decl_filepath"] = src_file
-          continue
-
-      for dirname in src_dirs:
-        filepath = os.path.join(dirname, src_file)
-        if os.path.isfile(filepath):
-          with open(filepath, 'r') as f:
-            text = f.read()
-          if op_check_kernel_in_text(text, k_name):
-            k_data["decl_filepath"] = filepath
-            break
+    named_files[k_name] = [f for f in [os.path.join(d, k_name + ".h") for d in [""] + src_dirs]
+                           if os.path.isfile(f)]
+    op_index_kernel_decls(named_files[k_name], decl_index)
+    for filepath in named_files[k_name]:
+      if k_name in decl_index[filepath]:
+        k_data["decl_filepath"] = filepath
+        break
 
   ## Any kernel declarations still not found must exist in files
   ## not named after the kernel. Search through content of all
   ## input-supplied files, and through all files of input-supplied
   ## directories:
-  for nk in range(0, len(kernels)):
-    if not "decl_filepath" in list(kernels[nk].keys()):
-      k_data = kernels[nk]
-      k_name = k_data["name"]
-
-      for src_file in src_files:
-        with open(src_file, 'r') as f:
-          text = f.read()
-        if op_check_kernel_in_text(text, k_name):
-          k_data["decl_filepath"] = src_file
-          break
-
-      if not "decl_filepath" in list(k_data.keys()):
-        for src_dir in src_dirs:
-          for src_dir_subfile in [s for s in os.listdir(src_dir) if os.path.isfile(os.path.join(src_dir, s))]:
-            src_dir_subfilepath = os.path.join(src_dir, src_dir_subfile)
-            with open(src_dir_subfilepath, 'r') as f:
-              text = f.read()
-            if op_check_kernel_in_text(text, k_name):
-              k_data["decl_filepath"] = src_dir_subfilepath
-              break
-          if "decl_filepath" in list(k_data.keys()):
+  if [k_data for k_data in decl_kernels if not "decl_filepath" in k_data]:
+    other_files = src_files[:]
+    for src_dir in src_dirs:
+      other_files += [os.path.join(src_dir, s) for s in os.listdir(src_dir)
+                      if os.path.isfile(os.path.join(src_dir, s))]
+    op_index_kernel_decls(other_files, decl_index)
+
+    for k_data in decl_kernels:
+      if not "decl_filepath" in k_data:
+        for filepath in other_files:
+          if k_data["name"] in decl_index[filepath]:
+            k_data["decl_filepath"] = filepath
             break
 
   fail = False
-  for nk in range(0, len(kernels)):
-    if not "decl_filepath" in list(kernels[nk].keys()):
+  for k_data in decl_kernels:
+    if not "decl_filepath" in k_data:
       fail = True
-      print(("Declaration not found for kernel " + kernels[nk]["name"]))
+      print(("Declaration not found for kernel " + k_data["name"]))
   if fail:
     exit(2)
+  for k_data in kernels:
+    if 'fused' in k_data:
+      k_data['decl_filepath'] = k_data['fused'][0]['decl_filepath']
 
   #  errors and warnings
 
@@ -917,24 +1163,55 @@ def main(srcFilesAndDirs=sys.argv[1:]):
   #
   masterFile = str(srcFilesAndDirs[0])
 
-  op2_gen_seq(masterFile, date, consts, kernels) # MPI+GENSEQ version - initial version, no vectorisation
-  # Vec translator is not yet ready for release, eg it cannot translate the 'aero' app.
-  op2_gen_mpi_vec(masterFile, date, consts, kernels) # MPI+GENSEQ with code that gets auto vectorised with intel compiler (version 15.0 and above)
+  ## Record a signature for each kernel:
+  for nk in range(0, len(kernels)):
+    if 'fused' in kernels[nk]:
+      decl_text = ''.join([read_text_file(f['decl_filepath']) for f in kernels[nk]['fused']])
+    else:
+      decl_text = read_text_file(kernels[nk]['decl_filepath'])
+    sig = op2_cache.kernel_signature(kernels[nk], nk, decl_text)
+    if cache['kernels'].get(kernels[nk]['name'], sig) != sig:
+      print('kernel ' + kernels[nk]['name'] + ' changed since the last translation')
+    new_cache['kernels'][kernels[nk]['name']] = sig
+
+  # the environment variables read by the code generators
+  generator_env = [os.getenv(v) for v in ('OP_TIME_THREADS', 'OP_OMP_PERSISTENT',
+                                             'OP_OMP_ATOMICS', 'OP_OMP_REPLICATE',
+                                             'OP_OMP_GATHER', 'OP_FUSE_LOOPS')]
+  generated_key = op2_cache.digest(masterFile, targets, consts, sets, macro_defs,
+                                   generator_env,
+                                   [new_cache['kernels'][k['name']] for k in kernels])
+  new_cache['generated'] = generated_key
+  if cache['generated'] == generated_key and op2_cache.outputs_present(cache):
+    print('No kernel changes since the last translation, not regenerating backend code')
+    new_cache['outputs'] = cache['outputs']
+    op2_cache.save_cache(cache_file, translator_version, srcFilesAndDirs, new_cache)
+    return
 
-  #code generators for OpenMP parallelisation with MPI
-  #op2_gen_openmp(masterFile, date, consts, kernels) # Initial OpenMP code generator
-  op2_gen_openmp_simple(masterFile, date, consts, kernels) # Simplified and Optimized OpenMP code generator
-  op2_gen_openacc(masterFile, date, consts, kernels) # Simplified and Optimized OpenMP code generator
+  ## Expand vector arguments once, before the descriptors are handed to
+  ## the code generators (the CUDA generator also uses the incremental
+  ## variant, inc_stage=1):
+  for k in kernels:
+    k.info(0)
+    k.info(1)
 
-  #code generators for NVIDIA GPUs with CUDA
+  #code generators not available as targets:
+  #op2_gen_openmp(masterFile, date, consts, kernels) # Initial OpenMP code generator
   #op2_gen_cuda(masterFile, date, consts, kernels,sets) # Optimized for Fermi GPUs
-  op2_gen_cuda_simple(masterFile, date, consts, kernels, sets, macro_defs) # Optimized for Kepler GPUs
+  generator_args = {
+    'seq':      (masterFile, date, consts, kernels),
+    'vec':      (masterFile, date, consts, kernels),
+    'openmp':   (masterFile, date, consts, kernels),
+    'openacc':  (masterFile, date, consts, kernels),
+    'cuda':     (masterFile, date, consts, kernels, sets, macro_defs),
+    'cuda_hyb': (masterFile, date, consts, kernels, sets),
+    'openmp4':  (masterFile, date, consts, kernels)}
+  generators = [(load_code_generator(t), generator_args[t]) for t in targets]
 
-  # generates openmp code as well as cuda code into the same file
-  op2_gen_cuda_simple_hyb(masterFile, date, consts, kernels, sets) # CPU and GPU will then do comutations as a hybrid application
+  generated_files = run_code_generators(generators, jobs)
 
-  #code generator for GPUs with OpenMP4.5
-  op2_gen_openmp4(masterFile, date, consts, kernels)
+  new_cache['outputs'] = sorted(set(generated_files))
+  op2_cache.save_cache(cache_file, translator_version, srcFilesAndDirs, new_cache)
 
   # import subprocess
   # retcode = subprocess.call("which clang-format > /dev/null", shell=True)
@@ -948,10 +1225,18 @@ def main(srcFilesAndDirs=sys.argv[1:]):
 if __name__ == '__main__':
   # parse the command line arguments (and options)
   import getopt
-  optlist,args = getopt.getopt(sys.argv[1:],'')
+  # options may come before or after the file names
+  optlist,args = getopt.gnu_getopt(sys.argv[1:],'j:',['targets='])
+  jobs = None
+  targets = None
+  for opt, val in optlist:
+    if opt == '-j':
+      jobs = int(val)
+    elif opt == '--targets':
+      targets = val
   # calling the generator
   if len(args) > 0:
-    main(srcFilesAndDirs=args)
+    main(srcFilesAndDirs=args, jobs=jobs, targets=targets)
   # Print usage message if no arguments given
   else:
     print(__doc__)
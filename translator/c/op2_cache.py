@@ -0,0 +1,116 @@
+##########################################################################
+#
+# Incremental translation cache
+#
+# op2.py records, for every input source file, a hash of its contents
+# together with the parse results derived from it, and a signature for
+# every kernel descriptor it hands to the code generators. On the next
+# run unchanged files are not re-parsed, and if nothing that the code
+# generators consume has changed they are not run at all.
+#
+# The cache is a JSON file, '.op2_cache' in the working directory by
+# default; set OP2_TRANSLATOR_CACHE to another path, or to '0' to
+# disable caching.
+#
+##########################################################################
+
+import copy
+import hashlib
+import json
+import os
+
+# bump to invalidate all existing caches when the cache layout changes
+cache_format = 1
+
+def translator_version():
+  """Hash of the translator sources, so that editing op2.py or any code
+  generator invalidates previously cached results"""
+
+  h = hashlib.sha1(str(cache_format).encode())
+  translator_dir = os.path.dirname(os.path.abspath(__file__))
+  for fname in sorted(os.listdir(translator_dir)):
+    if fname.endswith('.py'):
+      h.update(fname.encode())
+      with open(os.path.join(translator_dir, fname), 'rb') as f:
+        h.update(f.read())
+  return h.hexdigest()
+
+def digest(*items):
+  """Hash of a sequence of strings and JSON-serialisable objects"""
+
+  h = hashlib.sha1()
+  for item in items:
+    if not isinstance(item, str):
+      item = json.dumps(item, sort_keys=True)
+    h.update(item.encode())
+    h.update(b'\0')
+  return h.hexdigest()
+
+def cache_path():
+  path = os.getenv('OP2_TRANSLATOR_CACHE', '.op2_cache')
+  if path == '0':
+    return ''
+  return path
+
+def empty_cache():
+  return {'files': {},
+          'kernels': {},
+          'generated': None,
+          'outputs': []}
+
+def read_cache_file(path, version):
+  if path == '' or not os.path.isfile(path):
+    return {}
+  try:
+    with open(path, 'r') as f:
+      contents = json.load(f)
+  except (IOError, ValueError):
+    print("WARNING: ignoring unreadable translation cache '" + path + "'")
+    return {}
+  if contents.get('version') != version:
+    return {}
+  return contents.get('runs', {})
+
+def load_cache(path, version, run):
+  """Load the results cached for translator invocation 'run' (the list of
+  command line files and directories), discarding them if they were
+  written by a different version of the translator"""
+
+  return read_cache_file(path, version).get(' '.join(run), empty_cache())
+
+def save_cache(path, version, run, cache):
+  """Store 'cache' for invocation 'run', keeping the entries of other
+  invocations (e.g. the MPI entry file) sharing the same cache file"""
+
+  if path == '':
+    return
+  runs = read_cache_file(path, version)
+  runs[' '.join(run)] = cache
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump({'version': version, 'runs': runs}, f)
+  os.replace(tmp_path, path)
+
+def cached_file_entry(cache, src_file, key):
+  """Return a private copy of the parse results cached for 'src_file' if
+  they were produced from input with the same 'key', else None"""
+
+  entry = cache['files'].get(src_file)
+  if entry is None or entry['key'] != key:
+    return None
+  return copy.deepcopy(entry)
+
+def store_file_entry(cache, src_file, key, calls, consts, sets, loops):
+  cache['files'][src_file] = copy.deepcopy({'key': key,
+                                            'calls': calls,
+                                            'consts': consts,
+                                            'sets': sets,
+                                            'loops': loops})
+
+def kernel_signature(kernel, nk, decl_text):
+  """Signature of everything a code generator reads for kernel 'nk'"""
+
+  return digest(nk, kernel.as_dict(), decl_text)
+
+def outputs_present(cache):
+  return all(os.path.isfile(f) for f in cache['outputs'])
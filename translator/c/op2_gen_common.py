@@ -27,6 +27,130 @@ def comment_remover(text):
     )
     return re.sub(pattern, replacer, text)
 
+## Contents of every file read through read_text_file, by path:
+file_store = {}
+
+def read_text_file(filepath):
+  """Return the contents of 'filepath'. Each file is only read from disk
+  the first time it is requested; op2.py and the code generators all go
+  through this store, so every phase of a translation shares one read."""
+
+  key = os.path.normpath(filepath)
+  if not key in file_store:
+    with open(filepath, 'r') as f:
+      file_store[key] = f.read()
+  return file_store[key]
+
+## Paths of every file passed to write_text_file during this run:
+generated_files = []
+
+def write_text_file(filepath, text):
+  """Write 'text' to 'filepath', leaving the file (and so its mtime)
+  untouched if it already holds exactly that text. Returns True if the
+  file was (re)written."""
+
+  generated_files.append(filepath)
+  dirpath = os.path.dirname(filepath)
+  if dirpath != '':
+    os.makedirs(dirpath, exist_ok=True)
+  if os.path.isfile(filepath):
+    with open(filepath, 'r') as f:
+      if f.read() == text:
+        return False
+  with open(filepath, 'w') as f:
+    f.write(text)
+  return True
+
+##########################################################################
+# code emitter
+##########################################################################
+
+class CodeEmitter(object):
+  """Accumulates the text of one generated file.
+
+  Lines are indented by 'depth' spaces. In a line emitted for argument m,
+  the placeholders <ARG>, <DIM>, <TYP>, <IDX>, <INDARG>, <INDDIM> and
+  <INDTYP> are replaced by that argument's entries in the tables passed
+  to the constructor. With strip=False trailing white space is kept, as
+  the original OpenMP and CUDA generators did."""
+
+  placeholder_pattern = re.compile(r'<(INDDIM|INDTYP|INDARG|DIM|ARG|TYP|IDX)>')
+
+  def __init__(self, dims=(), idxs=(), typs=(), indtyps=(), inddims=(), strip=True):
+    self.lines = []
+    self.depth = 0
+    self.strip = strip
+    self.dims = dims
+    self.idxs = idxs
+    self.typs = typs
+    self.indtyps = indtyps
+    self.inddims = inddims
+    self.values = {}
+
+  def text(self):
+    return ''.join(self.lines)
+
+  def append(self, text):
+    """Add 'text' as it is, without indentation or substitution"""
+    self.lines.append(text)
+
+  def arg_values(self, m):
+    if not m in self.values:
+      values = {'INDARG': 'ind_arg'+str(m),
+                'DIM': str(self.dims[m]),
+                'ARG': 'arg'+str(m),
+                'TYP': self.typs[m],
+                'IDX': str(int(self.idxs[m]))}
+      if m < len(self.inddims):
+        values['INDDIM'] = str(self.inddims[m])
+        values['INDTYP'] = str(self.indtyps[m])
+      self.values[m] = values
+    return self.values[m]
+
+  def rep(self, line, m):
+    if m is None or not '<' in line:
+      return line
+    values = self.arg_values(m)
+    return self.placeholder_pattern.sub(
+        lambda match: values.get(match.group(1), match.group(0)), line)
+
+  def comm(self, line):
+    if len(line) == 0:
+      self.lines.append('\n')
+    elif self.strip:
+      self.lines.append(' '*self.depth+'//'+line.rstrip()+'\n')
+    else:
+      self.lines.append(' '*self.depth+'//'+line+'\n')
+
+  def code(self, text, m=None):
+    if self.strip:
+      if text == '':
+        self.lines.append('\n')
+      else:
+        self.lines.append(' '*self.depth+self.rep(text,m).rstrip()+'\n')
+    else:
+      self.lines.append(' '*self.depth+self.rep(text,m)+'\n')
+
+  def FOR(self, i, start, finish, m=None):
+    self.code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){', m)
+    self.depth += 2
+
+  def FOR_INC(self, i, start, finish, inc, m=None):
+    self.code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'+='+inc+' ){', m)
+    self.depth += 2
+
+  def ENDFOR(self):
+    self.depth -= 2
+    self.code('}')
+
+  def IF(self, line, m=None):
+    self.code('if ('+ line + ') {', m)
+    self.depth += 2
+
+  def ENDIF(self):
+    self.depth -= 2
+    self.code('}')
+
 def remove_trailing_w_space(text):
   text = text+' '
   line_start = 0
@@ -129,9 +253,7 @@ def replace_local_includes_with_file_contents(text, search_dir):
         if include_item_filepath == "":
           print(("Failed to locate file '{0}'".format(include_item)))
           quit()
-        f = open(include_item_filepath, 'r')
-        include_file_text = f.read()
-        f.close()
+        include_file_text = read_text_file(include_item_filepath)
         include_file_text = comment_remover(include_file_text)
         for line in include_file_text.split('\n'):
           text2 += leading_whitespace + line+'\n'
@@ -166,264 +288,401 @@ def op_parse_macro_defs(text):
     # print(key + " -> " + value)
   return defs
 
-def self_evaluate_macro_defs(macro_defs):
-  """Recursively evaluate C macro definitions that refer to other detected macros"""
-
-  ## First, calculate the expected number of substitutions to perform:
-  num_subs_expected = 0
-  for k in list(macro_defs.keys()):
-    k_val = macro_defs[k]
-    m = re.search(arithmetic_regex_pattern, k_val)
-    if m != None:
-      continue
+## Macro definition values split into identifier-like words, which may
+## name other macros, and the text between them:
+macro_token_pattern = re.compile(r'[a-zA-Z0-9_]+|[^a-zA-Z0-9_]+')
 
-    pattern = r'' + '([a-zA-Z0-9_]+)'
-    occurences = re.findall(pattern, k_val)
-    for o in occurences:
-      m = re.search(arithmetic_regex_pattern, o)
-      if m == None:
-        if o in list(macro_defs.keys()):
-          num_subs_expected += 1
-
-  substitutions_performed = True
-  num_subs_performed = 0
-  while substitutions_performed:
-    substitutions_performed = False
-    for k in list(macro_defs.keys()):
-      k_val = macro_defs[k]
-      m = re.search(arithmetic_regex_pattern, k_val)
-      if m != None:
-        ## This macro definiton is numeric
-        continue
-
-      if k == k_val:
-        del macro_defs[k]
-        continue
-
-      # print("Processing '{0}' -> '{1}'".format(k, k_val))
-
-      ## If value of key 'k' depends on value of other
-      ## keys, then substitute in value:
-      for k2 in list(macro_defs.keys()):
-        if k == k2:
-          continue
+## Results memoised for the macro table last passed to
+## self_evaluate_macro_defs: the full expansion of each macro, and the
+## evaluation of each string passed to evaluate_macro_defs_in_string.
+macro_memo = {'defs': None, 'expansions': {}, 'strings': {}}
 
-        pattern = r'' + '(^|[^a-zA-Z0-9_])' + k2 + '($|[^a-zA-Z0-9_])'
-        m = re.search(pattern, k_val)
+def is_arithmetic(string):
+  return re.search(arithmetic_regex_pattern, string) != None
 
-        if m != None:
-          ## The macro "k" refers to macro "k2"
-          k2_val = macro_defs[k2]
+def evaluate_arithmetic(string):
+  """Evaluate 'string' if it is a numeric expression, else return it unchanged"""
 
-          m = re.search(arithmetic_regex_pattern, k2_val)
-          if m == None:
-            # 'k2_val' has not been resolved. Wait for this to occur before
-            # substituting its value into 'k_val', as this minimises the total 
-            # number of substitutions performed across all macros and so 
-            # improves detection of infinite substitution loops.
-            continue
+  if is_arithmetic(string):
+    try:
+      res = eval(string)
+    except:
+      return string
+    if type(res) != type(""):
+      return str(res)
+  return string
+
+def is_atomic(string):
+  """True if 'string' is a number or wrapped in one pair of parentheses"""
+
+  string = string.strip()
+  if re.match(r'^[0-9]+$', string):
+    return True
+  if len(string) < 2 or string[0] != '(' or string[-1] != ')':
+    return False
+  depth = 0
+  for i in range(0, len(string)-1):
+    if string[i] == '(':
+      depth += 1
+    elif string[i] == ')':
+      depth -= 1
+      if depth == 0:
+        return False
+  return True
 
-          macro_defs[k] = re.sub(pattern, "\\g<1>"+k2_val+"\\g<2>", k_val)
-          # print("- performing a substitution of '" + k2 + "'->'" + k2_val + "' into '" + k_val + "' to produce '" + macro_defs[k] + "'")
-          k_val = macro_defs[k]
-          substitutions_performed = True
+def self_evaluate_macro_defs(macro_defs):
+  """Evaluate C macro definitions that refer to other detected macros.
 
-          num_subs_performed += 1
-          if num_subs_performed > num_subs_expected:
-            print(("WARNING: " + str(num_subs_performed) + " macro substitutions performed, but expected " + str(num_subs_expected) + ", probably stuck in a loop."))
-            return
+  The references between macros form a dependency graph, which is
+  resolved depth first so that each macro is substituted into the
+  macros using it once it has been fully resolved itself. References to
+  macros that do not resolve to numeric expressions, and references
+  closing a cycle, are left in place."""
 
-  ## Evaluate any mathematical expressions:
   for k in list(macro_defs.keys()):
-    val = macro_defs[k]
-    m = re.search(arithmetic_regex_pattern, val)
-    if m != None:
-      res = ""
-      try:
-        res = eval(val)
-      except:
-        pass
-      if type(res) != type(""):
-        if str(res) != val:
-          # print("Replacing '" + val + "' with '" + str(res) + "'")
-          macro_defs[k] = str(res)
+    if macro_defs[k] == k:
+      del macro_defs[k]
+
+  tokens = {}
+  deps = {}
+  for k in macro_defs:
+    tokens[k] = macro_token_pattern.findall(macro_defs[k])
+    deps[k] = [t for t in set(tokens[k]) if t in macro_defs and t != k]
+
+  def substitute(k, texts):
+    resolved_tokens = tokens[k][:]
+    for i in range(0, len(resolved_tokens)):
+      t = resolved_tokens[i]
+      if t in used[k]:
+        resolved_tokens[i] = texts[t]
+    return ''.join(resolved_tokens)
+
+  ## Integer values of resolved macros that are a single number or a
+  ## parenthesised expression. Substituting the value instead of the text
+  ## does not change what a macro evaluates to, and keeps chains of macros
+  ## that each use the previous one several times from growing
+  ## exponentially:
+  values = {}
+  def value_or_text(t):
+    if not t in values:
+      values[t] = resolved[t]
+      if is_atomic(resolved[t]):
+        value = evaluate_arithmetic(resolved[t])
+        if re.match(r'^-?[0-9]+$', value):
+          values[t] = value if value[0] != '-' else '(' + value + ')'
+    return values[t]
+
+  resolved = {}
+  used = {}
+  order = []
+  active = set()
+  for root in macro_defs:
+    if root in resolved:
+      continue
+    active.add(root)
+    stack = [(root, iter(deps[root]))]
+    while stack:
+      k, k_deps = stack[-1]
+      for d in k_deps:
+        if d in resolved:
+          continue
+        if d in active:
+          print(("WARNING: macro '" + d + "' is defined in terms of itself (via '" + k + "'), leaving it unexpanded."))
+          continue
+        active.add(d)
+        stack.append((d, iter(deps[d])))
+        break
+      else:
+        stack.pop()
+        active.discard(k)
+        used[k] = set(t for t in deps[k] if t in resolved and is_arithmetic(resolved[t]))
+        resolved[k] = substitute(k, dict((t, value_or_text(t)) for t in used[k]))
+        order.append(k)
+
+  ## Evaluate any mathematical expressions. Macros that do not evaluate
+  ## to a number keep the full text of the macros they use:
+  exact = set()
+  for k in order:
+    value = evaluate_arithmetic(resolved[k])
+    if value == resolved[k]:
+      exact.add(k)
+    macro_defs[k] = value
+  for k in reversed(order):
+    if k in exact:
+      exact.update(used[k])
+  texts = {}
+  for k in order:
+    if k in exact:
+      texts[k] = substitute(k, texts)
+      macro_defs[k] = evaluate_arithmetic(texts[k])
+
+  macro_memo['defs'] = macro_defs
+  macro_memo['expansions'] = {}
+  macro_memo['strings'] = {}
+
+def expand_macro_defs_in_string(macro_defs, string, expansions, active):
+  """Substitute every macro referenced in 'string', recursively"""
+
+  expanded = []
+  for t in macro_token_pattern.findall(string):
+    if not t in macro_defs:
+      expanded.append(t)
+    elif t in active:
+      print(("WARNING: macro '" + t + "' is defined in terms of itself, leaving it unexpanded."))
+      expanded.append(t)
+    else:
+      if not t in expansions:
+        active.add(t)
+        expansions[t] = expand_macro_defs_in_string(macro_defs, macro_defs[t], expansions, active)
+        active.discard(t)
+      expanded.append(expansions[t])
+  return ''.join(expanded)
 
 def evaluate_macro_defs_in_string(macro_defs, string):
   """Recursively evaluate C macro definitions in 'string' """
 
-  ## First, calculate the expected number of substitutions to perform:
-  num_subs_expected = 0
-  m = re.search(arithmetic_regex_pattern, string)
-  if m == None:
-    pattern = r'' + '([a-zA-Z0-9_]+)'
-    occurences = re.findall(pattern, string)
-    for o in occurences:
-      m = re.search(arithmetic_regex_pattern, o)
-      if m == None:
-        if o in list(macro_defs.keys()):
-          num_subs_expected = num_subs_expected + 1
-
-  resolved_string = string
-
-  substitutions_performed = True
-  num_subs_performed = 0
-  while substitutions_performed:
-    substitutions_performed = False
-    for k in list(macro_defs.keys()):
-      k_val = macro_defs[k]
-
-      k_pattern = r'' + r'' + '(^|[^a-zA-Z0-9_])' + k + '($|[^a-zA-Z0-9_])'
-      m = re.search(k_pattern, resolved_string)
-      if m != None:
-        ## "string" contains a reference to macro "k", so substitute in its definition:
-        resolved_string_new = re.sub(k_pattern, "\\g<1>"+k_val+"\\g<2>", resolved_string)
-        # print("Performing a substitution of '" + k + "'->'" + k_val + "' into '" + resolved_string + "'' to produce '" + resolved_string_new + "'")
-        resolved_string = resolved_string_new
-        substitutions_performed = True
-
-        num_subs_performed = num_subs_performed + 1
-        if num_subs_performed > num_subs_expected:
-          print(("WARNING: " + str(num_subs_performed) + " macro substitutions performed, but expected " + str(num_subs_expected) + ", probably stuck in a loop."))
-          return
-
-
-  if re.search(arithmetic_regex_pattern, resolved_string) != None:
-    res = ""
-    try:
-      res = eval(resolved_string)
-    except:
-      return resolved_string
-    else:
-      if type(res) != type(""):
-        resolved_string = str(res)
+  if macro_memo['defs'] is macro_defs:
+    expansions = macro_memo['expansions']
+    strings = macro_memo['strings']
+  else:
+    expansions = {}
+    strings = {}
 
-  return resolved_string
+  if not string in strings:
+    resolved_string = expand_macro_defs_in_string(macro_defs, string, expansions, set())
+    strings[string] = evaluate_arithmetic(resolved_string)
+  return strings[string]
 
-def create_kernel_info(kernel, inc_stage = 0):
-    OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
-
-    OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
-    OP_INC  = 4;  OP_MAX   = 5;  OP_MIN = 6;
-
-    name  = kernel['name']
-    nargs = kernel['nargs']
-    dims  = kernel['dims']
-    maps  = kernel['maps']
-    var   = kernel['var']
-    typs  = kernel['typs']
-    accs  = kernel['accs']
-    idxs  = kernel['idxs']
-    inds  = kernel['inds']
-    soaflags = kernel['soaflags']
-    optflags = kernel['optflags']
-    decl_filepath = kernel['decl_filepath']
-
-    ninds   = kernel['ninds']
-    inddims = kernel['inddims']
-    indaccs = kernel['indaccs']
-    indtyps = kernel['indtyps']
-    invinds = kernel['invinds']
-    mapnames = kernel['mapnames']
-    invmapinds = kernel['invmapinds']
-    mapinds = kernel['mapinds']
+##########################################################################
+# kernel descriptors
+##########################################################################
+
+OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
+
+OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
+OP_INC  = 4;  OP_MAX   = 5;  OP_MIN = 6;
+
+class Arg(object):
+  """One argument of an op_par_loop, after expansion of vector arguments"""
+
+  __slots__ = ('var', 'dim', 'map', 'mapname', 'typ', 'acc', 'idx', 'ind',
+               'soaflag', 'optflag', 'vectorised')
+
+  def __init__(self, var, dim, map, mapname, typ, acc, idx, ind,
+               soaflag, optflag, vectorised=0):
+    self.var = var
+    self.dim = dim
+    self.map = map
+    self.mapname = mapname
+    self.typ = typ
+    self.acc = acc
+    self.idx = idx
+    self.ind = ind
+    self.soaflag = soaflag
+    self.optflag = optflag
+    self.vectorised = vectorised
+
+class Kernel(object):
+  """Descriptor of an op_par_loop kernel, as built by op2.py.
+
+  The fields can be read as attributes or by key (kernel['dims']), which
+  is how the code generators have always accessed them. The expansion of
+  vector arguments and the index tables derived from it are computed the
+  first time a code generator asks for them and kept for the others.
+
+  A loop made by fusing adjacent loops (see op_fuse_loops in op2.py) also
+  has 'fused', the list of the kernels it calls: for each, its 'name',
+  'decl_filepath' and the indices of its arguments in 'args'"""
+
+  fields = ('name', 'nargs', 'dims', 'maps', 'var', 'typs', 'accs', 'idxs',
+            'inds', 'soaflags', 'optflags', 'ninds', 'inddims', 'indaccs',
+            'indtyps', 'invinds', 'mapnames', 'mapinds', 'invmapinds',
+            'decl_filepath', 'fused')
+  __slots__ = fields + ('_args', '_info')
+
+  def __init__(self, **fields):
+    for field in fields:
+      setattr(self, field, fields[field])
+    self._args = None
+    self._info = {}
+
+  def __getitem__(self, field):
+    if not field in Kernel.fields:
+      raise KeyError(field)
+    return getattr(self, field)
+
+  def __setitem__(self, field, value):
+    if not field in Kernel.fields:
+      raise KeyError(field)
+    setattr(self, field, value)
+    self._args = None
+    self._info = {}
+
+  def __contains__(self, field):
+    return field in Kernel.fields and hasattr(self, field)
+
+  def as_dict(self):
+    return dict((field, getattr(self, field)) for field in Kernel.fields
+                if hasattr(self, field))
+
+  def vectorised(self):
+    """True if any argument is a vector (negative index) map argument"""
+    return any(int(self.idxs[m]) < 0 and self.maps[m] == OP_MAP
+               for m in range(0, self.nargs))
+
+  def args(self):
+    """The arguments with each vector argument expanded into one Arg per
+    map index; empty if the kernel has no vector arguments"""
+
+    if self._args is None:
+      self._args = []
+      if self.vectorised():
+        vec_counter = 1
+        for m in range(0, self.nargs):
+          if int(self.idxs[m]) < 0 and self.maps[m] == OP_MAP:
+            for i in range(0, -1*int(self.idxs[m])):
+              self._args.append(Arg(self.var[m], self.dims[m], self.maps[m],
+                                    self.mapnames[m], self.typs[m], self.accs[m],
+                                    i, self.inds[m], self.soaflags[m],
+                                    self.optflags[m], vec_counter))
+            vec_counter = vec_counter + 1
+          else:
+            self._args.append(Arg(self.var[m], self.dims[m], self.maps[m],
+                                  self.mapnames[m], self.typs[m], int(self.accs[m]),
+                                  int(self.idxs[m]), self.inds[m], self.soaflags[m],
+                                  self.optflags[m]))
+    return self._args
+
+  def info(self, inc_stage = 0):
+    """The per-argument tables used by the code generators, see
+    create_kernel_info"""
+
+    if not inc_stage in self._info:
+      self._info[inc_stage] = self.create_info(inc_stage)
+    return self._info[inc_stage]
+
+  def create_info(self, inc_stage):
+    nargs = self.nargs
+    dims = self.dims
+    maps = self.maps
+    var = self.var
+    typs = self.typs
+    accs = self.accs
+    idxs = self.idxs
+    inds = self.inds
+    soaflags = self.soaflags
+    optflags = self.optflags
+    invinds = self.invinds
+    mapnames = self.mapnames
+    invmapinds = self.invmapinds
+    mapinds = self.mapinds
 
     nmaps = 0
-    if ninds > 0:
+    if self.ninds > 0:
       nmaps = max(mapinds)+1
     nargs_novec = nargs
 
-    vec =  [m for m in range(0,nargs) if int(idxs[m])<0 and maps[m] == OP_MAP]
-    if len(vec) > 0:
-      unique_args = [1];
-      vec_counter = 1;
-      vectorised = []
-      new_dims = []
-      new_maps = []
-      new_vars = []
-      new_typs = []
-      new_accs = []
-      new_idxs = []
-      new_inds = []
-      new_soaflags = []
-      new_optflags = []
-      new_mapnames = []
-      for m in range(0,nargs):
-          if int(idxs[m])<0 and maps[m] == OP_MAP:
-            if m > 0:
-              unique_args = unique_args + [len(new_dims)+1]
-            temp = [0]*(-1*int(idxs[m]))
-            for i in range(0,-1*int(idxs[m])):
-              temp[i] = var[m]
-            new_vars = new_vars+temp
-            for i in range(0,-1*int(idxs[m])):
-              temp[i] = typs[m]
-            new_typs = new_typs+temp
-            for i in range(0,-1*int(idxs[m])):
-              temp[i] = dims[m]
-            new_dims = new_dims+temp
-            new_maps = new_maps+[maps[m]]*int(-1*int(idxs[m]))
-            new_mapnames = new_mapnames+[mapnames[m]]*int(-1*int(idxs[m]))
-            new_soaflags = new_soaflags+[soaflags[m]]*int(-1*int(idxs[m]))
-            new_optflags = new_optflags+[optflags[m]]*int(-1*int(idxs[m]))
-            new_accs = new_accs+[accs[m]]*int(-1*int(idxs[m]))
-            for i in range(0,-1*int(idxs[m])):
-              new_idxs = new_idxs+[i]
-            new_inds = new_inds+[inds[m]]*int(-1*int(idxs[m]))
-            vectorised = vectorised + [vec_counter]*int(-1*int(idxs[m]))
-            vec_counter = vec_counter + 1;
-          else:
-            if m > 0:
-              unique_args = unique_args + [len(new_dims)+1]
-            new_dims = new_dims+[dims[m]]
-            new_maps = new_maps+[maps[m]]
-            new_mapnames = new_mapnames+[mapnames[m]]
-            new_accs = new_accs+[int(accs[m])]
-            new_soaflags = new_soaflags+[soaflags[m]]
-            new_optflags = new_optflags+[optflags[m]]
-            new_idxs = new_idxs+[int(idxs[m])]
-            new_inds = new_inds+[inds[m]]
-            new_vars = new_vars+[var[m]]
-            new_typs = new_typs+[typs[m]]
-            vectorised = vectorised+[0]
-      dims = new_dims
-      maps = new_maps
-      mapnames = new_mapnames
-      accs = new_accs
-      idxs = new_idxs
-      inds = new_inds
-      var = new_vars
-      typs = new_typs
-      soaflags = new_soaflags;
-      optflags = new_optflags;
-      nargs = len(vectorised);
-      mapinds = [0]*nargs
-      for i in range(0,nargs):
-        mapinds[i] = i
-        for j in range(0,i):
-          if (maps[i] == OP_MAP) and (mapnames[i] == mapnames[j]) and (idxs[i] == idxs[j]):
-            mapinds[i] = mapinds[j]
-
-      for i in range(1,ninds+1):
-        for index in range(0,len(inds)+1):
-          if inds[index] == i:
-            invinds[i-1] = index
-            break
+    args = self.args()
+    if len(args) > 0:
+      unique_args = [1]
+      for m in range(1, len(args)):
+        if args[m].vectorised == 0 or args[m].idx == 0:
+          unique_args.append(m+1)
+      vectorised = [a.vectorised for a in args]
+      dims = [a.dim for a in args]
+      maps = [a.map for a in args]
+      mapnames = [a.mapname for a in args]
+      accs = [a.acc for a in args]
+      idxs = [a.idx for a in args]
+      inds = [a.ind for a in args]
+      var = [a.var for a in args]
+      typs = [a.typ for a in args]
+      soaflags = [a.soaflag for a in args]
+      optflags = [a.optflag for a in args]
+      nargs = len(args)
+
+      first_map = {}
+      mapinds = list(range(0, nargs))
+      for i in range(0, nargs):
+        if maps[i] == OP_MAP:
+          mapinds[i] = first_map.setdefault((mapnames[i], idxs[i]), i)
+
+      first_ind = {}
+      for i in range(nargs-1, -1, -1):
+        first_ind[inds[i]] = i
+      invinds = invinds[:]
+      for i in range(0, self.ninds):
+        invinds[i] = first_ind[i+1]
+
+      first_map = {}
       invmapinds = invinds[:]
-      for i in range(0,ninds):
-        for j in range(0,i):
-          if (mapnames[invinds[i]] == mapnames[invinds[j]]):
-            invmapinds[i] = invmapinds[j]
+      for i in range(0, self.ninds):
+        invmapinds[i] = first_map.setdefault(mapnames[invinds[i]], invinds[i])
     else:
       vectorised = [0]*nargs
       unique_args = list(range(1,nargs+1))
 
-    cumulative_indirect_index = [-1]*nargs;
-    j = 0;
+    cumulative_indirect_index = [-1]*nargs
+    j = 0
     for i in range (0,nargs):
       if maps[i] == OP_MAP and ((not inc_stage) or accs[i] == OP_INC):
         cumulative_indirect_index[i] = j
         j = j + 1
 
-    return name, nargs, dims, maps, var, typs, accs, idxs, inds, soaflags, optflags, decl_filepath, \
-          ninds, inddims, indaccs, indtyps, invinds, mapnames, invmapinds, mapinds, nmaps, nargs_novec, \
+    return self.name, nargs, dims, maps, var, typs, accs, idxs, inds, soaflags, optflags, self.decl_filepath, \
+          self.ninds, self.inddims, self.indaccs, self.indtyps, invinds, mapnames, invmapinds, mapinds, nmaps, nargs_novec, \
           unique_args, vectorised, cumulative_indirect_index
+
+def create_kernel_info(kernel, inc_stage = 0):
+  """Return the tables describing 'kernel' with vector arguments expanded:
+
+  name, nargs, dims, maps, var, typs, accs, idxs, inds, soaflags, optflags,
+  decl_filepath, ninds, inddims, indaccs, indtyps, invinds, mapnames,
+  invmapinds, mapinds, nmaps, nargs_novec, unique_args, vectorised,
+  cumulative_indirect_index
+
+  The tables are computed once per kernel and shared between code
+  generators, which must not modify them"""
+
+  return kernel.info(inc_stage)
+
+def kernel_file_order(kernels):
+  """The order in which the master kernel file includes the kernel files:
+  those of fused loops last, as they may use the user kernels included by
+  the others"""
+
+  return [nk for nk in range(0, len(kernels)) if not 'fused' in kernels[nk]] + \
+         [nk for nk in range(0, len(kernels)) if 'fused' in kernels[nk]]
+
+def decl_includes(kernels, nk):
+  """The kernel declaration files that the kernel file of kernels[nk]
+  includes: its own, or for a fused loop those of the kernels it calls
+  that no kernel file before it in kernel_file_order includes"""
+
+  if not 'fused' in kernels[nk]:
+    return [kernels[nk]['decl_filepath']]
+  included = []
+  for k in kernel_file_order(kernels):
+    if k == nk:
+      break
+    if 'fused' in kernels[k]:
+      included += [f['decl_filepath'] for f in kernels[k]['fused']]
+    else:
+      included.append(kernels[k]['decl_filepath'])
+  files = []
+  for f in kernels[nk]['fused']:
+    if not f['decl_filepath'] in included + files:
+      files.append(f['decl_filepath'])
+  return files
+
+def fused_kernel_calls(kernel, line, depth):
+  """Turn the call 'line' of the user kernel of a fused loop, built with
+  each argument on a new line indented by depth+2, into a call of each of
+  the kernels it fuses"""
+
+  indent = '\n'+' '*(depth+2)
+  exprs = line[line.index('(')+1+len(indent):-2].split(','+indent)
+  calls = []
+  for f in kernel['fused']:
+    calls.append(f['name']+'('+','.join([indent+exprs[m] for m in f['args']])+');')
+  return ('\n'+' '*depth).join(calls)
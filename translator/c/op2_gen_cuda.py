@@ -14,86 +14,8 @@ import datetime
 import os
 import op2_gen_common
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  prefix = ' '*depth
-  file_text += prefix+rep(text,g_m)+'\n'
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def FOR_INC(i,start,finish,inc):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'+='+inc+' ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
-
 def op2_gen_cuda(master, date, consts, kernels, sets):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -161,102 +83,101 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims, strip=False)
 
-    comm('user function')
+    out.comm('user function')
 
-    code('__device__')
+    out.code('__device__')
     if FORTRAN:
-      code('include '+name+'.inc')
+      out.code('include '+name+'.inc')
     elif CPP:
-      code('#include "../'+name+'.h"')
+      out.code('#include "../'+name+'.h"')
 
-    comm('')
-    comm(' CUDA kernel function')
+    out.comm('')
+    out.comm(' CUDA kernel function')
 
     if FORTRAN:
-      code('subroutine op_cuda_'+name+'(')
+      out.code('subroutine op_cuda_'+name+'(')
     elif CPP:
-      code('__global__ void op_cuda_'+name+'(')
+      out.code('__global__ void op_cuda_'+name+'(')
 
-    depth = 2
+    out.depth = 2
 
     for g_m in range(0,ninds):
       if FORTRAN:
-        code('<INDTYP> *ind_<ARG>,')
+        out.code('<INDTYP> *ind_<ARG>,', g_m)
       elif CPP:
-        code('<INDTYP> *ind_<ARG>,')
+        out.code('<INDTYP> *ind_<ARG>,', g_m)
 
     if ninds>0:
       if FORTRAN:
-        code('int   *ind_map,')
-        code('short *arg_map,')
+        out.code('int   *ind_map,')
+        out.code('short *arg_map,')
       elif CPP:
-        code('int   *ind_map,')
-        code('short *arg_map,')
+        out.code('int   *ind_map,')
+        out.code('short *arg_map,')
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m] == OP_READ:
         # declared const for performance
         if FORTRAN:
-          code('const <TYP> *<ARG>,')
+          out.code('const <TYP> *<ARG>,', g_m)
         elif CPP:
-          code('const <TYP> *<ARG>,')
+          out.code('const <TYP> *<ARG>,', g_m)
       elif maps[g_m]==OP_ID and ninds>0:
         if FORTRAN:
-          code('<ARG>,')
+          out.code('<ARG>,', g_m)
         elif CPP:
-          code('<TYP>  *<ARG>,')
+          out.code('<TYP>  *<ARG>,', g_m)
       elif maps[g_m]==OP_GBL or maps[g_m]==OP_ID:
         if FORTRAN:
-          code('<ARG>,')
+          out.code('<ARG>,', g_m)
         elif CPP:
-          code('<TYP> *<ARG>,')
+          out.code('<TYP> *<ARG>,', g_m)
 
     if ninds>0:
       if FORTRAN:
-        code('int   *ind_arg_sizes,')
-        code('int   *ind_arg_offs, ')
-        code('int    block_offset, ')
-        code('int   *blkmap,       ')
-        code('int   *offset,       ')
-        code('int   *nelems,       ')
-        code('int   *ncolors,      ')
-        code('int   *colors,       ')
-        code('int   nblocks,       ')
-        code('int   set_size) {    ')
+        out.code('int   *ind_arg_sizes,')
+        out.code('int   *ind_arg_offs, ')
+        out.code('int    block_offset, ')
+        out.code('int   *blkmap,       ')
+        out.code('int   *offset,       ')
+        out.code('int   *nelems,       ')
+        out.code('int   *ncolors,      ')
+        out.code('int   *colors,       ')
+        out.code('int   nblocks,       ')
+        out.code('int   set_size) {    ')
       if CPP:
-        code('int   *ind_arg_sizes,')
-        code('int   *ind_arg_offs, ')
-        code('int    block_offset, ')
-        code('int   *blkmap,       ')
-        code('int   *offset,       ')
-        code('int   *nelems,       ')
-        code('int   *ncolors,      ')
-        code('int   *colors,       ')
-        code('int   nblocks,       ')
-        code('int   set_size) {    ')
+        out.code('int   *ind_arg_sizes,')
+        out.code('int   *ind_arg_offs, ')
+        out.code('int    block_offset, ')
+        out.code('int   *blkmap,       ')
+        out.code('int   *offset,       ')
+        out.code('int   *nelems,       ')
+        out.code('int   *ncolors,      ')
+        out.code('int   *colors,       ')
+        out.code('int   nblocks,       ')
+        out.code('int   set_size) {    ')
     else:
-      code('int   offset_s,    ')
-      code('int   set_size ) {')
-      code('')
+      out.code('int   offset_s,    ')
+      out.code('int   set_size ) {')
+      out.code('')
 
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-        code('<TYP> <ARG>_l[<DIM>];')
+        out.code('<TYP> <ARG>_l[<DIM>];', g_m)
         if accs[g_m] == OP_INC:
-          FOR('d','0','<DIM>')
-          code('<ARG>_l[d]=ZERO_<TYP>;')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>_l[d]=ZERO_<TYP>;', g_m)
+          out.ENDFOR()
         else:
-          FOR('d','0','<DIM>')
-          code('<ARG>_l[d]=<ARG>[d+blockIdx.x*<DIM>];')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>_l[d]=<ARG>[d+blockIdx.x*<DIM>];', g_m)
+          out.ENDFOR()
       elif maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-        code('<TYP> <ARG>_l[<DIM>];')
+        out.code('<TYP> <ARG>_l[<DIM>];', g_m)
       elif (ninds==0 and maps[g_m]==OP_ID and dims[g_m]!='1') and not(soaflags[g_m]):
-        code('<TYP> <ARG>_l[<DIM>];')
+        out.code('<TYP> <ARG>_l[<DIM>];', g_m)
 
     for m in range (1,ninds+1):
       g_m = m -1
@@ -265,110 +186,110 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
       if sum(v)>1 and sum(v_i)>0: #check this sum(v_i)
         if indaccs[m-1] == OP_INC:
           ind = int(max([idxs[i] for i in range(len(inds)) if inds[i]==m])) + 1
-          code('<INDTYP> *<ARG>_vec['+str(ind)+'] = {'); depth += 2;
+          out.code('<INDTYP> *<ARG>_vec['+str(ind)+'] = {', g_m); out.depth += 2;
           for n in range(0,nargs):
             if inds[n] == m:
               g_m = n
-              code('<ARG>_l,')
-          depth -= 2
-          code('};')
+              out.code('<ARG>_l,', g_m)
+          out.depth -= 2
+          out.code('};')
         else:
           ind = int(max([idxs[i] for i in range(len(inds)) if inds[i]==m])) + 1
           if indaccs[m-1] == OP_READ:
-            code('const <INDTYP> *<ARG>_vec['+str(ind)+'];')
+            out.code('const <INDTYP> *<ARG>_vec['+str(ind)+'];', g_m)
           else:
-            code('<INDTYP> *<ARG>_vec['+str(ind)+'];')
+            out.code('<INDTYP> *<ARG>_vec['+str(ind)+'];', g_m)
 #
 # lengthy code for general case with indirection
 #
     if ninds>0:
-      code('')
+      out.code('')
       for g_m in range (0,ninds):
-        code('__shared__  int  *ind_<ARG>_map, ind_<ARG>_size;')
+        out.code('__shared__  int  *ind_<ARG>_map, ind_<ARG>_size;', g_m)
       for g_m in range (0,ninds):
-        code('__shared__  <INDTYP> *ind_<ARG>_s;')
+        out.code('__shared__  <INDTYP> *ind_<ARG>_s;', g_m)
 
       if ind_inc:
-        code('__shared__ int    nelems2, ncolor;')
-
-      code('__shared__ int    nelem, offset_b;')
-      code('')
-      code('extern __shared__ char shared[];')
-      code('')
-      IF('blockIdx.x+blockIdx.y*gridDim.x >= nblocks')
-      code('return;')
-      ENDIF()
-      IF('threadIdx.x==0')
-      code('')
-      comm('get sizes and shift pointers and direct-mapped data')
-      code('')
-      code('int blockId = blkmap[blockIdx.x + blockIdx.y*gridDim.x  + block_offset];')
-      code('')
-      code('nelem    = nelems[blockId];')
-      code('offset_b = offset[blockId];')
-      code('')
+        out.code('__shared__ int    nelems2, ncolor;')
+
+      out.code('__shared__ int    nelem, offset_b;')
+      out.code('')
+      out.code('extern __shared__ char shared[];')
+      out.code('')
+      out.IF('blockIdx.x+blockIdx.y*gridDim.x >= nblocks')
+      out.code('return;')
+      out.ENDIF()
+      out.IF('threadIdx.x==0')
+      out.code('')
+      out.comm('get sizes and shift pointers and direct-mapped data')
+      out.code('')
+      out.code('int blockId = blkmap[blockIdx.x + blockIdx.y*gridDim.x  + block_offset];')
+      out.code('')
+      out.code('nelem    = nelems[blockId];')
+      out.code('offset_b = offset[blockId];')
+      out.code('')
 
       if ind_inc:
-        code('nelems2  = blockDim.x*(1+(nelem-1)/blockDim.x);')
-        code('ncolor   = ncolors[blockId];')
-        code('')
+        out.code('nelems2  = blockDim.x*(1+(nelem-1)/blockDim.x);')
+        out.code('ncolor   = ncolors[blockId];')
+        out.code('')
 
       for g_m in range (0,ninds):
-        code('ind_<ARG>_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds)+'];')
+        out.code('ind_<ARG>_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds)+'];', g_m)
 
-      code('')
+      out.code('')
       
       for m in range (1,ninds+1):
         g_m = m - 1
         c = [i for i in range(len(inds)) if inds[i]==m]
-        code('ind_<ARG>_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
-        '*set_size] + ind_arg_offs['+str(m-1)+'+blockId*'+str(ninds)+'];')
+        out.code('ind_<ARG>_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
+        '*set_size] + ind_arg_offs['+str(m-1)+'+blockId*'+str(ninds)+'];', g_m)
 
-      code('')
-      comm('set shared memory pointers')
-      code('int nbytes = 0;')
+      out.code('')
+      out.comm('set shared memory pointers')
+      out.code('int nbytes = 0;')
 
       for g_m in range(0,ninds):
-        code('ind_<ARG>_s = (<INDTYP> *) &shared[nbytes];')
+        out.code('ind_<ARG>_s = (<INDTYP> *) &shared[nbytes];', g_m)
         if g_m < ninds-1:
-          code('nbytes    += ROUND_UP(ind_<ARG>_size*sizeof(<INDTYP>)*<INDDIM>);')
+          out.code('nbytes    += ROUND_UP(ind_<ARG>_size*sizeof(<INDTYP>)*<INDDIM>);', g_m)
 
-      ENDIF()
-      code('__syncthreads(); // make sure all of above completed')
-      code('')
-      comm('copy indirect datasets into shared memory or zero increment')
-      code('')
+      out.ENDIF()
+      out.code('__syncthreads(); // make sure all of above completed')
+      out.code('')
+      out.comm('copy indirect datasets into shared memory or zero increment')
+      out.code('')
 
       for m in range(0,ninds):
         g_m = m
         if indaccs[m]==OP_READ or indaccs[m]==OP_RW or indaccs[m]==OP_INC:
-          FOR_INC('n','threadIdx.x','ind_<ARG>_size*<INDDIM>','blockDim.x')
+          out.FOR_INC('n','threadIdx.x','ind_<ARG>_size*<INDDIM>','blockDim.x', g_m)
           if indaccs[m]==OP_READ or indaccs[m]==OP_RW:
-            code('ind_arg'+str(m)+'_s[n] = ind_arg'+str(m)+'[n%'+inddims[m]+
+            out.code('ind_arg'+str(m)+'_s[n] = ind_arg'+str(m)+'[n%'+inddims[m]+
             '+ind_arg'+str(m)+'_map[n/'+inddims[m]+']*'+inddims[m]+'];')
-            code('')
+            out.code('')
           elif indaccs[m]==OP_INC:
-            code('ind_<ARG>_s[n] = ZERO_<INDTYP>;')
-          ENDFOR()
+            out.code('ind_<ARG>_s[n] = ZERO_<INDTYP>;', g_m)
+          out.ENDFOR()
 
-      code('')
-      code('__syncthreads();')
-      comm('process set elements')
-      code('')
+      out.code('')
+      out.code('__syncthreads();')
+      out.comm('process set elements')
+      out.code('')
 
       if ind_inc:
-        FOR_INC('n','threadIdx.x','nelems2','blockDim.x')
-        code('int col2 = -1;')
-        IF('n<nelem')
-        comm('initialise local variables')
+        out.FOR_INC('n','threadIdx.x','nelems2','blockDim.x')
+        out.code('int col2 = -1;')
+        out.IF('n<nelem')
+        out.comm('initialise local variables')
 
         for g_m in range(0,nargs):
           if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d] = ZERO_<TYP>;')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d] = ZERO_<TYP>;', g_m)
+            out.ENDFOR()
       else:
-        FOR_INC('n','threadIdx.x','nelem','blockDim.x')
+        out.FOR_INC('n','threadIdx.x','nelem','blockDim.x')
 
 #
 # simple alternative when no indirection
@@ -380,31 +301,31 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
           use_shared = 1
 
       if use_shared:
-        code('int   tid = threadIdx.x%OP_WARPSIZE;')
-        code('')
-        code('extern __shared__ char shared[];')
-        code('char *arg_s = shared + offset_s*(threadIdx.x/OP_WARPSIZE);')
+        out.code('int   tid = threadIdx.x%OP_WARPSIZE;')
+        out.code('')
+        out.code('extern __shared__ char shared[];')
+        out.code('char *arg_s = shared + offset_s*(threadIdx.x/OP_WARPSIZE);')
 
-      code('')
-      comm('process set elements')
-      FOR_INC('n','threadIdx.x+blockIdx.x*blockDim.x','set_size','blockDim.x*gridDim.x')
+      out.code('')
+      out.comm('process set elements')
+      out.FOR_INC('n','threadIdx.x+blockIdx.x*blockDim.x','set_size','blockDim.x*gridDim.x')
 
       if use_shared:
-        code('int offset = n - tid;')
-        code('int nelems = MIN(OP_WARPSIZE,set_size-offset);')
-        comm('copy data into shared memory, then into local')
+        out.code('int offset = n - tid;')
+        out.code('int nelems = MIN(OP_WARPSIZE,set_size-offset);')
+        out.comm('copy data into shared memory, then into local')
 
       for m in range(0,nargs):
         g_m = m
         if (maps[m]!=OP_GBL and accs[m]!=OP_WRITE and dims[m]!='1') and not(soaflags[m]):
-          FOR('m','0','<DIM>')
-          code('((<TYP> *)arg_s)[tid+m*nelems] = <ARG>[tid+m*nelems+offset*<DIM>];')
-          ENDFOR()
-          code('')
-          FOR('m','0','<DIM>')
-          code('<ARG>_l[m] = ((<TYP> *)arg_s)[m+tid*<DIM>];')
-          ENDFOR()
-          code('')
+          out.FOR('m','0','<DIM>', g_m)
+          out.code('((<TYP> *)arg_s)[tid+m*nelems] = <ARG>[tid+m*nelems+offset*<DIM>];', g_m)
+          out.ENDFOR()
+          out.code('')
+          out.FOR('m','0','<DIM>', g_m)
+          out.code('<ARG>_l[m] = ((<TYP> *)arg_s)[m+tid*<DIM>];', g_m)
+          out.ENDFOR()
+          out.code('')
 
 
 
@@ -417,17 +338,17 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
       s = [i for i in range(len(inds)) if inds[i]==m]
       if sum(s)>1:
         if indaccs[m-1] != OP_INC:
-          code('')
+          out.code('')
           ctr = 0
           for n in range(0,nargs):
             if inds[n] == m and vectorised[n]:
-              code('arg'+str(m-1)+'_vec['+str(ctr)+'] = ind_arg'+\
+              out.code('arg'+str(m-1)+'_vec['+str(ctr)+'] = ind_arg'+\
               str(inds[n]-1)+'_s+arg_map['+str(cumulative_indirect_index[n])+\
               '*set_size+n+offset_b]*'+str(dims[n])+';')
               ctr = ctr+1
 
-    code('')
-    comm('user-supplied kernel call')
+    out.code('')
+    out.comm('user-supplied kernel call')
 
     line = name+'('
     prefix = ' '*len(name)
@@ -439,22 +360,22 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
 
       if maps[m] == OP_GBL:
         if accs[m] == OP_READ or accs[m] == OP_WRITE:
-          line += rep(indent+'<ARG>,\n',m)
+          line += out.rep(indent+'<ARG>,\n',m)
         else:
-          line += rep(indent+'<ARG>_l,\n',m);
+          line += out.rep(indent+'<ARG>_l,\n',m);
         a =a+1
       elif maps[m]==OP_MAP and  accs[m]==OP_INC and vectorised[m]==0:
-        line += rep(indent+'<ARG>_l,\n',m)
+        line += out.rep(indent+'<ARG>_l,\n',m)
         a =a+1
       elif maps[m]==OP_MAP and vectorised[m]==0:
-        line += rep(indent+'ind_arg'+str(inds[m]-1)+'_s+arg_map['+\
+        line += out.rep(indent+'ind_arg'+str(inds[m]-1)+'_s+arg_map['+\
         str(cumulative_indirect_index[m])+'*set_size+n+offset_b]*<DIM>,'+'\n',m)
         a =a+1
       elif maps[m]==OP_MAP and m == 0:
-        line += rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
+        line += out.rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
         a =a+1
       elif maps[m]==OP_MAP and m>0 and vectorised[m] != vectorised[m-1]: #xxx:vector
-        line += rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
+        line += out.rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
         a =a+1
       elif maps[m]==OP_MAP and m>0 and vectorised[m] == vectorised[m-1]:
         line = line
@@ -462,149 +383,149 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
       elif maps[m]==OP_ID:
         if ninds>0:
           if soaflags[m]:
-            line += rep(indent+'<ARG>+(n+offset_b),\n',m)
+            line += out.rep(indent+'<ARG>+(n+offset_b),\n',m)
           else:
-            line += rep(indent+'<ARG>+(n+offset_b)*<DIM>,\n',m)
+            line += out.rep(indent+'<ARG>+(n+offset_b)*<DIM>,\n',m)
           a =a+1
         else:
           if dims[m] == '1' or soaflags[m]:
-            line += rep(indent+'<ARG>+n,\n',m)
+            line += out.rep(indent+'<ARG>+n,\n',m)
           else:
-            line += rep(indent+'<ARG>_l,\n',m)
+            line += out.rep(indent+'<ARG>_l,\n',m)
           a =a+1
       else:
         print('internal error 1 ')
 
-    code(line[0:-2]+');') #remove final ',' and \n
+    out.code(line[0:-2]+');', g_m) #remove final ',' and \n
 
 #
 # updating for indirect kernels ...
 #
     if ninds>0:
       if ind_inc:
-        code('col2 = colors[n+offset_b];')
-        ENDIF()
-        code('')
-        comm('store local variables')
-        code('')
+        out.code('col2 = colors[n+offset_b];')
+        out.ENDIF()
+        out.code('')
+        out.comm('store local variables')
+        out.code('')
 
         for g_m in range(0,nargs):
           if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-            code('int <ARG>_map;')
+            out.code('int <ARG>_map;', g_m)
 
-        IF('col2>=0')
+        out.IF('col2>=0')
 
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
-            code('<ARG>_map = arg_map['+str(cumulative_indirect_index[g_m])+'*set_size+n+offset_b];')
+            out.code('<ARG>_map = arg_map['+str(cumulative_indirect_index[g_m])+'*set_size+n+offset_b];', g_m)
 
-        ENDIF()
-        code('')
-        FOR('col','0','ncolor')
-        IF('col2==col')
+        out.ENDIF()
+        out.code('')
+        out.FOR('col','0','ncolor')
+        out.IF('col2==col')
 
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
-            FOR('d','0','<DIM>')
-            code('ind_arg'+str(inds[g_m]-1)+'_s[d+<ARG>_map*<DIM>] += <ARG>_l[d];')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('ind_arg'+str(inds[g_m]-1)+'_s[d+<ARG>_map*<DIM>] += <ARG>_l[d];', g_m)
+            out.ENDFOR()
 
-        ENDFOR()
-        code('__syncthreads();')
-        ENDFOR()
-      ENDFOR()
+        out.ENDFOR()
+        out.code('__syncthreads();')
+        out.ENDFOR()
+      out.ENDFOR()
 
       s = [i for i in range(1,ninds+1) if indaccs[i-1]!= OP_READ]
 
       if len(s)>0 and max(s)>0:
-        code('')
-        comm('apply pointered write/increment')
+        out.code('')
+        out.comm('apply pointered write/increment')
 
       for g_m in range(0,ninds):
         if indaccs[g_m]==OP_WRITE or indaccs[g_m]==OP_RW or indaccs[g_m]==OP_INC:
-          FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x')
+          out.FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x', g_m)
           if indaccs[g_m]==OP_WRITE or indaccs[g_m]==OP_RW:
-            code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] = <INDARG>_s[n];')
+            out.code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] = <INDARG>_s[n];', g_m)
           elif indaccs[g_m]==OP_INC:
-            code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] += <INDARG>_s[n];')
-          ENDFOR()
+            out.code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] += <INDARG>_s[n];', g_m)
+          out.ENDFOR()
 #
 # ... and direct kernels
 #
     else:
       if use_shared:
-        comm('copy back into shared memory, then to device')
+        out.comm('copy back into shared memory, then to device')
       for m in range(0,nargs):
         g_m = m
         if (maps[m]!=OP_GBL and accs[m]!=OP_READ and dims[m]!='1') and not(soaflags[m]):
-          code('')
-          FOR('m','0','<DIM>')
-          code('((<TYP> *)arg_s)[m+tid*<DIM>] = <ARG>_l[m];')
-          ENDFOR()
-          FOR('m','0','<DIM>')
-          code('<ARG>[tid+m*nelems+offset*<DIM>] = ((<TYP> *)arg_s)[tid+m*nelems];')
-          ENDFOR()
+          out.code('')
+          out.FOR('m','0','<DIM>', g_m)
+          out.code('((<TYP> *)arg_s)[m+tid*<DIM>] = <ARG>_l[m];', g_m)
+          out.ENDFOR()
+          out.FOR('m','0','<DIM>', g_m)
+          out.code('<ARG>[tid+m*nelems+offset*<DIM>] = ((<TYP> *)arg_s)[tid+m*nelems];', g_m)
+          out.ENDFOR()
 
-      depth -= 2
-      code('}')
+      out.depth -= 2
+      out.code('}')
 
 #
 # global reduction
 #
     if reduct:
-       code('')
-       comm('global reductions')
-       code('')
+       out.code('')
+       out.comm('global reductions')
+       out.code('')
        for m in range (0,nargs):
          g_m = m
          if maps[m]==OP_GBL and accs[m]!=OP_READ and accs[m] != OP_WRITE:
-           FOR('d','0','<DIM>')
+           out.FOR('d','0','<DIM>', g_m)
            if accs[m]==OP_INC:
-             code('op_reduction<OP_INC>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_INC>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            elif accs[m]==OP_MIN:
-             code('op_reduction<OP_MIN>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_MIN>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            elif accs[m]==OP_MAX:
-             code('op_reduction<OP_MAX>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_MAX>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            else:
              print('internal error: invalid reduction option')
              sys.exit(2);
-           ENDFOR()
-    depth -= 2
-    code('}')
-    code('')
+           out.ENDFOR()
+    out.depth -= 2
+    out.code('}')
+    out.code('')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm('host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm('host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){')
-        code('')
+        out.code('op_arg <ARG>){', g_m)
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL:
-        code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;')
+        out.code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
     #print vectorised
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -614,80 +535,80 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
 
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
 #
 #   indirect bits
 #
     if ninds>0:
-      code('')
-      code('int    ninds   = '+str(ninds)+';')
+      out.code('')
+      out.code('int    ninds   = '+str(ninds)+';')
       line = '  int    inds['+str(nargs)+'] = {'
       for m in range(0,nargs):
         line += str(inds[m]-1)+','
-      code(line[:-1]+'};')
-      code('')
-
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
-
-      code('')
-      comm('get plan')
-      code('#ifdef OP_PART_SIZE_'+ str(nk))
-      code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
-      code('#else')
-      code('  int part_size = OP_part_size;')
-      code('#endif')
-      code('')
-      code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
+      out.code(line[:-1]+'};', g_m)
+      out.code('')
+
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
+
+      out.code('')
+      out.comm('get plan')
+      out.code('#ifdef OP_PART_SIZE_'+ str(nk))
+      out.code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('  int part_size = OP_part_size;')
+      out.code('#endif')
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
-      code('')
-      code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('')
-
-    IF('set_size > 0')
-    code('')
-    code('op_timing_realloc('+str(nk)+');')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('')
+
+    out.IF('set_size > 0')
+    out.code('')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('')
     if any_soa:
-      code('int op2_stride_internal = set->size + set->exec_size + set->nonexec_size;')
+      out.code('int op2_stride_internal = set->size + set->exec_size + set->nonexec_size;')
       #code('op_decl_const_char(1, "int", sizeof(int), (char *)&op2_stride, "op2_stride");')
-      code('cutilSafeCall(cudaMemcpyToSymbol(op2_stride , &op2_stride_internal, sizeof(int)));');
-      code('')
+      out.code('cutilSafeCall(cudaMemcpyToSymbol(op2_stride , &op2_stride_internal, sizeof(int)));');
+      out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      code('op_plan *Plan = op_plan_get(name,set,part_size,nargs,args,ninds,inds);')
-      code('')
+      out.code('op_plan *Plan = op_plan_get(name,set,part_size,nargs,args,ninds,inds);')
+      out.code('')
 
 
 #
@@ -695,27 +616,27 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
 #
     g = [i for i in range(0,nargs) if maps[i] == OP_GBL and (accs[i] == OP_READ or accs[i] == OP_WRITE)]
     if len(g)>0:
-      comm('transfer constants to GPU')
-      code('int consts_bytes = 0;')
+      out.comm('transfer constants to GPU')
+      out.code('int consts_bytes = 0;')
       for m in range(0,nargs):
         g_m = m
         if maps[m]==OP_GBL and (accs[m]==OP_READ or accs[m]==OP_WRITE):
-          code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));')
+          out.code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));', g_m)
 
-      code('reallocConstArrays(consts_bytes);')
-      code('consts_bytes = 0;')
+      out.code('reallocConstArrays(consts_bytes);')
+      out.code('consts_bytes = 0;')
 
       for m in range(0,nargs):
         if maps[m]==OP_GBL and (accs[m]==OP_READ  or accs[m]==OP_WRITE):
           g_m = m
-          code('<ARG>.data   = OP_consts_h + consts_bytes;')
-          code('<ARG>.data_d = OP_consts_d + consts_bytes;')
-          FOR('d','0','<DIM>')
-          code('((<TYP> *)<ARG>.data)[d] = <ARG>h[d];')
-          ENDFOR()
-          code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));')
-      code('mvConstArraysToDevice(consts_bytes);')
-      code('')
+          out.code('<ARG>.data   = OP_consts_h + consts_bytes;', g_m)
+          out.code('<ARG>.data_d = OP_consts_d + consts_bytes;', g_m)
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('((<TYP> *)<ARG>.data)[d] = <ARG>h[d];', g_m)
+          out.ENDFOR()
+          out.code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));', g_m)
+      out.code('mvConstArraysToDevice(consts_bytes);')
+      out.code('')
 
 
 #
@@ -723,151 +644,151 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
 #
 
     if ninds == 0:
-      comm('set CUDA execution parameters')
-      code('#ifdef OP_BLOCK_SIZE_'+str(nk))
-      code('  int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
-      code('#else')
-      comm('  int nthread = OP_block_size;')
-      code('  int nthread = 128;')
-      code('#endif')
-      code('')
-      code('int nblocks = 200;')
-      code('')
+      out.comm('set CUDA execution parameters')
+      out.code('#ifdef OP_BLOCK_SIZE_'+str(nk))
+      out.code('  int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.comm('  int nthread = OP_block_size;')
+      out.code('  int nthread = 128;')
+      out.code('#endif')
+      out.code('')
+      out.code('int nblocks = 200;')
+      out.code('')
 
     if reduct:
-      comm('transfer global reduction data to GPU')
+      out.comm('transfer global reduction data to GPU')
       if ninds>0:
-        code('int maxblocks = 0;')
-        FOR('col','0','Plan->ncolors')
-        code('maxblocks = MAX(maxblocks,Plan->ncolblk[col]);')
-        ENDFOR()
+        out.code('int maxblocks = 0;')
+        out.FOR('col','0','Plan->ncolors')
+        out.code('maxblocks = MAX(maxblocks,Plan->ncolblk[col]);')
+        out.ENDFOR()
       else:
-        code('int maxblocks = nblocks;')
+        out.code('int maxblocks = nblocks;')
 
-      code('int reduct_bytes = 0;')
-      code('int reduct_size  = 0;')
+      out.code('int reduct_bytes = 0;')
+      out.code('int reduct_size  = 0;')
 
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-          code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));')
-          code('reduct_size   = MAX(reduct_size,sizeof(<TYP>));')
+          out.code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));', g_m)
+          out.code('reduct_size   = MAX(reduct_size,sizeof(<TYP>));', g_m)
 
-      code('reallocReductArrays(reduct_bytes);')
-      code('reduct_bytes = 0;')
+      out.code('reallocReductArrays(reduct_bytes);')
+      out.code('reduct_bytes = 0;')
 
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-          code('<ARG>.data   = OP_reduct_h + reduct_bytes;')
-          code('<ARG>.data_d = OP_reduct_d + reduct_bytes;')
-          FOR('b','0','maxblocks')
-          FOR('d','0','<DIM>')
+          out.code('<ARG>.data   = OP_reduct_h + reduct_bytes;', g_m)
+          out.code('<ARG>.data_d = OP_reduct_d + reduct_bytes;', g_m)
+          out.FOR('b','0','maxblocks')
+          out.FOR('d','0','<DIM>', g_m)
           if accs[g_m]==OP_INC:
-            code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = ZERO_<TYP>;')
+            out.code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = ZERO_<TYP>;', g_m)
           else:
-            code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = <ARG>h[d];')
-          ENDFOR()
-          ENDFOR()
-          code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));')
-      code('mvReductArraysToDevice(reduct_bytes);')
-      code('')
+            out.code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = <ARG>h[d];', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
+          out.code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));', g_m)
+      out.code('mvReductArraysToDevice(reduct_bytes);')
+      out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      comm('execute plan')
-      code('')
-      code('int block_offset = 0;')
-      FOR('col','0','Plan->ncolors')
-      IF('col==Plan->ncolors_core')
-      code('op_mpi_wait_all_cuda(nargs, args);')
-      ENDIF()
-      code('#ifdef OP_BLOCK_SIZE_'+str(nk))
-      code('int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
-      code('#else')
-      code('int nthread = OP_block_size;')
-      code('#endif')
-      code('')
-      code('dim3 nblocks = dim3(Plan->ncolblk[col] >= (1<<16) ? 65535 : Plan->ncolblk[col],')
-      code('Plan->ncolblk[col] >= (1<<16) ? (Plan->ncolblk[col]-1)/65535+1: 1, 1);')
-      IF('Plan->ncolblk[col] > 0')
+      out.comm('execute plan')
+      out.code('')
+      out.code('int block_offset = 0;')
+      out.FOR('col','0','Plan->ncolors')
+      out.IF('col==Plan->ncolors_core')
+      out.code('op_mpi_wait_all_cuda(nargs, args);')
+      out.ENDIF()
+      out.code('#ifdef OP_BLOCK_SIZE_'+str(nk))
+      out.code('int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('int nthread = OP_block_size;')
+      out.code('#endif')
+      out.code('')
+      out.code('dim3 nblocks = dim3(Plan->ncolblk[col] >= (1<<16) ? 65535 : Plan->ncolblk[col],')
+      out.code('Plan->ncolblk[col] >= (1<<16) ? (Plan->ncolblk[col]-1)/65535+1: 1, 1);')
+      out.IF('Plan->ncolblk[col] > 0')
 
       if reduct:
-        code('int nshared = MAX(Plan->nshared,reduct_size*nthread);')
+        out.code('int nshared = MAX(Plan->nshared,reduct_size*nthread);')
       else:
-        code('int nshared = Plan->nsharedCol[col];')
+        out.code('int nshared = Plan->nsharedCol[col];')
 
-      code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
+      out.code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
 
       for m in range(1,ninds+1):
         g_m = invinds[m-1]
-        code('(<TYP> *)<ARG>.data_d,')
+        out.code('(<TYP> *)<ARG>.data_d,', g_m)
 
-      code('Plan->ind_map,')
-      code('Plan->loc_map,')
+      out.code('Plan->ind_map,')
+      out.code('Plan->loc_map,')
 
       for g_m in range(0,nargs):
         if inds[g_m]==0:
-          code('(<TYP>*)<ARG>.data_d,')
-
-
-      code('Plan->ind_sizes,')
-      code('Plan->ind_offs,')
-      code('block_offset,')
-      code('Plan->blkmap,')
-      code('Plan->offset,')
-      code('Plan->nelems,')
-      code('Plan->nthrcol,')
-      code('Plan->thrcol,')
-      code('Plan->ncolblk[col],')
-      code('set_size);')
-      code('')
+          out.code('(<TYP>*)<ARG>.data_d,', g_m)
+
+
+      out.code('Plan->ind_sizes,')
+      out.code('Plan->ind_offs,')
+      out.code('block_offset,')
+      out.code('Plan->blkmap,')
+      out.code('Plan->offset,')
+      out.code('Plan->nelems,')
+      out.code('Plan->nthrcol,')
+      out.code('Plan->thrcol,')
+      out.code('Plan->ncolblk[col],')
+      out.code('set_size);')
+      out.code('')
       if reduct:
-        comm('transfer global reduction data back to CPU')
-        IF('col == Plan->ncolors_owned-1')
-        code('mvReductArraysToHost(reduct_bytes);')
-        ENDIF()
-
-      ENDFOR()
-      code('block_offset += Plan->ncolblk[col];')
-      ENDIF()
+        out.comm('transfer global reduction data back to CPU')
+        out.IF('col == Plan->ncolors_owned-1')
+        out.code('mvReductArraysToHost(reduct_bytes);')
+        out.ENDIF()
+
+      out.ENDFOR()
+      out.code('block_offset += Plan->ncolblk[col];')
+      out.ENDIF()
 #
 # kernel call for direct version
 #
     else:
-      comm('work out shared memory requirements per element')
-      code('')
-      code('int nshared = 0;')
+      out.comm('work out shared memory requirements per element')
+      out.code('')
+      out.code('int nshared = 0;')
 
       for g_m in range(0,nargs):
          if maps[g_m]!=OP_GBL and dims[g_m]!='1':
-           code('nshared = MAX(nshared,sizeof(<TYP>)*<DIM>);')
+           out.code('nshared = MAX(nshared,sizeof(<TYP>)*<DIM>);', g_m)
 
-      code('')
-      comm('execute plan')
-      code('int offset_s = nshared*OP_WARPSIZE;')
-      code('')
+      out.code('')
+      out.comm('execute plan')
+      out.code('int offset_s = nshared*OP_WARPSIZE;')
+      out.code('')
 
       if reduct:
-        code('nshared = MAX(nshared*nthread,reduct_size*nthread);')
+        out.code('nshared = MAX(nshared*nthread,reduct_size*nthread);')
       else:
-        code('nshared = nshared*nthread;')
+        out.code('nshared = nshared*nthread;')
 
-      code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
+      out.code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
 
       indent = '  '#*(len(name)+42)
       for g_m in range(0,nargs):
         if g_m > 0:
-          code(indent+'(<TYP> *) <ARG>.data_d,')
+          out.code(indent+'(<TYP> *) <ARG>.data_d,', g_m)
         else:
-          code(indent+'(<TYP> *) <ARG>.data_d,')
+          out.code(indent+'(<TYP> *) <ARG>.data_d,', g_m)
 
-      code(indent+'offset_s,')
-      code(indent+'set->size );')
+      out.code(indent+'offset_s,')
+      out.code(indent+'set->size );')
 
     if ninds>0:
-      code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
-      code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
+      out.code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
+      out.code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
 
 
 #
@@ -875,49 +796,49 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
 #
     if reduct:
       if ninds == 0:
-        comm('transfer global reduction data back to CPU')
-        code('mvReductArraysToHost(reduct_bytes);')
+        out.comm('transfer global reduction data back to CPU')
+        out.code('mvReductArraysToHost(reduct_bytes);')
 
       for m in range(0,nargs):
         g_m = m
         if maps[m]==OP_GBL and accs[m]!=OP_READ and accs[m]!=OP_WRITE:
-          FOR('b','0','maxblocks')
-          FOR('d','0','<DIM>')
+          out.FOR('b','0','maxblocks')
+          out.FOR('d','0','<DIM>', g_m)
           if accs[m]==OP_INC:
-            code('<ARG>h[d] = <ARG>h[d] + ((<TYP> *)<ARG>.data)[d+b*<DIM>];')
+            out.code('<ARG>h[d] = <ARG>h[d] + ((<TYP> *)<ARG>.data)[d+b*<DIM>];', g_m)
           elif accs[m]==OP_MIN:
-            code('<ARG>h[d] = MIN(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);')
+            out.code('<ARG>h[d] = MIN(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);', g_m)
           elif accs[m]==OP_MAX:
-            code('<ARG>h[d] = MAX(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);')
-          ENDFOR()
-          ENDFOR()
+            out.code('<ARG>h[d] = MAX(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
 
-          code('<ARG>.data = (char *)<ARG>h;')
-          code('op_mpi_reduce(&<ARG>,<ARG>h);')
+          out.code('<ARG>.data = (char *)<ARG>h;', g_m)
+          out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
     for g_m in range(0,nargs):
       if maps[g_m] == OP_GBL and accs[g_m] == OP_WRITE:
-        code('mvConstArraysToHost(consts_bytes);')
+        out.code('mvConstArraysToHost(consts_bytes);')
         break
 
     for g_m in range(0,nargs):
       if maps[g_m] == OP_GBL and accs[g_m] == OP_WRITE:
-        FOR('d','0','<DIM>')
-        code('<ARG>h[d] = ((<TYP> *)<ARG>.data)[d];') 
-        ENDFOR()
-        code('<ARG>.data = (char *)<ARG>h;')
-        code('op_mpi_reduce(&<ARG>,<ARG>h);')
+        out.FOR('d','0','<DIM>', g_m)
+        out.code('<ARG>h[d] = ((<TYP> *)<ARG>.data)[d];', g_m) 
+        out.ENDFOR()
+        out.code('<ARG>.data = (char *)<ARG>h;', g_m)
+        out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
-    ENDIF()
-    code('op_mpi_set_dirtybit_cuda(nargs, args);')
+    out.ENDIF()
+    out.code('op_mpi_set_dirtybit_cuda(nargs, args);')
 
 #
 # update kernel record
 #
 
-    comm('update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.comm('update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
@@ -925,24 +846,19 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
       for g_m in range (0,nargs):
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ or accs[g_m]==OP_WRITE:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
 
-    depth = depth - 2
-    code('}')
+    out.depth = out.depth - 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('cuda'):
-        os.makedirs('cuda')
-    fid = open('cuda/'+name+'_kernel.cu','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('cuda/'+name+'_kernel.cu', '//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -951,76 +867,72 @@ def op2_gen_cuda(master, date, consts, kernels, sets):
 #  output one master kernel file
 ##########################################################################
 
-  file_text = ''
+  out = op2_gen_common.CodeEmitter(strip=False)
 
-  comm('global constants')
+  out.comm('global constants')
 
-  code('#ifndef MAX_CONST_SIZE')
-  code('#define MAX_CONST_SIZE 128')
-  code('#endif')
-  code('')
+  out.code('#ifndef MAX_CONST_SIZE')
+  out.code('#define MAX_CONST_SIZE 128')
+  out.code('#endif')
+  out.code('')
 
   for nc in range (0,len(consts)):
     if consts[nc]['dim']==1:
-      code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+      out.code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
     else:
       if consts[nc]['dim'] > 0:
         num = str(consts[nc]['dim'])
       else:
         num = 'MAX_CONST_SIZE'
 
-      code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+      out.code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm('header')
+  out.comm('header')
   if os.path.exists('./user_types.h'):
-    code('#ifndef OP_FUN_PREFIX\n#define OP_FUN_PREFIX __host__ __device__\n#endif')
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"')
-  code('#include "op_cuda_rt_support.h"')
-  code('#include "op_cuda_reduction.h"')
-  code('')
+    out.code('#ifndef OP_FUN_PREFIX\n#define OP_FUN_PREFIX __host__ __device__\n#endif')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"')
+  out.code('#include "op_cuda_rt_support.h"')
+  out.code('#include "op_cuda_reduction.h"')
+  out.code('')
 
   # if any_soa:
   #   code('__constant__ int op2_stride;')
   #   code('')
   #   code('#define OP2_STRIDE(arr, idx) arr[op2_stride*(idx)]')
 
-  code('')
-  code('void op_decl_const_char(int dim, char const *type,')
-  code('int size, char *dat, char const *name){')
-  depth = depth + 2
+  out.code('')
+  out.code('void op_decl_const_char(int dim, char const *type,')
+  out.code('int size, char *dat, char const *name){')
+  out.depth = out.depth + 2
 
   for nc in range(0,len(consts)):
-    IF('!strcmp(name,"'+consts[nc]['name']+'")')
+    out.IF('!strcmp(name,"'+consts[nc]['name']+'")')
     if consts[nc]['dim'] < 0:
-      IF('!strcmp(name,"'+consts[nc]['name']+'") && size>MAX_CONST_SIZE) {')
-      code('printf("error: MAX_CONST_SIZE not big enough\n"); exit(1);')
-      ENDIF()
-    code('cutilSafeCall(cudaMemcpyToSymbol('+consts[nc]['name']+', dat, dim*size));')
-    ENDIF()
-    code('else ')
+      out.IF('!strcmp(name,"'+consts[nc]['name']+'") && size>MAX_CONST_SIZE) {')
+      out.code('printf("error: MAX_CONST_SIZE not big enough\n"); exit(1);')
+      out.ENDIF()
+    out.code('cutilSafeCall(cudaMemcpyToSymbol('+consts[nc]['name']+', dat, dim*size));')
+    out.ENDIF()
+    out.code('else ')
 
-  code('{')
-  depth = depth + 2
-  code('printf("error: unknown const name\\n"); exit(1);')
-  ENDIF()
+  out.code('{')
+  out.depth = out.depth + 2
+  out.code('printf("error: unknown const name\\n"); exit(1);')
+  out.ENDIF()
 
 
-  depth = depth - 2
-  code('}')
-  code('')
-  comm('user kernel files')
+  out.depth = out.depth - 2
+  out.code('}')
+  out.code('')
+  out.comm('user kernel files')
 
   for nk in range(0,len(kernels)):
-    file_text = file_text +\
-    '#include "'+kernels[nk]['name']+'_kernel.cu"\n'
+    out.append('#include "'+kernels[nk]['name']+'_kernel.cu"\n')
 
   master = master.split('.')[0]
-  fid = open('cuda/'+master.split('.')[0]+'_kernels.cu','w')
-  fid.write('//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('cuda/'+master.split('.')[0]+'_kernels.cu', '//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n' + out.text())
 
 
 
@@ -15,90 +15,9 @@ import glob
 import os
 import op2_gen_common
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line.rstrip()+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if text == '':
-    prefix = ''
-  else:
-    prefix = ' '*depth
-  file_text += prefix+rep(text,g_m).rstrip()+'\n'
-
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def FOR_INC(i,start,finish,inc):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'+='+inc+' ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
 
 def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -203,8 +122,7 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims)
 
 
     #strides for SoA
@@ -214,30 +132,28 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('__constant__ int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT;')
-            code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST=-1;')
+            out.code('__constant__ int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT;')
+            out.code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST=-1;')
       dir_soa = -1
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID and ((not dims[g_m].isdigit()) or int(dims[g_m]) > 1):
-          code('__constant__ int direct_'+name+'_stride_OP2CONSTANT;')
-          code('int direct_'+name+'_stride_OP2HOST=-1;')
+          out.code('__constant__ int direct_'+name+'_stride_OP2CONSTANT;')
+          out.code('int direct_'+name+'_stride_OP2HOST=-1;')
           dir_soa = g_m
           break
 
     file_name = decl_filepath
 
-    f = open(file_name, 'r')
-    kernel_text = f.read()
-    f.close()
+    kernel_text = op2_gen_common.read_text_file(file_name)
 
     if CPP:
       includes = op2_gen_common.extract_includes(kernel_text)
       if len(includes) > 0:
         for include in includes:
-          code(include)
-        code("")
+          out.code(include)
+        out.code("")
 
-    comm('user function')
+    out.comm('user function')
 
     kernel_text = op2_gen_common.comment_remover(kernel_text)
     kernel_text = op2_gen_common.remove_trailing_w_space(kernel_text)
@@ -289,89 +205,89 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
       body_text = re.sub('\\b'+varname+'\\b', varname+'_cuda',body_text)
 
     signature_text = '__device__ '+head_text + '_gpu( '+signature_text + ') {'
-    file_text += signature_text + body_text + '}\n'
+    out.append(signature_text + body_text + '}\n')
 
-    comm('')
-    comm(' CUDA kernel function')
+    out.comm('')
+    out.comm(' CUDA kernel function')
 
     if FORTRAN:
-      code('subroutine op_cuda_'+name+'(')
+      out.code('subroutine op_cuda_'+name+'(')
     elif CPP:
-      code('__global__ void op_cuda_'+name+'(')
+      out.code('__global__ void op_cuda_'+name+'(')
 
-    depth = 2
+    out.depth = 2
 
     if nopts > 0:
-      code('int optflags,')
+      out.code('int optflags,')
 
     for g_m in range(0,ninds):
       if (indaccs[g_m]==OP_READ):
-        code('const <INDTYP> *__restrict <INDARG>,')
+        out.code('const <INDTYP> *__restrict <INDARG>,', g_m)
       else:
-        code('<INDTYP> *__restrict <INDARG>,')
+        out.code('<INDTYP> *__restrict <INDARG>,', g_m)
 
     if nmaps > 0:
       k = []
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
           k = k + [mapnames[g_m]]
-          code('const int *__restrict opDat'+str(invinds[inds[g_m]-1])+'Map, ')
+          out.code('const int *__restrict opDat'+str(invinds[inds[g_m]-1])+'Map, ')
 
 
 
     for g_m in range(0,nargs):
       if maps[g_m] == OP_ID:
         if accs[g_m] == OP_READ:
-          code('const <TYP> *__restrict <ARG>,')
+          out.code('const <TYP> *__restrict <ARG>,', g_m)
         else:
-          code('<TYP> *<ARG>,')
+          out.code('<TYP> *<ARG>,', g_m)
       elif maps[g_m] == OP_GBL:
         if accs[g_m] == OP_INC or accs[g_m] == OP_MIN or accs[g_m] == OP_MAX or accs[g_m] == OP_WRITE:
-          code('<TYP> *<ARG>,')
+          out.code('<TYP> *<ARG>,', g_m)
         elif accs[g_m] == OP_READ:
-          code('const <TYP> *<ARG>,')
+          out.code('const <TYP> *<ARG>,', g_m)
 
     if ind_inc and inc_stage==1:
-      code('int   *ind_map,')
-      code('short *arg_map,')
-      code('int   *ind_arg_sizes,')
-      code('int   *ind_arg_offs, ')
+      out.code('int   *ind_map,')
+      out.code('short *arg_map,')
+      out.code('int   *ind_arg_sizes,')
+      out.code('int   *ind_arg_offs, ')
 
     if ninds>0:
       if op_color2:
-        code('int start,           ')
-        code('int end,             ')
-        code('int *col_reord,      ')
+        out.code('int start,           ')
+        out.code('int end,             ')
+        out.code('int *col_reord,      ')
       elif not atomics:
-        code('int    block_offset, ')
-        code('int   *blkmap,       ')
-        code('int   *offset,       ')
-        code('int   *nelems,       ')
-        code('int   *ncolors,      ')
-        code('int   *colors,       ')
-        code('int   nblocks,       ')
+        out.code('int    block_offset, ')
+        out.code('int   *blkmap,       ')
+        out.code('int   *offset,       ')
+        out.code('int   *nelems,       ')
+        out.code('int   *ncolors,      ')
+        out.code('int   *colors,       ')
+        out.code('int   nblocks,       ')
       else:
-        code('int start,           ')
-        code('int end,             ')
-      code('int   set_size) {    ')
+        out.code('int start,           ')
+        out.code('int end,             ')
+      out.code('int   set_size) {    ')
     else:
-      code('int   set_size ) {')
-      code('')
+      out.code('int   set_size ) {')
+      out.code('')
 
 
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m] != OP_WRITE:
-        code('<TYP> <ARG>_l[<DIM>];')
+        out.code('<TYP> <ARG>_l[<DIM>];', g_m)
         if accs[g_m] == OP_INC:
-          FOR('d','0','<DIM>')
-          code('<ARG>_l[d]=ZERO_<TYP>;')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>_l[d]=ZERO_<TYP>;', g_m)
+          out.ENDFOR()
         else:
-          FOR('d','0','<DIM>')
-          code('<ARG>_l[d]=<ARG>[d+blockIdx.x*<DIM>];')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>_l[d]=<ARG>[d+blockIdx.x*<DIM>];', g_m)
+          out.ENDFOR()
       elif maps[g_m]==OP_MAP and accs[g_m]==OP_INC and not op_color2 and not atomics:
-        code('<TYP> <ARG>_l[<DIM>];')
+        out.code('<TYP> <ARG>_l[<DIM>];', g_m)
 
     if not op_color2 and not atomics:
       for m in range (1,ninds+1):
@@ -381,137 +297,137 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
         if sum(v)>1 and sum(v_i)>0: #check this sum(v_i)
           if indaccs[m-1] == OP_INC:
             ind = int(max([idxs[i] for i in range(len(inds)) if inds[i]==m])) + 1
-            code('<INDTYP> *arg'+str(invinds[m-1])+'_vec['+str(ind)+'] = {'); depth += 2;
+            out.code('<INDTYP> *arg'+str(invinds[m-1])+'_vec['+str(ind)+'] = {', g_m); out.depth += 2;
             for n in range(0,nargs):
               if inds[n] == m:
                 g_m = n
-                code('<ARG>_l,')
-            depth -= 2
-            code('};')
+                out.code('<ARG>_l,', g_m)
+            out.depth -= 2
+            out.code('};')
 #
 # lengthy code for general case with indirection
 #
     if ninds>0 and not op_color2 and not atomics:
-      code('')
+      out.code('')
       if inc_stage==1:
         for g_m in range (0,ninds):
           if indaccs[g_m] == OP_INC:
-            code('__shared__  int  *<INDARG>_map, <INDARG>_size;')
-            code('__shared__  <INDTYP> *<INDARG>_s;')
-        code('')
+            out.code('__shared__  int  *<INDARG>_map, <INDARG>_size;', g_m)
+            out.code('__shared__  <INDTYP> *<INDARG>_s;', g_m)
+        out.code('')
       if ind_inc:
-        code('__shared__ int    nelems2, ncolor;')
-
-      code('__shared__ int    nelem, offset_b;')
-      code('')
-      code('extern __shared__ char shared[];')
-      code('')
-      IF('blockIdx.x+blockIdx.y*gridDim.x >= nblocks')
-      code('return;')
-      ENDIF()
-      IF('threadIdx.x==0')
-      code('')
-      comm('get sizes and shift pointers and direct-mapped data')
-      code('')
-      code('int blockId = blkmap[blockIdx.x + blockIdx.y*gridDim.x  + block_offset];')
-      code('')
-      code('nelem    = nelems[blockId];')
-      code('offset_b = offset[blockId];')
-      code('')
+        out.code('__shared__ int    nelems2, ncolor;')
+
+      out.code('__shared__ int    nelem, offset_b;')
+      out.code('')
+      out.code('extern __shared__ char shared[];')
+      out.code('')
+      out.IF('blockIdx.x+blockIdx.y*gridDim.x >= nblocks')
+      out.code('return;')
+      out.ENDIF()
+      out.IF('threadIdx.x==0')
+      out.code('')
+      out.comm('get sizes and shift pointers and direct-mapped data')
+      out.code('')
+      out.code('int blockId = blkmap[blockIdx.x + blockIdx.y*gridDim.x  + block_offset];')
+      out.code('')
+      out.code('nelem    = nelems[blockId];')
+      out.code('offset_b = offset[blockId];')
+      out.code('')
 
       if ind_inc:
-        code('nelems2  = blockDim.x*(1+(nelem-1)/blockDim.x);')
-        code('ncolor   = ncolors[blockId];')
-        code('')
+        out.code('nelems2  = blockDim.x*(1+(nelem-1)/blockDim.x);')
+        out.code('ncolor   = ncolors[blockId];')
+        out.code('')
 
       if inc_stage==1 and ind_inc:
         for g_m in range (0,ninds_staged):
           if indopts_staged[g_m-1] > 0:
-            IF('optflags & 1<<'+str(optidxs[indopts_staged[g_m-1]]))
-          code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds_staged)+'];')
+            out.IF('optflags & 1<<'+str(optidxs[indopts_staged[g_m-1]]))
+          out.code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds_staged)+'];')
           if indopts_staged[g_m-1] > 0:
-            ENDIF()
+            out.ENDIF()
 
-        code('')
+        out.code('')
         for m in range (1,ninds_staged+1):
           g_m = m - 1
           c = [i for i in range(nargs) if inds_staged[i]==m]
-          code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
+          out.code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
           '*set_size] + ind_arg_offs['+str(m-1)+'+blockId*'+str(ninds_staged)+'];')
 
-        code('')
-        comm('set shared memory pointers')
-        code('int nbytes = 0;')
+        out.code('')
+        out.comm('set shared memory pointers')
+        out.code('int nbytes = 0;')
 
         for g_m in range(0,ninds_staged):
-          code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_s = ('+typs[invinds_staged[g_m]]+' *) &shared[nbytes];')
+          out.code('ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_s = ('+typs[invinds_staged[g_m]]+' *) &shared[nbytes];')
           if g_m < ninds_staged-1:
             if indopts_staged[g_m-1] > 0:
-              IF('optflags & 1<<'+str(optidxs[indopts_staged[g_m-1]]))
-            code('nbytes    += ROUND_UP(ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_size*sizeof('+typs[invinds_staged[g_m]]+')*'+dims[invinds_staged[g_m]]+');')
+              out.IF('optflags & 1<<'+str(optidxs[indopts_staged[g_m-1]]))
+            out.code('nbytes    += ROUND_UP(ind_arg'+str(inds[invinds_staged[g_m]]-1)+'_size*sizeof('+typs[invinds_staged[g_m]]+')*'+dims[invinds_staged[g_m]]+');')
             if indopts_staged[g_m-1] > 0:
-              ENDIF()
+              out.ENDIF()
 
 
-      ENDIF()
-      code('__syncthreads(); // make sure all of above completed')
-      code('')
+      out.ENDIF()
+      out.code('__syncthreads(); // make sure all of above completed')
+      out.code('')
 
       if inc_stage==1:
         for g_m in range(0,ninds):
           if indaccs[g_m] == OP_INC:
-            FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x')
-            code('<INDARG>_s[n] = ZERO_<INDTYP>;')
-            ENDFOR()
+            out.FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x', g_m)
+            out.code('<INDARG>_s[n] = ZERO_<INDTYP>;', g_m)
+            out.ENDFOR()
         if ind_inc:
-          code('')
-          code('__syncthreads();')
-          code('')
+          out.code('')
+          out.code('__syncthreads();')
+          out.code('')
 
       if ind_inc:
-        FOR_INC('n','threadIdx.x','nelems2','blockDim.x')
-        code('int col2 = -1;')
+        out.FOR_INC('n','threadIdx.x','nelems2','blockDim.x')
+        out.code('int col2 = -1;')
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
-        IF('n<nelem')
-        comm('initialise local variables')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
+        out.IF('n<nelem')
+        out.comm('initialise local variables')
 
         for g_m in range(0,nargs):
           if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d] = ZERO_<TYP>;')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d] = ZERO_<TYP>;', g_m)
+            out.ENDFOR()
       else:
-        FOR_INC('n','threadIdx.x','nelem','blockDim.x')
+        out.FOR_INC('n','threadIdx.x','nelem','blockDim.x')
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
 
       #non-optional maps
       k = []
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not optflags[g_m]) and (not mapinds[g_m] in k):
           k = k + [mapinds[g_m]]
-          code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + offset_b + set_size * '+str(int(idxs[g_m]))+'];')
+          out.code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + offset_b + set_size * '+str(int(idxs[g_m]))+'];')
 
       #whatever didn't come up and is opt
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
           if optflags[g_m]==1:
-            IF('optflags & 1<<'+str(optidxs[g_m]))
+            out.IF('optflags & 1<<'+str(optidxs[g_m]))
           else:
             k = k + [mapinds[g_m]]
 
-          code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + offset_b + set_size * '+str(int(idxs[g_m]))+'];')
+          out.code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + offset_b + set_size * '+str(int(idxs[g_m]))+'];')
           if optflags[g_m]==1:
-            ENDIF()
+            out.ENDIF()
 
-      code('')
+      out.code('')
       for g_m in range (0,nargs):
         if accs[g_m] != OP_INC: #TODO: add opt handling here
           u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
@@ -525,58 +441,58 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
             first = [i for i in range(0,len(v)) if v[i] == 1]
             first = first[0]
 
-            indent = ' '*(depth+2)
+            indent = ' '*(out.depth+2)
             for k in range(0,sum(v)):
               if soaflags[g_m]:
                 line = line + indent + ' &ind_arg'+str(inds[first]-1)+'[map'+str(mapinds[g_m+k])+'idx],\n'
               else:
                 line = line + indent + ' &ind_arg'+str(inds[first]-1)+'[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
             line = line[:-2]+'};'
-            code(line)
+            out.code(line, g_m)
 #
 # simple version for atomics/global coloring
 #
     elif ninds>0:
-      code('int tid = threadIdx.x + blockIdx.x * blockDim.x;')
-      IF('tid + start < end')
+      out.code('int tid = threadIdx.x + blockIdx.x * blockDim.x;')
+      out.IF('tid + start < end')
       if atomics:
-        code('int n = tid + start;')
+        out.code('int n = tid + start;')
       else:
-        code('int n = col_reord[tid + start];')
-      comm('initialise local variables')
+        out.code('int n = col_reord[tid + start];')
+      out.comm('initialise local variables')
 
       for g_m in range(0,nargs):
         if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-          code('<TYP> <ARG>_l[<DIM>];')
-          FOR('d','0','<DIM>')
-          code('<ARG>_l[d] = ZERO_<TYP>;')
-          ENDFOR()
+          out.code('<TYP> <ARG>_l[<DIM>];', g_m)
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>_l[d] = ZERO_<TYP>;', g_m)
+          out.ENDFOR()
 
       #mapidx declarations
       k = []
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
           k = k + [mapinds[g_m]]
-          code('int map'+str(mapinds[g_m])+'idx;')
+          out.code('int map'+str(mapinds[g_m])+'idx;')
 
       #non-optional maps
       k = []
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not optflags[g_m]) and (not mapinds[g_m] in k):
           k = k + [mapinds[g_m]] #non-opt
-          code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + set_size * '+str(int(idxs[g_m]))+'];')
+          out.code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + set_size * '+str(int(idxs[g_m]))+'];')
 
       #whatever didn't come up and is opt
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
           if optflags[g_m]==1:
-            IF('optflags & 1<<'+str(optidxs[g_m]))
+            out.IF('optflags & 1<<'+str(optidxs[g_m]))
           else:
             k = k + [mapinds[g_m]]
 
-          code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + set_size * '+str(int(idxs[g_m]))+'];')
+          out.code('map'+str(mapinds[g_m])+'idx = opDat'+str(invmapinds[inds[g_m]-1])+'Map[n + set_size * '+str(int(idxs[g_m]))+'];')
           if optflags[g_m]==1:
-            ENDIF()
+            out.ENDIF()
 
       for g_m in range (0,nargs):
           u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
@@ -586,25 +502,25 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
             else:
               line = '<TYP>* <ARG>_vec[] = {\n'
             if atomics and accs[g_m] == OP_INC:
-              indent = ' '*(depth+2)
+              indent = ' '*(out.depth+2)
               for n in range(0,nargs):
                 if vectorised[n] == vectorised[g_m]:
                   line = line + indent + 'arg'+str(n)+'_l,\n'
               line = line[:-2]+'};'
-              code(line)
+              out.code(line, g_m)
             else:
               v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
               first = [i for i in range(0,len(v)) if v[i] == 1]
               first = first[0]
 
-              indent = ' '*(depth+2)
+              indent = ' '*(out.depth+2)
               for k in range(0,sum(v)):
                 if soaflags[g_m]:
                   line = line + indent + ' &ind_arg'+str(inds[first]-1)+'[map'+str(mapinds[g_m+k])+'idx],\n'
                 else:
                   line = line + indent + ' &ind_arg'+str(inds[first]-1)+'[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
               line = line[:-2]+'};'
-              code(line)
+              out.code(line, g_m)
 
 
 
@@ -613,15 +529,15 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 # simple alternative when no indirection
 #
     else:
-      code('')
-      comm('process set elements')
-      FOR_INC('n','threadIdx.x+blockIdx.x*blockDim.x','set_size','blockDim.x*gridDim.x')
+      out.code('')
+      out.comm('process set elements')
+      out.FOR_INC('n','threadIdx.x+blockIdx.x*blockDim.x','set_size','blockDim.x*gridDim.x')
 
 #
 # kernel call
 #
-    code('')
-    comm('user-supplied kernel call')
+    out.code('')
+    out.comm('user-supplied kernel call')
     line = name+'_gpu('
     prefix = ' '*len(name)
     a = 0 #only apply indentation if its not the 0th argument
@@ -632,203 +548,203 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 
       if maps[m] == OP_GBL:
         if accs[m] == OP_READ or accs[m] == OP_WRITE:
-          line += rep(indent+'<ARG>,\n',m)
+          line += out.rep(indent+'<ARG>,\n',m)
         else:
-          line += rep(indent+'<ARG>_l,\n',m);
+          line += out.rep(indent+'<ARG>_l,\n',m);
         a =a+1
       elif maps[m]==OP_MAP and  accs[m]==OP_INC and not op_color2:
         if vectorised[m]:
           if m+1 in unique_args:
-            line += rep(indent+'<ARG>_vec,\n',m)
+            line += out.rep(indent+'<ARG>_vec,\n',m)
         else:
-          line += rep(indent+'<ARG>_l,\n',m)
+          line += out.rep(indent+'<ARG>_l,\n',m)
         a =a+1
       elif maps[m]==OP_MAP:
         if vectorised[m]:
           if m+1 in unique_args:
-            line += rep(indent+'<ARG>_vec,\n',m)
+            line += out.rep(indent+'<ARG>_vec,\n',m)
         else:
           if soaflags[m]:
-            line += rep(indent+'ind_arg'+str(inds[m]-1)+'+map'+str(mapinds[m])+'idx,'+'\n',m)
+            line += out.rep(indent+'ind_arg'+str(inds[m]-1)+'+map'+str(mapinds[m])+'idx,'+'\n',m)
           else:
-            line += rep(indent+'ind_arg'+str(inds[m]-1)+'+map'+str(mapinds[m])+'idx*<DIM>,'+'\n',m)
+            line += out.rep(indent+'ind_arg'+str(inds[m]-1)+'+map'+str(mapinds[m])+'idx*<DIM>,'+'\n',m)
         a =a+1
       elif maps[m]==OP_ID:
         if ninds>0 and not op_color2 and not atomics:
           if soaflags[m]:
-            line += rep(indent+'<ARG>+(n+offset_b),\n',m)
+            line += out.rep(indent+'<ARG>+(n+offset_b),\n',m)
           else:
-            line += rep(indent+'<ARG>+(n+offset_b)*<DIM>,\n',m)
+            line += out.rep(indent+'<ARG>+(n+offset_b)*<DIM>,\n',m)
           a =a+1
         else:
           if soaflags[m]:
-            line += rep(indent+'<ARG>+n,\n',m)
+            line += out.rep(indent+'<ARG>+n,\n',m)
           else:
-            line += rep(indent+'<ARG>+n*<DIM>,\n',m)
+            line += out.rep(indent+'<ARG>+n*<DIM>,\n',m)
           a =a+1
       else:
         print('internal error 1 ')
 
-    code(line[0:-2]+');') #remove final ',' and \n
+    out.code(line[0:-2]+');', g_m) #remove final ',' and \n
 
 #
 # updating for indirect kernels ...
 #
     if ninds>0 and not op_color2 and not atomics:
       if ind_inc:
-        code('col2 = colors[n+offset_b];')
-        ENDIF()
-        code('')
-        comm('store local variables')
-        code('')
+        out.code('col2 = colors[n+offset_b];')
+        out.ENDIF()
+        out.code('')
+        out.comm('store local variables')
+        out.code('')
         if inc_stage==1:
           for g_m in range(0,nargs):
             if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-              code('int <ARG>_map;')
-          IF('col2>=0')
+              out.code('int <ARG>_map;', g_m)
+          out.IF('col2>=0')
           for g_m in range(0,nargs):
             if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
-              code('<ARG>_map = arg_map['+str(cumulative_indirect_index[g_m])+'*set_size+n+offset_b];')
-          ENDIF()
-          code('')
+              out.code('<ARG>_map = arg_map['+str(cumulative_indirect_index[g_m])+'*set_size+n+offset_b];', g_m)
+          out.ENDIF()
+          out.code('')
 
-        FOR('col','0','ncolor')
-        IF('col2==col')
+        out.FOR('col','0','ncolor')
+        out.IF('col2==col')
 
         if inc_stage==1:
           for g_m in range(0,nargs):
             if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
               if optflags[g_m]==1:
-                IF('optflags & 1<<'+str(optidxs[g_m]))
+                out.IF('optflags & 1<<'+str(optidxs[g_m]))
               for d in range(0,int(dims[g_m])):
                 if soaflags[g_m]:
-                  code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'_s[<ARG>_map+'+str(d)+'*ind_arg'+str(inds[g_m]-1)+'_size];')
+                  out.code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'_s[<ARG>_map+'+str(d)+'*ind_arg'+str(inds[g_m]-1)+'_size];', g_m)
                 else:
-                  code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'_s['+str(d)+'+<ARG>_map*<DIM>];')
+                  out.code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'_s['+str(d)+'+<ARG>_map*<DIM>];', g_m)
 #          for g_m in range(0,nargs):
 #            if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
               for d in range(0,int(dims[g_m])):
                 if soaflags[g_m]:
-                  code('ind_arg'+str(inds[g_m]-1)+'_s[<ARG>_map+'+str(d)+'*ind_arg'+str(inds[g_m]-1)+'_size] = <ARG>_l['+str(d)+'];')
+                  out.code('ind_arg'+str(inds[g_m]-1)+'_s[<ARG>_map+'+str(d)+'*ind_arg'+str(inds[g_m]-1)+'_size] = <ARG>_l['+str(d)+'];', g_m)
                 else:
-                  code('ind_arg'+str(inds[g_m]-1)+'_s['+str(d)+'+<ARG>_map*<DIM>] = <ARG>_l['+str(d)+'];')
+                  out.code('ind_arg'+str(inds[g_m]-1)+'_s['+str(d)+'+<ARG>_map*<DIM>] = <ARG>_l['+str(d)+'];', g_m)
 
               if optflags[g_m]==1:
-                ENDIF()
+                out.ENDIF()
         else:
           for g_m in range(0,nargs):
             if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
               if optflags[g_m]==1:
-                IF('optflags & 1<<'+str(optidxs[g_m]))
+                out.IF('optflags & 1<<'+str(optidxs[g_m]))
               for d in range(0,int(dims[g_m])):
                 if soaflags[g_m]:
-                  code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx];')
+                  out.code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx];', g_m)
                 else:
-                  code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>];')
+                  out.code('<ARG>_l['+str(d)+'] += ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>];', g_m)
 #          for g_m in range(0,nargs):
 #            if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
               for d in range(0,int(dims[g_m])):
                 if soaflags[g_m]:
-                  code('ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx] = <ARG>_l['+str(d)+'];')
+                  out.code('ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx] = <ARG>_l['+str(d)+'];', g_m)
                 else:
-                  code('ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>] = <ARG>_l['+str(d)+'];')
+                  out.code('ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>] = <ARG>_l['+str(d)+'];', g_m)
               if optflags[g_m]==1:
-                ENDIF()
+                out.ENDIF()
 
-        ENDFOR()
-        code('__syncthreads();')
-        ENDFOR()
+        out.ENDFOR()
+        out.code('__syncthreads();')
+        out.ENDFOR()
     if ninds>0 and atomics:
           for g_m in range(0,nargs):
             if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
               if optflags[g_m]==1:
-                IF('optflags & 1<<'+str(optidxs[g_m]))
+                out.IF('optflags & 1<<'+str(optidxs[g_m]))
               for d in range(0,int(dims[g_m])):
                 if soaflags[g_m]:
-                  code('atomicAdd(&ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx],<ARG>_l['+str(d)+']);')
+                  out.code('atomicAdd(&ind_arg'+str(inds[g_m]-1)+'['+str(d)+'*'+op2_gen_common.get_stride_string(g_m,maps,mapnames,name)+'+map'+str(mapinds[g_m])+'idx],<ARG>_l['+str(d)+']);', g_m)
                 else:
-                  code('atomicAdd(&ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>],<ARG>_l['+str(d)+']);')
+                  out.code('atomicAdd(&ind_arg'+str(inds[g_m]-1)+'['+str(d)+'+map'+str(mapinds[g_m])+'idx*<DIM>],<ARG>_l['+str(d)+']);', g_m)
               if optflags[g_m]==1:
-                ENDIF()
+                out.ENDIF()
 
 
-    ENDFOR()
+    out.ENDFOR()
 
     if inc_stage:
       for g_m in range(0,ninds):
         if indaccs[g_m]==OP_INC:
           if indopts[g_m] > 0:
-            IF('optflags & 1<<'+str(optidxs[indopts[g_m-1]]))
+            out.IF('optflags & 1<<'+str(optidxs[indopts[g_m-1]]))
           if soaflags[invinds[g_m]]:
-            FOR_INC('n','threadIdx.x','<INDARG>_size','blockDim.x')
+            out.FOR_INC('n','threadIdx.x','<INDARG>_size','blockDim.x', g_m)
             for d in range(0,int(dims[invinds[g_m]])):
-              code('arg'+str(invinds[g_m])+'_l['+str(d)+'] = <INDARG>_s[n+'+str(d)+'*<INDARG>_size] + <INDARG>[<INDARG>_map[n]+'+str(d)+'*'+op2_gen_common.get_stride_string(invinds[g_m],maps,mapnames,name)+'];')
+              out.code('arg'+str(invinds[g_m])+'_l['+str(d)+'] = <INDARG>_s[n+'+str(d)+'*<INDARG>_size] + <INDARG>[<INDARG>_map[n]+'+str(d)+'*'+op2_gen_common.get_stride_string(invinds[g_m],maps,mapnames,name)+'];', g_m)
             for d in range(0,int(dims[invinds[g_m]])):
-              code('<INDARG>[<INDARG>_map[n]+'+str(d)+'*'+op2_gen_common.get_stride_string(invinds[g_m],maps,mapnames,name)+'] = arg'+str(invinds[g_m])+'_l['+str(d)+'];')
-            ENDFOR()
+              out.code('<INDARG>[<INDARG>_map[n]+'+str(d)+'*'+op2_gen_common.get_stride_string(invinds[g_m],maps,mapnames,name)+'] = arg'+str(invinds[g_m])+'_l['+str(d)+'];', g_m)
+            out.ENDFOR()
           else:
-            FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x')
-            code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] += <INDARG>_s[n];')
-            ENDFOR()
+            out.FOR_INC('n','threadIdx.x','<INDARG>_size*<INDDIM>','blockDim.x', g_m)
+            out.code('<INDARG>[n%<INDDIM>+<INDARG>_map[n/<INDDIM>]*<INDDIM>] += <INDARG>_s[n];', g_m)
+            out.ENDFOR()
           if indopts[g_m] > 0:
-            ENDIF()
+            out.ENDIF()
 
 #
 # global reduction
 #
     if reduct:
-       code('')
-       comm('global reductions')
-       code('')
+       out.code('')
+       out.comm('global reductions')
+       out.code('')
        for m in range (0,nargs):
          g_m = m
          if maps[m]==OP_GBL and accs[m]!=OP_READ and accs[m] != OP_WRITE:
-           FOR('d','0','<DIM>')
+           out.FOR('d','0','<DIM>', g_m)
            if accs[m]==OP_INC:
-             code('op_reduction<OP_INC>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_INC>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            elif accs[m]==OP_MIN:
-             code('op_reduction<OP_MIN>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_MIN>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            elif accs[m]==OP_MAX:
-             code('op_reduction<OP_MAX>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);')
+             out.code('op_reduction<OP_MAX>(&<ARG>[d+blockIdx.x*<DIM>],<ARG>_l[d]);', g_m)
            else:
              print('internal error: invalid reduction option')
              sys.exit(2);
-           ENDFOR()
-    depth -= 2
-    code('}')
-    code('')
+           out.ENDFOR()
+    out.depth -= 2
+    out.code('}')
+    out.code('')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm('host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm('host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){')
-        code('')
+        out.code('op_arg <ARG>){', g_m)
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL:
-        code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;')
+        out.code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -838,92 +754,92 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
 
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
     if nopts>0:
-      code('int optflags = 0;')
+      out.code('int optflags = 0;')
       for i in range(0,nargs):
         if optflags[i] == 1:
-          IF('args['+str(i)+'].opt')
-          code('optflags |= 1<<'+str(optidxs[i])+';')
-          ENDIF()
+          out.IF('args['+str(i)+'].opt')
+          out.code('optflags |= 1<<'+str(optidxs[i])+';')
+          out.ENDIF()
     if nopts > 30:
       print('ERROR: too many optional arguments to store flags in an integer')
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timing_realloc('+str(nk)+');')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('')
 
 #
 #   indirect bits
 #
     if ninds>0:
-      code('')
-      code('int    ninds   = '+str(ninds)+';')
+      out.code('')
+      out.code('int    ninds   = '+str(ninds)+';')
       line = 'int    inds['+str(nargs)+'] = {'
       for m in range(0,nargs):
         line += str(inds[m]-1)+','
-      code(line[:-1]+'};')
-      code('')
+      out.code(line[:-1]+'};', g_m)
+      out.code('')
 
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
 
       if not atomics:
-        code('')
-        comm('get plan')
-        code('#ifdef OP_PART_SIZE_'+ str(nk))
-        code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
-        code('#else')
-        code('  int part_size = OP_part_size;')
-        code('#endif')
-        code('')
+        out.code('')
+        out.comm('get plan')
+        out.code('#ifdef OP_PART_SIZE_'+ str(nk))
+        out.code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
+        out.code('#else')
+        out.code('  int part_size = OP_part_size;')
+        out.code('#endif')
+        out.code('')
       #code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
-      code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 2);')
+      out.code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 2);')
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
-      code('')
-      code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 2);')
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 2);')
       #code('op_mpi_halo_exchanges_cuda(set, nargs, args);')
 
-    IF('set_size > 0')    
-    code('')
+    out.IF('set_size > 0')    
+    out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0 and not atomics:
       if inc_stage==1 and ind_inc:
-        code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_INC);')
+        out.code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_INC);')
       elif op_color2:
-        code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_COLOR2);')
+        out.code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_COLOR2);')
       else:
-        code('op_plan *Plan = op_plan_get(name,set,part_size,nargs,args,ninds,inds);')
-      code('')
+        out.code('op_plan *Plan = op_plan_get(name,set,part_size,nargs,args,ninds,inds);')
+      out.code('')
 
 
 #
@@ -931,27 +847,27 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 #
     g = [i for i in range(0,nargs) if maps[i] == OP_GBL and (accs[i] == OP_READ or accs[i] == OP_WRITE)]
     if len(g)>0:
-      comm('transfer constants to GPU')
-      code('int consts_bytes = 0;')
+      out.comm('transfer constants to GPU')
+      out.code('int consts_bytes = 0;')
       for m in range(0,nargs):
         g_m = m
         if maps[m]==OP_GBL and (accs[m]==OP_READ or accs[m] == OP_WRITE):
-          code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));')
+          out.code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));', g_m)
 
-      code('reallocConstArrays(consts_bytes);')
-      code('consts_bytes = 0;')
+      out.code('reallocConstArrays(consts_bytes);')
+      out.code('consts_bytes = 0;')
 
       for m in range(0,nargs):
         if maps[m]==OP_GBL and (accs[m] == OP_READ or accs[m] == OP_WRITE):
           g_m = m
-          code('<ARG>.data   = OP_consts_h + consts_bytes;')
-          code('<ARG>.data_d = OP_consts_d + consts_bytes;')
-          FOR('d','0','<DIM>')
-          code('((<TYP> *)<ARG>.data)[d] = <ARG>h[d];')
-          ENDFOR()
-          code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));')
-      code('mvConstArraysToDevice(consts_bytes);')
-      code('')
+          out.code('<ARG>.data   = OP_consts_h + consts_bytes;', g_m)
+          out.code('<ARG>.data_d = OP_consts_d + consts_bytes;', g_m)
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('((<TYP> *)<ARG>.data)[d] = <ARG>h[d];', g_m)
+          out.ENDFOR()
+          out.code('consts_bytes += ROUND_UP(<DIM>*sizeof(<TYP>));', g_m)
+      out.code('mvConstArraysToDevice(consts_bytes);')
+      out.code('')
 
       #managing constants
     if any_soa:
@@ -960,223 +876,223 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            IF('(OP_kernels[' +str(nk)+ '].count==1) || (opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(g_m)+'))')
-            code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(g_m)+');')
-            code('cudaMemcpyToSymbol(opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT, &opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST,sizeof(int));')
-            ENDIF()
+            out.IF('(OP_kernels[' +str(nk)+ '].count==1) || (opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(g_m)+'))')
+            out.code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(g_m)+');')
+            out.code('cudaMemcpyToSymbol(opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT, &opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST,sizeof(int));')
+            out.ENDIF()
       if dir_soa!=-1:
-          IF('(OP_kernels[' +str(nk)+ '].count==1) || (direct_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(dir_soa)+'))')
-          code('direct_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(dir_soa)+');')
-          code('cudaMemcpyToSymbol(direct_'+name+'_stride_OP2CONSTANT,&direct_'+name+'_stride_OP2HOST,sizeof(int));')
-          ENDIF()
+          out.IF('(OP_kernels[' +str(nk)+ '].count==1) || (direct_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(dir_soa)+'))')
+          out.code('direct_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(dir_soa)+');')
+          out.code('cudaMemcpyToSymbol(direct_'+name+'_stride_OP2CONSTANT,&direct_'+name+'_stride_OP2HOST,sizeof(int));')
+          out.ENDIF()
 
 #
 # transfer global reduction initial data
 #
 
     if ninds == 0 or atomics:
-      comm('set CUDA execution parameters')
-      code('#ifdef OP_BLOCK_SIZE_'+str(nk))
-      code('  int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
-      code('#else')
-      code('  int nthread = OP_block_size;')
-      code('#endif')
-      code('')
+      out.comm('set CUDA execution parameters')
+      out.code('#ifdef OP_BLOCK_SIZE_'+str(nk))
+      out.code('  int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('  int nthread = OP_block_size;')
+      out.code('#endif')
+      out.code('')
       if ninds==0:
-        code('int nblocks = 200;')
-        code('')
+        out.code('int nblocks = 200;')
+        out.code('')
 
     if reduct:
-      comm('transfer global reduction data to GPU')
+      out.comm('transfer global reduction data to GPU')
       if ninds>0 and not atomics:
-        code('int maxblocks = 0;')
-        FOR('col','0','Plan->ncolors')
-        code('maxblocks = MAX(maxblocks,Plan->ncolblk[col]);')
-        ENDFOR()
+        out.code('int maxblocks = 0;')
+        out.FOR('col','0','Plan->ncolors')
+        out.code('maxblocks = MAX(maxblocks,Plan->ncolblk[col]);')
+        out.ENDFOR()
       elif atomics and ninds>0:
-        code('int maxblocks = (MAX(set->core_size, set->size+set->exec_size-set->core_size)-1)/nthread+1;')
+        out.code('int maxblocks = (MAX(set->core_size, set->size+set->exec_size-set->core_size)-1)/nthread+1;')
       else:
-        code('int maxblocks = nblocks;')
+        out.code('int maxblocks = nblocks;')
 
-      code('int reduct_bytes = 0;')
-      code('int reduct_size  = 0;')
+      out.code('int reduct_bytes = 0;')
+      out.code('int reduct_size  = 0;')
 
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-          code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));')
-          code('reduct_size   = MAX(reduct_size,sizeof(<TYP>));')
+          out.code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));', g_m)
+          out.code('reduct_size   = MAX(reduct_size,sizeof(<TYP>));', g_m)
 
-      code('reallocReductArrays(reduct_bytes);')
-      code('reduct_bytes = 0;')
+      out.code('reallocReductArrays(reduct_bytes);')
+      out.code('reduct_bytes = 0;')
 
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-          code('<ARG>.data   = OP_reduct_h + reduct_bytes;')
-          code('<ARG>.data_d = OP_reduct_d + reduct_bytes;')
-          FOR('b','0','maxblocks')
-          FOR('d','0','<DIM>')
+          out.code('<ARG>.data   = OP_reduct_h + reduct_bytes;', g_m)
+          out.code('<ARG>.data_d = OP_reduct_d + reduct_bytes;', g_m)
+          out.FOR('b','0','maxblocks')
+          out.FOR('d','0','<DIM>', g_m)
           if accs[g_m]==OP_INC:
-            code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = ZERO_<TYP>;')
+            out.code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = ZERO_<TYP>;', g_m)
           else:
-            code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = <ARG>h[d];')
-          ENDFOR()
-          ENDFOR()
-          code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));')
-      code('mvReductArraysToDevice(reduct_bytes);')
-      code('')
+            out.code('((<TYP> *)<ARG>.data)[d+b*<DIM>] = <ARG>h[d];', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
+          out.code('reduct_bytes += ROUND_UP(maxblocks*<DIM>*sizeof(<TYP>));', g_m)
+      out.code('mvReductArraysToDevice(reduct_bytes);')
+      out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0 and not atomics:
-      comm('execute plan')
+      out.comm('execute plan')
       if not op_color2:
-        code('')
-        code('int block_offset = 0;')
-      FOR('col','0','Plan->ncolors')
-      IF('col==Plan->ncolors_core')
-      code('op_mpi_wait_all_grouped(nargs, args, 2);')
+        out.code('')
+        out.code('int block_offset = 0;')
+      out.FOR('col','0','Plan->ncolors')
+      out.IF('col==Plan->ncolors_core')
+      out.code('op_mpi_wait_all_grouped(nargs, args, 2);')
       #code('op_mpi_wait_all_cuda(nargs, args);')
-      ENDIF()
-      code('#ifdef OP_BLOCK_SIZE_'+str(nk))
-      code('int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
-      code('#else')
-      code('int nthread = OP_block_size;')
-      code('#endif')
-      code('')
+      out.ENDIF()
+      out.code('#ifdef OP_BLOCK_SIZE_'+str(nk))
+      out.code('int nthread = OP_BLOCK_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('int nthread = OP_block_size;')
+      out.code('#endif')
+      out.code('')
       if op_color2:
-        code('int start = Plan->col_offsets[0][col];')
-        code('int end = Plan->col_offsets[0][col+1];')
-        code('int nblocks = (end - start - 1)/nthread + 1;')
+        out.code('int start = Plan->col_offsets[0][col];')
+        out.code('int end = Plan->col_offsets[0][col+1];')
+        out.code('int nblocks = (end - start - 1)/nthread + 1;')
       else:
-        code('dim3 nblocks = dim3(Plan->ncolblk[col] >= (1<<16) ? 65535 : Plan->ncolblk[col],')
-        code('Plan->ncolblk[col] >= (1<<16) ? (Plan->ncolblk[col]-1)/65535+1: 1, 1);')
-        IF('Plan->ncolblk[col] > 0')
+        out.code('dim3 nblocks = dim3(Plan->ncolblk[col] >= (1<<16) ? 65535 : Plan->ncolblk[col],')
+        out.code('Plan->ncolblk[col] >= (1<<16) ? (Plan->ncolblk[col]-1)/65535+1: 1, 1);')
+        out.IF('Plan->ncolblk[col] > 0')
 
       if reduct or (inc_stage==1 and ind_inc):
         if reduct and inc_stage==1:
-          code('int nshared = MAX(Plan->nshared,reduct_size*nthread);')
+          out.code('int nshared = MAX(Plan->nshared,reduct_size*nthread);')
         elif reduct:
-          code('int nshared = reduct_size*nthread;')
+          out.code('int nshared = reduct_size*nthread;')
         else:
-          code('int nshared = Plan->nsharedCol[col];')
-        code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
+          out.code('int nshared = Plan->nsharedCol[col];')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
       else:
-        code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
 
       if nopts > 0:
-        code('optflags,')
+        out.code('optflags,')
       for m in range(1,ninds+1):
         g_m = invinds[m-1]
-        code('(<TYP> *)<ARG>.data_d,')
+        out.code('(<TYP> *)<ARG>.data_d,', g_m)
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('arg'+str(g_m)+'.map_data_d, ')
+            out.code('arg'+str(g_m)+'.map_data_d, ')
       for g_m in range(0,nargs):
         if inds[g_m]==0:
-          code('(<TYP>*)<ARG>.data_d,')
+          out.code('(<TYP>*)<ARG>.data_d,', g_m)
 
       if inc_stage==1 and ind_inc:
-        code('Plan->ind_map,')
-        code('Plan->loc_map,')
-        code('Plan->ind_sizes,')
-        code('Plan->ind_offs,')
+        out.code('Plan->ind_map,')
+        out.code('Plan->loc_map,')
+        out.code('Plan->ind_sizes,')
+        out.code('Plan->ind_offs,')
       if op_color2:
-        code('start,')
-        code('end,')
-        code('Plan->col_reord,')
+        out.code('start,')
+        out.code('end,')
+        out.code('Plan->col_reord,')
       else:
-        code('block_offset,')
-        code('Plan->blkmap,')
-        code('Plan->offset,')
-        code('Plan->nelems,')
-        code('Plan->nthrcol,')
-        code('Plan->thrcol,')
-        code('Plan->ncolblk[col],')
-      code('set->size+set->exec_size);')
-      code('')
+        out.code('block_offset,')
+        out.code('Plan->blkmap,')
+        out.code('Plan->offset,')
+        out.code('Plan->nelems,')
+        out.code('Plan->nthrcol,')
+        out.code('Plan->thrcol,')
+        out.code('Plan->ncolblk[col],')
+      out.code('set->size+set->exec_size);')
+      out.code('')
       if reduct:
-        comm('transfer global reduction data back to CPU')
-        IF('col == Plan->ncolors_owned-1')
-        code('mvReductArraysToHost(reduct_bytes);')
-        ENDIF()
+        out.comm('transfer global reduction data back to CPU')
+        out.IF('col == Plan->ncolors_owned-1')
+        out.code('mvReductArraysToHost(reduct_bytes);')
+        out.ENDIF()
       if not op_color2:
-        ENDFOR() #TODO sztem ez forditva van...
-        code('block_offset += Plan->ncolblk[col];')
-      ENDIF()
+        out.ENDFOR() #TODO sztem ez forditva van...
+        out.code('block_offset += Plan->ncolblk[col];')
+      out.ENDIF()
 
 #
 #
 #
     elif ninds>0 and atomics:
       if reduct:
-        FOR('round','0','3')
+        out.FOR('round','0','3')
       else:
-        FOR('round','0','2')
-      IF('round==1')
-      code('op_mpi_wait_all_grouped(nargs, args, 2);')
+        out.FOR('round','0','2')
+      out.IF('round==1')
+      out.code('op_mpi_wait_all_grouped(nargs, args, 2);')
       #code('op_mpi_wait_all_cuda(nargs, args);')
-      ENDIF()
+      out.ENDIF()
       if reduct:
-        code('int start = round==0 ? 0 : (round==1 ? set->core_size : set->size);')
-        code('int end = round==0 ? set->core_size : (round==1? set->size :  set->size + set->exec_size);')
+        out.code('int start = round==0 ? 0 : (round==1 ? set->core_size : set->size);')
+        out.code('int end = round==0 ? set->core_size : (round==1? set->size :  set->size + set->exec_size);')
       else:
-        code('int start = round==0 ? 0 : set->core_size;')
-        code('int end = round==0 ? set->core_size : set->size + set->exec_size;')
-      IF('end-start>0')
-      code('int nblocks = (end-start-1)/nthread+1;')
+        out.code('int start = round==0 ? 0 : set->core_size;')
+        out.code('int end = round==0 ? set->core_size : set->size + set->exec_size;')
+      out.IF('end-start>0')
+      out.code('int nblocks = (end-start-1)/nthread+1;')
       if reduct:
-        code('int nshared = reduct_size*nthread;')
-        code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
+        out.code('int nshared = reduct_size*nthread;')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
       else:
-        code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
       if nopts > 0:
-        code('optflags,')
+        out.code('optflags,')
       for m in range(1,ninds+1):
         g_m = invinds[m-1]
-        code('(<TYP> *)<ARG>.data_d,')
+        out.code('(<TYP> *)<ARG>.data_d,', g_m)
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('arg'+str(g_m)+'.map_data_d, ')
+            out.code('arg'+str(g_m)+'.map_data_d, ')
       for g_m in range(0,nargs):
         if inds[g_m]==0:
-          code('(<TYP>*)<ARG>.data_d,')
-      code('start,end,set->size+set->exec_size);')
-      ENDIF()
+          out.code('(<TYP>*)<ARG>.data_d,', g_m)
+      out.code('start,end,set->size+set->exec_size);')
+      out.ENDIF()
       if reduct:
-        code('if (round==1) mvReductArraysToHost(reduct_bytes);')
+        out.code('if (round==1) mvReductArraysToHost(reduct_bytes);')
 
-      ENDFOR()
+      out.ENDFOR()
 #
 # kernel call for direct version
 #
     else:
       if reduct:
-        code('int nshared = reduct_size*nthread;')
-        code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
+        out.code('int nshared = reduct_size*nthread;')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread,nshared>>>(')
       else:
-        code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
+        out.code('op_cuda_'+name+'<<<nblocks,nthread>>>(')
 
       indent = '  '#*(len(name)+42)
       if nopts > 0:
-        code(indent+'optflags,')
+        out.code(indent+'optflags,')
       for g_m in range(0,nargs):
         if g_m > 0:
-          code(indent+'(<TYP> *) <ARG>.data_d,')
+          out.code(indent+'(<TYP> *) <ARG>.data_d,', g_m)
         else:
-          code(indent+'(<TYP> *) <ARG>.data_d,')
+          out.code(indent+'(<TYP> *) <ARG>.data_d,', g_m)
 
-      code(indent+'set->size );')
+      out.code(indent+'set->size );')
 
     if ninds>0 and not atomics:
-      code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
-      code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
+      out.code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
+      out.code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
 
 
 #
@@ -1184,79 +1100,74 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 #
     if reduct:
       if ninds == 0:
-        comm('transfer global reduction data back to CPU')
-        code('mvReductArraysToHost(reduct_bytes);')
+        out.comm('transfer global reduction data back to CPU')
+        out.code('mvReductArraysToHost(reduct_bytes);')
 
       for m in range(0,nargs):
         g_m = m
         if maps[m]==OP_GBL and accs[m]!=OP_READ and accs[m] != OP_WRITE:
-          FOR('b','0','maxblocks')
-          FOR('d','0','<DIM>')
+          out.FOR('b','0','maxblocks')
+          out.FOR('d','0','<DIM>', g_m)
           if accs[m]==OP_INC:
-            code('<ARG>h[d] = <ARG>h[d] + ((<TYP> *)<ARG>.data)[d+b*<DIM>];')
+            out.code('<ARG>h[d] = <ARG>h[d] + ((<TYP> *)<ARG>.data)[d+b*<DIM>];', g_m)
           elif accs[m]==OP_MIN:
-            code('<ARG>h[d] = MIN(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);')
+            out.code('<ARG>h[d] = MIN(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);', g_m)
           elif accs[m]==OP_MAX:
-            code('<ARG>h[d] = MAX(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);')
-          ENDFOR()
-          ENDFOR()
+            out.code('<ARG>h[d] = MAX(<ARG>h[d],((<TYP> *)<ARG>.data)[d+b*<DIM>]);', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
 
-          code('<ARG>.data = (char *)<ARG>h;')
-          code('op_mpi_reduce(&<ARG>,<ARG>h);')
+          out.code('<ARG>.data = (char *)<ARG>h;', g_m)
+          out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
     for g_m in range(0,nargs):
       if maps[g_m] == OP_GBL and accs[g_m] == OP_WRITE:
-        code('')
-        code('mvConstArraysToHost(consts_bytes);')
+        out.code('')
+        out.code('mvConstArraysToHost(consts_bytes);')
         break
 
     for g_m in range(0,nargs):
       if maps[g_m] == OP_GBL and accs[g_m] == OP_WRITE:
-        FOR('d','0','<DIM>')
-        code('<ARG>h[d] = ((<TYP> *)<ARG>.data)[d];')
-        ENDFOR()
-        code('<ARG>.data = (char *)<ARG>h;')
-        code('op_mpi_reduce(&<ARG>,<ARG>h);')
+        out.FOR('d','0','<DIM>', g_m)
+        out.code('<ARG>h[d] = ((<TYP> *)<ARG>.data)[d];', g_m)
+        out.ENDFOR()
+        out.code('<ARG>.data = (char *)<ARG>h;', g_m)
+        out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
-    ENDIF()
-    code('op_mpi_set_dirtybit_cuda(nargs, args);')
+    out.ENDIF()
+    out.code('op_mpi_set_dirtybit_cuda(nargs, args);')
 
 #
 # update kernel record
 #
 
-    code('cutilSafeCall(cudaDeviceSynchronize());')
-    comm('update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.code('cutilSafeCall(cudaDeviceSynchronize());')
+    out.comm('update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
 
       for g_m in range (0,nargs):
         if optflags[g_m]==1:
-          IF('<ARG>.opt')
+          out.IF('<ARG>.opt', g_m)
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
         if optflags[g_m]==1:
-          ENDIF()
-    depth = depth - 2
-    code('}')
+          out.ENDIF()
+    out.depth = out.depth - 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('cuda'):
-        os.makedirs('cuda')
-    fid = open('cuda/'+name+'_kernel.cu','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('cuda/'+name+'_kernel.cu', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -1265,70 +1176,66 @@ def op2_gen_cuda_simple(master, date, consts, kernels,sets, macro_defs):
 #  output one master kernel file
 ##########################################################################
 
-  file_text = ''
+  out = op2_gen_common.CodeEmitter()
 
-  comm('global constants')
+  out.comm('global constants')
 
-  code('#ifndef MAX_CONST_SIZE')
-  code('#define MAX_CONST_SIZE 128')
-  code('#endif')
-  code('')
+  out.code('#ifndef MAX_CONST_SIZE')
+  out.code('#define MAX_CONST_SIZE 128')
+  out.code('#endif')
+  out.code('')
 
   for nc in range (0,len(consts)):
     if consts[nc]['dim']==1:
-      code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'_cuda;')
+      out.code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'_cuda;')
     else:
       if consts[nc]['dim'].isdigit() and int(consts[nc]['dim']) > 0:
         num = str(consts[nc]['dim'])
       else:
         num = 'MAX_CONST_SIZE'
 
-      code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'_cuda['+num+'];')
-  code('')
+      out.code('__constant__ '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'_cuda['+num+'];')
+  out.code('')
 
-  comm('header')
+  out.comm('header')
 
   if os.path.exists('./user_types.h'):
-    code('#ifndef OP_FUN_PREFIX\n#define OP_FUN_PREFIX __host__ __device__\n#endif')
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"')
-  code('#include "op_cuda_rt_support.h"')
-  code('#include "op_cuda_reduction.h"')
-
-  code('')
-  code('void op_decl_const_char(int dim, char const *type,')
-  code('int size, char *dat, char const *name){')
-  depth = depth + 2
-
-  code('if (!OP_hybrid_gpu) return;')
+    out.code('#ifndef OP_FUN_PREFIX\n#define OP_FUN_PREFIX __host__ __device__\n#endif')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"')
+  out.code('#include "op_cuda_rt_support.h"')
+  out.code('#include "op_cuda_reduction.h"')
+
+  out.code('')
+  out.code('void op_decl_const_char(int dim, char const *type,')
+  out.code('int size, char *dat, char const *name){')
+  out.depth = out.depth + 2
+
+  out.code('if (!OP_hybrid_gpu) return;')
   for nc in range(0,len(consts)):
-    IF('!strcmp(name,"'+consts[nc]['name']+'")')
+    out.IF('!strcmp(name,"'+consts[nc]['name']+'")')
     if not consts[nc]['dim'] or int(consts[nc]['dim']) > 1:
-      IF('!strcmp(name,"'+consts[nc]['name']+'") && size>MAX_CONST_SIZE')
-      code('printf("error: MAX_CONST_SIZE not big enough\\n"); exit(1);')
-      ENDIF()
-    code('cutilSafeCall(cudaMemcpyToSymbol('+consts[nc]['name']+'_cuda, dat, dim*size));')
-    ENDIF()
-    code('else ')
+      out.IF('!strcmp(name,"'+consts[nc]['name']+'") && size>MAX_CONST_SIZE')
+      out.code('printf("error: MAX_CONST_SIZE not big enough\\n"); exit(1);')
+      out.ENDIF()
+    out.code('cutilSafeCall(cudaMemcpyToSymbol('+consts[nc]['name']+'_cuda, dat, dim*size));')
+    out.ENDIF()
+    out.code('else ')
 
-  code('{')
-  depth = depth + 2
-  code('printf("error: unknown const name\\n"); exit(1);')
-  ENDIF()
+  out.code('{')
+  out.depth = out.depth + 2
+  out.code('printf("error: unknown const name\\n"); exit(1);')
+  out.ENDIF()
 
 
-  depth = depth - 2
-  code('}')
-  code('')
-  comm('user kernel files')
+  out.depth = out.depth - 2
+  out.code('}')
+  out.code('')
+  out.comm('user kernel files')
 
   for nk in range(0,len(kernels)):
-    file_text = file_text +\
-    '#include "'+kernels[nk]['name']+'_kernel.cu"\n'
+    out.append('#include "'+kernels[nk]['name']+'_kernel.cu"\n')
 
   master = master.split('.')[0]
-  fid = open('cuda/'+master.split('.')[0]+'_kernels.cu','w')
-  fid.write('//\n// auto-generated by op2.py\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('cuda/'+master.split('.')[0]+'_kernels.cu', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
@@ -15,89 +15,8 @@ import glob
 import os
 import op2_gen_common
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line.rstrip()+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if text == '':
-    prefix = ''
-  else:
-    prefix = ' '*depth
-  file_text += prefix+rep(text,g_m).rstrip()+'\n'
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def FOR2(i,start,finish,inc):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1, '+inc)
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'+='+inc+' ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
-
 def op2_gen_mpi_vec(master, date, consts, kernels):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -150,19 +69,16 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims)
 
 #
 # First original version
 #
-    comm('user function')
+    out.comm('user function')
     file_name = decl_filepath
 
-    f = open(file_name, 'r')
-    kernel_text = f.read()
-    file_text += kernel_text
-    f.close()
+    kernel_text = op2_gen_common.read_text_file(file_name)
+    out.append(kernel_text)
 
     ## Clang compiler can struggle to vectorize a loop if it uses a mix of
     ## Python-generated simd arrays for indirect data AND pointers to direct
@@ -174,11 +90,9 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
 # - direct kernels can be vectorised without modification
 #
     if indirect_kernel:
-      code('#ifdef VECTORIZE')
-      comm('user function -- modified for vectorisation')
-      f = open(file_name, 'r')
-      kernel_text = f.read()
-      f.close()
+      out.code('#ifdef VECTORIZE')
+      out.comm('user function -- modified for vectorisation')
+      kernel_text = op2_gen_common.read_text_file(file_name)
 
       kernel_text = op2_gen_common.comment_remover(kernel_text)
       kernel_text = op2_gen_common.remove_trailing_w_space(kernel_text)
@@ -264,8 +178,8 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
       #print signature_text
       #print  body_text
 
-      file_text += signature_text + body_text + '}\n'
-      code('#endif');
+      out.append(signature_text + body_text + '}\n')
+      out.code('#endif');
 
 
 
@@ -273,28 +187,28 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm(' host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm(' host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){');
-        code('')
+        out.code('op_arg <ARG>){', g_m);
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -304,33 +218,33 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
 #
 # create aligned pointers
 #
-    comm('create aligned pointers for dats')
+    out.comm('create aligned pointers for dats')
     for g_m in range (0,nargs):
         if maps[g_m] != OP_GBL:
           if (accs[g_m] == OP_INC or accs[g_m] == OP_RW or accs[g_m] == OP_WRITE):
-            code('ALIGNED_<TYP>       <TYP> * __restrict__ ptr'+\
-            str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;')
+            out.code('ALIGNED_<TYP>       <TYP> * __restrict__ ptr'+\
+            str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;', g_m)
             #code('<TYP>* __restrict__ __attribute__((align_value (<TYP>_ALIGN)))  ptr'+\
             #str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;')
-            code('DECLARE_PTR_ALIGNED(ptr'+str(g_m)+',<TYP>_ALIGN);')
+            out.code('DECLARE_PTR_ALIGNED(ptr'+str(g_m)+',<TYP>_ALIGN);', g_m)
 
           else:
-            code('ALIGNED_<TYP> const <TYP> * __restrict__ ptr'+\
-            str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;')
-            code('DECLARE_PTR_ALIGNED(ptr'+str(g_m)+',<TYP>_ALIGN);')
+            out.code('ALIGNED_<TYP> const <TYP> * __restrict__ ptr'+\
+            str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;', g_m)
+            out.code('DECLARE_PTR_ALIGNED(ptr'+str(g_m)+',<TYP>_ALIGN);', g_m)
             #code('const <TYP>* __restrict__ __attribute__((align_value (<TYP>_ALIGN)))  ptr'+\
             #str(g_m)+' = (<TYP> *) arg'+str(g_m)+'.data;')
 
@@ -339,92 +253,92 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timing_realloc('+str(nk)+');')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('')
 
 #
 #   indirect bits
 #
     if ninds>0:
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
 
-    code('')
+    out.code('')
     if grouped:
-      code('int exec_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 1);')
+      out.code('int exec_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 1);')
     else:
-      code('int exec_size = op_mpi_halo_exchanges(set, nargs, args);')
+      out.code('int exec_size = op_mpi_halo_exchanges(set, nargs, args);')
 
-    code('')
-    IF('exec_size >0')
-    code('')
+    out.code('')
+    out.IF('exec_size >0')
+    out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      code('#ifdef VECTORIZE')
+      out.code('#ifdef VECTORIZE')
 
-      code('#pragma novector')
-      FOR2('n','0','(exec_size/SIMD_VEC)*SIMD_VEC','SIMD_VEC')
+      out.code('#pragma novector')
+      out.FOR_INC('n','0','(exec_size/SIMD_VEC)*SIMD_VEC','SIMD_VEC')
       #initialize globals
       for g_m in range(0,nargs):
         if maps[g_m] == OP_GBL:
-          code('<TYP> dat{0}[SIMD_VEC];'.format(g_m))
-          FOR('i','0','SIMD_VEC')
+          out.code('<TYP> dat{0}[SIMD_VEC];'.format(g_m), g_m)
+          out.FOR('i','0','SIMD_VEC')
           if accs[g_m] == OP_INC:
-            code('dat{0}[i] = 0.0;'.format(g_m))
+            out.code('dat{0}[i] = 0.0;'.format(g_m))
           elif accs[g_m] == OP_MAX:
-            code('dat{0}[i] = -INFINITY;'.format(g_m))
+            out.code('dat{0}[i] = -INFINITY;'.format(g_m))
           elif accs[g_m] == OP_MIN:
-            code('dat{0}[i] = INFINITY;'.format(g_m))
+            out.code('dat{0}[i] = INFINITY;'.format(g_m))
           elif accs[g_m] == OP_READ:
-            code('dat{0}[i] = *((<TYP>*)arg{0}.data);'.format(g_m))
-          ENDFOR()
+            out.code('dat{0}[i] = *((<TYP>*)arg{0}.data);'.format(g_m), g_m)
+          out.ENDFOR()
 
-      code('if (n<set->core_size && n>0 && n % OP_mpi_test_frequency == 0)')
-      code('  op_mpi_test_all(nargs,args);')
-      IF('(n+SIMD_VEC >= set->core_size) && (n+SIMD_VEC-set->core_size < SIMD_VEC)')
+      out.code('if (n<set->core_size && n>0 && n % OP_mpi_test_frequency == 0)')
+      out.code('  op_mpi_test_all(nargs,args);')
+      out.IF('(n+SIMD_VEC >= set->core_size) && (n+SIMD_VEC-set->core_size < SIMD_VEC)')
       if grouped:
-        code('op_mpi_wait_all_grouped(nargs, args, 1);')
+        out.code('op_mpi_wait_all_grouped(nargs, args, 1);')
       else:
-        code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+        out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
       for g_m in range(0,nargs):
         if do_gen_direct_simd_arrays:
           if (maps[g_m] in [OP_MAP, OP_ID]) and (accs[g_m] in [OP_READ, OP_RW, OP_WRITE, OP_INC]):
-            code('ALIGNED_<TYP> <TYP> dat'+str(g_m)+'[<DIM>][SIMD_VEC];')
+            out.code('ALIGNED_<TYP> <TYP> dat'+str(g_m)+'[<DIM>][SIMD_VEC];', g_m)
         else:
           if maps[g_m] == OP_MAP and (accs[g_m] in [OP_READ, OP_RW, OP_WRITE, OP_INC]):
-            code('ALIGNED_<TYP> <TYP> dat'+str(g_m)+'[<DIM>][SIMD_VEC];')
+            out.code('ALIGNED_<TYP> <TYP> dat'+str(g_m)+'[<DIM>][SIMD_VEC];', g_m)
 
       #setup gathers
       idx_map_template = "int idx{0}_<DIM> = <DIM> * arg{1}.map_data[(n+i) * arg{1}.map->dim + {2}];"
       idx_id_template  = "int idx{0}_<DIM> = <DIM> * (n+i);"
-      code('#pragma omp simd simdlen(SIMD_VEC)')
-      FOR('i','0','SIMD_VEC')
+      out.code('#pragma omp simd simdlen(SIMD_VEC)')
+      out.FOR('i','0','SIMD_VEC')
       if nmaps > 0:
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP :
             if (accs[g_m] in [OP_READ, OP_RW, OP_WRITE]):#and (not mapinds[g_m] in k):
-              code(idx_map_template.format(g_m, invmapinds[inds[g_m]-1], idxs[g_m]))
+              out.code(idx_map_template.format(g_m, invmapinds[inds[g_m]-1], idxs[g_m]), g_m)
           elif do_gen_direct_simd_arrays and maps[g_m] == OP_ID :
-            code(idx_id_template.format(g_m))
-      code('')
+            out.code(idx_id_template.format(g_m), g_m)
+      out.code('')
 
       init_dat_template = "dat{0}[{1}][i] = (ptr{0})[idx{0}_<DIM> + {1}];"
       zero_dat_template = "dat{0}[{1}][i] = 0.0;"
@@ -435,24 +349,24 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
           if maps[g_m] != OP_GBL :
             if accs[g_m] in [OP_READ, OP_RW]:
               for d in range(0,int(dims[g_m])):
-                code(init_dat_template.format(g_m, d))
-              code('')
+                out.code(init_dat_template.format(g_m, d), g_m)
+              out.code('')
             elif accs[g_m] == OP_INC:
               for d in range(0,int(dims[g_m])):
-                code(zero_dat_template.format(g_m, d))
-              code('')
+                out.code(zero_dat_template.format(g_m, d))
+              out.code('')
         else:
           if maps[g_m] == OP_MAP :
             if accs[g_m] in [OP_READ, OP_RW]:#and (not mapinds[g_m] in k):
               for d in range(0,int(dims[g_m])):
                 init_dat_str = init_dat_template.format(g_m, d)
-                code(init_dat_str)
-              code('')
+                out.code(init_dat_str, g_m)
+              out.code('')
             elif (accs[g_m] == OP_INC):
               for d in range(0,int(dims[g_m])):
                 zero_dat_str = zero_dat_template.format(g_m, d)
-                code(zero_dat_str)
-              code('')
+                out.code(zero_dat_str)
+              out.code('')
           else: #globals
             if (accs[g_m] == OP_INC):
               # for d in range(0,int(dims[g_m])):
@@ -460,12 +374,12 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
               # code('')
               pass
 
-      ENDFOR()
+      out.ENDFOR()
       #kernel call
-      code('#pragma omp simd simdlen(SIMD_VEC)')
-      FOR('i','0','SIMD_VEC')
+      out.code('#pragma omp simd simdlen(SIMD_VEC)')
+      out.FOR('i','0','SIMD_VEC')
       line = name+'_vec('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if (not do_gen_direct_simd_arrays) and maps[g_m] == OP_ID:
           line = line + indent + '&(ptr'+str(g_m)+')['+str(dims[g_m])+' * (n+i)],'
@@ -476,99 +390,99 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
         else:
           line = line + indent + 'dat'+str(g_m)+','
       line = line +indent +'i);'
-      code(line)
-      ENDFOR()
+      out.code(line)
+      out.ENDFOR()
       #do the scatters
-      FOR('i','0','SIMD_VEC')
+      out.FOR('i','0','SIMD_VEC')
       if nmaps > 0:
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP :
             if (accs[g_m] in [OP_INC, OP_RW, OP_WRITE]):#and (not mapinds[g_m] in k):
-              code(idx_map_template.format(g_m, invmapinds[inds[g_m]-1], idxs[g_m]))
+              out.code(idx_map_template.format(g_m, invmapinds[inds[g_m]-1], idxs[g_m]), g_m)
           elif do_gen_direct_simd_arrays and maps[g_m] == OP_ID :
             if (accs[g_m] in [OP_INC, OP_RW, OP_WRITE]):
-              code(idx_id_template.format(g_m))
-      code('')
+              out.code(idx_id_template.format(g_m), g_m)
+      out.code('')
       dat_scatter_inc_template = "(ptr{0})[idx{0}_<DIM> + {1}] += dat{0}[{1}][i];"
       dat_scatter_wr_template  = "(ptr{0})[idx{0}_<DIM> + {1}] = dat{0}[{1}][i];"
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP :
           if (accs[g_m] == OP_INC ):
             for d in range(0,int(dims[g_m])):
-              code(dat_scatter_inc_template.format(g_m, d))
-            code('')
+              out.code(dat_scatter_inc_template.format(g_m, d), g_m)
+            out.code('')
           elif accs[g_m] in [OP_WRITE, OP_RW]:
             for d in range(0,int(dims[g_m])):
-              code(dat_scatter_wr_template.format(g_m, d))
-            code('')
+              out.code(dat_scatter_wr_template.format(g_m, d), g_m)
+            out.code('')
         elif do_gen_direct_simd_arrays and maps[g_m] == OP_ID:
           ## also scatter directly-written data
           if (accs[g_m] == OP_INC ):
             for d in range(0,int(dims[g_m])):
-              code(dat_scatter_inc_template.format(g_m, d))
+              out.code(dat_scatter_inc_template.format(g_m, d), g_m)
           elif accs[g_m] in [OP_WRITE, OP_RW]:
             for d in range(0,int(dims[g_m])):
-              code(dat_scatter_wr_template.format(g_m, d))
-            code('')
-      ENDFOR()
+              out.code(dat_scatter_wr_template.format(g_m, d), g_m)
+            out.code('')
+      out.ENDFOR()
 
       #do reductions
       for g_m in range(0,nargs):
         if maps[g_m] == OP_GBL:
-          FOR('i','0','SIMD_VEC')
+          out.FOR('i','0','SIMD_VEC')
           if accs[g_m] == OP_INC:
-            code('*(<TYP>*)arg'+str(g_m)+'.data += dat'+str(g_m)+'[i];')
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data += dat'+str(g_m)+'[i];', g_m)
           elif accs[g_m] == OP_MAX:
-            code('*(<TYP>*)arg'+str(g_m)+'.data = MAX(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);')
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data = MAX(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);', g_m)
           elif accs[g_m] == OP_MIN:
-            code('*(<TYP>*)arg'+str(g_m)+'.data = MIN(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);')
-          ENDFOR()
-
-
-      ENDFOR()
-      code('')
-      comm('remainder')
-      FOR('n','(exec_size/SIMD_VEC)*SIMD_VEC','exec_size')
-      depth = depth -2
-      code('#else')
-      FOR('n','0','exec_size')
-      depth = depth -2
-      code('#endif')
-      depth = depth +2
-      IF('n==set->core_size')
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data = MIN(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);', g_m)
+          out.ENDFOR()
+
+
+      out.ENDFOR()
+      out.code('')
+      out.comm('remainder')
+      out.FOR('n','(exec_size/SIMD_VEC)*SIMD_VEC','exec_size')
+      out.depth = out.depth -2
+      out.code('#else')
+      out.FOR('n','0','exec_size')
+      out.depth = out.depth -2
+      out.code('#endif')
+      out.depth = out.depth +2
+      out.IF('n==set->core_size')
       if grouped:
-        code('op_mpi_wait_all_grouped(nargs, args, 1);')
+        out.code('op_mpi_wait_all_grouped(nargs, args, 1);')
       else:
-        code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+        out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
       #do non-optional ones
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k) and (not optflags[g_m]):
             k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
       #do optional ones
       if nmaps > 0:
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             if optflags[g_m]:
-              IF('<ARG>.opt')
+              out.IF('<ARG>.opt', g_m)
             else:
               k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
             if optflags[g_m]:
-              ENDIF()
+              out.ENDIF()
 
-      code('')
+      out.code('')
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(ptr'+str(g_m)+')['+str(dims[g_m])+' * n]'
@@ -580,37 +494,37 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      out.code(line)
+      out.ENDFOR()
 
 #
 # kernel call for direct version
 #
     else:
-      code('#ifdef VECTORIZE')
+      out.code('#ifdef VECTORIZE')
 
-      code('#pragma novector')
-      FOR2('n','0','(exec_size/SIMD_VEC)*SIMD_VEC','SIMD_VEC')
+      out.code('#pragma novector')
+      out.FOR_INC('n','0','(exec_size/SIMD_VEC)*SIMD_VEC','SIMD_VEC')
 
 	  #initialize globals
       for g_m in range(0,nargs):
         if maps[g_m] == OP_GBL:
-          code('<TYP> dat{0}[SIMD_VEC];'.format(g_m))
-          FOR('i','0','SIMD_VEC')
+          out.code('<TYP> dat{0}[SIMD_VEC];'.format(g_m), g_m)
+          out.FOR('i','0','SIMD_VEC')
           if accs[g_m] == OP_INC:
-            code('dat{0}[i] = 0.0;'.format(g_m))
+            out.code('dat{0}[i] = 0.0;'.format(g_m))
           elif accs[g_m] == OP_MAX:
-            code('dat{0}[i] = -INFINITY;'.format(g_m))
+            out.code('dat{0}[i] = -INFINITY;'.format(g_m))
           elif accs[g_m] == OP_MIN:
-            code('dat{0}[i] = INFINITY;'.format(g_m))
+            out.code('dat{0}[i] = INFINITY;'.format(g_m))
           elif accs[g_m] == OP_READ:
-            code('dat{0}[i] = *((<TYP>*)arg{0}.data);'.format(g_m))
-          ENDFOR()
+            out.code('dat{0}[i] = *((<TYP>*)arg{0}.data);'.format(g_m), g_m)
+          out.ENDFOR()
 
-      code('#pragma omp simd simdlen(SIMD_VEC)')
-      FOR('i','0','SIMD_VEC')
+      out.code('#pragma omp simd simdlen(SIMD_VEC)')
+      out.FOR('i','0','SIMD_VEC')
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(ptr'+str(g_m)+')['+str(dims[g_m])+' * (n+i)]'
@@ -622,31 +536,31 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      out.code(line)
+      out.ENDFOR()
       #do reductions
       for g_m in range(0,nargs):
         if maps[g_m] == OP_GBL:
-          FOR('i','0','SIMD_VEC')
+          out.FOR('i','0','SIMD_VEC')
           if accs[g_m] == OP_INC:
-            code('*(<TYP>*)arg'+str(g_m)+'.data += dat'+str(g_m)+'[i];')
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data += dat'+str(g_m)+'[i];', g_m)
           elif accs[g_m] == OP_MAX:
-            code('*(<TYP>*)arg'+str(g_m)+'.data = MAX(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);')
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data = MAX(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);', g_m)
           elif accs[g_m] == OP_MIN:
-            code('*(<TYP>*)arg'+str(g_m)+'.data = MIN(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);')
-          ENDFOR()
-      ENDFOR()
-
-      comm('remainder')
-      FOR ('n','(exec_size/SIMD_VEC)*SIMD_VEC','exec_size')
-      depth = depth -2
-      code('#else')
-      FOR('n','0','exec_size')
-      depth = depth -2
-      code('#endif')
-      depth = depth +2
+            out.code('*(<TYP>*)arg'+str(g_m)+'.data = MIN(*(<TYP>*)arg'+str(g_m)+'.data,dat'+str(g_m)+'[i]);', g_m)
+          out.ENDFOR()
+      out.ENDFOR()
+
+      out.comm('remainder')
+      out.FOR ('n','(exec_size/SIMD_VEC)*SIMD_VEC','exec_size')
+      out.depth = out.depth -2
+      out.code('#else')
+      out.FOR('n','0','exec_size')
+      out.depth = out.depth -2
+      out.code('#endif')
+      out.depth = out.depth +2
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(ptr'+str(g_m)+')['+str(dims[g_m])+'*n]'
@@ -656,40 +570,40 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
-    ENDIF()
-    code('')
+      out.code(line)
+      out.ENDFOR()
+    out.ENDIF()
+    out.code('')
 
     #zero set size issues
     if ninds>0:
-      IF('exec_size == 0 || exec_size == set->core_size')
+      out.IF('exec_size == 0 || exec_size == set->core_size')
       if grouped:
-        code('op_mpi_wait_all_grouped(nargs, args, 1);')
+        out.code('op_mpi_wait_all_grouped(nargs, args, 1);')
       else:
-        code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+        out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
 
 #
 # combine reduction data from multiple OpenMP threads
 #
-    comm(' combine reduction data')
+    out.comm(' combine reduction data')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ:
-        code('op_mpi_reduce(&<ARG>,('+typs[g_m]+'*)<ARG>.data);')
+        out.code('op_mpi_reduce(&<ARG>,('+typs[g_m]+'*)<ARG>.data);', g_m)
 
-    code('op_mpi_set_dirtybit(nargs, args);')
-    code('')
+    out.code('op_mpi_set_dirtybit(nargs, args);')
+    out.code('')
 
 #
 # update kernel record
 #
 
-    comm(' update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.comm(' update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
@@ -697,9 +611,9 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
       for g_m in range (0,nargs):
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
     else:
       names = []
       for g_m in range(0,ninds):
@@ -707,7 +621,7 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
         if indaccs[g_m] != OP_WRITE and indaccs[g_m] != OP_READ:
           mult = ' * 2.0f'
         if not var[invinds[g_m]] in names:
-          code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[g_m])+'.size'+mult+';')
+          out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[g_m])+'.size'+mult+';')
           names = names + [var[invinds[g_m]]]
       for g_m in range(0,nargs):
         mult=''
@@ -716,31 +630,26 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
         if not var[g_m] in names:
           names = names + [var[invinds[g_m]]]
           if maps[g_m] == OP_ID:
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
           elif maps[g_m] == OP_GBL:
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[inds[g_m]-1])+'.map->dim * 4.0f;')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[inds[g_m]-1])+'.map->dim * 4.0f;')
 
-    depth -= 2
-    code('}')
+    out.depth -= 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('vec'):
-        os.makedirs('vec')
-    fid = open('vec/'+name+'_veckernel.cpp','w')
     date = datetime.datetime.now()
     #fid.write('//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n')
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('vec/'+name+'_veckernel.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -749,56 +658,53 @@ def op2_gen_mpi_vec(master, date, consts, kernels):
 #  output one master kernel file
 ##########################################################################
 
-  file_text =''
-
-  code('#define double_ALIGN 128')
-  code('#define float_ALIGN 64')
-  code('#define int_ALIGN 64')
-  code('#ifdef VECTORIZE')
-  code('#define SIMD_VEC 4')
-  code('#define ALIGNED_double __attribute__((aligned(double_ALIGN)))')
-  code('#define ALIGNED_float __attribute__((aligned(float_ALIGN)))')
-  code('#define ALIGNED_int __attribute__((aligned(int_ALIGN)))')
-  code('  #ifdef __ICC')
-  code('    #define DECLARE_PTR_ALIGNED(X, Y) __assume_aligned(X, Y)')
-  code('  #else')
-  code('    #define DECLARE_PTR_ALIGNED(X, Y)')
-  code('  #endif')
-  code('#else')
-  code('#define ALIGNED_double')
-  code('#define ALIGNED_float')
-  code('#define ALIGNED_int')
-  code('#define DECLARE_PTR_ALIGNED(X, Y)')
-  code('#endif')
-  code('')
-
-  comm(' global constants       ')
+  out = op2_gen_common.CodeEmitter()
+
+  out.code('#define double_ALIGN 128')
+  out.code('#define float_ALIGN 64')
+  out.code('#define int_ALIGN 64')
+  out.code('#ifdef VECTORIZE')
+  out.code('#define SIMD_VEC 4')
+  out.code('#define ALIGNED_double __attribute__((aligned(double_ALIGN)))')
+  out.code('#define ALIGNED_float __attribute__((aligned(float_ALIGN)))')
+  out.code('#define ALIGNED_int __attribute__((aligned(int_ALIGN)))')
+  out.code('  #ifdef __ICC')
+  out.code('    #define DECLARE_PTR_ALIGNED(X, Y) __assume_aligned(X, Y)')
+  out.code('  #else')
+  out.code('    #define DECLARE_PTR_ALIGNED(X, Y)')
+  out.code('  #endif')
+  out.code('#else')
+  out.code('#define ALIGNED_double')
+  out.code('#define ALIGNED_float')
+  out.code('#define ALIGNED_int')
+  out.code('#define DECLARE_PTR_ALIGNED(X, Y)')
+  out.code('#endif')
+  out.code('')
+
+  out.comm(' global constants       ')
 
   for nc in range (0,len(consts)):
     if not consts[nc]['user_declared']:
       if consts[nc]['dim']==1:
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
       else:
         if consts[nc]['dim'].isdigit() and int(consts[nc]['dim']) > 0:
           num = str(consts[nc]['dim'])
         else:
           num = 'MAX_CONST_SIZE'
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm(' header                 ')
+  out.comm(' header                 ')
 
   if os.path.exists('./user_types.h'):
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"')
-  code('')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"')
+  out.code('')
 
-  comm(' user kernel files')
+  out.comm(' user kernel files')
 
   for nk in range(0,len(kernels)):
-    code('#include "'+kernels[nk]['name']+'_veckernel.cpp"')
+    out.code('#include "'+kernels[nk]['name']+'_veckernel.cpp"')
   master = master.split('.')[0]
-  fid = open('vec/'+master.split('.')[0]+'_veckernels.cpp','w')
-  fid.write('//\n// auto-generated by op2.py\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('vec/'+master.split('.')[0]+'_veckernels.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
@@ -15,81 +15,9 @@ import datetime
 import op2_gen_common
 import os
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line.rstrip()+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if text == '':
-    prefix = ''
-  else:
-    prefix = ' '*depth
-  file_text += prefix+rep(text,g_m).rstrip()+'\n'
-
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
 
 def op2_gen_openacc(master, date, consts, kernels):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -148,22 +76,19 @@ def op2_gen_openacc(master, date, consts, kernels):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims)
 
     file_name = decl_filepath
-    f = open(file_name, 'r')
-    kernel_text = f.read()
-    f.close()
+    kernel_text = op2_gen_common.read_text_file(file_name)
 
-    comm('user function')
+    out.comm('user function')
 
     if CPP:
       includes = op2_gen_common.extract_includes(kernel_text)
       if len(includes) > 0:
         for include in includes:
-          code(include)
-        code("")
+          out.code(include)
+        out.code("")
 
     #strides for SoA
     if any_soa:
@@ -172,17 +97,17 @@ def op2_gen_openacc(master, date, consts, kernels):
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT;')
-            code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST=-1;')
+            out.code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT;')
+            out.code('int opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST=-1;')
       dir_soa = -1
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID and ((not dims[g_m].isdigit()) or int(dims[g_m]) > 1):
-          code('int direct_'+name+'_stride_OP2CONSTANT;')
-          code('int direct_'+name+'_stride_OP2HOST=-1;')
+          out.code('int direct_'+name+'_stride_OP2CONSTANT;')
+          out.code('int direct_'+name+'_stride_OP2HOST=-1;')
           dir_soa = g_m
           break
 
-    comm('user function')
+    out.comm('user function')
 
     kernel_text = op2_gen_common.comment_remover(kernel_text)
     kernel_text = op2_gen_common.remove_trailing_w_space(kernel_text)
@@ -229,38 +154,38 @@ def op2_gen_openacc(master, date, consts, kernels):
 
     head_text += "_openacc"
     signature_text = '//#pragma acc routine\ninline ' + head_text + '( '+signature_text + ') {'
-    file_text += signature_text + body_text + '}\n'
+    out.append(signature_text + body_text + '}\n')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm(' host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm(' host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){');
-        code('')
+        out.code('op_arg <ARG>){', g_m);
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL: #and accs[g_m] <> OP_READ:
-        code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;')
+        out.code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -270,88 +195,88 @@ def op2_gen_openacc(master, date, consts, kernels):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
     if nopts>0:
-      code('int optflags = 0;')
+      out.code('int optflags = 0;')
       for i in range(0,nargs):
         if optflags[i] == 1:
-          IF('args['+str(i)+'].opt')
-          code('optflags |= 1<<'+str(optidxs[i])+';')
-          ENDIF()
+          out.IF('args['+str(i)+'].opt')
+          out.code('optflags |= 1<<'+str(optidxs[i])+';')
+          out.ENDIF()
     if nopts > 30:
       print('ERROR: too many optional arguments to store flags in an integer')
 
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timing_realloc('+str(nk)+');')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('')
 
 #
 #   indirect bits
 #
     if ninds>0:
-      code('int  ninds   = '+str(ninds)+';')
+      out.code('int  ninds   = '+str(ninds)+';')
       line = 'int  inds['+str(nargs)+'] = {'
       for m in range(0,nargs):
         line += str(inds[m]-1)+','
-      code(line[:-1]+'};')
-      code('')
-
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
-
-      code('')
-      comm(' get plan')
-      code('#ifdef OP_PART_SIZE_'+ str(nk))
-      code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
-      code('#else')
-      code('  int part_size = OP_part_size;')
-      code('#endif')
-      code('')
-      code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
+      out.code(line[:-1]+'};', g_m)
+      out.code('')
+
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
+
+      out.code('')
+      out.comm(' get plan')
+      out.code('#ifdef OP_PART_SIZE_'+ str(nk))
+      out.code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('  int part_size = OP_part_size;')
+      out.code('#endif')
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
-      code('')
-      code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
-
-    code('')
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges_cuda(set, nargs, args);')
+
+    out.code('')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL: #and accs[g_m]<>OP_READ:
         if not dims[g_m].isdigit() or int(dims[g_m]) > 1:
           print('ERROR: OpenACC does not support multi-dimensional op_arg_gbl variables')
           exit(-1)
-        code('<TYP> <ARG>_l = <ARG>h[0];')
+        out.code('<TYP> <ARG>_l = <ARG>h[0];', g_m)
 
     if ninds > 0:
-      code('')
-      code('int ncolors = 0;')
-    code('')
-    IF('set_size >0')
-    code('')
+      out.code('')
+      out.code('int ncolors = 0;')
+    out.code('')
+    out.IF('set_size >0')
+    out.code('')
     #managing constants
     if any_soa:
       if nmaps > 0:
@@ -359,51 +284,51 @@ def op2_gen_openacc(master, date, consts, kernels):
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            IF('(OP_kernels[' +str(nk)+ '].count==1) || (opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(g_m)+'))')
-            code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(g_m)+');')
-            code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT = opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST;')
-            ENDIF()
+            out.IF('(OP_kernels[' +str(nk)+ '].count==1) || (opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(g_m)+'))')
+            out.code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(g_m)+');')
+            out.code('opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2CONSTANT = opDat'+str(invinds[inds[g_m]-1])+'_'+name+'_stride_OP2HOST;')
+            out.ENDIF()
       if dir_soa!=-1:
-          IF('(OP_kernels[' +str(nk)+ '].count==1) || (direct_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(dir_soa)+'))')
-          code('direct_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(dir_soa)+');')
-          code('direct_'+name+'_stride_OP2CONSTANT = direct_'+name+'_stride_OP2HOST;')
-          ENDIF()
-    code('')
-    comm('Set up typed device pointers for OpenACC')
+          out.IF('(OP_kernels[' +str(nk)+ '].count==1) || (direct_'+name+'_stride_OP2HOST != getSetSizeFromOpArg(&arg'+str(dir_soa)+'))')
+          out.code('direct_'+name+'_stride_OP2HOST = getSetSizeFromOpArg(&arg'+str(dir_soa)+');')
+          out.code('direct_'+name+'_stride_OP2CONSTANT = direct_'+name+'_stride_OP2HOST;')
+          out.ENDIF()
+    out.code('')
+    out.comm('Set up typed device pointers for OpenACC')
     if nmaps > 0:
       k = []
       for g_m in range(0,nargs):
         if maps[g_m] == OP_MAP and (not invmapinds[inds[g_m]-1] in k):
           k = k + [invmapinds[inds[g_m]-1]]
-          code('int *map'+str(mapinds[g_m])+' = arg'+str(invmapinds[inds[g_m]-1])+'.map_data_d;')
+          out.code('int *map'+str(mapinds[g_m])+' = arg'+str(invmapinds[inds[g_m]-1])+'.map_data_d;')
 
-    code('')
+    out.code('')
     for g_m in range(0,nargs):
       if maps[g_m] == OP_ID:
-        code(typs[g_m]+'* data'+str(g_m)+' = ('+typs[g_m]+'*)arg'+str(g_m)+'.data_d;')
+        out.code(typs[g_m]+'* data'+str(g_m)+' = ('+typs[g_m]+'*)arg'+str(g_m)+'.data_d;')
 
     for m in range(1,ninds+1):
       g_m = invinds[m-1]
-      code('<TYP> *data'+str(g_m)+' = (<TYP> *)<ARG>.data_d;')
+      out.code('<TYP> *data'+str(g_m)+' = (<TYP> *)<ARG>.data_d;', g_m)
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      code('')
-      code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_COLOR2);')
-      code('ncolors = Plan->ncolors;')
-      code('int *col_reord = Plan->col_reord;')
-      code('int set_size1 = set->size + set->exec_size;')
-      code('')
-      comm(' execute plan')
-      FOR('col','0','Plan->ncolors')
-      IF('col==1')
-      code('op_mpi_wait_all_cuda(nargs, args);')
-      ENDIF()
-      code('int start = Plan->col_offsets[0][col];')
-      code('int end = Plan->col_offsets[0][col+1];')
-      code('')
+      out.code('')
+      out.code('op_plan *Plan = op_plan_get_stage(name,set,part_size,nargs,args,ninds,inds,OP_COLOR2);')
+      out.code('ncolors = Plan->ncolors;')
+      out.code('int *col_reord = Plan->col_reord;')
+      out.code('int set_size1 = set->size + set->exec_size;')
+      out.code('')
+      out.comm(' execute plan')
+      out.FOR('col','0','Plan->ncolors')
+      out.IF('col==1')
+      out.code('op_mpi_wait_all_cuda(nargs, args);')
+      out.ENDIF()
+      out.code('int start = Plan->col_offsets[0][col];')
+      out.code('int end = Plan->col_offsets[0][col+1];')
+      out.code('')
 #      code('#pragma omp parallel for')
       line = '#pragma acc parallel loop independent deviceptr(col_reord,'
       if nmaps > 0:
@@ -430,37 +355,37 @@ def op2_gen_openacc(master, date, consts, kernels):
               line = line + ' reduction(min:arg'+str(g_m)+'_l)'
             if accs[g_m] == OP_MAX:
               line = line + ' reduction(max:arg'+str(g_m)+'_l)'
-      code(line)
-      FOR('e','start','end')
-      code('int n = col_reord[e];')
+      out.code(line, g_m)
+      out.FOR('e','start','end')
+      out.code('int n = col_reord[e];')
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
       #do non-optional ones
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k) and (not optflags[g_m]):
             k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = map'+str(invmapinds[inds[g_m]-1])+\
+            out.code('map'+str(mapinds[g_m])+'idx = map'+str(invmapinds[inds[g_m]-1])+\
               '[n + set_size1 * '+str(idxs[g_m])+'];')
       #do optional ones
       if nmaps > 0:
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             if optflags[g_m]:
-              IF('optflags & 1<<'+str(optidxs[g_m]))
+              out.IF('optflags & 1<<'+str(optidxs[g_m]))
             else:
               k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = map'+str(invmapinds[inds[g_m]-1])+\
+            out.code('map'+str(mapinds[g_m])+'idx = map'+str(invmapinds[inds[g_m]-1])+\
               '[n + set_size1 * '+str(idxs[g_m])+'];')
             if optflags[g_m]:
-              ENDIF()
+              out.ENDIF()
 
-      code('')
+      out.code('')
       for g_m in range (0,nargs):
         u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
         if len(u) > 0 and vectorised[g_m] > 0:
@@ -473,17 +398,17 @@ def op2_gen_openacc(master, date, consts, kernels):
           first = [i for i in range(0,len(v)) if v[i] == 1]
           first = first[0]
 
-          indent = ' '*(depth+2)
+          indent = ' '*(out.depth+2)
           for k in range(0,sum(v)):
             if soaflags[g_m]:
               line = line + indent + ' &data'+str(first)+'[map'+str(mapinds[g_m+k])+'idx],\n'
             else:
               line = line + indent + ' &data'+str(first)+'[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
           line = line[:-2]+'};'
-          code(line)
-      code('')
+          out.code(line, g_m)
+      out.code('')
       line = name+'_openacc('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           if soaflags[g_m]:
@@ -506,27 +431,27 @@ def op2_gen_openacc(master, date, consts, kernels):
             line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
-      code('')
+      out.code(line, g_m)
+      out.ENDFOR()
+      out.code('')
 
       if reduct:
-        comm(' combine reduction data')
-        IF('col == Plan->ncolors_owned-1')
+        out.comm(' combine reduction data')
+        out.IF('col == Plan->ncolors_owned-1')
         for g_m in range(0,nargs):
           if maps[g_m] == OP_GBL and accs[g_m] != OP_READ:
             if accs[g_m]==OP_INC or accs[g_m]==OP_WRITE:
-              code('<ARG>h[0] = <ARG>_l;')
+              out.code('<ARG>h[0] = <ARG>_l;', g_m)
             elif accs[g_m]==OP_MIN:
-              code('<ARG>h[0]  = MIN(<ARG>h[0],<ARG>_l);')
-              ENDFOR()
+              out.code('<ARG>h[0]  = MIN(<ARG>h[0],<ARG>_l);', g_m)
+              out.ENDFOR()
             elif  accs[g_m]==OP_MAX:
-              code('<ARG>h[0]  = MAX(<ARG>h[0],<ARG>_l);')
+              out.code('<ARG>h[0]  = MAX(<ARG>h[0],<ARG>_l);', g_m)
             else:
               error('internal error: invalid reduction option')
-            ENDFOR()
-        ENDIF()
-      ENDFOR()
+            out.ENDFOR()
+        out.ENDIF()
+      out.ENDFOR()
 
 #
 # kernel call for direct version
@@ -547,10 +472,10 @@ def op2_gen_openacc(master, date, consts, kernels):
               line = line + ' reduction(min:arg'+str(g_m)+'_l)'
             if accs[g_m] == OP_MAX:
               line = line + ' reduction(max:arg'+str(g_m)+'_l)'
-      code(line)
-      FOR('n','0','set->size')
+      out.code(line, g_m)
+      out.FOR('n','0','set->size')
       line = name+'_openacc('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           if soaflags[g_m]:
@@ -563,86 +488,81 @@ def op2_gen_openacc(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      out.code(line, g_m)
+      out.ENDFOR()
 
     if ninds>0:
-      code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
-      code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
+      out.code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
+      out.code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
 
-    ENDIF()
-    code('')
+    out.ENDIF()
+    out.code('')
 
     #zero set size issues
     if ninds>0:
-      IF('set_size == 0 || set_size == set->core_size || ncolors == 1')
-      code('op_mpi_wait_all_cuda(nargs, args);')
-      ENDIF()
+      out.IF('set_size == 0 || set_size == set->core_size || ncolors == 1')
+      out.code('op_mpi_wait_all_cuda(nargs, args);')
+      out.ENDIF()
 
 #
 # combine reduction data from multiple OpenMP threads
 #
-    comm(' combine reduction data')
+    out.comm(' combine reduction data')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ:
         if ninds==0: #direct version only
           if accs[g_m]==OP_INC or accs[g_m]==OP_WRITE:
-            code('<ARG>h[0] = <ARG>_l;')
+            out.code('<ARG>h[0] = <ARG>_l;', g_m)
           elif accs[g_m]==OP_MIN:
-            code('<ARG>h[0]  = MIN(<ARG>h[0],<ARG>_l);')
+            out.code('<ARG>h[0]  = MIN(<ARG>h[0],<ARG>_l);', g_m)
           elif accs[g_m]==OP_MAX:
-            code('<ARG>h[0]  = MAX(<ARG>h[0],<ARG>_l);')
+            out.code('<ARG>h[0]  = MAX(<ARG>h[0],<ARG>_l);', g_m)
           else:
             print('internal error: invalid reduction option')
         if typs[g_m] == 'double': #need for both direct and indirect
-          code('op_mpi_reduce_double(&<ARG>,<ARG>h);')
+          out.code('op_mpi_reduce_double(&<ARG>,<ARG>h);', g_m)
         elif typs[g_m] == 'float':
-          code('op_mpi_reduce_float(&<ARG>,<ARG>h);')
+          out.code('op_mpi_reduce_float(&<ARG>,<ARG>h);', g_m)
         elif typs[g_m] == 'int':
-          code('op_mpi_reduce_int(&<ARG>,<ARG>h);')
+          out.code('op_mpi_reduce_int(&<ARG>,<ARG>h);', g_m)
         else:
           print('Type '+typs[g_m]+' not supported in OpenACC code generator, please add it')
           exit(-1)
 
 
-    code('op_mpi_set_dirtybit_cuda(nargs, args);')
-    code('')
+    out.code('op_mpi_set_dirtybit_cuda(nargs, args);')
+    out.code('')
 
 #
 # update kernel record
 #
 
-    comm(' update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.comm(' update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
 
       for g_m in range (0,nargs):
         if optflags[g_m]==1:
-          IF('<ARG>.opt')
+          out.IF('<ARG>.opt', g_m)
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
         if optflags[g_m]==1:
-          ENDIF()
-    depth -= 2
-    code('}')
+          out.ENDIF()
+    out.depth -= 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('openacc'):
-        os.makedirs('openacc')
-    fid = open('openacc/'+name+'_acckernel.c','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('openacc/'+name+'_acckernel.c', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -651,42 +571,39 @@ def op2_gen_openacc(master, date, consts, kernels):
 #  output one master kernel file
 ##########################################################################
 
-  file_text =''
+  out = op2_gen_common.CodeEmitter()
 
-  comm(' global constants       ')
+  out.comm(' global constants       ')
 
   for nc in range (0,len(consts)):
     if not consts[nc]['user_declared']:
       if consts[nc]['dim']==1:
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
       else:
         if consts[nc]['dim'].isdigit() and int(consts[nc]['dim']) > 0:
           num = str(consts[nc]['dim'])
         else:
           num = 'MAX_CONST_SIZE'
 
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm(' header                 ')
+  out.comm(' header                 ')
 
   if os.path.exists('./user_types.h'):
-    code('#include "../user_types.h"')
-  code('#include "op_lib_c.h"       ')
-  code('')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_c.h"       ')
+  out.code('')
 
-  code('void op_decl_const_char(int dim, char const *type,')
-  code('int size, char *dat, char const *name){}')
+  out.code('void op_decl_const_char(int dim, char const *type,')
+  out.code('int size, char *dat, char const *name){}')
 
-  comm(' user kernel files')
+  out.comm(' user kernel files')
 
   for nk in range(0,len(kernels)):
-    code('#include "'+kernels[nk]['name']+'_acckernel.c"')
+    out.code('#include "'+kernels[nk]['name']+'_acckernel.c"')
   master = master.split('.')[0]
-  fid = open('openacc/'+master.split('.')[0]+'_acckernels.c','w')
-  fid.write('//\n// auto-generated by op2.py\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('openacc/'+master.split('.')[0]+'_acckernels.c', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 
 
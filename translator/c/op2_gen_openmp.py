@@ -14,78 +14,9 @@ import datetime
 import os
 import op2_gen_common
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  prefix = ' '*depth
-  file_text += prefix+rep(text,g_m)+'\n'
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
-
 
 def op2_gen_openmp(master, date, consts, kernels):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -143,97 +74,96 @@ def op2_gen_openmp(master, date, consts, kernels):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims, strip=False)
 
-    comm('user function')
+    out.comm('user function')
 
     if FORTRAN:
-      code('include '+name+'.inc')
+      out.code('include '+name+'.inc')
     elif CPP:
-      code('#include "../'+decl_filepath+'"')
+      out.code('#include "../'+decl_filepath+'"')
 
-    comm('')
-    comm(' x86 kernel function')
+    out.comm('')
+    out.comm(' x86 kernel function')
 
     if FORTRAN:
-      code('subroutine op_x86_'+name+'(')
+      out.code('subroutine op_x86_'+name+'(')
     elif CPP:
-      code('void op_x86_'+name+'(')
+      out.code('void op_x86_'+name+'(')
 
-    depth = 2
+    out.depth = 2
 
     if ninds>0:
       if FORTRAN:
-        code('integer(4)  blockIdx,')
+        out.code('integer(4)  blockIdx,')
       elif CPP:
-        code('int    blockIdx,')
+        out.code('int    blockIdx,')
 
     for g_m in range(0,ninds):
       if FORTRAN:
-        code('<INDTYP> *ind_<ARG>,')
+        out.code('<INDTYP> *ind_<ARG>,', g_m)
       elif CPP:
-        code('<INDTYP> *ind_<ARG>,')
+        out.code('<INDTYP> *ind_<ARG>,', g_m)
 
     if ninds>0:
       if FORTRAN:
-        code('int   *ind_map,')
-        code('short *arg_map,')
+        out.code('int   *ind_map,')
+        out.code('short *arg_map,')
       elif CPP:
-        code('int   *ind_map,')
-        code('short *arg_map,')
+        out.code('int   *ind_map,')
+        out.code('short *arg_map,')
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m] == OP_READ:
         # declared const for performance
         if FORTRAN:
-          code('const <TYP> *<ARG>,')
+          out.code('const <TYP> *<ARG>,', g_m)
         elif CPP:
-          code('const <TYP> *<ARG>,')
+          out.code('const <TYP> *<ARG>,', g_m)
       elif maps[g_m]==OP_ID and ninds>0:
         if FORTRAN:
-          code('<ARG>,')
+          out.code('<ARG>,', g_m)
         elif CPP:
-          code('<TYP> *<ARG>,')
+          out.code('<TYP> *<ARG>,', g_m)
       elif maps[g_m]==OP_GBL or maps[g_m]==OP_ID:
         if FORTRAN:
-          code('<ARG>,')
+          out.code('<ARG>,', g_m)
         elif CPP:
-          code('<TYP> *<ARG>,')
+          out.code('<TYP> *<ARG>,', g_m)
 
     if ninds>0:
       if FORTRAN:
-        code('ind_arg_sizes,')
-        code('ind_arg_offs, ')
-        code('block_offset, ')
-        code('blkmap,       ')
-        code('offset,       ')
-        code('nelems,       ')
-        code('ncolors,      ')
-        code('colors,       ')
-        code('set_size) {    ')
-        code('')
+        out.code('ind_arg_sizes,')
+        out.code('ind_arg_offs, ')
+        out.code('block_offset, ')
+        out.code('blkmap,       ')
+        out.code('offset,       ')
+        out.code('nelems,       ')
+        out.code('ncolors,      ')
+        out.code('colors,       ')
+        out.code('set_size) {    ')
+        out.code('')
       elif CPP:
-        code('int   *ind_arg_sizes,')
-        code('int   *ind_arg_offs, ')
-        code('int    block_offset, ')
-        code('int   *blkmap,       ')
-        code('int   *offset,       ')
-        code('int   *nelems,       ')
-        code('int   *ncolors,      ')
-        code('int   *colors,       ')
-        code('int   set_size) {    ')
-        code('')
+        out.code('int   *ind_arg_sizes,')
+        out.code('int   *ind_arg_offs, ')
+        out.code('int    block_offset, ')
+        out.code('int   *blkmap,       ')
+        out.code('int   *offset,       ')
+        out.code('int   *nelems,       ')
+        out.code('int   *ncolors,      ')
+        out.code('int   *colors,       ')
+        out.code('int   set_size) {    ')
+        out.code('')
     else:
       if FORTRAN:
-        code('start, finish )')
+        out.code('start, finish )')
       elif CPP:
-        code('int  start, int  finish ) {')
-      code('')
+        out.code('int  start, int  finish ) {')
+      out.code('')
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-        code('<TYP>  <ARG>_l[<DIM>];')
+        out.code('<TYP>  <ARG>_l[<DIM>];', g_m)
 
     for m in range (1,ninds+1):
       g_m = m-1
@@ -242,102 +172,102 @@ def op2_gen_openmp(master, date, consts, kernels):
       if sum(v)>1 and sum(v_i)>0:
         if indaccs[m-1] == OP_INC:
           ind = int(max([idxs[i] for i in range(len(inds)) if inds[i]==m])) + 1
-          code('<INDTYP> *<ARG>_vec['+str(ind)+'] = {'); depth += 2;
+          out.code('<INDTYP> *<ARG>_vec['+str(ind)+'] = {', g_m); out.depth += 2;
           for n in range(0,nargs):
             if inds[n] == m:
               g_m = n
-              code('<ARG>_l,')
-          depth -= 2
-          code('};')
+              out.code('<ARG>_l,', g_m)
+          out.depth -= 2
+          out.code('};')
         else:
           ind = int(max([idxs[i] for i in range(len(inds)) if inds[i]==m])) + 1
           if indaccs[m-1] == OP_READ:
-            code('const <INDTYP> *<ARG>_vec['+str(ind)+'];')
+            out.code('const <INDTYP> *<ARG>_vec['+str(ind)+'];', g_m)
           else:
-            code('<INDTYP> *<ARG>_vec['+str(ind)+'];')
+            out.code('<INDTYP> *<ARG>_vec['+str(ind)+'];', g_m)
 #
 # lengthy code for general case with indirection
 #
     if ninds>0:
-      code('')
+      out.code('')
       for g_m in range (0,ninds):
-        code('int  *ind_<ARG>_map, ind_<ARG>_size;')
+        out.code('int  *ind_<ARG>_map, ind_<ARG>_size;', g_m)
       for g_m in range (0,ninds):
-        code('<INDTYP> *ind_<ARG>_s;')
+        out.code('<INDTYP> *ind_<ARG>_s;', g_m)
 
       if FORTRAN:
-        code('integer(4) :: nelem, offset_b, blockId')
-        code('character :: shared[64000]')
+        out.code('integer(4) :: nelem, offset_b, blockId')
+        out.code('character :: shared[64000]')
       elif CPP:
-        code('int    nelem, offset_b;')
-        code('')
-        code('char shared[128000];')
-
-      code('')
-      IF('0==0')
-      code('')
-      comm(' get sizes and shift pointers and direct-mapped data')
-      code('')
-      code('int blockId = blkmap[blockIdx + block_offset];')
-      code('nelem    = nelems[blockId];')
-      code('offset_b = offset[blockId];')
-      code('')
+        out.code('int    nelem, offset_b;')
+        out.code('')
+        out.code('char shared[128000];')
+
+      out.code('')
+      out.IF('0==0')
+      out.code('')
+      out.comm(' get sizes and shift pointers and direct-mapped data')
+      out.code('')
+      out.code('int blockId = blkmap[blockIdx + block_offset];')
+      out.code('nelem    = nelems[blockId];')
+      out.code('offset_b = offset[blockId];')
+      out.code('')
 
       for g_m in range (0,ninds):
-        code('ind_<ARG>_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds)+'];')
-      code('')
+        out.code('ind_<ARG>_size = ind_arg_sizes['+str(g_m)+'+blockId*'+ str(ninds)+'];', g_m)
+      out.code('')
       for m in range (1,ninds+1):
         g_m = m-1
         c = [i for i in range(len(inds)) if inds[i]==m]
-        code('ind_<ARG>_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
-        '*set_size] + ind_arg_offs['+str(m-1)+'+blockId*'+str(ninds)+'];')
+        out.code('ind_<ARG>_map = &ind_map['+str(cumulative_indirect_index[c[0]])+\
+        '*set_size] + ind_arg_offs['+str(m-1)+'+blockId*'+str(ninds)+'];', g_m)
 
-      code('')
-      comm(' set shared memory pointers')
-      code('int nbytes = 0;')
+      out.code('')
+      out.comm(' set shared memory pointers')
+      out.code('int nbytes = 0;')
 
       for g_m in range(0,ninds):
-        code('ind_<ARG>_s = (<INDTYP> *) &shared[nbytes];')
+        out.code('ind_<ARG>_s = (<INDTYP> *) &shared[nbytes];', g_m)
         if g_m < ninds-1:
-          code('nbytes += ROUND_UP(ind_<ARG>_size*sizeof(<INDTYP>)*<INDDIM>);')
-      ENDIF()
-      code('')
-      comm(' copy indirect datasets into shared memory or zero increment')
-      code('')
+          out.code('nbytes += ROUND_UP(ind_<ARG>_size*sizeof(<INDTYP>)*<INDDIM>);', g_m)
+      out.ENDIF()
+      out.code('')
+      out.comm(' copy indirect datasets into shared memory or zero increment')
+      out.code('')
 
       for g_m in range(0,ninds):
         if indaccs[g_m]==OP_READ or indaccs[g_m]==OP_RW or indaccs[g_m]==OP_INC:
-          FOR('n','0','<INDARG>_size')
-          FOR('d','0','<INDDIM>')
+          out.FOR('n','0','<INDARG>_size', g_m)
+          out.FOR('d','0','<INDDIM>', g_m)
           if indaccs[g_m]==OP_READ or indaccs[g_m]==OP_RW:
-            code('<INDARG>_s[d+n*<INDDIM>] = <INDARG>[d+<INDARG>_map[n]*<INDDIM>];')
-            code('')
+            out.code('<INDARG>_s[d+n*<INDDIM>] = <INDARG>[d+<INDARG>_map[n]*<INDDIM>];', g_m)
+            out.code('')
           elif indaccs[g_m]==OP_INC:
-            code('<INDARG>_s[d+n*<INDDIM>] = ZERO_<INDTYP>;')
-          ENDFOR()
-          ENDFOR()
+            out.code('<INDARG>_s[d+n*<INDDIM>] = ZERO_<INDTYP>;', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
 
-      code('')
-      comm(' process set elements')
-      code('')
+      out.code('')
+      out.comm(' process set elements')
+      out.code('')
 
       if ind_inc:
-        FOR('n','0','nelem')
-        comm(' initialise local variables            ')
+        out.FOR('n','0','nelem')
+        out.comm(' initialise local variables            ')
         for g_m in range(0,nargs):
           if maps[g_m]==OP_MAP and accs[g_m]==OP_INC:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d] = ZERO_<TYP>;')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d] = ZERO_<TYP>;', g_m)
+            out.ENDFOR()
       else:
-        FOR('n','0','nelem')
+        out.FOR('n','0','nelem')
 
 #
 # simple alternative when no indirection
 #
     else:
-      comm(' process set elements')
-      FOR('n','start','finish')
+      out.comm(' process set elements')
+      out.FOR('n','start','finish')
 
 #
 # kernel call
@@ -347,17 +277,17 @@ def op2_gen_openmp(master, date, consts, kernels):
       s = [i for i in range(len(inds)) if inds[i]==m]
       if sum(s)>1:
         if indaccs[m-1] != OP_INC:
-          code('')
+          out.code('')
           ctr = 0
           for n in range(0,nargs):
             if inds[n] == m and vectorised[n]:
-              code('arg'+str(m-1)+'_vec['+str(ctr)+'] = ind_arg'+\
+              out.code('arg'+str(m-1)+'_vec['+str(ctr)+'] = ind_arg'+\
               str(inds[n]-1)+'_s+arg_map['+str(cumulative_indirect_index[n])+\
               '*set_size+n+offset_b]*'+str(dims[n])+';')
               ctr = ctr+1
 
-    code('')
-    comm(' user-supplied kernel call')
+    out.code('')
+    out.comm(' user-supplied kernel call')
 
     line = name+'('
     prefix = ' '*len(name)
@@ -368,118 +298,118 @@ def op2_gen_openmp(master, date, consts, kernels):
         indent = '     '+' '*len(name)
 
       if maps[m] == OP_GBL:
-        line += rep(indent+'<ARG>,\n',m)
+        line += out.rep(indent+'<ARG>,\n',m)
         a = a+1
       elif maps[m]==OP_MAP and  accs[m]==OP_INC and vectorised[m]==0:
-        line += rep(indent+'<ARG>_l,\n',m);
+        line += out.rep(indent+'<ARG>_l,\n',m);
         a = a+1
       elif maps[m]==OP_MAP and vectorised[m]==0:
-        line += rep(indent+'ind_arg'+str(inds[m]-1)+'_s+arg_map['+\
+        line += out.rep(indent+'ind_arg'+str(inds[m]-1)+'_s+arg_map['+\
         str(cumulative_indirect_index[m])+'*set_size+n+offset_b]*<DIM>,\n',m)
         a = a+1
       elif maps[m]==OP_MAP and m == 0:
-        line += rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
+        line += out.rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
         a = a+1
       elif maps[m]==OP_MAP and m>0 and vectorised[m] != vectorised[m-1]: #xxx:vector
-        line += rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
+        line += out.rep(indent+'<ARG>_vec,'+'\n',inds[m]-1)
         a = a+1
       elif maps[m]==OP_MAP and m>0 and vectorised[m] == vectorised[m-1]:
         line = line
         a = a+1
       elif maps[m]==OP_ID:
         if ninds>0:
-          line += rep(indent+'<ARG>+(n+offset_b)*<DIM>,'+'\n',m)
+          line += out.rep(indent+'<ARG>+(n+offset_b)*<DIM>,'+'\n',m)
           a = a+1
         else:
-          line += rep(indent+'<ARG>+n*<DIM>,'+'\n',m)
+          line += out.rep(indent+'<ARG>+n*<DIM>,'+'\n',m)
           a = a+1
       else:
         print('internal error 1 ')
 
-    code(line[0:-2]+');') #remove final ',' and \n
+    out.code(line[0:-2]+');', g_m) #remove final ',' and \n
 
 #
 # updating for indirect kernels ...
 #
     if ninds>0:
       if ind_inc:
-        code('')
-        comm(' store local variables            ')
+        out.code('')
+        out.comm(' store local variables            ')
 
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
-            code('int <ARG>_map = arg_map['+ str(cumulative_indirect_index[g_m])+\
-                '*set_size+n+offset_b];')
-        code('')
+            out.code('int <ARG>_map = arg_map['+ str(cumulative_indirect_index[g_m])+\
+                '*set_size+n+offset_b];', g_m)
+        out.code('')
 
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
-            FOR('d','0','<DIM>')
-            code('ind_arg'+str(inds[g_m]-1)+'_s[d+<ARG>_map*<DIM>] += <ARG>_l[d];')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('ind_arg'+str(inds[g_m]-1)+'_s[d+<ARG>_map*<DIM>] += <ARG>_l[d];', g_m)
+            out.ENDFOR()
 
-      ENDFOR()
+      out.ENDFOR()
 
       s = [i for i in range(1,ninds+1) if indaccs[i-1]!= OP_READ]
 
       if len(s)>0 and max(s)>0:
-        code('')
-        comm(' apply pointered write/increment')
+        out.code('')
+        out.comm(' apply pointered write/increment')
 
       for g_m in range(0,ninds):
         if indaccs[g_m]==OP_WRITE or indaccs[g_m]==OP_RW or indaccs[g_m]==OP_INC:
-          FOR('n','0','<INDARG>_size')
-          FOR('d','0','<INDDIM>')
+          out.FOR('n','0','<INDARG>_size', g_m)
+          out.FOR('d','0','<INDDIM>', g_m)
           if indaccs[g_m]==OP_WRITE or indaccs[g_m]==OP_RW:
-            code('<INDARG>[d+<INDARG>_map[n]*<INDDIM>] = <INDARG>_s[d+n*<INDDIM>];')
+            out.code('<INDARG>[d+<INDARG>_map[n]*<INDDIM>] = <INDARG>_s[d+n*<INDDIM>];', g_m)
           elif indaccs[g_m]==OP_INC:
-            code('<INDARG>[d+<INDARG>_map[n]*<INDDIM>] += <INDARG>_s[d+n*<INDDIM>];')
-          ENDFOR()
-          ENDFOR()
+            out.code('<INDARG>[d+<INDARG>_map[n]*<INDDIM>] += <INDARG>_s[d+n*<INDDIM>];', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
 #
 # ... and direct kernels
 #
     else:
-      depth -= 2
-      code('}')
+      out.depth -= 2
+      out.code('}')
 
 #
 # global reduction
 #
-    depth -= 2
-    code('}')
-    code('')
+    out.depth -= 2
+    out.code('}')
+    out.code('')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm(' host stub function          ')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm(' host stub function          ')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){');
-        code('')
+        out.code('op_arg <ARG>){', g_m);
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m] != OP_READ:
-        code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;')
+        out.code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -489,258 +419,253 @@ def op2_gen_openmp(master, date, consts, kernels):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
 #
 #   indirect bits
 #
     if ninds>0:
-      code('int  ninds   = '+str(ninds)+';')
+      out.code('int  ninds   = '+str(ninds)+';')
       line = 'int  inds['+str(nargs)+'] = {'
       for m in range(0,nargs):
         line += str(inds[m]-1)+','
-      code(line[:-1]+'};')
-      code('')
+      out.code(line[:-1]+'};', g_m)
+      out.code('')
 
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
 
-      code('')
-      comm(' get plan')
-      code('#ifdef OP_PART_SIZE_'+ str(nk))
-      code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
-      code('#else')
-      code('  int part_size = OP_part_size;')
-      code('#endif')
-      code('')
-      code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
+      out.code('')
+      out.comm(' get plan')
+      out.code('#ifdef OP_PART_SIZE_'+ str(nk))
+      out.code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
+      out.code('#else')
+      out.code('  int part_size = op_tune_part_size('+str(nk)+', name, OP_part_size);')
+      out.code('#endif')
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
-      code('')
-      code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
 
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('')
 
 #
 # set number of threads in x86 execution and create arrays for reduction
 #
 
     if reduct or ninds==0:
-      comm(' set number of threads')
-      code('#ifdef _OPENMP')
-      code('  int nthreads = omp_get_max_threads();')
-      code('#else')
-      code('  int nthreads = 1;')
-      code('#endif')
+      out.comm(' set number of threads')
+      out.code('#ifdef _OPENMP')
+      out.code('  int nthreads = omp_get_max_threads();')
+      out.code('#else')
+      out.code('  int nthreads = 1;')
+      out.code('#endif')
 
     if reduct:
-      code('')
-      comm(' allocate and initialise arrays for global reduction')
+      out.code('')
+      out.comm(' allocate and initialise arrays for global reduction')
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m]!=OP_WRITE:
-          code('<TYP> <ARG>_l[<DIM>+64*64];')
-          FOR('thr','0','nthreads')
+          out.code('<TYP> <ARG>_l[<DIM>+64*64];', g_m)
+          out.FOR('thr','0','nthreads')
           if accs[g_m]==OP_INC:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d+thr*64]=ZERO_<TYP>;')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d+thr*64]=ZERO_<TYP>;', g_m)
+            out.ENDFOR()
           else:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d+thr*64]=<ARG>h[d];')
-            ENDFOR()
-          ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d+thr*64]=<ARG>h[d];', g_m)
+            out.ENDFOR()
+          out.ENDFOR()
 
-    code('')
-    IF('set_size >0')
-    code('')
+    out.code('')
+    out.IF('set_size >0')
+    out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      code('op_plan *Plan = op_plan_get_stage_upload(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_ALL,0);')
-      code('')
-      comm(' execute plan')
-      code('int block_offset = 0;')
-      FOR('col','0','Plan->ncolors')
-      IF('col==Plan->ncolors_core')
-      code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
-      code('int nblocks = Plan->ncolblk[col];')
-      code('')
-      code('#pragma omp parallel for')
-      FOR('blockIdx','0','nblocks')
-      code('op_x86_'+name+'( blockIdx,')
+      out.code('op_plan *Plan = op_plan_get_stage_upload(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_ALL,0);')
+      out.code('')
+      out.comm(' execute plan')
+      out.code('int block_offset = 0;')
+      out.FOR('col','0','Plan->ncolors')
+      out.IF('col==Plan->ncolors_core')
+      out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
+      out.code('int nblocks = Plan->ncolblk[col];')
+      out.code('')
+      out.code('#pragma omp parallel for')
+      out.FOR('blockIdx','0','nblocks')
+      out.code('op_x86_'+name+'( blockIdx,')
 
       for m in range(1,ninds+1):
         g_m = invinds[m-1]
-        code('(<TYP> *)<ARG>.data,')
+        out.code('(<TYP> *)<ARG>.data,', g_m)
 
-      code('Plan->ind_map,')
-      code('Plan->loc_map,')
+      out.code('Plan->ind_map,')
+      out.code('Plan->loc_map,')
 
       for m in range(0,nargs):
         g_m = m
         if inds[m]==0 and maps[m] == OP_GBL and accs[m] != OP_READ and accs[m] != OP_WRITE:
-          code('&<ARG>_l[64*omp_get_thread_num()],')
+          out.code('&<ARG>_l[64*omp_get_thread_num()],', g_m)
         elif inds[m]==0:
-          code('(<TYP> *)<ARG>.data,')
-
-      code('Plan->ind_sizes,')
-      code('Plan->ind_offs,')
-      code('block_offset,')
-      code('Plan->blkmap,')
-      code('Plan->offset,')
-      code('Plan->nelems,')
-      code('Plan->nthrcol,')
-      code('Plan->thrcol,')
-      code('set_size);')
-      ENDFOR()
-      code('')
+          out.code('(<TYP> *)<ARG>.data,', g_m)
+
+      out.code('Plan->ind_sizes,')
+      out.code('Plan->ind_offs,')
+      out.code('block_offset,')
+      out.code('Plan->blkmap,')
+      out.code('Plan->offset,')
+      out.code('Plan->nelems,')
+      out.code('Plan->nthrcol,')
+      out.code('Plan->thrcol,')
+      out.code('set_size);')
+      out.ENDFOR()
+      out.code('')
 
       if reduct:
-        comm(' combine reduction data')
-        IF('col == Plan->ncolors_owned-1')
+        out.comm(' combine reduction data')
+        out.IF('col == Plan->ncolors_owned-1')
         for m in range(0,nargs):
           if maps[m] == OP_GBL and accs[m] != OP_READ and accs[m] != OP_WRITE:
-            FOR('thr','0','nthreads')
+            out.FOR('thr','0','nthreads')
             if accs[m]==OP_INC:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d] += <ARG>_l[d+thr*64];')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d] += <ARG>_l[d+thr*64];', g_m)
+              out.ENDFOR()
             elif accs[m]==OP_MIN:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+              out.ENDFOR()
             elif  accs(m)==OP_MAX:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+              out.ENDFOR()
             else:
               error('internal error: invalid reduction option')
-            ENDFOR()
-        ENDIF()
-      code('block_offset += nblocks;');
-      ENDIF()
+            out.ENDFOR()
+        out.ENDIF()
+      out.code('block_offset += nblocks;');
+      out.ENDIF()
 
 #
 # kernel call for direct version
 #
     else:
-      comm(' execute plan')
-      code('#pragma omp parallel for')
-      FOR('thr','0','nthreads')
-      code('int start  = (set->size* thr)/nthreads;')
-      code('int finish = (set->size*(thr+1))/nthreads;')
-      code('op_x86_'+name+'(')
+      out.comm(' execute plan')
+      out.code('#pragma omp parallel for')
+      out.FOR('thr','0','nthreads')
+      out.code('int start  = (set->size* thr)/nthreads;')
+      out.code('int finish = (set->size*(thr+1))/nthreads;')
+      out.code('op_x86_'+name+'(')
 
       for g_m in range(0,nargs):
         indent = ''
         if maps[g_m]==OP_GBL and accs[g_m] != OP_READ and accs[g_m] != OP_WRITE:
-          code(indent+'<ARG>_l + thr*64,')
+          out.code(indent+'<ARG>_l + thr*64,', g_m)
         else:
-          code(indent+'(<TYP> *) <ARG>.data,')
+          out.code(indent+'(<TYP> *) <ARG>.data,', g_m)
 
-      code('start, finish );')
-      ENDFOR()
+      out.code('start, finish );')
+      out.ENDFOR()
 
     if ninds>0:
-      code('op_timing_realloc('+str(nk)+');')
-      code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer; ')
-      code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
+      out.code('op_timing_realloc('+str(nk)+');')
+      out.code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer; ')
+      out.code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
 
-    ENDIF()
-    code('')
+    out.ENDIF()
+    out.code('')
 
 #
 # combine reduction data from multiple OpenMP threads, direct version
 #
-    comm(' combine reduction data')
+    out.comm(' combine reduction data')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m] != OP_WRITE and ninds==0:
-        FOR('thr','0','nthreads')
+        out.FOR('thr','0','nthreads')
         if accs[g_m]==OP_INC:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d] += <ARG>_l[d+thr*64];')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d] += <ARG>_l[d+thr*64];', g_m)
+          out.ENDFOR()
         elif accs[g_m]==OP_MIN:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+          out.ENDFOR()
         elif accs[g_m]==OP_MAX:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+          out.ENDFOR()
         else:
           print('internal error: invalid reduction option')
-        ENDFOR()
+        out.ENDFOR()
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ:
-        code('op_mpi_reduce(&<ARG>,<ARG>h);')
+        out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
-    code('op_mpi_set_dirtybit(nargs, args);')
-    code('')
+    out.code('op_mpi_set_dirtybit(nargs, args);')
+    out.code('')
 
 #
 # update kernel record
 #
 
-    comm(' update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('op_timing_realloc('+str(nk)+');')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.comm(' update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
 
       for g_m in range (0,nargs):
         if optflags[g_m]==1:
-          IF('<ARG>.opt')
+          out.IF('<ARG>.opt', g_m)
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
         if optflags[g_m]==1:
-          ENDIF()
-    depth -= 2
-    code('}')
+          out.ENDIF()
+    out.depth -= 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('openmp'):
-        os.makedirs('openmp')
-    fid = open('openmp/'+name+'_kernel.cpp','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('openmp/'+name+'_kernel.cpp', '//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -749,39 +674,36 @@ def op2_gen_openmp(master, date, consts, kernels):
 #  output one master kernel file
 ##########################################################################
 
-  file_text =''
+  out = op2_gen_common.CodeEmitter(strip=False)
 
-  comm(' global constants       ')
+  out.comm(' global constants       ')
 
   for nc in range (0,len(consts)):
     if not consts[nc]['user_declared']:
       if consts[nc]['dim']==1:
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
       else:
         if consts[nc]['dim'] > 0:
           num = str(consts[nc]['dim'])
         else:
           num = 'MAX_CONST_SIZE'
 
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm(' header                 ')
+  out.comm(' header                 ')
 
   if os.path.exists('./user_types.h'):
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"       ')
-  code('')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"       ')
+  out.code('')
 
-  comm(' user kernel files')
+  out.comm(' user kernel files')
 
   for nk in range(0,len(kernels)):
-    code('#include "'+kernels[nk]['name']+'_kernel.cpp"')
+    out.code('#include "'+kernels[nk]['name']+'_kernel.cpp"')
   master = master.split('.')[0]
-  fid = open('openmp/'+master.split('.')[0]+'_kernels.cpp','w')
-  fid.write('//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('openmp/'+master.split('.')[0]+'_kernels.cpp', '//\n// auto-generated by op2.py on '+date.strftime("%Y-%m-%d %H:%M")+'\n//\n\n' + out.text())
 
 
 
@@ -15,83 +15,24 @@ import os
 import op2_gen_common
 
 insert_thread_timers = os.getenv('OP_TIME_THREADS', False);
+# run all colours of an indirect loop in one parallel region, rather than
+# starting a new one for each colour
+persistent_region = os.getenv('OP_OMP_PERSISTENT', False);
+# kernels (a comma separated list of names, or 'all') whose indirect
+# increments are done with atomic updates, without colouring
+atomics_kernels = os.getenv('OP_OMP_ATOMICS', '').split(',')
+# kernels (as above) whose indirect increments are summed into a buffer with
+# separate entries for each block, which are then added up for each element
+replicate_kernels = os.getenv('OP_OMP_REPLICATE', '').split(',')
+# kernels (as above) whose indirect increments are stored for each element
+# and map index, then gathered for each incremented element through the
+# inverse of the map
+gather_kernels = os.getenv('OP_OMP_GATHER', '').split(',')
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line.rstrip()+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if text == '':
-    prefix = ''
-  else:
-    prefix = ' '*depth
-  file_text += prefix+rep(text,g_m).rstrip()+'\n'
-
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
 
 
 def op2_gen_openmp_simple(master, date, consts, kernels):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -142,6 +83,42 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
         j = i
     reduct = j >= 0
 
+#
+# atomic updates, replicate and reduce or gathering replace colouring if all indirect
+# arguments are read or incremented, and no dataset is both
+#
+    no_colour = ind_inc
+    for i in range(0,nargs):
+      if maps[i] == OP_MAP and accs[i] != OP_READ and accs[i] != OP_INC:
+        no_colour = False
+      if maps[i] == OP_MAP and accs[i] == OP_INC:
+        for j in range(0,nargs):
+          if maps[j] == OP_MAP and accs[j] == OP_READ and var[j] == var[i]:
+            no_colour = False
+    atomics = no_colour and ('all' in atomics_kernels or name in atomics_kernels)
+    replicate = no_colour and not atomics and \
+                ('all' in replicate_kernels or name in replicate_kernels)
+    gather = no_colour and not atomics and not replicate and \
+             ('all' in gather_kernels or name in gather_kernels)
+    for i in range(0,nargs):
+      if maps[i] == OP_MAP and accs[i] == OP_INC:
+        if optflags[i]:
+          replicate = False
+          gather = False
+        # a dataset is gathered through the inverse of a single map
+        for j in range(0,nargs):
+          if maps[j] == OP_MAP and accs[j] == OP_INC and var[j] == var[i] \
+             and mapnames[j] != mapnames[i]:
+            gather = False
+    persistent = persistent_region and not atomics and not replicate and not gather
+    planless = atomics or gather
+
+    # staged index of each incremented dataset in an OP_STAGE_INC plan
+    inc_staged = {}
+    for i in range(0,nargs):
+      if maps[i] == OP_MAP and accs[i] == OP_INC and not inds[i]-1 in inc_staged:
+        inc_staged[inds[i]-1] = len(inc_staged)
+
 ##########################################################################
 #  start with the user kernel function
 ##########################################################################
@@ -149,46 +126,46 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims)
 
-    comm('user function')
+    out.comm('user function')
 
     if FORTRAN:
-      code('include '+name+'.inc')
+      out.code('include '+name+'.inc')
     elif CPP:
-      code('#include "../'+decl_filepath+'"')
+      for f in op2_gen_common.decl_includes(kernels, nk):
+        out.code('#include "../'+f+'"')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm(' host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm(' host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){');
-        code('')
+        out.code('op_arg <ARG>){', g_m);
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
     for g_m in range (0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m] != OP_READ:
-        code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;')
+        out.code('<TYP>*<ARG>h = (<TYP> *)<ARG>.data;', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
 
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -198,172 +175,298 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
     if insert_thread_timers:
-      code("op_timing_realloc_manytime({0}, {1});".format(str(nk), "omp_get_max_threads()"))
+      out.code("op_timing_realloc_manytime({0}, {1});".format(str(nk), "omp_get_max_threads()"))
     else:
-      code('op_timing_realloc('+str(nk)+');')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
+      out.code('op_timing_realloc('+str(nk)+');')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
     if insert_thread_timers:
-      code('double non_thread_walltime = 0.0;')
-    code('')
+      out.code('double non_thread_walltime = 0.0;')
+    out.code('')
 
 #
 #   indirect bits
 #
     if ninds>0:
-      code('int  ninds   = '+str(ninds)+';')
-      line = 'int  inds['+str(nargs)+'] = {'
-      for m in range(0,nargs):
-        line += str(inds[m]-1)+','
-      code(line[:-1]+'};')
-      code('')
-
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
-
-      code('')
-      comm(' get plan')
-      code('#ifdef OP_PART_SIZE_'+ str(nk))
-      code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
-      code('#else')
-      code('  int part_size = OP_part_size;')
-      code('#endif')
-      code('')
-      code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
+      if not planless:
+        out.code('int  ninds   = '+str(ninds)+';')
+        line = 'int  inds['+str(nargs)+'] = {'
+        for m in range(0,nargs):
+          line += str(inds[m]-1)+','
+        out.code(line[:-1]+'};', g_m)
+        out.code('')
+
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
+
+      out.code('')
+      if not planless:
+        out.comm(' get plan')
+        out.code('#ifdef OP_PART_SIZE_'+ str(nk))
+        out.code('  int part_size = OP_PART_SIZE_'+str(nk)+';')
+        out.code('#else')
+        out.code('  int part_size = op_tune_part_size('+str(nk)+', name, OP_part_size);')
+        out.code('#endif')
+        out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
-      code('')
-      code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
+      out.code('')
+      out.code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
 
 #
 # set number of threads in x86 execution and create arrays for reduction
 #
 
-    if reduct or ninds==0:
-      comm(' set number of threads')
-      code('#ifdef _OPENMP')
-      code('  int nthreads = omp_get_max_threads();')
-      code('#else')
-      code('  int nthreads = 1;')
-      code('#endif')
+    if reduct or ninds==0 or atomics or replicate or gather:
+      out.comm(' set number of threads')
+      out.code('#ifdef _OPENMP')
+      out.code('  int nthreads = omp_get_max_threads();')
+      out.code('#else')
+      out.code('  int nthreads = 1;')
+      out.code('#endif')
 
     if reduct:
-      code('')
-      comm(' allocate and initialise arrays for global reduction')
+      out.code('')
+      out.comm(' allocate and initialise arrays for global reduction')
       for g_m in range(0,nargs):
         if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m] != OP_WRITE:
-          code('<TYP> <ARG>_l[nthreads*64];')
-          FOR('thr','0','nthreads')
+          out.code('<TYP> <ARG>_l[nthreads*64];', g_m)
+          out.FOR('thr','0','nthreads')
           if accs[g_m]==OP_INC:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d+thr*64]=ZERO_<TYP>;')
-            ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d+thr*64]=ZERO_<TYP>;', g_m)
+            out.ENDFOR()
           else:
-            FOR('d','0','<DIM>')
-            code('<ARG>_l[d+thr*64]=<ARG>h[d];')
-            ENDFOR()
-          ENDFOR()
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d+thr*64]=<ARG>h[d];', g_m)
+            out.ENDFOR()
+          out.ENDFOR()
 
-    code('')
-    IF('set_size >0')
-    code('')
+    out.code('')
+    out.IF('set_size >0')
+    out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      code('op_plan *Plan = op_plan_get_stage_upload(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_ALL,0);')
-      code('')
-      comm(' execute plan')
-      code('int block_offset = 0;')
-      FOR('col','0','Plan->ncolors')
-      IF('col==Plan->ncolors_core')
-      code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
-      code('int nblocks = Plan->ncolblk[col];')
-      code('')
-      if insert_thread_timers:
-        # Pause process timing and switch to per-thread timing:
-        code('// Pause process timing and switch to per-thread timing:')
-        code('op_timers_core(&cpu_t2, &wall_t2);')
-        code('non_thread_walltime += wall_t2 - wall_t1;')
-
-        code('#pragma omp parallel')
-        code('{')
-        depth += 2
-        code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
-        code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
-        code('')
-        code('int nthreads = omp_get_num_threads();')
-        code('int thr = omp_get_thread_num();')
-        code('int thr_start = (nblocks * thr) / nthreads;')
-        code('int thr_end = (nblocks * (thr+1)) / nthreads;')
-        code('if (thr_end > nblocks) thr_end = nblocks;')
-        FOR('blockIdx','thr_start','thr_end')
+      if replicate:
+        out.code('op_plan *Plan = op_plan_get_stage_upload(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_INC,0);')
+        out.code('op_plan_inverse(Plan);')
+        out.code('')
+        out.comm(' each block adds its increments to its own entries of a buffer')
+        out.code('size_t inc_bytes = 0;')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('inc_bytes += ROUND_UP(Plan->nindirect['+str(m)+'] * <DIM> * sizeof(<TYP>));', g_m)
+        out.code('char *inc_buf = op_plan_inc_buffer(inc_bytes);')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('<TYP> *ind_arg'+str(m)+'_inc = (<TYP> *)inc_buf;', g_m)
+          out.code('inc_buf += ROUND_UP(Plan->nindirect['+str(m)+'] * <DIM> * sizeof(<TYP>));', g_m)
+        out.code('')
+        out.comm(' blocks ending each round')
+        out.code('int round_end[3] = {0, 0, Plan->nblocks};')
+        out.FOR('b','0','Plan->nblocks')
+        out.IF('Plan->offset[b] < set->core_size')
+        out.code('round_end[0] = b+1;')
+        out.ENDIF()
+        out.IF('Plan->offset[b] < set->size')
+        out.code('round_end[1] = b+1;')
+        out.ENDIF()
+        out.ENDFOR()
+        out.code('')
+      if gather:
+        out.comm(' each element adds its increments to its own entries of a buffer,')
+        out.comm(' one for each map index')
+        out.code('size_t inc_bytes = 0;')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('inc_bytes += ROUND_UP(set_size * <ARG>.map->dim * <DIM> * sizeof(<TYP>));', g_m)
+        out.code('char *inc_buf = op_plan_inc_buffer(inc_bytes);')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('<TYP> *ind_arg'+str(m)+'_inc = (<TYP> *)inc_buf;', g_m)
+          out.code('inc_buf += ROUND_UP(set_size * <ARG>.map->dim * <DIM> * sizeof(<TYP>));', g_m)
+        out.code('')
+      if atomics or replicate or gather:
+        out.comm(' execute without colouring: core elements, elements that need the')
+        out.comm(' halo exchange, then the executed halo')
+        out.FOR('round','0','3')
+        out.IF('round==1 && set_size > set->core_size')
+        out.code('op_mpi_wait_all(nargs, args);')
+        out.ENDIF()
+        if replicate:
+          out.code('int start = round==0 ? 0 : round_end[round-1];')
+          out.code('int end = round_end[round];')
+        else:
+          out.code('int start = round==0 ? 0 : (round==1 ? set->core_size : set->size);')
+          out.code('int end = round==0 ? set->core_size : (round==1 ? set->size : set_size);')
+        if insert_thread_timers:
+          # Pause process timing and switch to per-thread timing:
+          out.code('// Pause process timing and switch to per-thread timing:')
+          out.code('op_timers_core(&cpu_t2, &wall_t2);')
+          out.code('non_thread_walltime += wall_t2 - wall_t1;')
+        out.code('#pragma omp parallel for')
+        out.FOR('thr','0','nthreads')
+        if insert_thread_timers:
+          out.code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
+          out.code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
+        out.code('int thr_start = start + ((end-start)* thr)/nthreads;')
+        out.code('int thr_end   = start + ((end-start)*(thr+1))/nthreads;')
+        if replicate:
+          out.FOR('blockId','thr_start','thr_end')
+          out.code('int nelem    = Plan->nelems[blockId];')
+          out.code('int offset_b = Plan->offset[blockId];')
+          for m in inc_staged:
+            g_m = invinds[m]
+            ind = str(inc_staged[m])+' + blockId * Plan->ninds_staged'
+            out.code('<TYP> *ind_arg'+str(m)+'_b = ind_arg'+str(m)+'_inc + <DIM> * Plan->ind_offs['+ind+'];', g_m)
+            out.FOR('i','0','<DIM> * Plan->ind_sizes['+ind+']', g_m)
+            out.code('ind_arg'+str(m)+'_b[i] = ZERO_<TYP>;', g_m)
+            out.ENDFOR()
+          out.FOR('n','offset_b','offset_b+nelem')
+        else:
+          out.FOR('n','thr_start','thr_end')
       else:
-        code('#pragma omp parallel for')
-        FOR('blockIdx','0','nblocks')
-
-      code('int blockId  = Plan->blkmap[blockIdx + block_offset];')
-      code('int nelem    = Plan->nelems[blockId];')
-      code('int offset_b = Plan->offset[blockId];')
-      FOR('n','offset_b','offset_b+nelem')
+        out.code('op_plan *Plan = op_plan_get_stage_upload(name,set,part_size,nargs,args,ninds,inds,OP_STAGE_ALL,0);')
+        out.code('')
+        out.comm(' execute plan')
+        if persistent:
+          if insert_thread_timers:
+            # Pause process timing and switch to per-thread timing:
+            out.code('// Pause process timing and switch to per-thread timing:')
+            out.code('op_timers_core(&cpu_t2, &wall_t2);')
+            out.code('non_thread_walltime += wall_t2 - wall_t1;')
+          out.code('#pragma omp parallel')
+          out.code('{')
+          out.depth += 2
+          if insert_thread_timers:
+            out.code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
+            out.code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
+            out.code('int thr = omp_get_thread_num();')
+            out.code('')
+        out.code('int block_offset = 0;')
+        out.FOR('col','0','Plan->ncolors')
+        out.IF('col==Plan->ncolors_core')
+        if persistent:
+          # MPI calls are left to the master thread
+          out.code('#pragma omp master')
+          out.code('op_mpi_wait_all(nargs, args);')
+          out.code('#pragma omp barrier')
+        else:
+          out.code('op_mpi_wait_all(nargs, args);')
+        out.ENDIF()
+        out.code('int nblocks = Plan->ncolblk[col];')
+        out.code('')
+        if persistent:
+          out.code('#pragma omp for')
+          out.FOR('blockIdx','0','nblocks')
+        elif insert_thread_timers:
+          # Pause process timing and switch to per-thread timing:
+          out.code('// Pause process timing and switch to per-thread timing:')
+          out.code('op_timers_core(&cpu_t2, &wall_t2);')
+          out.code('non_thread_walltime += wall_t2 - wall_t1;')
+
+          out.code('#pragma omp parallel')
+          out.code('{')
+          out.depth += 2
+          out.code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
+          out.code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
+          out.code('')
+          out.code('int nthreads = omp_get_num_threads();')
+          out.code('int thr = omp_get_thread_num();')
+          out.code('int thr_start = (nblocks * thr) / nthreads;')
+          out.code('int thr_end = (nblocks * (thr+1)) / nthreads;')
+          out.code('if (thr_end > nblocks) thr_end = nblocks;')
+          out.FOR('blockIdx','thr_start','thr_end')
+        else:
+          out.code('#pragma omp parallel for')
+          out.FOR('blockIdx','0','nblocks')
+
+        out.code('int blockId  = Plan->blkmap[blockIdx + block_offset];')
+        out.code('int nelem    = Plan->nelems[blockId];')
+        out.code('int offset_b = Plan->offset[blockId];')
+        out.FOR('n','offset_b','offset_b+nelem')
+      # the increments of replicate use the plan's local indices instead, and
+      # those of gather the element's entries in the buffer
+      uses_map = [maps[g_m] == OP_MAP and not ((replicate or gather) and accs[g_m] == OP_INC) for g_m in range(0,nargs)]
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
-          if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
+          if uses_map[g_m] and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
       #do non-optional ones
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
-          if maps[g_m] == OP_MAP and (not mapinds[g_m] in k) and (not optflags[g_m]):
+          if uses_map[g_m] and (not mapinds[g_m] in k) and (not optflags[g_m]):
             k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
       #do optional ones
       if nmaps > 0:
         for g_m in range(0,nargs):
-          if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
+          if uses_map[g_m] and (not mapinds[g_m] in k):
             if optflags[g_m]:
               if vectorised[g_m]:
                 index = vectorised.index(vectorised[g_m])
               else:
                 index = g_m
-              IF('arg'+str(index)+'.opt')
+              out.IF('arg'+str(index)+'.opt')
             else:
               k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
             if optflags[g_m]:
-              ENDIF()
+              out.ENDIF()
 
-      code('')
+      if atomics:
+        out.code('')
+        out.comm(' increments are collected locally and added atomically')
+        for g_m in range(0,nargs):
+          if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
+            out.code('<TYP> <ARG>_l[<DIM>];', g_m)
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('<ARG>_l[d] = ZERO_<TYP>;', g_m)
+            out.ENDFOR()
+
+      if gather:
+        out.code('')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('<TYP> *ind_arg'+str(m)+'_n = ind_arg'+str(m)+'_inc + <DIM> * <ARG>.map->dim * n;', g_m)
+          out.FOR('i','0','<DIM> * <ARG>.map->dim', g_m)
+          out.code('ind_arg'+str(m)+'_n[i] = ZERO_<TYP>;', g_m)
+          out.ENDFOR()
+
+      out.code('')
       for g_m in range (0,nargs):
         u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
         if len(u) > 0 and vectorised[g_m] > 0:
@@ -376,14 +479,21 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
           first = [i for i in range(0,len(v)) if v[i] == 1]
           first = first[0]
 
-          indent = ' '*(depth+2)
+          indent = ' '*(out.depth+2)
           for k in range(0,sum(v)):
-            line = line + indent + ' &((<TYP>*)arg'+str(first)+'.data)[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
+            if atomics and accs[g_m] == OP_INC:
+              line = line + indent + ' arg'+str(g_m+k)+'_l,\n'
+            elif replicate and accs[g_m] == OP_INC:
+              line = line + indent + ' &ind_arg'+str(inds[g_m]-1)+'_b[<DIM> * Plan->loc_maps['+str(g_m+k)+'][n]],\n'
+            elif gather and accs[g_m] == OP_INC:
+              line = line + indent + ' &ind_arg'+str(inds[g_m]-1)+'_n[<DIM> * '+str(idxs[g_m+k])+'],\n'
+            else:
+              line = line + indent + ' &((<TYP>*)arg'+str(first)+'.data)[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
           line = line[:-2]+'};'
-          code(line)
-      code('')
+          out.code(line, g_m)
+      out.code('')
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(('+typs[g_m]+'*)arg'+str(g_m)+'.data)['+str(dims[g_m])+' * n]'
@@ -391,6 +501,12 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
           if vectorised[g_m]:
             if g_m+1 in unique_args:
                 line = line + indent + 'arg'+str(g_m)+'_vec'
+          elif atomics and accs[g_m] == OP_INC:
+            line = line + indent + 'arg'+str(g_m)+'_l'
+          elif replicate and accs[g_m] == OP_INC:
+            line = line + indent + '&ind_arg'+str(inds[g_m]-1)+'_b['+str(dims[g_m])+' * Plan->loc_maps['+str(g_m)+'][n]]'
+          elif gather and accs[g_m] == OP_INC:
+            line = line + indent + '&ind_arg'+str(inds[g_m]-1)+'_n['+str(dims[g_m])+' * '+str(idxs[g_m])+']'
           else:
             line = line + indent + '&(('+typs[g_m]+'*)arg'+str(invinds[inds[g_m]-1])+'.data)['+str(dims[g_m])+' * map'+str(mapinds[g_m])+'idx]'
         if maps[g_m] == OP_GBL:
@@ -403,67 +519,149 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
             line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
-      if insert_thread_timers:
-        depth -= 2
-        code('}')
-        code('')
-        code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
-        code('OP_kernels[' +str(nk)+ '].times[thr]  += thr_wall_t2 - thr_wall_t1;')
-      ENDFOR()
-      code('')
+      if 'fused' in kernels[nk]:
+        line = op2_gen_common.fused_kernel_calls(kernels[nk], line, out.depth)
+      out.code(line, g_m)
+      if atomics:
+        out.code('')
+        for g_m in range(0,nargs):
+          if maps[g_m] == OP_MAP and accs[g_m] == OP_INC:
+            if optflags[g_m]:
+              if vectorised[g_m]:
+                index = vectorised.index(vectorised[g_m])
+              else:
+                index = g_m
+              out.IF('arg'+str(index)+'.opt')
+            out.FOR('d','0','<DIM>', g_m)
+            out.code('#pragma omp atomic')
+            out.code('((<TYP>*)arg'+str(invinds[inds[g_m]-1])+'.data)[<DIM> * map'+str(mapinds[g_m])+'idx + d] += <ARG>_l[d];', g_m)
+            out.ENDFOR()
+            if optflags[g_m]:
+              out.ENDIF()
+      out.ENDFOR()
+      if atomics or replicate or gather:
+        if replicate:
+          out.ENDFOR()
+        if insert_thread_timers:
+          out.code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
+          out.code('OP_kernels[' +str(nk)+ '].times[thr]  += thr_wall_t2 - thr_wall_t1;')
+        out.ENDFOR()
+        if insert_thread_timers:
+          out.code('// OpenMP block complete, so switch back to process timing:')
+          out.code('op_timers_core(&cpu_t1, &wall_t1);')
+      else:
+        if insert_thread_timers and not persistent:
+          out.depth -= 2
+          out.code('}')
+          out.code('')
+          out.code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
+          out.code('OP_kernels[' +str(nk)+ '].times[thr]  += thr_wall_t2 - thr_wall_t1;')
+        out.ENDFOR()
+      out.code('')
 
       if reduct:
-        comm(' combine reduction data')
-        IF('col == Plan->ncolors_owned-1')
+        out.comm(' combine reduction data')
+        if atomics or replicate or gather:
+          out.IF('round == 1')
+        else:
+          out.IF('col == Plan->ncolors_owned-1')
+        if persistent:
+          out.code('#pragma omp single')
+          out.code('{')
+          out.depth += 2
         for m in range(0,nargs):
           if maps[m] == OP_GBL and accs[m] != OP_READ:
-            FOR('thr','0','nthreads')
+            out.FOR('thr','0','nthreads')
             if accs[m]==OP_INC:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d] += <ARG>_l[d+thr*64];')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d] += <ARG>_l[d+thr*64];', g_m)
+              out.ENDFOR()
             elif accs[m]==OP_MIN:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+              out.ENDFOR()
             elif  accs[m]==OP_MAX:
-              FOR('d','0','<DIM>')
-              code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);')
-              ENDFOR()
+              out.FOR('d','0','<DIM>', g_m)
+              out.code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+              out.ENDFOR()
             else:
               error('internal error: invalid reduction option')
-            ENDFOR()
-        ENDIF()
-
-      if insert_thread_timers:
-        code('// Revert to process-level timing:')
-        code('op_timers_core(&cpu_t1, &wall_t1);')
-        code('')
-      code('block_offset += nblocks;');
-      ENDIF()
+            out.ENDFOR()
+        if persistent:
+          out.depth -= 2
+          out.code('}')
+        out.ENDIF()
+
+      if insert_thread_timers and not persistent and not atomics and not replicate and not gather:
+        out.code('// Revert to process-level timing:')
+        out.code('op_timers_core(&cpu_t1, &wall_t1);')
+        out.code('')
+      if not atomics and not replicate and not gather:
+        out.code('block_offset += nblocks;');
+      out.ENDIF()
+      if persistent:
+        if insert_thread_timers:
+          out.code('')
+          out.code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
+          out.code('OP_kernels[' +str(nk)+ '].times[thr]  += thr_wall_t2 - thr_wall_t1;')
+        out.depth -= 2
+        out.code('}')
+        if insert_thread_timers:
+          out.code('// Revert to process-level timing:')
+          out.code('op_timers_core(&cpu_t1, &wall_t1);')
+
+      if replicate:
+        out.code('')
+        out.comm(' sum the block increments of each element')
+        for m in inc_staged:
+          g_m = invinds[m]
+          s_m = str(inc_staged[m])
+          out.code('#pragma omp parallel for')
+          out.FOR('e','0','Plan->inv_size['+s_m+']')
+          out.FOR('p','Plan->inv_offs['+s_m+'][e]','Plan->inv_offs['+s_m+'][e+1]')
+          out.code('int pos = Plan->inv_pos['+s_m+'][p];')
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('((<TYP>*)<ARG>.data)[<DIM> * e + d] += ind_arg'+str(m)+'_inc[<DIM> * pos + d];', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
+          out.ENDFOR()
+
+      if gather:
+        out.code('')
+        out.comm(' gather the increments of each element through the inverse of the map')
+        for m in inc_staged:
+          g_m = invinds[m]
+          out.code('op_map_inverse *inv'+str(m)+' = op_get_map_inverse(<ARG>.map);', g_m)
+          out.code('#pragma omp parallel for')
+          out.FOR('e','0','inv'+str(m)+'->size')
+          out.FOR('p','inv'+str(m)+'->offs[e]','inv'+str(m)+'->offs[e+1]')
+          out.code('int pos = inv'+str(m)+'->pos[p];')
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('((<TYP>*)<ARG>.data)[<DIM> * e + d] += ind_arg'+str(m)+'_inc[<DIM> * pos + d];', g_m)
+          out.ENDFOR()
+          out.ENDFOR()
+          out.ENDFOR()
 
 #
 # kernel call for direct version
 #
     else:
-      comm(' execute plan')
+      out.comm(' execute plan')
       if insert_thread_timers:
         # Pause process timing, and switch to per-thread timing:
-        code('// Pause process timing, and switch to per-thread timing:')
-        code('op_timers_core(&cpu_t2, &wall_t2);')
-        code('non_thread_walltime += wall_t2 - wall_t1;')
-      code('#pragma omp parallel for')
-      FOR('thr','0','nthreads')
+        out.code('// Pause process timing, and switch to per-thread timing:')
+        out.code('op_timers_core(&cpu_t2, &wall_t2);')
+        out.code('non_thread_walltime += wall_t2 - wall_t1;')
+      out.code('#pragma omp parallel for')
+      out.FOR('thr','0','nthreads')
       if insert_thread_timers:
-        code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
-        code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
-      code('int start  = (set->size* thr)/nthreads;')
-      code('int finish = (set->size*(thr+1))/nthreads;')
-      FOR('n','start','finish')
+        out.code('double thr_wall_t1, thr_wall_t2, thr_cpu_t1, thr_cpu_t2;')
+        out.code('op_timers_core(&thr_cpu_t1, &thr_wall_t1);')
+      out.code('int start  = (set->size* thr)/nthreads;')
+      out.code('int finish = (set->size*(thr+1))/nthreads;')
+      out.FOR('n','start','finish')
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(('+typs[g_m]+'*)arg'+str(g_m)+'.data)['+str(dims[g_m])+'*n]'
@@ -476,99 +674,96 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      if 'fused' in kernels[nk]:
+        line = op2_gen_common.fused_kernel_calls(kernels[nk], line, out.depth)
+      out.code(line, g_m)
+      out.ENDFOR()
       if insert_thread_timers:
-        code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
-        code('OP_kernels['+str(nk)+'].times[thr]  += thr_wall_t2 - thr_wall_t1;')
-      ENDFOR()
+        out.code('op_timers_core(&thr_cpu_t2, &thr_wall_t2);')
+        out.code('OP_kernels['+str(nk)+'].times[thr]  += thr_wall_t2 - thr_wall_t1;')
+      out.ENDFOR()
       if insert_thread_timers:
         # OpenMP block complete, so switch back to process timing:
-        code('// OpenMP block complete, so switch back to process timing:')
-        code('op_timers_core(&cpu_t1, &wall_t1);')
+        out.code('// OpenMP block complete, so switch back to process timing:')
+        out.code('op_timers_core(&cpu_t1, &wall_t1);')
 
-    if ninds>0:
-      code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
-      code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
+    if ninds>0 and not planless:
+      out.code('OP_kernels['+str(nk)+'].transfer  += Plan->transfer;')
+      out.code('OP_kernels['+str(nk)+'].transfer2 += Plan->transfer2;')
 
-    ENDIF()
-    code('')
+    out.ENDIF()
+    out.code('')
 
     #zero set size issues
     if ninds>0:
-      IF('set_size == 0 || set_size == set->core_size')
-      code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+      out.IF('set_size == 0 || set_size == set->core_size')
+      out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
 
 #
 # combine reduction data from multiple OpenMP threads, direct version
 #
-    comm(' combine reduction data')
+    out.comm(' combine reduction data')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ and accs[g_m] != OP_WRITE and ninds==0:
-        FOR('thr','0','nthreads')
+        out.FOR('thr','0','nthreads')
         if accs[g_m]==OP_INC:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d] += <ARG>_l[d+thr*64];')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d] += <ARG>_l[d+thr*64];', g_m)
+          out.ENDFOR()
         elif accs[g_m]==OP_MIN:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d]  = MIN(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+          out.ENDFOR()
         elif accs[g_m]==OP_MAX:
-          FOR('d','0','<DIM>')
-          code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);')
-          ENDFOR()
+          out.FOR('d','0','<DIM>', g_m)
+          out.code('<ARG>h[d]  = MAX(<ARG>h[d],<ARG>_l[d+thr*64]);', g_m)
+          out.ENDFOR()
         else:
           print('internal error: invalid reduction option')
-        ENDFOR()
+        out.ENDFOR()
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ:
-        code('op_mpi_reduce(&<ARG>,<ARG>h);')
+        out.code('op_mpi_reduce(&<ARG>,<ARG>h);', g_m)
 
-    code('op_mpi_set_dirtybit(nargs, args);')
-    code('')
+    out.code('op_mpi_set_dirtybit(nargs, args);')
+    out.code('')
 
 #
 # update kernel record
 #
 
-    comm(' update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.comm(' update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
     if insert_thread_timers:
-      code('non_thread_walltime += wall_t2 - wall_t1;')
+      out.code('non_thread_walltime += wall_t2 - wall_t1;')
     if insert_thread_timers:
-        code('OP_kernels[' +str(nk)+ '].times[0] += non_thread_walltime;')
+        out.code('OP_kernels[' +str(nk)+ '].times[0] += non_thread_walltime;')
     else:
-        code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+        out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
 
       for g_m in range (0,nargs):
         if optflags[g_m]==1:
-          IF('<ARG>.opt')
+          out.IF('<ARG>.opt', g_m)
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
         if optflags[g_m]==1:
-          ENDIF()
+          out.ENDIF()
 
-    depth -= 2
-    code('}')
+    out.depth -= 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('openmp'):
-        os.makedirs('openmp')
-    fid = open('openmp/'+name+'_kernel.cpp','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('openmp/'+name+'_kernel.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -577,44 +772,41 @@ def op2_gen_openmp_simple(master, date, consts, kernels):
 #  output one master kernel file
 ##########################################################################
 
-  file_text =''
+  out = op2_gen_common.CodeEmitter()
 
-  code('#ifdef _OPENMP')
-  code('  #include <omp.h>')
-  code('#endif')
-  code('')
+  out.code('#ifdef _OPENMP')
+  out.code('  #include <omp.h>')
+  out.code('#endif')
+  out.code('')
 
-  comm(' global constants       ')
+  out.comm(' global constants       ')
 
   for nc in range (0,len(consts)):
     if not consts[nc]['user_declared']:
       if consts[nc]['dim']==1:
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
       else:
         if consts[nc]['dim'].isdigit() and int(consts[nc]['dim']) > 0:
           num = str(consts[nc]['dim'])
         else:
           num = 'MAX_CONST_SIZE'
 
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm(' header                 ')
+  out.comm(' header                 ')
 
   if os.path.exists('./user_types.h'):
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"       ')
-  code('')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"       ')
+  out.code('')
 
-  comm(' user kernel files')
+  out.comm(' user kernel files')
 
-  for nk in range(0,len(kernels)):
-    code('#include "'+kernels[nk]['name']+'_kernel.cpp"')
+  for nk in op2_gen_common.kernel_file_order(kernels):
+    out.code('#include "'+kernels[nk]['name']+'_kernel.cpp"')
   master = master.split('.')[0]
-  fid = open('openmp/'+master.split('.')[0]+'_kernels.cpp','w')
-  fid.write('//\n// auto-generated by op2.py\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('openmp/'+master.split('.')[0]+'_kernels.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 
 
@@ -14,81 +14,9 @@ import datetime
 import os
 import op2_gen_common
 
-def comm(line):
-  global file_text, FORTRAN, CPP
-  global depth
-  prefix = ' '*depth
-  if len(line) == 0:
-    file_text +='\n'
-  elif FORTRAN:
-    file_text +='!  '+line+'\n'
-  elif CPP:
-    file_text +=prefix+'//'+line.rstrip()+'\n'
-
-def rep(line,m):
-  global dims, idxs, typs, indtyps, inddims
-  if m < len(inddims):
-    line = re.sub('<INDDIM>',str(inddims[m]),line)
-    line = re.sub('<INDTYP>',str(indtyps[m]),line)
-
-  line = re.sub('<INDARG>','ind_arg'+str(m),line)
-  line = re.sub('<DIM>',str(dims[m]),line)
-  line = re.sub('<ARG>','arg'+str(m),line)
-  line = re.sub('<TYP>',typs[m],line)
-  line = re.sub('<IDX>',str(int(idxs[m])),line)
-  return line
-
-def code(text):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if text == '':
-    prefix = ''
-  else:
-    prefix = ' '*depth
-  file_text += prefix+rep(text,g_m).rstrip()+'\n'
-
-def FOR(i,start,finish):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('do '+i+' = '+start+', '+finish+'-1')
-  elif CPP:
-    code('for ( int '+i+'='+start+'; '+i+'<'+finish+'; '+i+'++ ){')
-  depth += 2
-
-def ENDFOR():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('enddo')
-  elif CPP:
-    code('}')
-
-def IF(line):
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  if FORTRAN:
-    code('if ('+line+') then')
-  elif CPP:
-    code('if ('+ line + ') {')
-  depth += 2
-
-def ENDIF():
-  global file_text, FORTRAN, CPP, g_m
-  global depth
-  depth -= 2
-  if FORTRAN:
-    code('endif')
-  elif CPP:
-    code('}')
-
 
 def op2_gen_seq(master, date, consts, kernels):
 
-  global dims, idxs, typs, indtyps, inddims
-  global FORTRAN, CPP, g_m, file_text, depth
-
   OP_ID   = 1;  OP_GBL   = 2;  OP_MAP = 3;
 
   OP_READ = 1;  OP_WRITE = 2;  OP_RW  = 3;
@@ -148,41 +76,41 @@ def op2_gen_seq(master, date, consts, kernels):
     FORTRAN = 0;
     CPP     = 1;
     g_m = 0;
-    file_text = ''
-    depth = 0
+    out = op2_gen_common.CodeEmitter(dims, idxs, typs, indtyps, inddims)
 
-    comm('user function')
+    out.comm('user function')
 
     if FORTRAN:
-      code('include '+name+'.inc')
+      out.code('include '+name+'.inc')
     elif CPP:
-      code('#include "../'+decl_filepath+'"')
+      for f in op2_gen_common.decl_includes(kernels, nk):
+        out.code('#include "../'+f+'"')
 
 ##########################################################################
 # then C++ stub function
 ##########################################################################
 
-    code('')
-    comm(' host stub function')
-    code('void op_par_loop_'+name+'(char const *name, op_set set,')
-    depth += 2
+    out.code('')
+    out.comm(' host stub function')
+    out.code('void op_par_loop_'+name+'(char const *name, op_set set,')
+    out.depth += 2
 
     for m in unique_args:
       g_m = m - 1
       if m == unique_args[len(unique_args)-1]:
-        code('op_arg <ARG>){');
-        code('')
+        out.code('op_arg <ARG>){', g_m);
+        out.code('')
       else:
-        code('op_arg <ARG>,')
+        out.code('op_arg <ARG>,', g_m)
 
-    code('int nargs = '+str(nargs)+';')
-    code('op_arg args['+str(nargs)+'];')
-    code('')
+    out.code('int nargs = '+str(nargs)+';')
+    out.code('op_arg args['+str(nargs)+'];')
+    out.code('')
     for g_m in range (0,nargs):
       u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
       if len(u) > 0 and vectorised[g_m] > 0:
-        code('<ARG>.idx = 0;')
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('<ARG>.idx = 0;', g_m)
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
         v = [int(vectorised[i] == vectorised[g_m]) for i in range(0,len(vectorised))]
         first = [i for i in range(0,len(v)) if v[i] == 1]
@@ -192,79 +120,79 @@ def op2_gen_seq(master, date, consts, kernels):
         else:
           argtyp = 'op_arg_dat('
 
-        FOR('v','1',str(sum(v)))
-        code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
-        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');')
-        ENDFOR()
-        code('')
+        out.FOR('v','1',str(sum(v)))
+        out.code('args['+str(g_m)+' + v] = '+argtyp+'arg'+str(first)+'.dat, v, arg'+\
+        str(first)+'.map, <DIM>, "<TYP>", '+accsstring[accs[g_m]-1]+');', g_m)
+        out.ENDFOR()
+        out.code('')
       elif vectorised[g_m]>0:
         pass
       else:
-        code('args['+str(g_m)+'] = <ARG>;')
+        out.code('args['+str(g_m)+'] = <ARG>;', g_m)
 
 #
 # start timing
 #
-    code('')
-    comm(' initialise timers')
-    code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
-    code('op_timing_realloc('+str(nk)+');')
-    code('op_timers_core(&cpu_t1, &wall_t1);')
-    code('')
+    out.code('')
+    out.comm(' initialise timers')
+    out.code('double cpu_t1, cpu_t2, wall_t1, wall_t2;')
+    out.code('op_timing_realloc('+str(nk)+');')
+    out.code('op_timers_core(&cpu_t1, &wall_t1);')
+    out.code('')
 
 #
 #   indirect bits
 #
     if ninds>0:
-      IF('OP_diags>2')
-      code('printf(" kernel routine with indirection: '+name+'\\n");')
-      ENDIF()
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine with indirection: '+name+'\\n");')
+      out.ENDIF()
 
 #
 # direct bit
 #
     else:
-      code('')
-      IF('OP_diags>2')
-      code('printf(" kernel routine w/o indirection:  '+ name + '");')
-      ENDIF()
+      out.code('')
+      out.IF('OP_diags>2')
+      out.code('printf(" kernel routine w/o indirection:  '+ name + '");')
+      out.ENDIF()
 
-    code('')
+    out.code('')
     if grouped:
-      code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 1);')
+      out.code('int set_size = op_mpi_halo_exchanges_grouped(set, nargs, args, 1);')
     else:
-      code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
+      out.code('int set_size = op_mpi_halo_exchanges(set, nargs, args);')
 
-    code('')
-    IF('set_size > 0')
-    code('')
+    out.code('')
+    out.IF('set_size > 0')
+    out.code('')
 
 #
 # kernel call for indirect version
 #
     if ninds>0:
-      FOR('n','0','set_size')
-      code('if (n<set->core_size && n>0 && n % OP_mpi_test_frequency == 0)')
-      code('  op_mpi_test_all(nargs,args);')
-      IF('n==set->core_size')
+      out.FOR('n','0','set_size')
+      out.code('if (n<set->core_size && n>0 && n % OP_mpi_test_frequency == 0)')
+      out.code('  op_mpi_test_all(nargs,args);')
+      out.IF('n==set->core_size')
       if grouped:
-        code('op_mpi_wait_all_grouped(nargs, args, 1);')
+        out.code('op_mpi_wait_all_grouped(nargs, args, 1);')
       else:
-        code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+        out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k):
             k = k + [mapinds[g_m]]
-            code('int map'+str(mapinds[g_m])+'idx;')
+            out.code('int map'+str(mapinds[g_m])+'idx;')
       #do non-optional ones
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapinds[g_m] in k) and (not optflags[g_m]):
             k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
       #do optional ones
       if nmaps > 0:
         for g_m in range(0,nargs):
@@ -274,14 +202,14 @@ def op2_gen_seq(master, date, consts, kernels):
                 index = vectorised.index(vectorised[g_m])
               else:
                 index = g_m
-              IF('arg'+str(index)+'.opt')
+              out.IF('arg'+str(index)+'.opt')
             else:
               k = k + [mapinds[g_m]]
-            code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
+            out.code('map'+str(mapinds[g_m])+'idx = arg'+str(invmapinds[inds[g_m]-1])+'.map_data[n * arg'+str(invmapinds[inds[g_m]-1])+'.map->dim + '+str(idxs[g_m])+'];')
             if optflags[g_m]:
-              ENDIF()
+              out.ENDIF()
 
-      code('')
+      out.code('')
       for g_m in range (0,nargs):
         u = [i for i in range(0,len(unique_args)) if unique_args[i]-1 == g_m]
         if len(u) > 0 and vectorised[g_m] > 0:
@@ -294,15 +222,15 @@ def op2_gen_seq(master, date, consts, kernels):
           first = [i for i in range(0,len(v)) if v[i] == 1]
           first = first[0]
         
-          indent = ' '*(depth+2)
+          indent = ' '*(out.depth+2)
           for k in range(0,sum(v)):
             line = line + indent + ' &((<TYP>*)arg'+str(first)+'.data)[<DIM> * map'+str(mapinds[g_m+k])+'idx],\n'
           line = line[:-2]+'};'
-          code(line)
-      code('')
+          out.code(line, g_m)
+      out.code('')
 
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(('+typs[g_m]+'*)arg'+str(g_m)+'.data)['+str(dims[g_m])+' * n]'
@@ -319,16 +247,18 @@ def op2_gen_seq(master, date, consts, kernels):
             line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      if 'fused' in kernels[nk]:
+        line = op2_gen_common.fused_kernel_calls(kernels[nk], line, out.depth)
+      out.code(line, g_m)
+      out.ENDFOR()
 
 #
 # kernel call for direct version
 #
     else:
-      FOR('n','0','set_size')
+      out.FOR('n','0','set_size')
       line = name+'('
-      indent = '\n'+' '*(depth+2)
+      indent = '\n'+' '*(out.depth+2)
       for g_m in range(0,nargs):
         if maps[g_m] == OP_ID:
           line = line + indent + '&(('+typs[g_m]+'*)arg'+str(g_m)+'.data)['+str(dims[g_m])+'*n]'
@@ -338,61 +268,63 @@ def op2_gen_seq(master, date, consts, kernels):
           line = line +','
         else:
            line = line +');'
-      code(line)
-      ENDFOR()
+      if 'fused' in kernels[nk]:
+        line = op2_gen_common.fused_kernel_calls(kernels[nk], line, out.depth)
+      out.code(line, g_m)
+      out.ENDFOR()
 
-    ENDIF()
-    code('')
+    out.ENDIF()
+    out.code('')
 
     #zero set size issues
     if ninds>0:
-      IF('set_size == 0 || set_size == set->core_size')
-      code('op_mpi_wait_all(nargs, args);')
-      ENDIF()
+      out.IF('set_size == 0 || set_size == set->core_size')
+      out.code('op_mpi_wait_all(nargs, args);')
+      out.ENDIF()
 
 #
 # combine reduction data from multiple OpenMP threads
 #
-    comm(' combine reduction data')
+    out.comm(' combine reduction data')
     for g_m in range(0,nargs):
       if maps[g_m]==OP_GBL and accs[g_m]!=OP_READ:
 #        code('op_mpi_reduce(&<ARG>,('+typs[g_m]+'*)<ARG>.data);')
         if typs[g_m] == 'double': #need for both direct and indirect
-          code('op_mpi_reduce_double(&<ARG>,('+typs[g_m]+'*)<ARG>.data);')
+          out.code('op_mpi_reduce_double(&<ARG>,('+typs[g_m]+'*)<ARG>.data);', g_m)
         elif typs[g_m] == 'float':
-          code('op_mpi_reduce_float(&<ARG>,('+typs[g_m]+'*)<ARG>.data);')
+          out.code('op_mpi_reduce_float(&<ARG>,('+typs[g_m]+'*)<ARG>.data);', g_m)
         elif typs[g_m] == 'int':
-          code('op_mpi_reduce_int(&<ARG>,('+typs[g_m]+'*)<ARG>.data);')
+          out.code('op_mpi_reduce_int(&<ARG>,('+typs[g_m]+'*)<ARG>.data);', g_m)
         else:
           print('Type '+typs[g_m]+' not supported in OpenACC code generator, please add it')
           exit(-1)
 
-    code('op_mpi_set_dirtybit(nargs, args);')
-    code('')
+    out.code('op_mpi_set_dirtybit(nargs, args);')
+    out.code('')
 
 #
 # update kernel record
 #
 
-    comm(' update kernel record')
-    code('op_timers_core(&cpu_t2, &wall_t2);')
-    code('OP_kernels[' +str(nk)+ '].name      = name;')
-    code('OP_kernels[' +str(nk)+ '].count    += 1;')
-    code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
+    out.comm(' update kernel record')
+    out.code('op_timers_core(&cpu_t2, &wall_t2);')
+    out.code('OP_kernels[' +str(nk)+ '].name      = name;')
+    out.code('OP_kernels[' +str(nk)+ '].count    += 1;')
+    out.code('OP_kernels[' +str(nk)+ '].time     += wall_t2 - wall_t1;')
 
     if ninds == 0:
       line = 'OP_kernels['+str(nk)+'].transfer += (float)set->size *'
 
       for g_m in range (0,nargs):
         if optflags[g_m]==1:
-          IF('<ARG>.opt')
+          out.IF('<ARG>.opt', g_m)
         if maps[g_m]!=OP_GBL:
           if accs[g_m]==OP_READ:
-            code(line+' <ARG>.size;')
+            out.code(line+' <ARG>.size;', g_m)
           else:
-            code(line+' <ARG>.size * 2.0f;')
+            out.code(line+' <ARG>.size * 2.0f;', g_m)
         if optflags[g_m]==1:
-          ENDIF()
+          out.ENDIF()
     else:
       names = []
       for g_m in range(0,ninds):
@@ -401,10 +333,10 @@ def op2_gen_seq(master, date, consts, kernels):
           mult = ' * 2.0f'
         if not var[invinds[g_m]] in names:
           if optflags[g_m]==1:
-            IF('arg'+str(invinds[g_m])+'.opt')
-          code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[g_m])+'.size'+mult+';')
+            out.IF('arg'+str(invinds[g_m])+'.opt')
+          out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[g_m])+'.size'+mult+';')
           if optflags[g_m]==1:
-            ENDIF()
+            out.ENDIF()
           names = names + [var[invinds[g_m]]]
       for g_m in range(0,nargs):
         mult=''
@@ -413,34 +345,29 @@ def op2_gen_seq(master, date, consts, kernels):
         if not var[g_m] in names:
           names = names + [var[g_m]]
           if optflags[g_m]==1:
-            IF('<ARG>.opt')
+            out.IF('<ARG>.opt', g_m)
           if maps[g_m] == OP_ID:
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
           elif maps[g_m] == OP_GBL:
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(g_m)+'.size'+mult+';')
           if optflags[g_m]==1:
-            ENDIF()
+            out.ENDIF()
       if nmaps > 0:
         k = []
         for g_m in range(0,nargs):
           if maps[g_m] == OP_MAP and (not mapnames[g_m] in k):
             k = k + [mapnames[g_m]]
-            code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[inds[g_m]-1])+'.map->dim * 4.0f;')
+            out.code('OP_kernels['+str(nk)+'].transfer += (float)set->size * arg'+str(invinds[inds[g_m]-1])+'.map->dim * 4.0f;')
 
-    depth -= 2
-    code('}')
+    out.depth -= 2
+    out.code('}')
 
 
 ##########################################################################
 #  output individual kernel file
 ##########################################################################
-    if not os.path.exists('seq'):
-        os.makedirs('seq')
-    fid = open('seq/'+name+'_seqkernel.cpp','w')
     date = datetime.datetime.now()
-    fid.write('//\n// auto-generated by op2.py\n//\n\n')
-    fid.write(file_text)
-    fid.close()
+    op2_gen_common.write_text_file('seq/'+name+'_seqkernel.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
 
 # end of main kernel call loop
 
@@ -449,35 +376,32 @@ def op2_gen_seq(master, date, consts, kernels):
 #  output one master kernel file
 ##########################################################################
 
-  file_text =''
+  out = op2_gen_common.CodeEmitter()
 
-  comm(' global constants       ')
+  out.comm(' global constants       ')
 
   for nc in range (0,len(consts)):
     if not consts[nc]['user_declared']:
       if consts[nc]['dim']==1:
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+';')
       else:
         if consts[nc]['dim'].isdigit() and int(consts[nc]['dim']) > 0:
           num = str(consts[nc]['dim'])
         else:
           num = 'MAX_CONST_SIZE'
-        code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
-  code('')
+        out.code('extern '+consts[nc]['type'][1:-1]+' '+consts[nc]['name']+'['+num+'];')
+  out.code('')
 
-  comm(' header                 ')
+  out.comm(' header                 ')
 
   if os.path.exists('./user_types.h'):
-    code('#include "../user_types.h"')
-  code('#include "op_lib_cpp.h"       ')
-  code('')
+    out.code('#include "../user_types.h"')
+  out.code('#include "op_lib_cpp.h"       ')
+  out.code('')
 
-  comm(' user kernel files')
+  out.comm(' user kernel files')
 
-  for nk in range(0,len(kernels)):
-    code('#include "'+kernels[nk]['name']+'_seqkernel.cpp"')
+  for nk in op2_gen_common.kernel_file_order(kernels):
+    out.code('#include "'+kernels[nk]['name']+'_seqkernel.cpp"')
   master = master.split('.')[0]
-  fid = open('seq/'+master.split('.')[0]+'_seqkernels.cpp','w')
-  fid.write('//\n// auto-generated by op2.py\n//\n\n')
-  fid.write(file_text)
-  fid.close()
+  op2_gen_common.write_text_file('seq/'+master.split('.')[0]+'_seqkernels.cpp', '//\n// auto-generated by op2.py\n//\n\n' + out.text())
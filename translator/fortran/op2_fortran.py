@@ -9,7 +9,7 @@
  This prototype is written in Python and is directly based on the
  parsing and code generation of the matlab source code transformation code
 
- usage: ./op2_fortran.py 'file1','file2',...
+ usage: ./op2_fortran.py [--targets=target1,target2,...] 'file1','file2',...
 
  This code generator is for parsing applications written using the OP2 FORTRAN API
 
@@ -27,52 +27,33 @@
  xxx_kernel.F90  -- for OpenMP x86 execution
  xxx_kernel.CUF   -- for CUDA execution (based on PGI CUDA FORTRAN)
 
+ Only the code generators for the selected targets are run: 'seq', 'vec',
+ 'openmp', 'cuda', 'openacc' and 'openmp4', or 'all' (every target except
+ 'openacc', the default). Targets are given with --targets or the
+ OP2_TARGETS environment variable.
+
 """
 
 import sys
 import re
 import datetime
 
-#import openmp code generation function
-import op2_gen_openmp
-from op2_gen_openmp import *
-import op2_gen_openmp2
-from op2_gen_openmp2 import *
-import op2_gen_openmp3
-from op2_gen_openmp3 import *
-
-import op2_gen_openacc
-from op2_gen_openacc import *
-
-import op2_gen_openmp4
-from op2_gen_openmp4 import *
-
-
-
-#import mpiseq code generation function
-import op2_gen_mpiseq
-from op2_gen_mpiseq import *
-import op2_gen_mpiseq2
-from op2_gen_mpiseq2 import *
-import op2_gen_mpiseq3
-from op2_gen_mpiseq3 import *
-import op2_gen_mpivec
-from op2_gen_mpivec import *
-
+import os
+import importlib
 
-#import cuda code generation function
-import op2_gen_cuda
-from op2_gen_cuda import *
-import op2_gen_cuda_gbl
-from op2_gen_cuda_gbl import *
-import op2_gen_cuda_color2
-from op2_gen_cuda_color2 import *
-import op2_gen_cuda_permute
-from op2_gen_cuda_permute import *
-import op2_gen_cudaINC
-from op2_gen_cudaINC import *
-import op2_gen_cuda_old
-from op2_gen_cuda_old import *
+#
+# target-specific code generators, by target name: each module provides
+# a generator function of the same name, and is only imported if its
+# target is selected
+#
+code_generators = {
+  'seq':     'op2_gen_mpiseq3',     # generate host stubs for MPI+SEQ -- optimised by removing the overhead due to fortran c to f pointer setups
+  'vec':     'op2_gen_mpivec',      # generate host stubs for MPI+SEQ with intel vectorization optimisations
+  'openmp':  'op2_gen_openmp3',     # optimised by removing the overhead due to fortran c to f pointer setups
+  'cuda':    'op2_gen_cuda_color2', # does global coloring
+  'openacc': 'op2_gen_openacc',     # optimised by removing the overhead due to fortran c to f pointer setups
+  'openmp4': 'op2_gen_openmp4' }    # optimised by removing the overhead due to fortran c to f pointer setups
+default_targets = ['seq', 'vec', 'openmp', 'cuda', 'openmp4']
 
 
 #
@@ -501,6 +482,26 @@ def op_par_loop_parse(text):
 #                      ** BEGIN MAIN APPLICATION **
 ##########################################################################
 
+############# select targets from --targets= or OP2_TARGETS ##############
+targets = os.getenv('OP2_TARGETS', 'all')
+for arg in sys.argv[1:]:
+  if arg.startswith('--targets='):
+    targets = arg[len('--targets='):]
+sys.argv = [arg for arg in sys.argv if not arg.startswith('--targets=')]
+
+selected = []
+for target in targets.split(','):
+  target = target.strip()
+  if target == 'all':
+    selected = selected + default_targets
+  elif target in code_generators:
+    selected = selected + [target]
+  elif target != '':
+    print('Unknown code generation target \''+target+'\', valid targets are: '+ \
+          ', '.join(code_generators.keys()))
+    sys.exit(1)
+targets = [t for t in code_generators.keys() if t in selected]
+
 #####################loop over all input source files#####################
 init_ctr = 1
 auto_soa=os.getenv('OP_AUTO_SOA','0')
@@ -1027,29 +1028,19 @@ if npart==0 and nhdf5>0:
 
 ########## finally, generate target-specific kernel files ################
 
-#MPI+SEQ
+# generators not available as targets:
 #op2_gen_mpiseq(str(sys.argv[init_ctr]), date, consts, kernels, hydra)  # generate host stubs for MPI+SEQ
-op2_gen_mpiseq3(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)  # generate host stubs for MPI+SEQ -- optimised by removing the overhead due to fortran c to f pointer setups
-op2_gen_mpivec(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)  # generate host stubs for MPI+SEQ with intel vectorization optimisations
-
-#OpenMP
-op2_gen_openmp3(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)  # optimised by removing the overhead due to fortran c to f pointer setups
 #op2_gen_openmp2(str(sys.argv[init_ctr]), date, consts, kernels, hydra) # version without staging
 #op2_gen_openmp(str(sys.argv[init_ctr]), date, consts, kernels, hydra)  # original version - one that most op2 papers refer to
-
-#CUDA
 #op2_gen_cuda(str(sys.argv[1]), date, consts, kernels, hydra, bookleaf)
 #op2_gen_cuda_gbl(str(sys.argv[init_ctr]), date, consts, kernels, hydra,bookleaf) # global coloring
 #op2_gen_cuda_permute(str(sys.argv[init_ctr]), date, consts, kernels, hydra,bookleaf) # permute does a different coloring (permute execution within blocks by color)
-op2_gen_cuda_color2(str(sys.argv[init_ctr]), date, consts, kernels, hydra,bookleaf) # does global coloring
 #op2_gen_cudaINC(str(sys.argv[1]), date, consts, kernels, hydra)      # stages increment data only in shared memory
 #op2_gen_cuda_old(str(sys.argv[1]), date, consts, kernels, hydra)     # Code generator targettign Fermi GPUs
 
-#OpenACC
-#op2_gen_openacc(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)  # optimised by removing the overhead due to fortran c to f pointer setups
-
-#OpenMP4 offload
-op2_gen_openmp4(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)  # optimised by removing the overhead due to fortran c to f pointer setups
+for target in targets:
+  generator = getattr(importlib.import_module(code_generators[target]), code_generators[target])
+  generator(str(sys.argv[init_ctr]), date, consts, kernels, hydra, bookleaf)
 
 #if hydra:
 #  op2_gen_cuda_hydra() #includes several Hydra specific features